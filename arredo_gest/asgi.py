@@ -5,6 +5,10 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
+
+Serve anche lo stream degli eventi della Kanban (gestione/eventi.py), che con
+WSGI non è disponibile. Il canale degli eventi è in memoria, quindi un solo
+processo: `uvicorn arredo_gest.asgi:application --workers 1`.
 """
 
 import os
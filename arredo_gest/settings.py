@@ -26,11 +26,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'gestione.profilazione.ProfilazioneMiddleware', # Per primo: misura anche gli altri middleware
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'gestione.database.PrimarioDopoScritturaMiddleware', # Dopo l'autenticazione: serve l'utente
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django_htmx.middleware.HtmxMiddleware',
@@ -40,7 +42,8 @@ ROOT_URLCONF = 'arredo_gest.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates che misura anche il tempo di render (vedi gestione/profilazione.py)
+        'BACKEND': 'gestione.profilazione.DjangoTemplatesProfilati',
         # Trova 'templates/registration/login.html'
         'DIRS': [os.path.join(BASE_DIR, 'templates')],
         'APP_DIRS': True,
@@ -57,12 +60,35 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'arredo_gest.wsgi.application'
 
+# SQLite con WAL, PRAGMA e transazioni BEGIN IMMEDIATE (vedi gestione/sqlite/base.py).
+# I PRAGMA predefiniti si cambiano con OPTIONS['pragma'], es. {'busy_timeout': 10000}.
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'gestione.sqlite',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        'OPTIONS': {'pragma': {}},
+    },
+    # Lo stesso file in sola lettura, per dashboard, report ed esportazioni (vedi gestione/database.py).
+    # Nei test è lo stesso database di 'default'.
+    'lettura': {
+        'ENGINE': 'gestione.sqlite',
+        'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {'sola_lettura': True},
+        'TEST': {'MIRROR': 'default'},
+    },
 }
+# Replica per le letture dei report, se c'è. In locale va bene una copia del file
+# aggiornata con `manage.py aggiorna_replica` (es. GESTIONE_DB_REPLICA=replica.sqlite3).
+DB_REPLICA = os.environ.get('GESTIONE_DB_REPLICA')
+if DB_REPLICA:
+    DATABASES['replica'] = {
+        'ENGINE': 'gestione.sqlite',
+        'NAME': BASE_DIR / DB_REPLICA,
+        'OPTIONS': {'sola_lettura': True},
+        'TEST': {'MIRROR': 'default'},
+    }
+DATABASE_ROUTERS = ['gestione.database.RouterLettura']
+REPLICA_PRIMARIO_DOPO_SCRITTURA_SECONDI = 5 # Dopo una scrittura l'utente legge dal primario (0 = mai)
 
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',},
@@ -80,6 +106,59 @@ STATIC_URL = 'static/'
 # Dice a Django dove trovare la cartella 'static' (anche se ora usiamo CSS inline)
 STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static')]
 
+# Cache su file: condivisa tra i processi del server, così l'invalidazione della
+# dashboard (gestione/cache_dashboard.py) vale per tutti. Con un solo processo
+# va bene anche 'django.core.cache.backends.locmem.LocMemCache'.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
+    }
+}
+# I test usano una cache in memoria, non questa (vedi gestione/esecutore_test.py)
+TEST_RUNNER = 'gestione.esecutore_test.EsecutoreTest'
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 LOGIN_REDIRECT_URL = '/'
-LOGOUT_REDIRECT_URL = '/'
\ No newline at end of file
+LOGOUT_REDIRECT_URL = '/'
+
+# Esportazioni in background (vedi gestione/esportazioni.py)
+ESPORTAZIONI_DIR = BASE_DIR / 'esportazioni'
+ESPORTAZIONI_TTL_MINUTI = 60 # Per quanto un file generato viene riusato con gli stessi filtri
+
+# Profilazione delle richieste (vedi gestione/profilazione.py)
+LOG_DIR = BASE_DIR / 'logs' # Creata alla prima riga scritta (vedi profilazione.FileARotazione)
+PROFILAZIONE_CAMPIONAMENTO = 0.1 # Frazione di richieste misurate: 0 = spenta, 1 = tutte
+PROFILAZIONE_SOGLIA_QUERY_LENTA_MS = 100
+PROFILAZIONE_LOG = LOG_DIR / 'profilazione.log'
+PROFILAZIONE_LOG_BACKUP = 5 # File ruotati tenuti (e letti dalla pagina delle prestazioni)
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'format': '%(message)s'}, # Il messaggio è già una riga JSON
+    },
+    'handlers': {
+        'profilazione': {
+            'class': 'gestione.profilazione.FileARotazione',
+            'filename': PROFILAZIONE_LOG,
+            'maxBytes': 5 * 1024 * 1024,
+            'backupCount': PROFILAZIONE_LOG_BACKUP,
+            'encoding': 'utf-8',
+            'formatter': 'json',
+        },
+        'query_lente': {
+            'class': 'gestione.profilazione.FileARotazione',
+            'filename': LOG_DIR / 'query_lente.log',
+            'maxBytes': 5 * 1024 * 1024,
+            'backupCount': 2,
+            'encoding': 'utf-8',
+            'formatter': 'json',
+        },
+    },
+    'loggers': {
+        'gestione.profilazione': {'handlers': ['profilazione'], 'level': 'INFO', 'propagate': False},
+        'gestione.query_lente': {'handlers': ['query_lente'], 'level': 'WARNING', 'propagate': False},
+    },
+}
@@ -1,8 +1,18 @@
 # gestione/admin.py
 
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.models import User
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import DecimalField, ExpressionWrapper, F, FloatField
+from django.db.models.functions import Cast, NullIf
+from django.template.response import TemplateResponse
+from django.urls import path
+from django.utils.functional import cached_property
+from . import importazioni
+from .forms import ImportazioneForm
 from .models import (
     # --- CORREZIONE IMPORT ---
     # Rimosso 'Categoria', aggiunti i modelli corretti
@@ -13,7 +23,7 @@ from .models import (
     Trattativa, Attivita, MessaggioChat, ProfiloUtente,
     
     # --- NUOVO IMPORT ---
-    ImpostazioniGenerali
+    ImpostazioniGenerali, EsportazioneJob
 )
 
 # --- Configurazione per Profilo Utente ---
@@ -31,6 +41,14 @@ class UserAdmin(BaseUserAdmin):
             return list()
         return super(UserAdmin, self).get_inline_instances(request, obj)
 
+    def get_object(self, request, object_id, from_field=None):
+        # Utenti senza profilo (fixture, bulk_create): lo crea prima dell'inline,
+        # che altrimenti mostrerebbe un modulo vuoto al posto del costo orario
+        utente = super().get_object(request, object_id, from_field)
+        if utente is not None:
+            ProfiloUtente.di(utente)
+        return utente
+
 admin.site.unregister(User)
 admin.site.register(User, UserAdmin)
 
@@ -38,6 +56,90 @@ admin.site.register(User, UserAdmin)
 class ProfiloUtenteAdmin(admin.ModelAdmin):
     list_display = ('utente', 'costo_orario')
 
+# --- CONTEGGI STIMATI SULLE TABELLE GRANDI ---
+CONTEGGIO_STIMATO_OLTRE = 10000 # Sotto questa stima si conta davvero (COUNT costa poco)
+
+def conteggio_stimato(queryset):
+    """
+    Stima delle righe di un queryset senza filtri: MAX(id) - MIN(id) + 1, due
+    letture dell'indice della chiave primaria invece di un COUNT(*) che scorre
+    tutta la tabella. Non sottostima mai (gli id cancellati contano ancora):
+    tutte le pagine restano raggiungibili, al più le ultime sono vuote.
+    None se il queryset è filtrato (lì la stima non vale) o la chiave non è un intero.
+    """
+    query = queryset.query
+    pk = queryset.model._meta.pk
+    if query.where or query.distinct or query.combinator or pk.get_internal_type() not in ('AutoField', 'BigAutoField'):
+        return None
+    conn = connections[queryset.db]
+    tabella, colonna = conn.ops.quote_name(queryset.model._meta.db_table), conn.ops.quote_name(pk.column)
+    with conn.cursor() as cursore:
+        # Due sottoquery: con MIN e MAX nella stessa SELECT SQLite scorrerebbe la tabella
+        cursore.execute(f'SELECT (SELECT MAX({colonna}) FROM {tabella}) - (SELECT MIN({colonna}) FROM {tabella}) + 1')
+        (stima,) = cursore.fetchone()
+    return stima or 0
+
+class PaginatorStimato(Paginator):
+    """Paginator della changelist: sulle tabelle grandi senza filtri il totale è una stima."""
+
+    @cached_property
+    def count(self):
+        stima = conteggio_stimato(self.object_list)
+        if stima is None or stima < CONTEGGIO_STIMATO_OLTRE:
+            return super().count
+        return stima
+
+class ConteggioStimatoAdminMixin:
+    paginator = PaginatorStimato
+    # Niente "N di M totali" sotto i filtri: sarebbe un altro COUNT(*) su tutta la tabella
+    show_full_result_count = False
+
+# --- IMPORTAZIONE IN BLOCCO (CSV/XLSX) ---
+class ImportazioneAdminMixin:
+    """
+    Aggiunge alla changelist il pulsante "Importa" e la pagina di caricamento
+    (vedi importazioni.py). Per file molto grandi c'è il comando `importa_dati`.
+    """
+    tipo_importazione = None
+    change_list_template = 'admin/gestione/change_list_importazione.html'
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return [
+            path('importa/', self.admin_site.admin_view(self.importa_view), name='%s_%s_importa' % info),
+        ] + super().get_urls()
+
+    def importa_view(self, request):
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        form = ImportazioneForm(request.POST or None, request.FILES or None)
+        risultato = None
+        if request.method == 'POST' and form.is_valid():
+            file = form.cleaned_data['file']
+            try:
+                risultato = importazioni.importa(
+                    file, self.tipo_importazione, formato=importazioni.formato_da_nome(file.name),
+                    prova=form.cleaned_data['prova'],
+                )
+            except importazioni.ErroreImportazione as e:
+                form.add_error('file', str(e))
+            else:
+                livello = messages.WARNING if risultato.errori_totali else messages.SUCCESS
+                azione = "valide (nessuna scrittura)" if risultato.prova else "importate"
+                self.message_user(request, (
+                    f"{risultato.righe_lette} righe lette, {risultato.righe_importate} {azione}, "
+                    f"{risultato.errori_totali} scartate."
+                ), livello)
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': f"Importa {self.model._meta.verbose_name_plural}",
+            'form': form,
+            'risultato': risultato,
+            'colonne': importazioni.IMPORTATORI[self.tipo_importazione].colonne,
+        }
+        return TemplateResponse(request, 'admin/gestione/importazione.html', context)
+
 # --- CORREZIONE REGISTRAZIONE ---
 # Registriamo i due nuovi modelli di categoria
 @admin.register(CategoriaMerceologica)
@@ -52,7 +154,8 @@ class CategoriaServizioAdmin(admin.ModelAdmin):
 # --------------------------------
 
 @admin.register(Vendita)
-class VenditaAdmin(admin.ModelAdmin):
+class VenditaAdmin(ConteggioStimatoAdminMixin, ImportazioneAdminMixin, admin.ModelAdmin):
+    tipo_importazione = 'vendite'
     list_display = (
         'data_vendita', 'descrizione', 'categoria', 
         'prezzo_vendita', 'costo_acquisto', 'get_margine_euro',
@@ -64,21 +167,30 @@ class VenditaAdmin(admin.ModelAdmin):
     )
     search_fields = ('descrizione', 'cliente')
     date_hierarchy = 'data_vendita'
+    list_select_related = ('categoria', 'venditore')
 
-    @admin.display(description='Margine (€)')
+    # Margini calcolati nella query (e quindi ordinabili), non riga per riga in Python
+    def get_queryset(self, request):
+        margine = F('prezzo_vendita') - F('costo_acquisto')
+        return super().get_queryset(request).annotate(
+            margine_euro=ExpressionWrapper(margine, output_field=DecimalField(max_digits=11, decimal_places=2)),
+            # Cast a float: su SQLite un DecimalField intero darebbe una divisione intera.
+            # Prezzo zero -> NULL, mostrato come N/A
+            margine_percentuale=ExpressionWrapper(
+                Cast(margine, FloatField()) * 100 / Cast(NullIf(F('prezzo_vendita'), 0), FloatField()),
+                output_field=FloatField(),
+            ),
+        )
+
+    @admin.display(description='Margine (€)', ordering='margine_euro')
     def get_margine_euro(self, obj):
-        return obj.margine_lordo_unitario
-    
-    # --- CORREZIONE CALCOLO MARGINE % ---
-    @admin.display(description='Margine (%)')
+        return obj.margine_euro
+
+    @admin.display(description='Margine (%)', ordering='margine_percentuale')
     def get_margine_percent(self, obj):
-        # Calcoliamo la percentuale qui, 
-        # perché la proprietà non esiste nel modello
-        if obj.prezzo_vendita and obj.prezzo_vendita > 0:
-            percentuale = (obj.margine_lordo_unitario / obj.prezzo_vendita) * 100
-            return f"{percentuale:.2f}%"
-        return "N/A"
-    # ------------------------------------
+        if obj.margine_percentuale is None:
+            return "N/A"
+        return f"{obj.margine_percentuale:.2f}%"
 
 #
 # --- MODIFICA (PUNTO 18) ---
@@ -119,42 +231,51 @@ class BudgetAdmin(admin.ModelAdmin):
 class AttivitaInline(admin.TabularInline):
     model = Attivita
     extra = 1
-    fields = ('data_attivita', 'categoria', 'descrizione', 'tempo_dedicato_ore', 'eseguita_da')
+    fields = ('data_attivita', 'categoria', 'descrizione', 'tempo_dedicato_ore', 'ruolo')
 
 @admin.register(Trattativa)
-class TrattativaAdmin(admin.ModelAdmin):
+class TrattativaAdmin(ConteggioStimatoAdminMixin, ImportazioneAdminMixin, admin.ModelAdmin):
+    tipo_importazione = 'trattative'
     list_display = (
         'titolo', 'stato', 'cliente_nome', 
         'valore_stimato', 'costo_materiali_stimato', 'commerciale', 'data_ultimo_aggiornamento'
     )
     list_filter = ('stato', 'commerciale', 'data_creazione')
     search_fields = ('titolo', 'cliente_nome')
+    list_select_related = ('commerciale',)
     inlines = [AttivitaInline]
 
 @admin.register(Attivita)
-class AttivitaAdmin(admin.ModelAdmin):
+class AttivitaAdmin(ConteggioStimatoAdminMixin, ImportazioneAdminMixin, admin.ModelAdmin):
+    tipo_importazione = 'attivita'
     list_display = (
         'descrizione', 'trattativa', 'categoria', 'data_attivita', 
         'tempo_dedicato_ore', 'ruolo'
     )
     list_filter = ('data_attivita', 'ruolo', 'categoria')
     search_fields = ('descrizione', 'trattativa__titolo')
+    # Attivita.__str__ usa trattativa.titolo: senza JOIN sarebbe una query per riga
+    list_select_related = ('trattativa', 'categoria', 'ruolo')
 
 @admin.register(MessaggioChat)
-class MessaggioChatAdmin(admin.ModelAdmin):
+class MessaggioChatAdmin(ConteggioStimatoAdminMixin, admin.ModelAdmin):
     list_display = ('trattativa', 'utente', 'timestamp', 'messaggio')
     list_filter = ('timestamp', 'utente')
     search_fields = ('messaggio', 'trattativa__titolo')
+    list_select_related = ('trattativa', 'utente')
 
 # --- NUOVA REGISTRAZIONE IMPOSTAZIONI ---
 @admin.register(ImpostazioniGenerali)
 class ImpostazioniGeneraliAdmin(admin.ModelAdmin):
-    list_display = ('soglia_alert_margine_servizio',)
+    list_display = (
+        '__str__', 'soglia_alert_margine_servizio', 'soglia_alert_giorni_evasione',
+        'soglia_alert_resi_difetti', 'soglia_alert_finanziamenti_respinti',
+    )
     
-    # Rimuovi la possibilità di "aggiungere" nuove impostazioni, 
-    # si può solo modificare l'unica esistente.
+    # Si può "aggiungere" solo la prima volta (la riga non si crea più leggendo),
+    # poi si può solo modificare l'unica esistente.
     def has_add_permission(self, request):
-        return False
+        return not ImpostazioniGenerali.objects.exists()
     
     # Rimuovi la possibilità di eliminare
     def has_delete_permission(self, request, obj=None):
@@ -163,4 +284,9 @@ class ImpostazioniGeneraliAdmin(admin.ModelAdmin):
 @admin.register(RuoloCosto)
 class RuoloCostoAdmin(admin.ModelAdmin):
     list_display = ('nome', 'costo_orario')
-    search_fields = ('nome',)
\ No newline at end of file
+    search_fields = ('nome',)
+
+@admin.register(EsportazioneJob)
+class EsportazioneJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'formato', 'stato', 'utente', 'righe_elaborate', 'righe_totali', 'data_creazione', 'data_completamento')
+    list_filter = ('stato', 'formato')
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class GestioneConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'gestione'
+
+    def ready(self):
+        # Registra i segnali che mantengono aggiornati i riepiloghi
+        from . import signals  # noqa: F401
@@ -0,0 +1,344 @@
+# gestione/benchmark.py
+"""
+Benchmark delle viste principali su dataset sintetici di dimensioni diverse.
+
+Gira su un database di test creato apposta (come `manage.py test`), quindi non
+tocca i dati reali. Il risultato è un JSON confrontabile tra un commit e l'altro.
+
+benchmark_concorrenza() misura invece le scritture concorrenti su SQLite, con
+il backend di Django e con gestione.sqlite, su file temporanei; benchmark_ricerca()
+la ricerca globale su un indice FTS5 con un milione di messaggi, sempre su file.
+"""
+
+import contextlib
+import datetime
+import importlib
+import itertools
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+
+import django
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connection, connections, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from . import indice_ricerca
+from .dati_sintetici import genera_dataset
+from .models import Trattativa, RuoloCosto
+from .profilazione import percentile
+
+# Vendite e attività/messaggi crescono con il numero di trattative
+VENDITE_PER_TRATTATIVA = 1.25
+
+
+def _dettaglio_piu_pesante():
+    trattativa = Trattativa.objects.order_by('-costo_personale_totale').first()
+    return reverse('trattativa_dettaglio', args=[trattativa.pk])
+
+def _report_attivita_filtrato():
+    """Ultimo anno e un ruolo: le tabelle per trattativa leggono il riepilogo per trattativa."""
+    oggi = datetime.date.today()
+    ruolo = RuoloCosto.objects.order_by('id').first()
+    return reverse('report_attivita') + f"?dal={oggi.year - 1}-{oggi.month:02d}&al={oggi.year}-{oggi.month:02d}&ruolo={ruolo.pk}"
+
+# (nome, funzione che ritorna l'URL): l'URL si calcola dopo aver generato i dati
+SCENARI = [
+    ('dashboard', lambda: reverse('dashboard')),
+    ('report_venditori', lambda: reverse('report_venditori')),
+    ('kanban_board', lambda: reverse('kanban_board')),
+    ('trattativa_lista', lambda: reverse('trattativa_lista')),
+    ('trattativa_dettaglio', _dettaglio_piu_pesante),
+    ('report_attivita', lambda: reverse('report_attivita')),
+    ('report_attivita_filtrato', _report_attivita_filtrato),
+    ('esporta_trattative_csv', lambda: reverse('esporta_trattative_csv')),
+    ('esporta_trattative_excel', lambda: reverse('esporta_trattative_excel')),
+]
+
+
+def _misura(client, url):
+    """Ritorna (secondi, numero di query, byte) di una GET, consumando anche lo streaming."""
+    # Le query si contano su tutte le connessioni: report ed esportazioni leggono da 'lettura'
+    with contextlib.ExitStack() as pila:
+        query = [pila.enter_context(CaptureQueriesContext(connections[alias])) for alias in connections]
+        inizio = time.perf_counter()
+        risposta = client.get(url)
+        corpo = b''.join(risposta.streaming_content) if risposta.streaming else risposta.content
+        durata = time.perf_counter() - inizio
+    if risposta.status_code >= 400:
+        raise RuntimeError(f"{url}: stato HTTP {risposta.status_code}")
+    return durata, sum(len(q) for q in query), len(corpo)
+
+def misura_scenari(client, ripetizioni, scenari=SCENARI):
+    risultati = {}
+    for nome, url in scenari:
+        url = url()
+        _misura(client, url) # riscaldamento (cache dei template, prime letture)
+        tempi, numero_query, dimensione = [], 0, 0
+        for _ in range(ripetizioni):
+            durata, numero_query, dimensione = _misura(client, url)
+            tempi.append(durata * 1000)
+        risultati[nome] = {
+            'ms_mediana': round(statistics.median(tempi), 2),
+            'ms_p95': round(percentile(tempi, 95), 2),
+            'ms_min': round(min(tempi), 2),
+            'ms_max': round(max(tempi), 2),
+            'query': numero_query,
+            'byte': dimensione,
+        }
+    return risultati
+
+
+def _commit_corrente():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def esegui_benchmark(dimensioni, ripetizioni=5, seme=1, log=None):
+    """
+    Per ogni dimensione (numero di trattative) svuota il DB di test, genera il
+    dataset e misura gli scenari. Il DB di test va creato dal chiamante.
+    """
+    log = log or (lambda messaggio: None)
+    risultato = {
+        'commit': _commit_corrente(),
+        'data': datetime.datetime.now().isoformat(timespec='seconds'),
+        'ambiente': {
+            'python': platform.python_version(), 'django': django.get_version(),
+            'database': connection.vendor, 'sqlite': sqlite3.sqlite_version,
+        },
+        'ripetizioni': ripetizioni,
+        'dimensioni': {},
+    }
+    for num_trattative in dimensioni:
+        call_command('flush', interactive=False, verbosity=0)
+        inizio = time.perf_counter()
+        conteggi = genera_dataset(
+            num_trattative=num_trattative, num_vendite=int(num_trattative * VENDITE_PER_TRATTATIVA), seme=seme,
+        )
+        secondi_generazione = time.perf_counter() - inizio
+        log(f"{num_trattative} trattative: dataset generato in {secondi_generazione:.1f}s {conteggi}")
+
+        utente = User.objects.create_superuser('benchmark', 'benchmark@example.com', 'benchmark')
+        client = Client()
+        client.force_login(utente)
+        viste = misura_scenari(client, ripetizioni)
+        for nome, valori in viste.items():
+            log(f"  {nome:<28} mediana {valori['ms_mediana']:>9.2f} ms  p95 {valori['ms_p95']:>9.2f} ms  query {valori['query']}")
+        risultato['dimensioni'][str(num_trattative)] = {
+            'righe': conteggi, 'secondi_generazione': round(secondi_generazione, 2), 'viste': viste,
+        }
+    return risultato
+
+
+def confronta(precedente, attuale):
+    """
+    Righe di testo con la variazione della mediana (e del numero di query) per ogni
+    vista e dimensione presenti in entrambi i risultati.
+    """
+    righe = [f"Confronto {precedente.get('commit')} -> {attuale.get('commit')}"]
+    for dimensione, dati in attuale['dimensioni'].items():
+        vecchi = precedente['dimensioni'].get(dimensione)
+        if not vecchi:
+            continue
+        righe.append(f"{dimensione} trattative:")
+        for nome, valori in dati['viste'].items():
+            prima = vecchi['viste'].get(nome)
+            if not prima:
+                continue
+            variazione = (valori['ms_mediana'] - prima['ms_mediana']) / prima['ms_mediana'] * 100 if prima['ms_mediana'] else 0
+            righe.append(
+                f"  {nome:<28} {prima['ms_mediana']:>9.2f} -> {valori['ms_mediana']:>9.2f} ms ({variazione:+.1f}%)"
+                f"  query {prima['query']} -> {valori['query']}"
+            )
+    return righe
+
+def salva(risultato, percorso):
+    with open(percorso, 'w', encoding='utf-8') as f:
+        json.dump(risultato, f, indent=2, ensure_ascii=False)
+
+def carica(percorso):
+    with open(percorso, encoding='utf-8') as f:
+        return json.load(f)
+
+
+# --- CONCORRENZA SU SQLITE ---
+# (nome, ENGINE, OPTIONS di chi scrive, OPTIONS di chi legge)
+CONFIGURAZIONI_SQLITE = [
+    ('django.db.backends.sqlite3', 'django.db.backends.sqlite3', {}, {}),
+    ('gestione.sqlite (WAL, BEGIN IMMEDIATE)', 'gestione.sqlite', {}, {'sola_lettura': True}),
+]
+RIGHE_CONCORRENZA = 20000
+
+def _prepara_file(percorso, righe):
+    with sqlite3.connect(percorso) as db:
+        db.execute('CREATE TABLE scheda (id INTEGER PRIMARY KEY, stato TEXT, valore REAL)')
+        db.execute('CREATE TABLE storico (id INTEGER PRIMARY KEY, scheda_id INTEGER, istante REAL)')
+        stati = ['LEAD', 'CONTATTATO', 'PREVENTIVO', 'VINTO', 'PERSO']
+        db.executemany(
+            'INSERT INTO scheda (stato, valore) VALUES (?, ?)',
+            ((stati[n % len(stati)], n % 1000) for n in range(righe)),
+        )
+    sqlite3.connect(percorso).close()
+
+def _aggiungi_alias(alias, engine, percorso, opzioni):
+    connections.settings[alias] = {
+        **connections.settings[DEFAULT_DB_ALIAS], 'ENGINE': engine, 'NAME': percorso, 'OPTIONS': dict(opzioni),
+    }
+
+def _scrittore(alias, fine, conteggi, seme):
+    """Come move_trattativa: legge la card, la sposta e registra lo spostamento, in una transazione."""
+    casuale = random.Random(seme)
+    scritture = errori = 0
+    try:
+        while time.perf_counter() < fine:
+            scheda = casuale.randint(1, RIGHE_CONCORRENZA)
+            try:
+                with transaction.atomic(using=alias):
+                    cursore = connections[alias].cursor()
+                    cursore.execute('SELECT stato FROM scheda WHERE id = %s', [scheda])
+                    cursore.fetchone()
+                    cursore.execute('UPDATE scheda SET stato = %s, valore = valore + 1 WHERE id = %s', [casuale.choice('ABC'), scheda])
+                    cursore.execute('INSERT INTO storico (scheda_id, istante) VALUES (%s, %s)', [scheda, time.time()])
+                scritture += 1
+            except OperationalError:
+                errori += 1 # "database is locked"
+    finally:
+        connections[alias].close()
+    with conteggi['lock']:
+        conteggi['scritture'] += scritture
+        conteggi['errori'] += errori
+
+def _lettore(alias, fine, conteggi):
+    """Come un report: aggregati su tutta la tabella, in autocommit."""
+    letture = 0
+    try:
+        while time.perf_counter() < fine:
+            cursore = connections[alias].cursor()
+            cursore.execute('SELECT stato, COUNT(*), SUM(valore) FROM scheda GROUP BY stato')
+            cursore.fetchall()
+            letture += 1
+    except OperationalError:
+        pass
+    finally:
+        connections[alias].close()
+    with conteggi['lock']:
+        conteggi['letture'] += letture
+
+def benchmark_concorrenza(scrittori=8, lettori=2, secondi=5.0, log=None):
+    """
+    Per ogni configurazione di CONFIGURAZIONI_SQLITE crea un file SQLite nuovo e
+    lo fa usare per `secondi` da `scrittori` thread che scrivono e `lettori`
+    thread che leggono. Ritorna scritture e letture al secondo ed errori di lock.
+    """
+    log = log or (lambda messaggio: None)
+    risultati = {}
+    with tempfile.TemporaryDirectory(prefix='benchmark_sqlite_') as cartella:
+        for numero, (nome, engine, opzioni_scrittura, opzioni_lettura) in enumerate(CONFIGURAZIONI_SQLITE):
+            percorso = os.path.join(cartella, f'prova_{numero}.sqlite3')
+            _prepara_file(percorso, RIGHE_CONCORRENZA)
+            scrittura, lettura = f'benchmark_scrittura_{numero}', f'benchmark_lettura_{numero}'
+            _aggiungi_alias(scrittura, engine, percorso, opzioni_scrittura)
+            _aggiungi_alias(lettura, engine, percorso, opzioni_lettura)
+            # Chi scrive per primo imposta il journal_mode del file
+            connections[scrittura].ensure_connection()
+            connections[scrittura].close()
+
+            conteggi = {'lock': threading.Lock(), 'scritture': 0, 'errori': 0, 'letture': 0}
+            fine = time.perf_counter() + secondi
+            threads = [threading.Thread(target=_scrittore, args=(scrittura, fine, conteggi, n)) for n in range(scrittori)]
+            threads += [threading.Thread(target=_lettore, args=(lettura, fine, conteggi)) for _ in range(lettori)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            del connections.settings[scrittura], connections.settings[lettura]
+
+            risultati[nome] = {
+                'scritture_al_secondo': round(conteggi['scritture'] / secondi, 1),
+                'errori_lock': conteggi['errori'],
+                'letture_al_secondo': round(conteggi['letture'] / secondi, 1),
+            }
+            log(
+                f"{nome:<40} scritture/s {risultati[nome]['scritture_al_secondo']:>8.1f}  "
+                f"errori di lock {conteggi['errori']:>5}  letture/s {risultati[nome]['letture_al_secondo']:>7.1f}"
+            )
+    return {
+        'data': datetime.datetime.now().isoformat(timespec='seconds'),
+        'sqlite': sqlite3.sqlite_version, 'scrittori': scrittori, 'lettori': lettori, 'secondi': secondi,
+        'configurazioni': risultati,
+    }
+
+
+# --- RICERCA GLOBALE (FTS5) ---
+PAROLE_VOCABOLARIO = 20000
+LETTERE = 'abcdefghilmnopqrstuvz'
+
+def _vocabolario(rnd):
+    """Parole inventate con frequenze alla Zipf, come in un testo vero: la prima è la più comune."""
+    parole = list(dict.fromkeys(
+        ''.join(rnd.choice(LETTERE) for _ in range(rnd.randint(3, 10))) for _ in range(PAROLE_VOCABOLARIO)
+    ))
+    return parole, list(itertools.accumulate(1 / rango for rango in range(1, len(parole) + 1)))
+
+def _prepara_indice(percorso, messaggi, rnd, log):
+    parole, pesi = _vocabolario(rnd)
+    crea_indice = importlib.import_module('gestione.migrations.0012_indice_ricerca').CREA_INDICE
+    righe = (
+        (indice_ricerca.MESSAGGIO * indice_ricerca.BANDA + n, '',
+         ' '.join(rnd.choices(parole, cum_weights=pesi, k=rnd.randint(4, 20))), n // 10)
+        for n in range(1, messaggi + 1)
+    )
+    inizio = time.perf_counter()
+    with sqlite3.connect(percorso) as db:
+        db.execute(crea_indice)
+        db.executemany(f'INSERT INTO {indice_ricerca.TABELLA} (rowid, titolo, testo, trattativa_id) VALUES (?, ?, ?, ?)', righe)
+        db.execute(f"INSERT INTO {indice_ricerca.TABELLA} ({indice_ricerca.TABELLA}) VALUES ('optimize')")
+    log(f"Indice con {messaggi} messaggi creato in {time.perf_counter() - inizio:.1f}s ({os.path.getsize(percorso) / 2**20:.0f} MB)")
+    return parole
+
+def benchmark_ricerca(messaggi=1_000_000, ripetizioni=5, seme=1, log=None):
+    """
+    Crea su un file temporaneo l'indice della ricerca con `messaggi` messaggi
+    sintetici e misura la query di indice_ricerca.cerca() per parole di frequenza
+    diversa, dalla più comune alla più rara, e per prefissi.
+    """
+    log = log or (lambda messaggio: None)
+    rnd = random.Random(seme)
+    risultati = {}
+    with tempfile.TemporaryDirectory(prefix='benchmark_ricerca_') as cartella:
+        percorso = os.path.join(cartella, 'ricerca.sqlite3')
+        parole = _prepara_indice(percorso, messaggi, rnd, log)
+        ricerche = [parole[0], parole[9], parole[99], parole[999], parole[9999], f'{parole[0]} {parole[99]}', parole[3][:2], parole[3][:4]]
+        sql = indice_ricerca.SQL_CERCA.replace('%s', '?')
+        with sqlite3.connect(percorso) as db:
+            for testo in ricerche:
+                match = indice_ricerca.espressione(testo)
+                trovati = db.execute(
+                    f'SELECT COUNT(*) FROM {indice_ricerca.TABELLA} WHERE {indice_ricerca.TABELLA} MATCH ?', [match],
+                ).fetchone()[0]
+                tempi = []
+                for _ in range(ripetizioni):
+                    inizio = time.perf_counter()
+                    db.execute(sql, indice_ricerca.parametri_ricerca(match, 20)).fetchall()
+                    tempi.append((time.perf_counter() - inizio) * 1000)
+                risultati[testo] = {'trovati': trovati, 'ms_mediana': round(statistics.median(tempi), 2), 'ms_max': round(max(tempi), 2)}
+                log(f"  {match:<28} trovati {trovati:>8}  mediana {risultati[testo]['ms_mediana']:>8.2f} ms  max {risultati[testo]['ms_max']:>8.2f} ms")
+    return {
+        'data': datetime.datetime.now().isoformat(timespec='seconds'),
+        'sqlite': sqlite3.sqlite_version, 'messaggi': messaggi, 'finestra_punteggio': indice_ricerca.FINESTRA_PUNTEGGIO,
+        'ricerche': risultati,
+    }
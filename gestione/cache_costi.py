@@ -0,0 +1,68 @@
+# gestione/cache_costi.py
+"""
+Cache di processo dei costi orari dei ruoli (la soglia del margine è in impostazioni.py).
+
+Il calcolatore dei costi delle attività li legge a ogni richiesta: qui si
+caricano una volta per processo e si ricaricano quando un ruolo cambia (vedi
+signals.py). Gli altri processi non ricevono il
+segnale: la ricarica periodica (DURATA_SECONDI) limita quanto restano indietro.
+
+Serve solo alle anteprime. I totali salvati sulle trattative e la validazione
+dei form leggono sempre il DB.
+"""
+
+import threading
+import time
+from decimal import Decimal
+
+from django.db import transaction
+
+from .models import RuoloCosto
+
+DURATA_SECONDI = 60
+
+_lock = threading.Lock()
+_valori = {} # nome -> (scadenza, valore)
+_generazione = 0 # Cambia a ogni svuota(): un caricamento partito prima non viene salvato
+
+
+def _leggi(nome, carica):
+    adesso = time.monotonic()
+    voce = _valori.get(nome)
+    if voce is not None and voce[0] > adesso:
+        return voce[1]
+    generazione = _generazione
+    valore = carica()
+    with _lock:
+        if generazione == _generazione:
+            _valori[nome] = (adesso + DURATA_SECONDI, valore)
+    return valore
+
+
+# --- LETTURA ---
+def costi_ruoli():
+    """{id ruolo: costo orario} di tutti i ruoli."""
+    return _leggi('ruoli', lambda: dict(RuoloCosto.objects.values_list('id', 'costo_orario')))
+
+def costo_orario(ruolo_id):
+    """Costo orario del ruolo; 0 se l'id non è valido o il ruolo non esiste."""
+    try:
+        return costi_ruoli().get(int(ruolo_id), Decimal(0))
+    except (TypeError, ValueError):
+        return Decimal(0)
+
+
+# --- INVALIDAZIONE ---
+def svuota():
+    global _generazione
+    with _lock:
+        _generazione += 1
+        _valori.clear()
+
+def svuota_a_fine_transazione():
+    """
+    Svuota subito (chi è nella stessa transazione vede i valori nuovi) e di nuovo
+    dopo il commit, così non resta niente caricato dagli altri thread nel frattempo.
+    """
+    svuota()
+    transaction.on_commit(svuota)
@@ -0,0 +1,108 @@
+# gestione/cache_dashboard.py
+"""
+Cache dei dati della dashboard (KPI, tabella categorie, grafico degli ultimi 12 mesi).
+
+Ogni voce è salvata insieme alla versione dei dati con cui è stata calcolata.
+Una modifica a vendite, attività, trattative, costi mensili, budget o ruoli
+cambia la versione (vedi signals.py), e da quel momento le voci vecchie non valgono
+più: non serve cercarle e cancellarle. Funziona con qualunque backend di cache
+(locmem, file, memcached...); con più processi serve un backend condiviso.
+
+Lo storico del grafico (i mesi prima di quello corrente) cambia solo quando si
+modificano dati vecchi: ha una versione sua e una voce di lunga durata.
+"""
+
+import hashlib
+import json
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+PREFISSO = 'gestione:dashboard'
+CHIAVE_VERSIONE = f'{PREFISSO}:versione'
+CHIAVE_VERSIONE_STORICO = f'{PREFISSO}:versione_storico'
+DURATA_DATI = 60 * 60 # Rete di sicurezza: anche senza modifiche i dati si ricalcolano ogni ora
+DURATA_STORICO = 60 * 60 * 24 * 31
+
+_in_attesa = threading.local()
+
+
+def chiave_dati(anno, mese):
+    filtri = json.dumps([anno, mese])
+    return f'{PREFISSO}:dati:{hashlib.sha256(filtri.encode()).hexdigest()[:32]}'
+
+def chiave_storico(anno, mese):
+    """Lo storico arriva al mese (anno, mese) escluso: la chiave cambia da sola a inizio mese."""
+    return f'{PREFISSO}:storico:{anno}-{mese:02d}'
+
+
+# --- INVALIDAZIONE ---
+def invalida(storico=False):
+    """Cambia la versione dei dati e, con `storico`, anche quella dello storico del grafico."""
+    nuova = time.time_ns()
+    versioni = {CHIAVE_VERSIONE: nuova}
+    if storico:
+        versioni[CHIAVE_VERSIONE_STORICO] = nuova
+    cache.set_many(versioni, None)
+
+def invalida_a_fine_transazione(storico=False):
+    """
+    Come invalida(), ma a fine transazione (o subito, in autocommit) e una volta
+    sola per transazione: chi legge dopo il commit non trova mai dati vecchi
+    salvati con la versione nuova.
+    """
+    _in_attesa.storico = getattr(_in_attesa, 'storico', False) or storico
+    transaction.on_commit(_applica_invalidazione)
+
+def _applica_invalidazione():
+    if not hasattr(_in_attesa, 'storico'):
+        return # già applicata da una callback precedente della stessa transazione
+    storico = _in_attesa.storico
+    del _in_attesa.storico
+    invalida(storico)
+
+
+# --- LETTURA ---
+def _versione(trovati, chiave):
+    versione = trovati.get(chiave)
+    if versione is None:
+        # Cache vuota (riavvio, voce espulsa): si parte da una versione nuova
+        cache.add(chiave, time.time_ns(), None)
+        versione = cache.get(chiave)
+    return versione
+
+def _valore(voce, versione):
+    if voce is not None and voce[0] == versione:
+        return voce[1]
+    return None
+
+def dati_dashboard(anno, mese, calcola_dati, mese_corrente=None, calcola_storico=None):
+    """
+    Ritorna (dati, storico). Se è tutto in cache costa una sola lettura (get_many);
+    le voci mancanti o di una versione vecchia vengono ricalcolate e salvate.
+    Senza `calcola_storico` (viste filtrate, senza grafico) lo storico è None.
+    """
+    chiave = chiave_dati(anno, mese)
+    chiavi = [CHIAVE_VERSIONE, chiave]
+    if calcola_storico:
+        chiave_st = chiave_storico(*mese_corrente)
+        chiavi += [CHIAVE_VERSIONE_STORICO, chiave_st]
+    trovati = cache.get_many(chiavi)
+
+    # La versione si legge prima dei dati: se cambia durante il calcolo, la voce salvata è già vecchia
+    versione = _versione(trovati, CHIAVE_VERSIONE)
+    dati = _valore(trovati.get(chiave), versione)
+    if dati is None:
+        dati = calcola_dati()
+        cache.set(chiave, (versione, dati), DURATA_DATI)
+
+    storico = None
+    if calcola_storico:
+        versione_storico = _versione(trovati, CHIAVE_VERSIONE_STORICO)
+        storico = _valore(trovati.get(chiave_st), versione_storico)
+        if storico is None:
+            storico = calcola_storico()
+            cache.set(chiave_st, (versione_storico, storico), DURATA_STORICO)
+    return dati, storico
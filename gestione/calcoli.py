@@ -0,0 +1,136 @@
+# gestione/calcoli.py
+
+from django.db.models import Sum, F, BooleanField, DecimalField, FloatField, Value, OuterRef, Subquery
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast, Coalesce, NullIf, Round
+from decimal import Decimal
+from .models import Trattativa, Attivita
+
+
+# --- ESPRESSIONI DI COSTO (BASATE SU RUOLO) ---
+def get_costo_attivita_query(filtro=None):
+    """
+    Ritorna un'espressione SQL per calcolare il costo delle attività.
+    Logica: Ore * costo_orario del Ruolo.
+    `filtro` (opzionale) è un Q applicato all'aggregazione.
+    """
+    return Sum(
+        F('tempo_dedicato_ore') * Coalesce(F('ruolo__costo_orario'), Decimal(0.0)),
+        filter=filtro,
+        output_field=DecimalField()
+    )
+
+def get_costo_personale_query():
+    """
+    Ritorna un'espressione SQL per calcolare il costo aggregato.
+    """
+    return Sum(
+        F('attivita__tempo_dedicato_ore') * Coalesce(F('attivita__ruolo__costo_orario'), Decimal(0.0)),
+        output_field=DecimalField()
+    )
+
+
+# --- NUOVA FUNZIONE HELPER (PUNTO 19) ---
+def get_trattative_annotate():
+    """
+    Queryset base delle trattative con commerciale. Costo personale, ricavo servizi
+    e margini sono colonne vere di Trattativa (vedi TOTALI DENORMALIZZATI più sotto),
+    quindi non servono più JOIN e GROUP BY su attività e ruoli.
+    """
+    return Trattativa.objects.all().select_related('commerciale').order_by('-data_ultimo_aggiornamento')
+
+
+# --- TRATTATIVE APERTE ---
+def filtro_trattative_aperte():
+    """
+    Condizione "trattativa non chiusa" da passare a .filter(), scritta come SQL
+    letterale identico alla condizione dell'indice parziale trattativa_aperte_idx.
+    Con Q(stato__in=...) i valori diventano parametri e SQLite non può sapere
+    che la query ricade nell'indice parziale.
+    """
+    stati = ', '.join(f"'{stato}'" for stato in Trattativa.STATI_CHIUSI)
+    colonna = f'"{Trattativa._meta.db_table}"."stato"'
+    return RawSQL(f"NOT ({colonna} IN ({stati}))", (), output_field=BooleanField())
+
+
+# --- TOTALI DENORMALIZZATI SU TRATTATIVA ---
+def _espressioni_totali(costo_personale, ricavo_servizi):
+    """
+    Valori per un UPDATE di Trattativa dati costo personale e ricavo servizi
+    (espressioni SQL). I derivati sono scritti in funzione dei nuovi totali, perché
+    in un UPDATE ogni F() legge il valore della riga *prima* della modifica.
+    """
+    valore_totale = F('valore_stimato') + ricavo_servizi
+    costo_totale = F('costo_materiali_stimato') + costo_personale
+    return {
+        'costo_personale_totale': _arrotonda(costo_personale),
+        'ricavo_servizi_totale': _arrotonda(ricavo_servizi),
+        'valore_totale_stimato': _arrotonda(valore_totale),
+        'costo_totale_stimato': _arrotonda(costo_totale),
+        'margine_stimato_euro': _arrotonda(valore_totale - costo_totale),
+        # Cast a float: su SQLite un DecimalField intero darebbe una divisione intera
+        'margine_stimato_perc': Coalesce(
+            _arrotonda(Cast(
+                Cast(valore_totale - costo_totale, FloatField()) * 100 / Cast(NullIf(valore_totale, Decimal(0)), FloatField()),
+                DecimalField(max_digits=7, decimal_places=2),
+            )),
+            Decimal(0),
+            output_field=DecimalField(max_digits=7, decimal_places=2),
+        ),
+    }
+
+def _arrotonda(espressione):
+    # SQLite calcola in virgola mobile: si salva già arrotondato al centesimo
+    return Round(espressione, 2, output_field=DecimalField(max_digits=12, decimal_places=2))
+
+def applica_delta_servizi(trattativa_id, delta_costo=Decimal(0), delta_ricavo=Decimal(0)):
+    """
+    Somma i delta di costo personale e ricavo servizi ai totali della trattativa
+    e aggiorna i margini, con un solo UPDATE atomico (niente lettura-modifica-scrittura).
+    """
+    if not trattativa_id or (not delta_costo and not delta_ricavo):
+        return
+    Trattativa.objects.filter(pk=trattativa_id).update(**_espressioni_totali(
+        F('costo_personale_totale') + Value(Decimal(delta_costo)),
+        F('ricavo_servizi_totale') + Value(Decimal(delta_ricavo)),
+    ))
+
+def ricalcola_margini(trattative):
+    """Ricalcola solo i derivati (es. dopo una modifica di valore o costo del prodotto)."""
+    return trattative.update(**_espressioni_totali(F('costo_personale_totale'), F('ricavo_servizi_totale')))
+
+def _totali_da_attivita():
+    """Subquery (costo personale, ricavo servizi) calcolate dalle attività della trattativa."""
+    attivita = Attivita.objects.filter(trattativa=OuterRef('pk')).order_by().values('trattativa')
+    costo = Subquery(attivita.annotate(totale=get_costo_attivita_query()).values('totale'))
+    ricavo = Subquery(attivita.annotate(totale=Sum('prezzo_vendita_attivita')).values('totale'))
+    return (
+        Coalesce(costo, Decimal(0), output_field=DecimalField(max_digits=12, decimal_places=2)),
+        Coalesce(ricavo, Decimal(0), output_field=DecimalField(max_digits=12, decimal_places=2)),
+    )
+
+def ricalcola_totali_trattative(trattative=None):
+    """
+    Ricalcola da zero i totali (e i margini) delle trattative indicate, o di tutte.
+    Usato quando cambia il costo orario di un ruolo e dal comando verifica_totali_trattative.
+    """
+    if trattative is None:
+        trattative = Trattativa.objects.all()
+    return trattative.update(**_espressioni_totali(*_totali_da_attivita()))
+
+def trattative_con_totali_errati():
+    """
+    Ritorna [(id, costo memorizzato, costo atteso, ricavo memorizzato, ricavo atteso)]
+    per le trattative i cui totali non corrispondono alle attività.
+    Il confronto è fatto in Python sui valori arrotondati al centesimo.
+    """
+    costo, ricavo = _totali_da_attivita()
+    righe = Trattativa.objects.annotate(costo_atteso=costo, ricavo_atteso=ricavo).values_list(
+        'pk', 'costo_personale_totale', 'costo_atteso', 'ricavo_servizi_totale', 'ricavo_atteso',
+    ).order_by('pk')
+    centesimo = Decimal('0.01')
+    return [
+        riga for riga in righe.iterator(chunk_size=2000)
+        if riga[1].quantize(centesimo) != riga[2].quantize(centesimo)
+        or riga[3].quantize(centesimo) != riga[4].quantize(centesimo)
+    ]
@@ -0,0 +1,178 @@
+# gestione/database.py
+"""
+Instradamento delle letture dei report su una replica o sulla connessione in sola lettura.
+
+Le viste dei report (dashboard, report, esportazioni) sono decorate con
+@su_lettura e le loro SELECT vanno, nell'ordine:
+- sull'alias ALIAS_REPLICA, se configurato in settings.DATABASES e raggiungibile.
+  Può essere indietro rispetto al primario (vedi il comando aggiorna_replica);
+- sull'alias ALIAS_LETTURA: lo stesso file del primario aperto in sola lettura.
+  Con il WAL una lettura lunga non tiene occupata la connessione di chi scrive
+  (vedi gestione/sqlite/base.py);
+- su 'default'.
+Le scritture restano sempre su 'default'.
+
+Chi ha appena scritto non deve rileggere dalla replica un dato vecchio:
+PrimarioDopoScritturaMiddleware segna nella cache condivisa gli utenti che hanno
+scritto, e per REPLICA_PRIMARIO_DOPO_SCRITTURA_SECONDI le loro letture saltano
+la replica.
+
+Dentro una transazione di 'default' si legge da 'default': la transazione deve
+vedere le sue scritture non ancora confermate. Per lo stesso motivo nei test
+(TestCase gira tutto in una transazione) gli alias di lettura non vengono mai usati.
+"""
+
+import contextlib
+import contextvars
+import functools
+import logging
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.http import FileResponse, StreamingHttpResponse
+
+logger = logging.getLogger(__name__)
+
+ALIAS_LETTURA = 'lettura'
+ALIAS_REPLICA = 'replica'
+
+REPLICA_PAUSA_DOPO_ERRORE_SECONDI = 30 # Replica non raggiungibile: per un po' non si riprova
+
+# Lettura in corso: None fuori dai blocchi lettura(), altrimenti se la replica è ammessa
+_lettura = contextvars.ContextVar('gestione_lettura', default=None)
+# Richiesta in corso per PrimarioDopoScritturaMiddleware: {'scritture': bool}, None fuori dalle richieste
+_richiesta = contextvars.ContextVar('gestione_richiesta_scritture', default=None)
+
+_lock = threading.Lock()
+_replica_in_pausa_fino = 0.0
+
+
+# --- SCELTA DELL'ALIAS ---
+def _replica_disponibile():
+    global _replica_in_pausa_fino
+    if ALIAS_REPLICA not in connections.settings or time.monotonic() < _replica_in_pausa_fino:
+        return False
+    try:
+        connections[ALIAS_REPLICA].ensure_connection()
+    except DatabaseError:
+        logger.warning('Replica %r non raggiungibile, letture sul primario', ALIAS_REPLICA, exc_info=True)
+        with _lock:
+            _replica_in_pausa_fino = time.monotonic() + REPLICA_PAUSA_DOPO_ERRORE_SECONDI
+        return False
+    return True
+
+def alias_lettura():
+    """Alias da usare per le letture in corso, None per quello predefinito."""
+    replica_ammessa = _lettura.get()
+    if replica_ammessa is None or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        return None
+    if replica_ammessa and _replica_disponibile():
+        return ALIAS_REPLICA
+    if ALIAS_LETTURA in connections.settings:
+        return ALIAS_LETTURA
+    return None
+
+
+@contextlib.contextmanager
+def lettura(replica=True):
+    """Le query di sola lettura del blocco vanno sulla replica (se `replica`) o sull'alias di lettura."""
+    # Niente token/reset: per le risposte in streaming il blocco può chiudersi in un altro contesto
+    precedente = _lettura.get()
+    _lettura.set(replica)
+    try:
+        yield
+    finally:
+        _lettura.set(precedente)
+
+def _itera_in_lettura(contenuto, replica):
+    # Le risposte in streaming leggono il DB dopo che la vista è tornata
+    with lettura(replica):
+        yield from contenuto
+
+def su_lettura(vista):
+    """Decoratore per le viste che leggono soltanto (report, esportazioni)."""
+    @functools.wraps(vista)
+    def wrapper(request, *args, **kwargs):
+        replica = not scrittura_recente(request.user)
+        with lettura(replica):
+            risposta = vista(request, *args, **kwargs)
+        if isinstance(risposta, StreamingHttpResponse) and not isinstance(risposta, FileResponse) and not risposta.is_async:
+            risposta.streaming_content = _itera_in_lettura(risposta.streaming_content, replica)
+        return risposta
+    return wrapper
+
+
+# --- PRIMARIO DOPO UNA SCRITTURA ---
+def _chiave_scrittura(utente_id):
+    return f'gestione:database:scrittura:{utente_id}'
+
+def segna_scrittura(utente):
+    """Per qualche secondo le letture dell'utente saltano la replica."""
+    secondi = settings.REPLICA_PRIMARIO_DOPO_SCRITTURA_SECONDI
+    if utente.is_authenticated and secondi:
+        cache.set(_chiave_scrittura(utente.pk), True, secondi)
+
+def scrittura_recente(utente):
+    """True se l'utente ha scritto negli ultimi REPLICA_PRIMARIO_DOPO_SCRITTURA_SECONDI."""
+    if ALIAS_REPLICA not in connections.settings or not utente.is_authenticated:
+        return False # Senza replica non serve guardare (ed evita un get sulla cache)
+    return cache.get(_chiave_scrittura(utente.pk), False)
+
+
+class PrimarioDopoScritturaMiddleware:
+    """
+    Segna l'utente che durante la richiesta ha scritto sul DB (con l'ORM: se ne
+    accorge RouterLettura.db_for_write). Va messo dopo AuthenticationMiddleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stato = {'scritture': False}
+        token = _richiesta.set(stato)
+        try:
+            risposta = self.get_response(request)
+        finally:
+            _richiesta.reset(token)
+        if stato['scritture']:
+            segna_scrittura(request.user)
+        return risposta
+
+
+# --- REPLICA DI PROVA ---
+def aggiorna_replica(origine, destinazione):
+    """
+    Copia il database `origine` su `destinazione` con l'API di backup di SQLite:
+    la copia è coerente anche se intanto qualcuno scrive. Fa da replica in locale.
+    """
+    sorgente = sqlite3.connect(origine)
+    copia = sqlite3.connect(destinazione)
+    try:
+        sorgente.backup(copia)
+    finally:
+        copia.close()
+        sorgente.close()
+
+
+class RouterLettura:
+    """DATABASE_ROUTERS: letture dei blocchi lettura() sulla replica o sull'alias di lettura, il resto su 'default'."""
+
+    def db_for_read(self, model, **hints):
+        return alias_lettura()
+
+    def db_for_write(self, model, **hints):
+        stato = _richiesta.get()
+        if stato is not None:
+            stato['scritture'] = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True # Stesso database
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
@@ -0,0 +1,240 @@
+# gestione/dati_sintetici.py
+"""
+Generatore di un dataset sintetico ma realistico per benchmark e test di prestazioni.
+
+Tutto viene inserito con bulk_create a blocchi, quindi i segnali non partono:
+a fine generazione totali delle trattative, riepiloghi mensili e indice di ricerca
+vengono ricalcolati una volta sola, come li avrebbero mantenuti i segnali. Lo
+storico degli stati (il percorso di ogni trattativa nella Kanban) si genera qui.
+"""
+
+import datetime
+import random
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from . import riepiloghi, indice_ricerca, previsioni
+from .calcoli import ricalcola_totali_trattative
+from .models import (
+    ProfiloUtente, RuoloCosto, CategoriaMerceologica, CategoriaServizio,
+    Vendita, StatMensile, Budget, Trattativa, Attivita, MessaggioChat, PassaggioStato,
+)
+
+PREFISSO_UTENTI = 'demo_'
+
+CATEGORIE_MERCEOLOGICHE = ['Cucine', 'Zona Giorno', 'Zona Notte', 'Bagni', 'Complementi']
+CATEGORIE_SERVIZI = ['Progettazione', 'Rilievo Misure', 'Trasporto', 'Montaggio', 'Assistenza Post-Vendita']
+RUOLI = [('Commerciale', '30.00'), ('Progettista', '40.00'), ('Montatore', '25.00'), ('Squadra Esterna', '55.00')]
+
+# Distribuzione degli stati (imbuto di vendita): molti lead, pochi in montaggio
+PESI_STATI = {
+    Trattativa.STATO_LEAD: 30, Trattativa.STATO_APPUNTAMENTO: 15, Trattativa.STATO_PROGETTAZIONE: 12,
+    Trattativa.STATO_PREVENTIVO: 12, Trattativa.STATO_CONSEGNA: 4, Trattativa.STATO_MONTAGGIO: 3,
+    Trattativa.STATO_VINTO: 12, Trattativa.STATO_PERSO: 12,
+}
+# Le trattative più avanti nell'imbuto hanno più attività e più messaggi
+FASE_STATO = {stato: i for i, (stato, _) in enumerate(Trattativa.STATI_KANBAN_CHOICES)}
+FASI_APERTE = [stato for stato, _ in Trattativa.STATI_KANBAN_CHOICES if stato not in Trattativa.STATI_CHIUSI]
+
+
+def _valore_prodotto(rnd):
+    """Valore di una vendita: distribuzione log-normale (mediana ~8.000€, coda lunga)."""
+    return Decimal(min(rnd.lognormvariate(9, 0.6), 120000)).quantize(Decimal('1'))
+
+def _costo_prodotto(rnd, valore):
+    """Costo d'acquisto tra il 45% e il 70% del prezzo."""
+    return (valore * Decimal(rnd.uniform(0.45, 0.70))).quantize(Decimal('0.01'))
+
+def _istante_casuale(rnd, inizio, fine):
+    return inizio + (fine - inizio) * rnd.random()
+
+def _mesi_indietro(oggi, mesi):
+    """(anno, mese) degli ultimi `mesi` mesi, corrente compreso."""
+    risultato = []
+    for n in range(mesi):
+        anno, mese = divmod(oggi.year * 12 + oggi.month - 1 - n, 12)
+        risultato.append((anno, mese + 1))
+    return risultato
+
+
+def genera_dataset(num_utenti=10, num_trattative=2000, num_vendite=2500, max_attivita=6, max_messaggi=10,
+                   mesi=24, seme=None, dimensione_batch=1000, log=None):
+    """
+    Crea utenti, categorie, ruoli, vendite, trattative (in tutti gli stati),
+    attività, messaggi, statistiche mensili e budget. Ritorna un dict con i conteggi.
+    `log` (opzionale) riceve un messaggio di avanzamento per ogni fase.
+    """
+    rnd = random.Random(seme)
+    log = log or (lambda messaggio: None)
+    adesso = timezone.now()
+    oggi = timezone.localdate()
+    inizio_periodo = adesso - datetime.timedelta(days=30 * mesi)
+    conteggi = {}
+
+    with transaction.atomic():
+        # --- Anagrafiche ---
+        password = make_password('demo') # hash calcolato una volta sola
+        esistenti = set(User.objects.filter(username__startswith=PREFISSO_UTENTI).values_list('username', flat=True))
+        User.objects.bulk_create([
+            User(username=f'{PREFISSO_UTENTI}{i}', first_name=f'Venditore {i}', password=password)
+            for i in range(num_utenti) if f'{PREFISSO_UTENTI}{i}' not in esistenti
+        ], batch_size=dimensione_batch)
+        utenti = list(User.objects.filter(username__startswith=PREFISSO_UTENTI).order_by('pk')[:num_utenti])
+        # bulk_create non invia post_save: il profilo va creato qui
+        con_profilo = set(ProfiloUtente.objects.filter(utente__in=utenti).values_list('utente_id', flat=True))
+        ProfiloUtente.objects.bulk_create(
+            [ProfiloUtente(utente=u) for u in utenti if u.pk not in con_profilo], batch_size=dimensione_batch,
+        )
+        # Pochi venditori fanno la maggior parte delle vendite
+        pesi_utenti = [1 / (i + 1) for i in range(len(utenti))]
+
+        categorie = [CategoriaMerceologica.objects.get_or_create(nome=nome)[0] for nome in CATEGORIE_MERCEOLOGICHE]
+        servizi = [CategoriaServizio.objects.get_or_create(nome=nome)[0] for nome in CATEGORIE_SERVIZI]
+        ruoli = [
+            RuoloCosto.objects.get_or_create(nome=nome, defaults={'costo_orario': Decimal(costo)})[0]
+            for nome, costo in RUOLI
+        ]
+        log(f"Anagrafiche: {len(utenti)} utenti, {len(categorie)} categorie, {len(ruoli)} ruoli.")
+
+        # --- Vendite (una parte verrà collegata alle trattative vinte) ---
+        vendite = []
+        for i in range(num_vendite):
+            valore = _valore_prodotto(rnd)
+            vendite.append(Vendita(
+                descrizione=f'Vendita {i}', categoria=rnd.choice(categorie),
+                venditore=rnd.choices(utenti, pesi_utenti)[0], cliente=f'Cliente V{i}',
+                prezzo_vendita=valore, costo_acquisto=_costo_prodotto(rnd, valore),
+                data_vendita=_istante_casuale(rnd, inizio_periodo, adesso).date(),
+                flag_finanziamento=rnd.random() < 0.25, flag_reso=rnd.random() < 0.03,
+                flag_ritardo_consegna=rnd.random() < 0.08,
+            ))
+        vendite = Vendita.objects.bulk_create(vendite, batch_size=dimensione_batch)
+        vendite_libere = iter(vendite)
+        conteggi['vendite'] = len(vendite)
+        log(f"Vendite: {len(vendite)}.")
+
+        # --- Trattative ---
+        stati, pesi_stati = zip(*PESI_STATI.items())
+        trattative = []
+        for i in range(num_trattative):
+            stato = rnd.choices(stati, pesi_stati)[0]
+            valore = _valore_prodotto(rnd)
+            trattative.append(Trattativa(
+                titolo=f'{rnd.choice(CATEGORIE_MERCEOLOGICHE)} - progetto {i}', cliente_nome=f'Cliente {i}',
+                cliente_contatto=f'cliente{i}@example.com', stato=stato,
+                commerciale=rnd.choices(utenti, pesi_utenti)[0],
+                valore_stimato=valore, costo_materiali_stimato=_costo_prodotto(rnd, valore),
+                vendita_collegata=next(vendite_libere, None) if stato == Trattativa.STATO_VINTO else None,
+            ))
+        trattative = Trattativa.objects.bulk_create(trattative, batch_size=dimensione_batch)
+        # auto_now / auto_now_add: le date realistiche si impostano dopo l'inserimento
+        for t in trattative:
+            t.data_creazione = _istante_casuale(rnd, inizio_periodo, adesso)
+            t.data_ultimo_aggiornamento = _istante_casuale(rnd, t.data_creazione, adesso)
+        Trattativa.objects.bulk_update(trattative, ['data_creazione', 'data_ultimo_aggiornamento'], batch_size=dimensione_batch)
+        # La vendita di una trattativa vinta avviene alla chiusura, non prima della creazione
+        vinte = [t for t in trattative if t.vendita_collegata_id]
+        for t in vinte:
+            t.vendita_collegata.data_vendita = timezone.localtime(t.data_ultimo_aggiornamento).date()
+        Vendita.objects.bulk_update([t.vendita_collegata for t in vinte], ['data_vendita'], batch_size=dimensione_batch)
+        conteggi['trattative'] = len(trattative)
+        log(f"Trattative: {len(trattative)}.")
+
+        # --- Attività e messaggi (a blocchi, per non tenere tutto in memoria) ---
+        conteggi['attivita'] = conteggi['messaggi'] = 0
+        attivita, messaggi = [], []
+        for t in trattative:
+            fase = FASE_STATO[t.stato] + 1
+            for _ in range(rnd.randint(0, min(max_attivita, fase))):
+                servizio = rnd.choice(servizi)
+                ore = Decimal(rnd.choice([1, 1.5, 2, 3, 4, 6, 8]))
+                attivita.append(Attivita(
+                    trattativa=t, ruolo=rnd.choice(ruoli), categoria=servizio, descrizione=servizio.nome,
+                    tempo_dedicato_ore=ore, prezzo_vendita_attivita=Decimal(rnd.choice([0, 0, 50, 150, 300, 600])),
+                    data_attivita=_istante_casuale(rnd, t.data_creazione, adesso).date(),
+                ))
+            for _ in range(rnd.randint(0, min(max_messaggi, fase * 2))):
+                messaggi.append(MessaggioChat(
+                    trattativa=t, utente=rnd.choice(utenti), messaggio=rnd.choice([
+                        'Cliente richiamato, attende il preventivo.', 'Misure confermate.',
+                        'Consegna da pianificare con il magazzino.', 'Richiesto sconto sul top.',
+                    ]),
+                ))
+            if len(attivita) >= dimensione_batch:
+                conteggi['attivita'] += len(Attivita.objects.bulk_create(attivita, batch_size=dimensione_batch))
+                attivita = []
+            if len(messaggi) >= dimensione_batch:
+                conteggi['messaggi'] += _inserisci_messaggi(rnd, messaggi, adesso, dimensione_batch)
+                messaggi = []
+        conteggi['attivita'] += len(Attivita.objects.bulk_create(attivita, batch_size=dimensione_batch))
+        conteggi['messaggi'] += _inserisci_messaggi(rnd, messaggi, adesso, dimensione_batch)
+        log(f"Attività: {conteggi['attivita']}, messaggi: {conteggi['messaggi']}.")
+
+        # --- Statistiche mensili e budget ---
+        periodi = _mesi_indietro(oggi, mesi)
+        StatMensile.objects.bulk_create([
+            StatMensile(
+                anno=anno, mese=mese, costo_marketing_mese=Decimal(rnd.randint(800, 4000)),
+                costi_operativi_fissi=Decimal(rnd.randint(9000, 15000)), finanziamenti_non_approvati=rnd.randint(0, 5),
+            )
+            for anno, mese in periodi
+        ], ignore_conflicts=True, batch_size=dimensione_batch)
+        Budget.objects.bulk_create([
+            Budget(
+                anno=anno, mese=mese, categoria=categoria, obiettivo_vendite_euro=Decimal(rnd.randint(20, 80) * 1000),
+                obiettivo_margine_percentuale=Decimal(rnd.choice([28, 30, 32, 35])),
+            )
+            for anno, mese in periodi for categoria in categorie
+        ], ignore_conflicts=True, batch_size=dimensione_batch)
+        log(f"Statistiche mensili e budget: {len(periodi)} mesi.")
+
+        # --- Storico degli stati ---
+        conteggi['passaggi'] = 0
+        passaggi = []
+        for t in trattative:
+            passaggi += _percorso(rnd, t)
+            if len(passaggi) >= dimensione_batch:
+                conteggi['passaggi'] += len(PassaggioStato.objects.bulk_create(passaggi, batch_size=dimensione_batch))
+                passaggi = []
+        conteggi['passaggi'] += len(PassaggioStato.objects.bulk_create(passaggi, batch_size=dimensione_batch))
+        log(f"Passaggi di stato: {conteggi['passaggi']}.")
+
+        # --- Quello che avrebbero fatto i segnali ---
+        ricalcola_totali_trattative()
+        riepiloghi.ricostruisci_tutto()
+        indice_ricerca.ricostruisci()
+        previsioni.invalida_a_fine_transazione()
+        log("Totali trattative, riepiloghi mensili, indice di ricerca e previsioni ricalcolati.")
+    return conteggi
+
+def _percorso(rnd, trattativa):
+    """
+    Passaggi di stato di una trattativa, dalla creazione all'ultimo aggiornamento:
+    le vinte attraversano tutte le fasi, le perse si fermano a una fase a caso.
+    """
+    if trattativa.stato == Trattativa.STATO_VINTO:
+        percorso = FASI_APERTE + [trattativa.stato]
+    elif trattativa.stato == Trattativa.STATO_PERSO:
+        percorso = FASI_APERTE[:rnd.randint(1, len(FASI_APERTE))] + [trattativa.stato]
+    else:
+        percorso = FASI_APERTE[:FASE_STATO[trattativa.stato] + 1]
+    date = [trattativa.data_creazione]
+    if len(percorso) > 1:
+        date += sorted(
+            _istante_casuale(rnd, trattativa.data_creazione, trattativa.data_ultimo_aggiornamento) for _ in percorso[2:]
+        ) + [trattativa.data_ultimo_aggiornamento]
+    return [
+        PassaggioStato(trattativa=trattativa, stato_precedente=precedente, stato=stato, data=data)
+        for precedente, stato, data in zip([None] + percorso[:-1], percorso, date)
+    ]
+
+def _inserisci_messaggi(rnd, messaggi, adesso, dimensione_batch):
+    messaggi = MessaggioChat.objects.bulk_create(messaggi, batch_size=dimensione_batch)
+    for m in messaggi:
+        m.timestamp = _istante_casuale(rnd, m.trattativa.data_creazione, adesso)
+    MessaggioChat.objects.bulk_update(messaggi, ['timestamp'], batch_size=dimensione_batch)
+    return len(messaggi)
@@ -0,0 +1,25 @@
+# gestione/esecutore_test.py
+"""
+Esecutore dei test (settings.TEST_RUNNER): come quello di Django, ma con la
+cache in memoria per tutta la suite. Con la cache su file dei settings i segnali
+dei test scriverebbero le versioni di dashboard, impostazioni e previsioni nella
+cartella cache/ del progetto: invaliderebbero quella del server di sviluppo e
+le voci rimaste entrerebbero nei test successivi.
+"""
+
+from django.test import override_settings
+from django.test.runner import DiscoverRunner
+
+CACHE_TEST = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+class EsecutoreTest(DiscoverRunner):
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self._cache_test = override_settings(CACHES=CACHE_TEST)
+        self._cache_test.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self._cache_test.disable()
+        super().teardown_test_environment(**kwargs)
@@ -0,0 +1,348 @@
+# gestione/esportazioni.py
+"""
+Esportazione del report trattative (Excel e CSV) in streaming.
+
+Le righe vengono lette dal DB a blocchi con `.iterator()` e scritte una alla volta,
+quindi la memoria usata non dipende dal numero di trattative esportate. Anche
+l'Excel esce a blocchi: lo zip del .xlsx si scrive mentre arrivano le righe.
+Le esportazioni grandi passano da EsportazioneJob e dal worker `esegui_esportazioni`.
+"""
+
+import csv
+import datetime
+import hashlib
+import io
+import json
+import os
+import zipfile
+from decimal import Decimal
+from xml.etree import ElementTree as ET
+from xml.sax.saxutils import escape
+
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.styles import Font, Alignment
+from openpyxl.utils import get_column_letter
+from openpyxl.utils.datetime import to_excel
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from . import database
+from .calcoli import get_trattative_annotate
+from .models import Trattativa, EsportazioneJob
+
+DIMENSIONE_BLOCCO = 2000
+
+FORMATO_EURO = '€ #,##0.00'
+FORMATO_PERCENTUALE = '0.00%'
+
+# (intestazione, tipo colonna) - il tipo decide formato e larghezza in Excel
+COLONNE = [
+    ("ID", None), ("Titolo", None), ("Stato", None), ("Cliente", None), ("Commerciale", None),
+    ("Data Creazione", 'data'), ("Valore Prodotto (€)", 'euro'), ("Ricavo Servizi (€)", 'euro'), ("Valore Totale (€)", 'euro'),
+    ("Costo Materiali (€)", 'euro'), ("Costo Personale (€)", 'euro'), ("Costo Totale (€)", 'euro'),
+    ("Margine Stimato (€)", 'euro'), ("Margine Stimato (%)", 'percentuale'),
+]
+
+
+def righe_trattative(trattative, dimensione_blocco=DIMENSIONE_BLOCCO):
+    """
+    Genera una lista di valori per ogni trattativa (queryset di get_trattative_annotate),
+    leggendo dal DB a blocchi.
+    """
+    for t in trattative.iterator(chunk_size=dimensione_blocco):
+        commerciale_username = t.commerciale.username if t.commerciale else "N/A"
+        yield [
+            t.id, t.titolo, t.get_stato_display(), t.cliente_nome, commerciale_username,
+            t.data_creazione.replace(tzinfo=None), # Rimuovi timezone per Excel
+            float(t.valore_stimato), # Valore Prodotto
+            float(t.ricavo_servizi_totale), # Ricavo Servizi
+            float(t.valore_totale_stimato), # Valore Totale
+            float(t.costo_materiali_stimato), # Costo Materiali
+            float(t.costo_personale_totale), # Costo Personale
+            float(t.costo_totale_stimato), # Costo Totale
+            float(t.margine_stimato_euro), # Margine €
+            float(t.margine_stimato_perc) / 100.0 # Margine %
+        ]
+
+
+# --- EXCEL ---
+FOGLIO_XLSX = 'xl/worksheets/sheet1.xml'
+_NS_XLSX = {'x': 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'}
+
+def _modello_xlsx():
+    """
+    Workbook write-only (openpyxl) con intestazioni, larghezze, stili e una riga
+    d'esempio. Ritorna (parti fisse dello zip, foglio fino alle righe dei dati,
+    foglio dopo le righe, stile di ogni colonna letto dalla riga d'esempio).
+    """
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Report Trattative")
+
+    # In modalità write-only le larghezze vanno impostate prima delle righe
+    for i, (_, tipo) in enumerate(COLONNE, 1):
+        ws.column_dimensions[get_column_letter(i)].width = {'euro': 18, 'percentuale': 15}.get(tipo, 20)
+
+    intestazioni = []
+    for intestazione, _ in COLONNE:
+        cella = WriteOnlyCell(ws, value=intestazione)
+        cella.font = Font(bold=True)
+        cella.alignment = Alignment(horizontal="center")
+        intestazioni.append(cella)
+    ws.append(intestazioni)
+
+    esempio = []
+    for _, tipo in COLONNE:
+        formato = {'euro': FORMATO_EURO, 'percentuale': FORMATO_PERCENTUALE}.get(tipo)
+        cella = WriteOnlyCell(ws, value=datetime.datetime(2000, 1, 1) if tipo == 'data' else 0)
+        if formato:
+            cella.number_format = formato
+        esempio.append(cella)
+    ws.append(esempio)
+
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    with zipfile.ZipFile(buffer) as archivio:
+        parti = {nome: archivio.read(nome) for nome in archivio.namelist()}
+    foglio = parti.pop(FOGLIO_XLSX).decode()
+    stili = [c.get('s') for c in ET.fromstring(foglio).find('x:sheetData/x:row[@r="2"]', _NS_XLSX)]
+    apertura = foglio[:foglio.index('<row r="2"')]
+    chiusura = foglio[foglio.index('</sheetData>'):]
+    return parti, apertura.encode(), chiusura.encode(), stili
+
+def _cella_xml(riferimento, valore, stile):
+    if valore is None:
+        return ''
+    stile = f' s="{stile}"' if stile else ''
+    if isinstance(valore, bool):
+        return f'<c r="{riferimento}"{stile} t="b"><v>{int(valore)}</v></c>'
+    if isinstance(valore, (datetime.date, datetime.datetime)):
+        valore = to_excel(valore)
+    if isinstance(valore, (int, float, Decimal)):
+        return f'<c r="{riferimento}"{stile}><v>{valore}</v></c>'
+    testo = escape(ILLEGAL_CHARACTERS_RE.sub('', str(valore)))
+    return f'<c r="{riferimento}"{stile} t="inlineStr"><is><t xml:space="preserve">{testo}</t></is></c>'
+
+def _riga_xml(numero, riga, colonne, stili):
+    celle = ''.join(_cella_xml(f'{colonna}{numero}', valore, stile) for valore, colonna, stile in zip(riga, colonne, stili))
+    return f'<row r="{numero}">{celle}</row>'
+
+class _UscitaZip:
+    """Pseudo-file non posizionabile per zipfile: tiene i byte scritti finché il generatore non li consegna."""
+    def __init__(self):
+        self.blocchi = []
+
+    def write(self, dati):
+        self.blocchi.append(bytes(dati))
+        return len(dati)
+
+    def flush(self):
+        pass
+
+    def svuota(self):
+        dati = b''.join(self.blocchi)
+        self.blocchi = []
+        return dati
+
+def genera_xlsx(righe, righe_per_blocco=DIMENSIONE_BLOCCO):
+    """
+    Generatore dei byte del file .xlsx, da passare a StreamingHttpResponse.
+    Lo zip si scrive in streaming: parti fisse e stili vengono dal modello di
+    openpyxl, le righe del foglio sono compresse e consegnate ogni
+    `righe_per_blocco` righe, mentre arrivano dal DB.
+    """
+    parti, apertura, chiusura, stili = _modello_xlsx()
+    colonne = [get_column_letter(i) for i in range(1, len(COLONNE) + 1)]
+    uscita = _UscitaZip()
+    # Senza seek() zipfile scrive dimensioni e CRC del foglio dopo i dati (data descriptor)
+    with zipfile.ZipFile(uscita, 'w', zipfile.ZIP_DEFLATED) as archivio:
+        for nome, contenuto in parti.items():
+            archivio.writestr(nome, contenuto)
+        with archivio.open(FOGLIO_XLSX, 'w') as foglio:
+            foglio.write(apertura)
+            blocco = []
+            for numero, riga in enumerate(righe, 2):
+                blocco.append(_riga_xml(numero, riga, colonne, stili))
+                if len(blocco) == righe_per_blocco:
+                    foglio.write(''.join(blocco).encode())
+                    blocco = []
+                    yield uscita.svuota()
+            foglio.write(''.join(blocco).encode() + chiusura)
+    yield uscita.svuota()
+
+def scrivi_xlsx(righe, destinazione):
+    """Scrive il file di genera_xlsx su `destinazione` (percorso o file binario)."""
+    if isinstance(destinazione, (str, os.PathLike)):
+        with open(destinazione, 'wb') as file:
+            scrivi_xlsx(righe, file)
+        return destinazione
+    for blocco in genera_xlsx(righe):
+        destinazione.write(blocco)
+    return destinazione
+
+
+# --- CSV ---
+class _Eco:
+    """Pseudo-buffer: csv.writer scrive qui e noi ritorniamo subito la riga."""
+    def write(self, value):
+        return value
+
+def _valori_csv(riga):
+    # Separatore ';' e virgola decimale: il CSV si apre correttamente in Excel italiano
+    valori = []
+    for valore, (_, tipo) in zip(riga, COLONNE):
+        if tipo == 'percentuale':
+            valore = f"{valore * 100:.2f}".replace('.', ',')
+        elif tipo == 'euro':
+            valore = f"{valore:.2f}".replace('.', ',')
+        elif isinstance(valore, datetime.datetime):
+            valore = valore.strftime('%d/%m/%Y %H:%M')
+        valori.append(valore)
+    return valori
+
+def genera_csv(righe):
+    """Generatore di stringhe CSV, da passare a StreamingHttpResponse."""
+    writer = csv.writer(_Eco(), delimiter=';')
+    yield '\ufeff' # BOM, per gli accenti in Excel
+    yield writer.writerow([intestazione for intestazione, _ in COLONNE])
+    for riga in righe:
+        yield writer.writerow(_valori_csv(riga))
+
+def scrivi_csv(righe, destinazione):
+    """Scrive il CSV su un file di testo già aperto."""
+    for blocco in genera_csv(righe):
+        destinazione.write(blocco)
+    return destinazione
+
+
+# --- FILTRI ---
+def filtri_da_richiesta(dati):
+    """
+    Estrae dai parametri GET/POST i filtri riconosciuti (stato, commerciale,
+    intervallo sulla data di creazione). Valori non validi vengono ignorati.
+    """
+    filtri = {}
+    stato = dati.get('stato')
+    if stato in dict(Trattativa.STATI_KANBAN_CHOICES):
+        filtri['stato'] = stato
+    commerciale = dati.get('commerciale') or ''
+    if commerciale.isdigit():
+        filtri['commerciale'] = int(commerciale)
+    for campo in ('data_da', 'data_a'):
+        try:
+            data = parse_date(dati.get(campo) or '')
+        except ValueError:
+            data = None
+        if data:
+            filtri[campo] = data.isoformat()
+    return filtri
+
+def _inizio_giorno(data):
+    return timezone.make_aware(datetime.datetime.combine(data, datetime.time.min))
+
+def filtra_trattative(queryset, filtri):
+    """Applica al queryset i filtri prodotti da filtri_da_richiesta."""
+    if 'stato' in filtri:
+        queryset = queryset.filter(stato=filtri['stato'])
+    if 'commerciale' in filtri:
+        queryset = queryset.filter(commerciale_id=filtri['commerciale'])
+    if 'data_da' in filtri:
+        queryset = queryset.filter(data_creazione__gte=_inizio_giorno(datetime.date.fromisoformat(filtri['data_da'])))
+    if 'data_a' in filtri:
+        giorno_dopo = datetime.date.fromisoformat(filtri['data_a']) + datetime.timedelta(days=1)
+        queryset = queryset.filter(data_creazione__lt=_inizio_giorno(giorno_dopo))
+    return queryset
+
+def trattative_da_esportare(filtri):
+    return filtra_trattative(get_trattative_annotate(), filtri).order_by('stato', '-data_ultimo_aggiornamento')
+
+
+# --- JOB IN BACKGROUND ---
+def chiave_filtri(formato, filtri):
+    dati = json.dumps({'formato': formato, 'filtri': filtri}, sort_keys=True)
+    return hashlib.sha256(dati.encode()).hexdigest()
+
+def trova_o_crea_job(formato, filtri, utente=None):
+    """
+    Ritorna un job dell'utente riusabile con gli stessi filtri (in coda, in corso, o
+    completato entro ESPORTAZIONI_TTL_MINUTI con il file ancora presente), altrimenti
+    ne crea uno. Ricerca e creazione stanno in una transazione: inizia con BEGIN
+    IMMEDIATE (vedi sqlite/base.py), quindi due richieste uguali nello stesso momento
+    si mettono in fila e la seconda trova il job della prima.
+    """
+    chiave = chiave_filtri(formato, filtri)
+    limite = timezone.now() - datetime.timedelta(minutes=settings.ESPORTAZIONI_TTL_MINUTI)
+    with transaction.atomic():
+        candidati = EsportazioneJob.objects.filter(chiave_filtri=chiave, utente=utente).exclude(stato=EsportazioneJob.STATO_ERRORE)
+        for job in candidati.filter(data_creazione__gte=limite)[:5]:
+            if not job.terminato or os.path.exists(job.percorso_file):
+                return job, False
+        job = EsportazioneJob.objects.create(utente=utente, formato=formato, filtri=filtri, chiave_filtri=chiave)
+    return job, True
+
+def esegui_job(job_id):
+    """
+    Genera il file di un job. Il job viene "prenotato" con un UPDATE condizionale,
+    così due worker non lo elaborano mai entrambi.
+    """
+    prenotato = EsportazioneJob.objects.filter(pk=job_id, stato=EsportazioneJob.STATO_IN_CODA).update(stato=EsportazioneJob.STATO_IN_CORSO)
+    if not prenotato:
+        return
+    job = EsportazioneJob.objects.get(pk=job_id)
+    percorso_tmp = None
+    try:
+        # Le letture vanno sulla connessione dei report; gli UPDATE dell'avanzamento su 'default'.
+        # Un job appena creato è una scrittura recente dell'utente: la replica potrebbe non avere i suoi ultimi dati
+        eta = timezone.now() - job.data_creazione
+        with database.lettura(replica=eta.total_seconds() >= settings.REPLICA_PRIMARIO_DOPO_SCRITTURA_SECONDI):
+            trattative = trattative_da_esportare(job.filtri)
+            righe_totali = filtra_trattative(Trattativa.objects.all(), job.filtri).count()
+            EsportazioneJob.objects.filter(pk=job.pk).update(righe_totali=righe_totali)
+
+            os.makedirs(settings.ESPORTAZIONI_DIR, exist_ok=True)
+            percorso = os.path.join(settings.ESPORTAZIONI_DIR, f"{job.pk}_{job.chiave_filtri[:12]}.{job.formato}")
+            percorso_tmp = percorso + '.tmp'
+            righe = _con_avanzamento(righe_trattative(trattative), job.pk)
+            if job.formato == EsportazioneJob.FORMATO_CSV:
+                with open(percorso_tmp, 'w', encoding='utf-8', newline='') as destinazione:
+                    scrivi_csv(righe, destinazione)
+            else:
+                scrivi_xlsx(righe, percorso_tmp)
+        os.replace(percorso_tmp, percorso)
+
+        EsportazioneJob.objects.filter(pk=job.pk).update(
+            stato=EsportazioneJob.STATO_COMPLETATO, percorso_file=percorso,
+            righe_elaborate=righe_totali, data_completamento=timezone.now(),
+        )
+    except Exception as e:
+        # Il file a metà non serve a nessuno: non resta nella cartella delle esportazioni
+        if percorso_tmp and os.path.exists(percorso_tmp):
+            os.remove(percorso_tmp)
+        EsportazioneJob.objects.filter(pk=job.pk).update(
+            stato=EsportazioneJob.STATO_ERRORE, messaggio_errore=str(e), data_completamento=timezone.now(),
+        )
+    finally:
+        close_old_connections()
+
+def _con_avanzamento(righe, job_id, ogni=DIMENSIONE_BLOCCO):
+    """Passa le righe invariate, salvando l'avanzamento del job ogni `ogni` righe."""
+    for numero, riga in enumerate(righe, 1):
+        yield riga
+        if numero % ogni == 0:
+            EsportazioneJob.objects.filter(pk=job_id).update(righe_elaborate=numero)
+
+def pulisci_job_scaduti():
+    """Elimina i file e i job completati più vecchi del TTL. Ritorna quanti job sono stati rimossi."""
+    limite = timezone.now() - datetime.timedelta(minutes=settings.ESPORTAZIONI_TTL_MINUTI)
+    scaduti = EsportazioneJob.objects.filter(
+        stato__in=[EsportazioneJob.STATO_COMPLETATO, EsportazioneJob.STATO_ERRORE],
+        data_creazione__lt=limite,
+    )
+    for percorso in scaduti.exclude(percorso_file='').values_list('percorso_file', flat=True):
+        if os.path.exists(percorso):
+            os.remove(percorso)
+    return scaduti.delete()[0]
@@ -0,0 +1,146 @@
+# gestione/eventi.py
+"""
+Aggiornamenti in tempo reale della Kanban con Server-Sent Events.
+
+Spostamenti, chiusure, nuove trattative ed eliminazioni vengono pubblicati (vedi
+signals.py) come piccoli delta JSON con la card già renderizzata; ogni board
+aperta li riceve dallo stream `eventi_kanban` e li applica senza ricaricare.
+
+Il canale vive in memoria nel processo. Funziona quindi con un solo processo ASGI
+(es. `uvicorn arredo_gest.asgi:application`), che serve nei suoi thread anche le
+viste sincrone che pubblicano. Con più processi serve un canale condiviso al posto
+di Canale (es. Redis pub/sub) con la stessa interfaccia.
+"""
+
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+
+from django.db import transaction
+from django.template.loader import render_to_string
+
+from .models import Trattativa
+
+EVENTI_RECENTI = 200 # Ripetuti a chi si riconnette con Last-Event-ID
+CODA_MAX = 500 # Eventi in attesa per una connessione lenta prima di farle ricaricare la board
+BATTITO_SECONDI = 20 # Commento SSE periodico: tiene viva la connessione attraverso i proxy
+DURATA_MAX_SECONDI = 5 * 60 # Poi lo stream si chiude e il browser si riconnette (libera le connessioni morte)
+RIPROVA_MS = 3000
+
+# Evento che chiede al browser di ricaricare la board: gli eventi persi non sono più disponibili
+RICARICA = (None, 'ricarica', '{}')
+
+
+class Canale:
+    """Pub/sub in memoria: pubblica() si può chiamare da qualunque thread, gli iscritti sono code asyncio."""
+
+    def __init__(self, recenti=EVENTI_RECENTI):
+        # Gli id di un altro processo (o di prima di un riavvio) non sono confrontabili con i nostri
+        self.avvio = format(time.time_ns(), 'x')
+        self._lock = threading.Lock()
+        self._iscritti = {} # coda -> loop asyncio che la legge
+        self._recenti = deque(maxlen=recenti)
+        self._ultimo = 0
+
+    def pubblica(self, tipo, dati):
+        with self._lock:
+            self._ultimo += 1
+            evento = (f'{self.avvio}-{self._ultimo}', tipo, json.dumps(dati, ensure_ascii=False))
+            self._recenti.append((self._ultimo, evento))
+            iscritti = list(self._iscritti.items())
+        for coda, loop in iscritti:
+            try:
+                loop.call_soon_threadsafe(_consegna, coda, evento)
+            except RuntimeError:
+                pass # loop già chiuso: la coda sparisce con disiscrivi()
+        return evento[0]
+
+    def iscrivi(self, ultimo_visto=None):
+        """
+        Ritorna (coda, arretrati): gli eventi successivi a `ultimo_visto` (Last-Event-ID)
+        ancora in memoria, oppure None se nel frattempo se ne sono persi.
+        """
+        coda = asyncio.Queue(CODA_MAX)
+        with self._lock:
+            self._iscritti[coda] = asyncio.get_running_loop()
+            return coda, self._arretrati(ultimo_visto)
+
+    def disiscrivi(self, coda):
+        with self._lock:
+            self._iscritti.pop(coda, None)
+
+    @property
+    def iscritti(self):
+        return len(self._iscritti)
+
+    def _arretrati(self, ultimo_visto):
+        if not ultimo_visto:
+            return []
+        avvio, _, numero = ultimo_visto.rpartition('-')
+        if avvio != self.avvio or not numero.isdigit() or int(numero) > self._ultimo:
+            return None
+        primo = self._recenti[0][0] if self._recenti else self._ultimo + 1
+        if int(numero) < primo - 1:
+            return None
+        return [evento for n, evento in self._recenti if n > int(numero)]
+
+
+def _consegna(coda, evento):
+    try:
+        coda.put_nowait(evento)
+    except asyncio.QueueFull:
+        # Il client non tiene il passo: svuota la coda e chiedigli di ricaricare
+        while not coda.empty():
+            coda.get_nowait()
+        coda.put_nowait(RICARICA)
+
+
+def formatta(evento):
+    id_evento, tipo, dati = evento
+    righe = [f'id: {id_evento}'] if id_evento else []
+    righe += [f'event: {tipo}', f'data: {dati}']
+    return '\n'.join(righe) + '\n\n'
+
+async def flusso(canale, ultimo_visto=None, battito=None, durata=None):
+    """Generatore asincrono dello stream SSE di un client: arretrati, poi eventi e battiti fino a `durata`."""
+    battito = battito or BATTITO_SECONDI
+    durata = durata or DURATA_MAX_SECONDI
+    coda, arretrati = canale.iscrivi(ultimo_visto)
+    loop = asyncio.get_running_loop()
+    try:
+        yield f'retry: {RIPROVA_MS}\n\n'
+        for evento in [RICARICA] if arretrati is None else arretrati:
+            yield formatta(evento)
+        fine = loop.time() + durata
+        while (resto := fine - loop.time()) > 0:
+            try:
+                evento = await asyncio.wait_for(coda.get(), min(battito, resto))
+            except asyncio.TimeoutError:
+                yield ': battito\n\n'
+                continue
+            yield formatta(evento)
+            if evento is RICARICA:
+                return
+    finally:
+        canale.disiscrivi(coda)
+
+
+kanban = Canale()
+
+
+def pubblica_card(trattativa, stato_precedente=None):
+    """
+    Manda alle board aperte la card aggiornata (stato_precedente None = nuova);
+    dopo il commit, così chi la riceve la ritrova nel DB.
+    """
+    def pubblica():
+        tipo = 'creata' if stato_precedente is None else 'spostata'
+        if trattativa.stato in Trattativa.STATI_CHIUSI:
+            tipo = 'chiusa'
+        kanban.pubblica(tipo, {
+            'id': trattativa.id, 'stato': trattativa.stato, 'stato_precedente': stato_precedente,
+            'html': render_to_string('gestione/partials/_partial_kanban_card.html', {'trattativa': trattativa}),
+        })
+    transaction.on_commit(pubblica)
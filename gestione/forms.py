@@ -98,4 +98,12 @@ class TrattativaDettaglioForm(forms.ModelForm):
     commerciale = forms.ModelChoiceField(label="Commerciale Assegnato", queryset=User.objects.filter(is_staff=True), required=False, widget=forms.Select(attrs={'class': 'form-select'}))
     class Meta:
         model = Trattativa
-        fields = ['titolo', 'cliente_nome', 'cliente_contatto', 'valore_stimato', 'costo_materiali_stimato', 'commerciale']
\ No newline at end of file
+        fields = ['titolo', 'cliente_nome', 'cliente_contatto', 'valore_stimato', 'costo_materiali_stimato', 'commerciale']
+
+class ImportazioneForm(forms.Form):
+    """Caricamento di un file per l'importazione in blocco (pagina dell'admin)."""
+    file = forms.FileField(label="File CSV o XLSX")
+    prova = forms.BooleanField(
+        label="Solo prova", required=False, initial=True,
+        help_text="Valida tutte le righe e mostra gli errori senza scrivere nel database.",
+    )
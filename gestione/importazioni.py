@@ -0,0 +1,452 @@
+# gestione/importazioni.py
+"""
+Importazione in blocco di vendite, trattative e attività da CSV o XLSX.
+
+Il file si legge una riga alla volta (csv, openpyxl in sola lettura), le
+anagrafiche (categorie, ruoli, utenti) si risolvono con dizionari caricati una
+volta sola e le righe valide si inseriscono con bulk_create a blocchi, quindi la
+memoria usata non dipende dalla dimensione del file. Le righe non valide vengono
+saltate e segnalate con il loro numero; in prova (dry-run) si valida senza scrivere.
+Ogni blocco si salva in una transazione breve (vedi importa()).
+
+bulk_create non manda i segnali: a fine importazione totali delle trattative,
+riepiloghi mensili, cache della dashboard e previsioni si aggiornano una volta
+sola; l'indice di ricerca e lo stato iniziale delle trattative a ogni blocco inserito.
+"""
+
+import csv
+import datetime
+import io
+import os
+from decimal import Decimal
+
+import openpyxl
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from . import riepiloghi, cache_dashboard, indice_ricerca, previsioni
+from .calcoli import ricalcola_totali_trattative
+from .models import (
+    Vendita, Trattativa, Attivita, CategoriaMerceologica, CategoriaServizio, RuoloCosto, PassaggioStato,
+)
+
+DIMENSIONE_BLOCCO = 2000
+ERRORI_MAX = 1000 # Errori conservati nel risultato; oltre si contano soltanto
+DELIMITATORI_CSV = ';,\t' # Il primo è quello delle nostre esportazioni
+VALORI_VERI = {'1', 'si', 'sì', 's', 'x', 'true', 'vero', 'yes', 'y'}
+ID_PER_QUERY = 500 # Id per ogni "IN (...)" dei ricalcoli finali
+
+
+class ErroreImportazione(ValueError):
+    """Errore sull'intero file (formato, colonne mancanti): non si importa niente."""
+
+class ErroreRiga(ValueError):
+    """Riga non valida: viene saltata e finisce nel report."""
+
+
+class RisultatoImportazione:
+
+    def __init__(self, tipo, prova, su_errore=None):
+        self.tipo = tipo
+        self.prova = prova
+        self.righe_lette = 0
+        self.righe_importate = 0 # in prova: righe valide, che sarebbero state importate
+        self.errori = [] # (numero di riga, messaggio), al massimo ERRORI_MAX
+        self.errori_totali = 0
+        self._su_errore = su_errore
+
+    def aggiungi_errore(self, numero, messaggio):
+        self.errori_totali += 1
+        if len(self.errori) < ERRORI_MAX:
+            self.errori.append((numero, messaggio))
+        if self._su_errore:
+            self._su_errore(numero, messaggio)
+
+
+# --- LETTURA DEL FILE ---
+def formato_da_nome(nome):
+    estensione = nome.rsplit('.', 1)[-1].lower() if '.' in nome else ''
+    if estensione not in ('csv', 'xlsx'):
+        raise ErroreImportazione("Formato non supportato: servono file .csv o .xlsx.")
+    return estensione
+
+def _normalizza_intestazione(valore):
+    return '_'.join(str(valore or '').strip().lower().split())
+
+def _righe_csv(file):
+    # I file caricati sono binari: la decodifica avviene mentre si legge
+    testo = io.TextIOWrapper(getattr(file, 'file', file), encoding='utf-8-sig', newline='')
+    try:
+        prima = testo.readline()
+        delimitatore = max(DELIMITATORI_CSV, key=prima.count)
+        yield next(csv.reader([prima], delimiter=delimitatore), [])
+        yield from csv.reader(testo, delimiter=delimitatore)
+    except UnicodeDecodeError:
+        raise ErroreImportazione("Il CSV deve essere codificato in UTF-8.")
+    finally:
+        testo.detach() # il file resta al chiamante
+
+def _righe_xlsx(file):
+    try:
+        wb = openpyxl.load_workbook(getattr(file, 'file', file), read_only=True, data_only=True)
+    except Exception:
+        raise ErroreImportazione("File Excel non leggibile.")
+    try:
+        yield from wb.worksheets[0].iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+def leggi_righe(file, formato):
+    """
+    Ritorna (intestazioni, righe): le righe sono coppie (numero di riga nel foglio,
+    dict intestazione -> valore), generate una alla volta. Le righe vuote si saltano.
+    """
+    righe = _righe_xlsx(file) if formato == 'xlsx' else _righe_csv(file)
+    intestazioni = [_normalizza_intestazione(v) for v in next(righe, ())]
+    return intestazioni, (
+        (numero, dict(zip(intestazioni, valori)))
+        for numero, valori in enumerate(righe, 2)
+        if any(v not in (None, '') for v in valori)
+    )
+
+
+# --- CONVERSIONE DEI VALORI ---
+def _testo(valore):
+    return '' if valore is None else str(valore).strip()
+
+def _numero(valore):
+    """Numeri da Excel o testo, anche all'italiana (1.234,56 €)."""
+    if isinstance(valore, (int, float, Decimal)) and not isinstance(valore, bool):
+        return Decimal(str(valore))
+    testo = _testo(valore).replace('€', '').replace(' ', '')
+    if ',' in testo:
+        testo = testo.replace('.', '').replace(',', '.')
+    return testo
+
+def _data(valore):
+    if isinstance(valore, datetime.datetime):
+        return valore.date()
+    if isinstance(valore, datetime.date):
+        return valore
+    testo = _testo(valore)
+    try:
+        return datetime.datetime.strptime(testo, '%d/%m/%Y').date()
+    except ValueError:
+        return testo # ISO (AAAA-MM-GG): lo interpreta il campo del modello
+
+def _data_ora(valore):
+    """Data e ora (ISO o GG/MM/AAAA HH:MM); una data sola vale mezzogiorno, ora locale."""
+    testo = _testo(valore)
+    try:
+        istante = valore if isinstance(valore, datetime.datetime) else parse_datetime(testo)
+        if istante is None:
+            try:
+                istante = datetime.datetime.strptime(testo, '%d/%m/%Y %H:%M')
+            except ValueError:
+                data = _data(valore)
+                data = data if isinstance(data, datetime.date) else parse_date(data)
+                if data is None:
+                    return testo
+                istante = datetime.datetime.combine(data, datetime.time(12))
+    except ValueError:
+        return testo # non valido: l'errore lo segnala il campo del modello
+    return timezone.make_aware(istante) if timezone.is_naive(istante) else istante
+
+def _booleano(valore):
+    if isinstance(valore, bool):
+        return valore
+    return _testo(valore).lower() in VALORI_VERI
+
+
+class _Riga:
+    """Legge i campi di una riga accumulando gli errori, poi li solleva tutti insieme."""
+
+    def __init__(self, modello, valori):
+        self.modello = modello
+        self.valori = valori
+        self.errori = []
+
+    def campo(self, nome, converti=_testo, obbligatorio=False):
+        """Valore della colonna `nome`, validato dal campo omonimo del modello."""
+        campo = self.modello._meta.get_field(nome)
+        grezzo = self.valori.get(nome)
+        if _testo(grezzo) == '':
+            if obbligatorio:
+                self.errori.append(f"{nome}: valore obbligatorio.")
+            return campo.get_default()
+        try:
+            # clean() applica anche max_length, max_digits e choices del modello
+            return campo.clean(converti(grezzo), None)
+        except ValidationError as e:
+            self.errori.append(f"{nome}: {' '.join(e.messages)}")
+            return None
+
+    def anagrafica(self, colonna, mappa, descrizione, obbligatorio=False):
+        nome = _testo(self.valori.get(colonna))
+        if not nome:
+            if obbligatorio:
+                self.errori.append(f"{colonna}: valore obbligatorio.")
+            return None
+        if nome.lower() not in mappa:
+            self.errori.append(f"{colonna}: {descrizione} '{nome}' inesistente.")
+            return None
+        return mappa[nome.lower()]
+
+    def verifica(self):
+        if self.errori:
+            raise ErroreRiga(' '.join(self.errori))
+
+
+class Anagrafiche:
+    """Nome (minuscolo) -> id di categorie, ruoli e utenti, letti una volta per importazione."""
+
+    def __init__(self):
+        self.categorie = {nome.lower(): pk for pk, nome in CategoriaMerceologica.objects.values_list('id', 'nome')}
+        self.servizi = {nome.lower(): pk for pk, nome in CategoriaServizio.objects.values_list('id', 'nome')}
+        self.ruoli = {nome.lower(): pk for pk, nome in RuoloCosto.objects.values_list('id', 'nome')}
+        self.utenti = {nome.lower(): pk for pk, nome in User.objects.values_list('id', 'username')}
+        # Stato per chiave (PREVENTIVO) o per etichetta, con o senza numero ("Preventivo Inviato")
+        self.stati = {}
+        for chiave, etichetta in Trattativa.STATI_KANBAN_CHOICES:
+            for nome in (chiave, etichetta, etichetta.split('. ', 1)[-1]):
+                self.stati[nome.lower()] = chiave
+
+
+# --- TIPI DI DATI IMPORTABILI ---
+class Importatore:
+    modello = None
+    colonne = () # (nome, obbligatoria)
+
+    def costruisci(self, valori, anagrafiche):
+        """Ritorna l'istanza (non salvata) della riga, o solleva ErroreRiga."""
+        raise NotImplementedError
+
+    def salva(self, blocco, risultato, prova):
+        """Inserisce un blocco di (numero di riga, istanza) già validate."""
+        if not prova:
+            oggetti = self.modello.objects.bulk_create([oggetto for _, oggetto in blocco])
+            indice_ricerca.indicizza(self.modello, [oggetto.pk for oggetto in oggetti])
+        risultato.righe_importate += len(blocco)
+
+    def completa(self):
+        """Quello che avrebbero fatto i segnali, una volta sola a fine importazione."""
+
+
+class ImportatoreVendite(Importatore):
+    modello = Vendita
+    colonne = (
+        ('data_vendita', True), ('descrizione', True), ('categoria', True), ('prezzo_vendita', True),
+        ('costo_acquisto', True), ('cliente', False), ('venditore', False),
+        ('flag_finanziamento', False), ('flag_reso', False), ('flag_ritardo_consegna', False),
+    )
+
+    def __init__(self):
+        self.mesi = set()
+
+    def costruisci(self, valori, anagrafiche):
+        riga = _Riga(Vendita, valori)
+        vendita = Vendita(
+            data_vendita=riga.campo('data_vendita', _data, obbligatorio=True),
+            descrizione=riga.campo('descrizione', obbligatorio=True),
+            categoria_id=riga.anagrafica('categoria', anagrafiche.categorie, "categoria", obbligatorio=True),
+            prezzo_vendita=riga.campo('prezzo_vendita', _numero, obbligatorio=True),
+            costo_acquisto=riga.campo('costo_acquisto', _numero, obbligatorio=True),
+            cliente=riga.campo('cliente') or None,
+            venditore_id=riga.anagrafica('venditore', anagrafiche.utenti, "utente"),
+            flag_finanziamento=_booleano(valori.get('flag_finanziamento')),
+            flag_reso=_booleano(valori.get('flag_reso')),
+            flag_ritardo_consegna=_booleano(valori.get('flag_ritardo_consegna')),
+        )
+        riga.verifica()
+        return vendita
+
+    def salva(self, blocco, risultato, prova):
+        super().salva(blocco, risultato, prova)
+        self.mesi.update((v.data_vendita.year, v.data_vendita.month) for _, v in blocco)
+
+    def completa(self):
+        for anno, mese in self.mesi:
+            riepiloghi.segna_mese(riepiloghi.VENDITE, anno, mese)
+
+
+class ImportatoreTrattative(Importatore):
+    modello = Trattativa
+    colonne = (
+        ('titolo', True), ('cliente_nome', True), ('cliente_contatto', False), ('stato', False),
+        ('commerciale', False), ('valore_stimato', False), ('costo_materiali_stimato', False),
+        ('data_creazione', False),
+    )
+
+    def __init__(self):
+        self.mesi = set()
+
+    def costruisci(self, valori, anagrafiche):
+        riga = _Riga(Trattativa, valori)
+        stato = _testo(valori.get('stato'))
+        if stato and stato.lower() not in anagrafiche.stati:
+            riga.errori.append(f"stato: '{stato}' non è uno stato valido.")
+        trattativa = Trattativa(
+            titolo=riga.campo('titolo', obbligatorio=True),
+            cliente_nome=riga.campo('cliente_nome', obbligatorio=True),
+            cliente_contatto=riga.campo('cliente_contatto') or None,
+            stato=anagrafiche.stati.get(stato.lower(), Trattativa.STATO_LEAD),
+            commerciale_id=riga.anagrafica('commerciale', anagrafiche.utenti, "utente"),
+            valore_stimato=riga.campo('valore_stimato', _numero),
+            costo_materiali_stimato=riga.campo('costo_materiali_stimato', _numero),
+        )
+        # auto_now_add sovrascrive la data in bulk_create: si reimposta dopo l'inserimento
+        trattativa.data_importata = riga.campo('data_creazione', _data_ora)
+        riga.verifica()
+        trattativa.calcola_derivati() # save() non viene chiamato
+        return trattativa
+
+    def salva(self, blocco, risultato, prova):
+        super().salva(blocco, risultato, prova)
+        if prova:
+            return
+        con_data = []
+        for _, trattativa in blocco:
+            if trattativa.data_importata:
+                trattativa.data_creazione = trattativa.data_ultimo_aggiornamento = trattativa.data_importata
+                con_data.append(trattativa)
+            self.mesi.add(_mese_locale(trattativa.data_creazione))
+        Trattativa.objects.bulk_update(con_data, ['data_creazione', 'data_ultimo_aggiornamento'])
+        PassaggioStato.objects.bulk_create([
+            PassaggioStato(trattativa=trattativa, stato=trattativa.stato, data=trattativa.data_creazione)
+            for _, trattativa in blocco
+        ])
+
+    def completa(self):
+        for anno, mese in self.mesi:
+            riepiloghi.segna_mese(riepiloghi.TRATTATIVE, anno, mese)
+        cache_dashboard.invalida_a_fine_transazione() # pipeline delle trattative aperte
+        previsioni.invalida_a_fine_transazione()
+
+
+class ImportatoreAttivita(Importatore):
+    modello = Attivita
+    colonne = (
+        ('trattativa', True), ('ruolo', True), ('categoria', True), ('descrizione', True),
+        ('tempo_dedicato_ore', False), ('prezzo_vendita_attivita', False), ('data_attivita', False), ('note', False),
+    )
+
+    def __init__(self):
+        self.trattative = set()
+        self.mesi = set()
+
+    def costruisci(self, valori, anagrafiche):
+        riga = _Riga(Attivita, valori)
+        trattativa_id = _testo(valori.get('trattativa'))
+        if not trattativa_id.isdigit():
+            riga.errori.append("trattativa: serve l'id numerico della trattativa.")
+        attivita = Attivita(
+            trattativa_id=int(trattativa_id) if trattativa_id.isdigit() else None,
+            ruolo_id=riga.anagrafica('ruolo', anagrafiche.ruoli, "ruolo", obbligatorio=True),
+            categoria_id=riga.anagrafica('categoria', anagrafiche.servizi, "categoria servizio", obbligatorio=True),
+            descrizione=riga.campo('descrizione', obbligatorio=True),
+            tempo_dedicato_ore=riga.campo('tempo_dedicato_ore', _numero),
+            prezzo_vendita_attivita=riga.campo('prezzo_vendita_attivita', _numero),
+            data_attivita=riga.campo('data_attivita', _data),
+            note=riga.campo('note') or None,
+        )
+        riga.verifica()
+        return attivita
+
+    def salva(self, blocco, risultato, prova):
+        # Le trattative si verificano per blocco, con una query sola
+        esistenti = set(Trattativa.objects.filter(
+            pk__in={a.trattativa_id for _, a in blocco}
+        ).values_list('id', flat=True))
+        validi = []
+        for numero, attivita in blocco:
+            if attivita.trattativa_id in esistenti:
+                validi.append((numero, attivita))
+            else:
+                risultato.aggiungi_errore(numero, f"trattativa: la trattativa {attivita.trattativa_id} non esiste.")
+        super().salva(validi, risultato, prova)
+        self.trattative.update(a.trattativa_id for _, a in validi)
+        self.mesi.update((a.data_attivita.year, a.data_attivita.month) for _, a in validi)
+
+    def completa(self):
+        ids = sorted(self.trattative)
+        for inizio in range(0, len(ids), ID_PER_QUERY):
+            gruppo = ids[inizio:inizio + ID_PER_QUERY]
+            ricalcola_totali_trattative(Trattativa.objects.filter(pk__in=gruppo))
+            riepiloghi.ricalcola_attivita_trattative(gruppo)
+            # I servizi delle trattative vinte entrano nel riepilogo del mese della vendita
+            for data in Vendita.objects.filter(trattativa_vinta__in=gruppo).dates('data_vendita', 'month'):
+                riepiloghi.segna_data_vendita(data)
+        for anno, mese in self.mesi:
+            riepiloghi.segna_mese(riepiloghi.ATTIVITA, anno, mese)
+        cache_dashboard.invalida_a_fine_transazione()
+        previsioni.invalida_a_fine_transazione() # valori totali delle trattative
+
+
+IMPORTATORI = {
+    'vendite': ImportatoreVendite,
+    'trattative': ImportatoreTrattative,
+    'attivita': ImportatoreAttivita,
+}
+
+def _mese_locale(istante):
+    locale = timezone.localtime(istante)
+    return locale.year, locale.month
+
+
+def importa(file, tipo, formato='csv', prova=False, dimensione_blocco=DIMENSIONE_BLOCCO, su_errore=None, log=None):
+    """
+    Importa le righe del file (percorso o file binario) come `tipo` (vedi IMPORTATORI).
+    `su_errore(numero, messaggio)` riceve tutti gli errori di riga, anche oltre
+    ERRORI_MAX. Solleva ErroreImportazione se il file non è importabile.
+
+    Ogni blocco si salva nella sua transazione: le transazioni iniziano con BEGIN
+    IMMEDIATE (vedi sqlite/base.py) e una sola per tutto il file terrebbe il lock
+    di scrittura per minuti, bloccando Kanban e attività degli altri utenti. Se
+    l'importazione si interrompe a metà, i blocchi già salvati restano (con
+    totali e riepiloghi aggiornati): non è tutto o niente. In prova non si apre
+    nessuna transazione.
+    """
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'rb') as aperto:
+            return importa(aperto, tipo, formato, prova, dimensione_blocco, su_errore, log)
+    importatore = IMPORTATORI[tipo]()
+    log = log or (lambda messaggio: None)
+    risultato = RisultatoImportazione(tipo, prova, su_errore)
+
+    intestazioni, righe = leggi_righe(file, formato)
+    mancanti = [nome for nome, obbligatoria in importatore.colonne if obbligatoria and nome not in intestazioni]
+    if mancanti:
+        raise ErroreImportazione(f"Colonne mancanti: {', '.join(mancanti)}.")
+
+    def salva(blocco):
+        if prova:
+            importatore.salva(blocco, risultato, prova)
+        else:
+            with transaction.atomic():
+                importatore.salva(blocco, risultato, prova)
+
+    anagrafiche = Anagrafiche()
+    try:
+        blocco = []
+        for numero, valori in righe:
+            risultato.righe_lette += 1
+            try:
+                blocco.append((numero, importatore.costruisci(valori, anagrafiche)))
+            except ErroreRiga as e:
+                risultato.aggiungi_errore(numero, str(e))
+            if len(blocco) >= dimensione_blocco:
+                salva(blocco)
+                blocco = []
+                log(f"{risultato.righe_lette} righe lette, {risultato.righe_importate} valide.")
+        if blocco:
+            salva(blocco)
+    finally:
+        # Anche dopo un errore: i blocchi salvati non devono restare senza totali e riepiloghi.
+        # Fuori da una transazione: ricalcoli e riepiloghi prendono il lock a pezzi
+        if not prova and risultato.righe_importate:
+            importatore.completa()
+    return risultato
@@ -0,0 +1,77 @@
+# gestione/impostazioni.py
+"""
+Impostazioni generali (la riga unica di ImpostazioniGenerali) lette senza query.
+
+Ogni processo tiene una copia dei valori insieme alla versione con cui li ha
+letti. La versione sta nella cache condivisa, come in cache_dashboard: un
+salvataggio la cambia (vedi signals.py) e ogni processo rilegge la riga alla
+prima lettura successiva. A regime una lettura costa un get sulla cache e
+nessuna query; con più processi serve un backend di cache condiviso.
+"""
+
+import threading
+import time
+from dataclasses import dataclass, fields
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import ImpostazioniGenerali
+
+CHIAVE_VERSIONE = 'gestione:impostazioni:versione'
+
+
+@dataclass(frozen=True)
+class Impostazioni:
+    """
+    Registro tipizzato delle impostazioni: un attributo per campo di
+    ImpostazioniGenerali, con lo stesso nome. Se la riga non esiste valgono i
+    default del modello.
+    """
+    soglia_alert_margine_servizio: Decimal
+    soglia_alert_giorni_evasione: int
+    soglia_alert_resi_difetti: int
+    soglia_alert_finanziamenti_respinti: int
+
+    @classmethod
+    def da_modello(cls, riga):
+        return cls(**{campo.name: getattr(riga, campo.name) for campo in fields(cls)})
+
+
+_lock = threading.Lock()
+_copia = None # (versione, Impostazioni)
+
+
+def _versione():
+    versione = cache.get(CHIAVE_VERSIONE)
+    if versione is None:
+        # Cache vuota (riavvio, voce espulsa): si parte da una versione nuova
+        cache.add(CHIAVE_VERSIONE, time.time_ns(), None)
+        versione = cache.get(CHIAVE_VERSIONE)
+    return versione
+
+def correnti():
+    """Le impostazioni correnti; il DB si legge solo se la versione è cambiata."""
+    global _copia
+    # La versione si legge prima della riga: se cambia nel frattempo, la copia è già vecchia
+    versione = _versione()
+    copia = _copia
+    if copia is not None and copia[0] == versione:
+        return copia[1]
+    valori = Impostazioni.da_modello(ImpostazioniGenerali.load())
+    with _lock:
+        _copia = (versione, valori)
+    return valori
+
+
+# --- INVALIDAZIONE ---
+def invalida():
+    global _copia
+    with _lock:
+        _copia = None
+    cache.set(CHIAVE_VERSIONE, time.time_ns(), None)
+
+def invalida_a_fine_transazione():
+    """Come invalida(), dopo il commit: gli altri processi rileggono la riga già salvata."""
+    transaction.on_commit(invalida)
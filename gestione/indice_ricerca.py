@@ -0,0 +1,221 @@
+# gestione/indice_ricerca.py
+"""
+Ricerca testuale su trattative, vendite, attività e messaggi della chat, con un
+indice FTS5 di SQLite.
+
+La tabella virtuale TABELLA (migrazione 0012) ha una riga per oggetto, con
+rowid = tipo * BANDA + id: la riga di un oggetto si aggiorna o si cancella per
+rowid, senza scansioni. Si cerca su `titolo` (pesa di più nel punteggio bm25) e
+`testo`; `trattativa_id` serve solo per i link.
+
+Calcolare bm25 costa per ogni riga trovata: una parola comune in un milione di
+messaggi vuol dire secondi. Si ordinano per pertinenza solo le prime
+FINESTRA_PUNTEGGIO righe trovate in ordine di rowid decrescente, cioè prima
+trattative, vendite e attività, poi i messaggi più recenti.
+
+I segnali segnano gli oggetti modificati e l'indice si aggiorna una volta sola a
+fine transazione, come i riepiloghi mensili. bulk_create non manda segnali:
+importazioni e dati sintetici chiamano indicizza() / ricostruisci().
+"""
+
+import re
+import threading
+from collections import defaultdict
+from dataclasses import dataclass
+
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.urls import reverse
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from . import database
+from .models import Trattativa, Vendita, Attivita, MessaggioChat
+
+TABELLA = 'gestione_ricerca'
+
+# Il tipo sta nei bit alti del rowid: i tipi con il numero più alto entrano per primi nella finestra
+MESSAGGIO, ATTIVITA, VENDITA, TRATTATIVA = range(4)
+BANDA = 1 << 40
+TIPI = {Trattativa: TRATTATIVA, Vendita: VENDITA, Attivita: ATTIVITA, MessaggioChat: MESSAGGIO}
+ETICHETTE = {TRATTATIVA: 'Trattativa', VENDITA: 'Vendita', ATTIVITA: 'Attività', MESSAGGIO: 'Messaggio'}
+
+# Campi che finiscono nell'indice: se non cambiano, il salvataggio non tocca l'indice
+CAMPI_INDICIZZATI = {
+    Trattativa: ('titolo', 'cliente_nome', 'cliente_contatto'),
+    Vendita: ('descrizione', 'cliente'),
+    Attivita: ('descrizione', 'note', 'trattativa_id'),
+    MessaggioChat: ('messaggio', 'trattativa_id'),
+}
+
+# Per tipo: (SELECT di rowid, titolo, testo, trattativa_id; colonna dell'id per filtrare)
+_SORGENTI = {
+    TRATTATIVA: (
+        f"SELECT {TRATTATIVA * BANDA} + id, titolo, cliente_nome || ' ' || COALESCE(cliente_contatto, ''), id "
+        "FROM gestione_trattativa", 'id',
+    ),
+    VENDITA: (
+        f"SELECT {VENDITA * BANDA} + v.id, v.descrizione, COALESCE(v.cliente, ''), t.id "
+        "FROM gestione_vendita v LEFT JOIN gestione_trattativa t ON t.vendita_collegata_id = v.id", 'v.id',
+    ),
+    ATTIVITA: (
+        f"SELECT {ATTIVITA * BANDA} + id, descrizione, COALESCE(note, ''), trattativa_id "
+        "FROM gestione_attivita", 'id',
+    ),
+    MESSAGGIO: (
+        f"SELECT {MESSAGGIO * BANDA} + id, '', messaggio, trattativa_id "
+        "FROM gestione_messaggiochat", 'id',
+    ),
+}
+
+ID_PER_QUERY = 500
+PESI_BM25 = (10.0, 1.0) # titolo, testo
+FINESTRA_PUNTEGGIO = 1000 # Righe trovate ordinate per pertinenza (vedi sopra)
+PAROLE_PER_ESTRATTO = 12
+MIN_CARATTERI_PAROLA = 2 # Le parole di una lettera non si cercano
+MAX_PAROLE = 8
+# Segnaposto delle parole trovate: il testo si fa l'escape prima di trasformarli in <mark>
+_INIZIO, _FINE = '\x02', '\x03'
+_PAROLA = re.compile(r'\w+')
+
+_in_attesa = threading.local()
+
+
+# --- AGGIORNAMENTO DELL'INDICE ---
+def _inserisci(cursore, tipo, ids=None):
+    """Scrive (o riscrive) nell'indice gli oggetti `ids` del tipo, tutti se None."""
+    select, colonna_id = _SORGENTI[tipo]
+    sql = f'INSERT OR REPLACE INTO {TABELLA} (rowid, titolo, testo, trattativa_id) {select}'
+    if ids is None:
+        cursore.execute(sql)
+        return
+    ids = list(ids)
+    for inizio in range(0, len(ids), ID_PER_QUERY):
+        gruppo = ids[inizio:inizio + ID_PER_QUERY]
+        cursore.execute(f"{sql} WHERE {colonna_id} IN ({', '.join(['%s'] * len(gruppo))})", gruppo)
+
+def _rimuovi(cursore, rowids):
+    rowids = list(rowids)
+    for inizio in range(0, len(rowids), ID_PER_QUERY):
+        gruppo = rowids[inizio:inizio + ID_PER_QUERY]
+        cursore.execute(f"DELETE FROM {TABELLA} WHERE rowid IN ({', '.join(['%s'] * len(gruppo))})", gruppo)
+
+def indicizza(modello, ids):
+    """Aggiorna subito nell'indice gli oggetti `ids` del modello (es. dopo un bulk_create)."""
+    with connection.cursor() as cursore:
+        _inserisci(cursore, TIPI[modello], ids)
+
+def ricostruisci():
+    """Svuota e ricostruisce l'indice da tutte le tabelle."""
+    with transaction.atomic(), connection.cursor() as cursore:
+        cursore.execute(f'DELETE FROM {TABELLA}')
+        for tipo in _SORGENTI:
+            _inserisci(cursore, tipo)
+        # Fonde i segmenti scritti a blocchi: le ricerche successive leggono meno pagine
+        cursore.execute(f"INSERT INTO {TABELLA} ({TABELLA}) VALUES ('optimize')")
+
+
+# --- CODA DEGLI OGGETTI DA AGGIORNARE ---
+def segna(modello, pk, eliminato=False):
+    """
+    Segna un oggetto da aggiornare (o togliere) nell'indice. L'aggiornamento parte
+    a fine transazione (o subito, in autocommit), così una cancellazione a cascata
+    di 100 messaggi costa una DELETE sola.
+    """
+    if not hasattr(_in_attesa, 'oggetti'):
+        _in_attesa.oggetti = {}
+    _in_attesa.oggetti[(TIPI[modello], pk)] = eliminato
+    transaction.on_commit(_svuota_coda)
+
+def _svuota_coda():
+    oggetti = getattr(_in_attesa, 'oggetti', None)
+    if not oggetti:
+        return
+    _in_attesa.oggetti = {}
+    da_scrivere, da_rimuovere = defaultdict(list), []
+    for (tipo, pk), eliminato in oggetti.items():
+        if eliminato:
+            da_rimuovere.append(tipo * BANDA + pk)
+        else:
+            da_scrivere[tipo].append(pk)
+    with connection.cursor() as cursore:
+        _rimuovi(cursore, da_rimuovere)
+        for tipo, ids in da_scrivere.items():
+            _inserisci(cursore, tipo, ids)
+
+
+# --- RICERCA ---
+@dataclass
+class Risultato:
+    tipo: int
+    oggetto_id: int
+    trattativa_id: int
+    titolo: str # HTML, con le parole trovate in <mark>
+    estratto: str # HTML, come titolo
+    trattativa_titolo: str = ''
+
+    @property
+    def etichetta(self):
+        return ETICHETTE[self.tipo]
+
+    @property
+    def url(self):
+        if self.trattativa_id:
+            return reverse('trattativa_dettaglio', args=[self.trattativa_id])
+        if self.tipo == VENDITA:
+            return reverse('admin:gestione_vendita_change', args=[self.oggetto_id])
+        return None
+
+
+# La sottoquery trova il rowid più basso della finestra: scorrere le righe per rowid non calcola bm25
+SQL_CERCA = (
+    f"SELECT rowid, trattativa_id, highlight({TABELLA}, 0, %s, %s), snippet({TABELLA}, 1, %s, %s, '…', %s) "
+    f"FROM {TABELLA} WHERE {TABELLA} MATCH %s AND rowid >= COALESCE(("
+    f"SELECT rowid FROM {TABELLA} WHERE {TABELLA} MATCH %s ORDER BY rowid DESC LIMIT 1 OFFSET %s"
+    f"), 0) ORDER BY bm25({TABELLA}, %s, %s) LIMIT %s"
+)
+
+def parametri_ricerca(match, limite):
+    return [
+        _INIZIO, _FINE, _INIZIO, _FINE, PAROLE_PER_ESTRATTO,
+        match, match, FINESTRA_PUNTEGGIO - 1, *PESI_BM25, limite,
+    ]
+
+def espressione(testo):
+    """
+    Espressione MATCH di FTS5 per il testo digitato: tutte le parole, l'ultima
+    anche come prefisso (è quella che si sta scrivendo; le parole intere leggono
+    un solo elenco dell'indice, i prefissi lunghi li devono fondere). Ritorna ''
+    se non c'è niente da cercare. Le parole sono tra virgolette: la sintassi di
+    FTS5 nel testo dell'utente non ha effetto.
+    """
+    parole = [p for p in _PAROLA.findall(testo) if len(p) >= MIN_CARATTERI_PAROLA][:MAX_PAROLE]
+    if not parole:
+        return ''
+    return ' '.join([f'"{parola}"' for parola in parole[:-1]] + [f'"{parole[-1]}"*'])
+
+def _html(testo):
+    return mark_safe(escape(testo or '').replace(_INIZIO, '<mark>').replace(_FINE, '</mark>'))
+
+def cerca(testo, limite=20):
+    """Gli oggetti che contengono tutte le parole di `testo`, dal più pertinente (lista di Risultato)."""
+    match = espressione(testo)
+    if not match:
+        return []
+    # Query SQL diretta: il router non la vede, l'alias si sceglie qui (vedi database.py)
+    with connections[database.alias_lettura() or DEFAULT_DB_ALIAS].cursor() as cursore:
+        cursore.execute(SQL_CERCA, parametri_ricerca(match, limite))
+        righe = cursore.fetchall()
+    risultati = [
+        Risultato(
+            tipo=rowid // BANDA, oggetto_id=rowid % BANDA, trattativa_id=trattativa_id,
+            titolo=_html(titolo), estratto=_html(estratto),
+        )
+        for rowid, trattativa_id, titolo, estratto in righe
+    ]
+    # Attività e messaggi si mostrano con il titolo della loro trattativa
+    titoli = dict(Trattativa.objects.filter(
+        pk__in={r.trattativa_id for r in risultati if r.tipo in (ATTIVITA, MESSAGGIO)}
+    ).values_list('id', 'titolo'))
+    for risultato in risultati:
+        risultato.trattativa_titolo = titoli.get(risultato.trattativa_id, '')
+    return risultati
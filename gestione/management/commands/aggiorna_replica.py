@@ -0,0 +1,26 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from gestione import database
+
+
+class Command(BaseCommand):
+    help = "Copia il database principale sul file della replica (alias 'replica', vedi GESTIONE_DB_REPLICA)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ogni', type=float, default=0,
+                            help="Ripete la copia ogni N secondi (simula il ritardo di una replica); 0 = una volta sola.")
+
+    def handle(self, *args, **options):
+        if database.ALIAS_REPLICA not in settings.DATABASES:
+            raise CommandError("Nessuna replica configurata: impostare GESTIONE_DB_REPLICA.")
+        origine = settings.DATABASES['default']['NAME']
+        destinazione = settings.DATABASES[database.ALIAS_REPLICA]['NAME']
+        while True:
+            database.aggiorna_replica(origine, destinazione)
+            self.stdout.write(self.style.SUCCESS(f"Replica aggiornata: {destinazione}"))
+            if not options['ogni']:
+                break
+            time.sleep(options['ogni'])
@@ -0,0 +1,54 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+
+from gestione import benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        "Misura dashboard, kanban, lista, dettaglio ed esportazioni su dataset sintetici "
+        "di varie dimensioni (in un DB di test separato) e salva i risultati in JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dimensioni', default='500,2000,10000',
+            help="Numeri di trattative da provare, separati da virgola (default: 500,2000,10000).",
+        )
+        parser.add_argument('--ripetizioni', type=int, default=5, help="Richieste misurate per ogni vista.")
+        parser.add_argument('--seme', type=int, default=1)
+        parser.add_argument('--output', help="File JSON dei risultati (default: benchmark/<data>_<commit>.json).")
+        parser.add_argument('--confronta', help="JSON di un benchmark precedente da confrontare con questo.")
+
+    def handle(self, *args, **options):
+        try:
+            dimensioni = [int(d) for d in options['dimensioni'].split(',') if d.strip()]
+        except ValueError:
+            raise CommandError("--dimensioni deve essere una lista di numeri, es. 500,2000")
+        precedente = benchmark.carica(options['confronta']) if options['confronta'] else None
+
+        setup_test_environment()
+        # Come `manage.py test`: anche 'lettura' (MIRROR) punta al database di test
+        database = setup_databases(verbosity=0, interactive=False, serialized_aliases=[])
+        try:
+            risultato = benchmark.esegui_benchmark(
+                dimensioni, ripetizioni=options['ripetizioni'], seme=options['seme'], log=self.stdout.write,
+            )
+        finally:
+            teardown_databases(database, verbosity=0)
+            teardown_test_environment()
+
+        percorso = options['output']
+        if not percorso:
+            cartella = os.path.join(settings.BASE_DIR, 'benchmark')
+            os.makedirs(cartella, exist_ok=True)
+            percorso = os.path.join(cartella, f"{risultato['data'].replace(':', '')}_{risultato['commit'] or 'locale'}.json")
+        benchmark.salva(risultato, percorso)
+        self.stdout.write(self.style.SUCCESS(f"Risultati salvati in {percorso}"))
+
+        if precedente:
+            for riga in benchmark.confronta(precedente, risultato):
+                self.stdout.write(riga)
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from gestione import benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        "Confronta le scritture concorrenti su SQLite (thread che spostano card mentre altri "
+        "leggono report) tra il backend di Django e gestione.sqlite, su file temporanei."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scrittori', type=int, default=8)
+        parser.add_argument('--lettori', type=int, default=2)
+        parser.add_argument('--secondi', type=float, default=5.0, help="Durata di ogni prova.")
+        parser.add_argument('--output', help="File JSON dove salvare i risultati.")
+
+    def handle(self, *args, **options):
+        risultato = benchmark.benchmark_concorrenza(
+            options['scrittori'], options['lettori'], options['secondi'], log=self.stdout.write,
+        )
+        if options['output']:
+            benchmark.salva(risultato, options['output'])
+            self.stdout.write(self.style.SUCCESS(f"Risultati salvati in {options['output']}"))
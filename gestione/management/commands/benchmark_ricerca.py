@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from gestione import benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        "Misura la ricerca globale (indice FTS5) su un file temporaneo con un milione di "
+        "messaggi sintetici, per parole comuni, rare e prefissi."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messaggi', type=int, default=1_000_000)
+        parser.add_argument('--ripetizioni', type=int, default=5)
+        parser.add_argument('--seme', type=int, default=1)
+        parser.add_argument('--output', help="File JSON dove salvare i risultati.")
+
+    def handle(self, *args, **options):
+        risultato = benchmark.benchmark_ricerca(
+            options['messaggi'], options['ripetizioni'], options['seme'], log=self.stdout.write,
+        )
+        if options['output']:
+            benchmark.salva(risultato, options['output'])
+            self.stdout.write(self.style.SUCCESS(f"Risultati salvati in {options['output']}"))
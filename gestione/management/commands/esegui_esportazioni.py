@@ -0,0 +1,42 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from gestione import esportazioni
+from gestione.models import EsportazioneJob
+
+
+class Command(BaseCommand):
+    help = "Worker delle esportazioni in background: elabora i job in coda con un pool di thread."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--thread', type=int, default=2, help="Numero di esportazioni eseguite in parallelo.")
+        parser.add_argument('--intervallo', type=float, default=2.0, help="Secondi di attesa tra un controllo della coda e il successivo.")
+        parser.add_argument('--una-volta', action='store_true', help="Elabora i job in coda ed esce.")
+
+    def handle(self, *args, **options):
+        # Job rimasti "in corso" da un worker interrotto tornano in coda
+        ripresi = EsportazioneJob.objects.filter(stato=EsportazioneJob.STATO_IN_CORSO).update(stato=EsportazioneJob.STATO_IN_CODA)
+        if ripresi:
+            self.stdout.write(f"{ripresi} job interrotti rimessi in coda.")
+
+        in_esecuzione = set()
+        with ThreadPoolExecutor(max_workers=options['thread']) as pool:
+            while True:
+                in_esecuzione = {f for f in in_esecuzione if not f.done()}
+                liberi = options['thread'] - len(in_esecuzione)
+                if liberi > 0:
+                    job_ids = list(
+                        EsportazioneJob.objects.filter(stato=EsportazioneJob.STATO_IN_CODA)
+                        .order_by('data_creazione').values_list('pk', flat=True)[:liberi]
+                    )
+                    for job_id in job_ids:
+                        in_esecuzione.add(pool.submit(esportazioni.esegui_job, job_id))
+                        self.stdout.write(f"Avviata esportazione #{job_id}")
+                if options['una_volta'] and not in_esecuzione:
+                    break
+                if not options['una_volta']:
+                    esportazioni.pulisci_job_scaduti()
+                time.sleep(0.1 if options['una_volta'] else options['intervallo'])
+        self.stdout.write(self.style.SUCCESS("Nessun job in coda."))
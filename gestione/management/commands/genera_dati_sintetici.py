@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from gestione.dati_sintetici import genera_dataset
+
+
+class Command(BaseCommand):
+    help = (
+        "Genera un dataset sintetico realistico (utenti, categorie, ruoli, vendite, trattative, "
+        "attività, messaggi, statistiche mensili e budget) inserito in blocco con bulk_create."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--utenti', type=int, default=10, help="Numero di venditori (utenti 'demo_N').")
+        parser.add_argument('--trattative', type=int, default=2000)
+        parser.add_argument('--vendite', type=int, default=2500)
+        parser.add_argument('--max-attivita', type=int, default=6, help="Attività massime per trattativa.")
+        parser.add_argument('--max-messaggi', type=int, default=10, help="Messaggi chat massimi per trattativa.")
+        parser.add_argument('--mesi', type=int, default=24, help="Periodo coperto, a ritroso da oggi.")
+        parser.add_argument('--seme', type=int, default=None, help="Seme casuale, per avere sempre gli stessi dati.")
+        parser.add_argument('--batch', type=int, default=1000, help="Righe per ogni INSERT.")
+
+    def handle(self, *args, **options):
+        conteggi = genera_dataset(
+            num_utenti=options['utenti'], num_trattative=options['trattative'], num_vendite=options['vendite'],
+            max_attivita=options['max_attivita'], max_messaggi=options['max_messaggi'], mesi=options['mesi'],
+            seme=options['seme'], dimensione_batch=options['batch'], log=self.stdout.write,
+        )
+        riepilogo = ', '.join(f"{n} {nome}" for nome, n in conteggi.items())
+        self.stdout.write(self.style.SUCCESS(f"Dataset generato: {riepilogo}."))
@@ -0,0 +1,46 @@
+import csv
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gestione import importazioni
+
+
+class Command(BaseCommand):
+    help = (
+        "Importa vendite, trattative o attività da un file CSV o XLSX, leggendolo una riga alla volta "
+        "e inserendo le righe valide a blocchi. Le righe non valide vengono saltate e segnalate."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('tipo', choices=sorted(importazioni.IMPORTATORI))
+        parser.add_argument('file', help="Percorso del file .csv (UTF-8, separatore ; o ,) o .xlsx.")
+        parser.add_argument('--prova', action='store_true', help="Valida soltanto, senza scrivere nel database.")
+        parser.add_argument('--blocco', type=int, default=importazioni.DIMENSIONE_BLOCCO, help="Righe per ogni INSERT.")
+        parser.add_argument('--errori', help="Scrive qui (CSV) tutti gli errori di riga, non solo i primi.")
+
+    def handle(self, *args, **options):
+        report = open(options['errori'], 'w', newline='', encoding='utf-8') if options['errori'] else None
+        try:
+            su_errore = None
+            if report:
+                writer = csv.writer(report, delimiter=';')
+                writer.writerow(['riga', 'errore'])
+                su_errore = lambda numero, messaggio: writer.writerow([numero, messaggio])
+            risultato = importazioni.importa(
+                options['file'], options['tipo'], formato=importazioni.formato_da_nome(options['file']),
+                prova=options['prova'], dimensione_blocco=options['blocco'], su_errore=su_errore, log=self.stdout.write,
+            )
+        except (importazioni.ErroreImportazione, OSError) as e:
+            raise CommandError(str(e))
+        finally:
+            if report:
+                report.close()
+
+        if not report:
+            for numero, messaggio in risultato.errori[:50]:
+                self.stderr.write(f"Riga {numero}: {messaggio}")
+            if risultato.errori_totali > 50:
+                self.stderr.write(f"... e altri {risultato.errori_totali - 50} errori (usa --errori per il report completo).")
+        azione = "valide (prova, nessuna scrittura)" if risultato.prova else "importate"
+        messaggio = f"{risultato.righe_lette} righe lette, {risultato.righe_importate} {azione}, {risultato.errori_totali} scartate."
+        self.stdout.write(self.style.WARNING(messaggio) if risultato.errori_totali else self.style.SUCCESS(messaggio))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from gestione import riepiloghi
+
+
+class Command(BaseCommand):
+    help = "Ricostruisce da zero le tabelle dei fatti mensili usate da dashboard, report venditori e report attività."
+
+    def handle(self, *args, **options):
+        mesi = riepiloghi.ricostruisci_tutto()
+        self.stdout.write(self.style.SUCCESS(f"Riepiloghi ricostruiti ({mesi} mesi elaborati)."))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from gestione import indice_ricerca
+
+
+class Command(BaseCommand):
+    help = "Ricostruisce da zero l'indice della ricerca globale (trattative, vendite, attività, chat)."
+
+    def handle(self, *args, **options):
+        indice_ricerca.ricostruisci()
+        self.stdout.write(self.style.SUCCESS("Indice di ricerca ricostruito."))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from gestione.calcoli import trattative_con_totali_errati, ricalcola_totali_trattative
+from gestione.models import Trattativa
+
+
+class Command(BaseCommand):
+    help = (
+        "Confronta i totali denormalizzati di ogni trattativa (costo personale, ricavo servizi) "
+        "con quelli calcolati dalle attività. Con --ripara ricalcola quelli errati."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ripara', action='store_true', help="Ricalcola i totali delle trattative non allineate.")
+        parser.add_argument('--tutte', action='store_true', help="Con --ripara, ricalcola tutte le trattative (anche i margini).")
+
+    def handle(self, *args, **options):
+        if options['ripara'] and options['tutte']:
+            aggiornate = ricalcola_totali_trattative()
+            self.stdout.write(self.style.SUCCESS(f"Totali ricalcolati per {aggiornate} trattative."))
+            return
+
+        errate = trattative_con_totali_errati()
+        for pk, costo, costo_atteso, ricavo, ricavo_atteso in errate:
+            self.stdout.write(
+                f"Trattativa {pk}: costo personale {costo} (atteso {costo_atteso}), "
+                f"ricavo servizi {ricavo} (atteso {ricavo_atteso})"
+            )
+        if not errate:
+            self.stdout.write(self.style.SUCCESS("Tutti i totali sono allineati."))
+            return
+        if options['ripara']:
+            aggiornate = ricalcola_totali_trattative(Trattativa.objects.filter(pk__in=[riga[0] for riga in errate]))
+            self.stdout.write(self.style.SUCCESS(f"Totali ricalcolati per {aggiornate} trattative."))
+        else:
+            self.stdout.write(self.style.WARNING(f"{len(errate)} trattative non allineate. Usa --ripara per correggerle."))
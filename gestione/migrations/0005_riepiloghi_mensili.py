@@ -0,0 +1,57 @@
+# Generated by Django 4.2.30 on 2026-10-18 00:21
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('gestione', '0004_remove_attivita_eseguita_da_attivita_ruolo'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RiepilogoVenditeMensile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('anno', models.PositiveIntegerField()),
+                ('mese', models.PositiveIntegerField()),
+                ('tot_venduto_prodotti', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('tot_costo_prodotti', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('numero_vendite', models.PositiveIntegerField(default=0)),
+                ('numero_finanziamenti', models.PositiveIntegerField(default=0)),
+                ('numero_resi', models.PositiveIntegerField(default=0)),
+                ('tot_venduto_servizi', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('costo_personale', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('costo_montaggio', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('giorni_evasione_totali', models.IntegerField(default=0)),
+                ('numero_evasioni', models.PositiveIntegerField(default=0)),
+                ('categoria', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='riepiloghi_vendite', to='gestione.categoriamerceologica')),
+                ('venditore', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='riepiloghi_vendite', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Riepilogo Vendite Mensile',
+                'verbose_name_plural': 'Riepiloghi Vendite Mensili',
+                'ordering': ['-anno', '-mese'],
+            },
+        ),
+        migrations.CreateModel(
+            name='RiepilogoTrattativeMensile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('anno', models.PositiveIntegerField()),
+                ('mese', models.PositiveIntegerField()),
+                ('lead_generati', models.PositiveIntegerField(default=0)),
+                ('preventivi_persi', models.PositiveIntegerField(default=0)),
+                ('commerciale', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='riepiloghi_trattative', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Riepilogo Trattative Mensile',
+                'verbose_name_plural': 'Riepiloghi Trattative Mensili',
+                'ordering': ['-anno', '-mese'],
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-18 00:24
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('gestione', '0005_riepiloghi_mensili'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EsportazioneJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('formato', models.CharField(choices=[('xlsx', 'Excel'), ('csv', 'CSV')], default='xlsx', max_length=10)),
+                ('filtri', models.JSONField(blank=True, default=dict)),
+                ('chiave_filtri', models.CharField(db_index=True, help_text='Hash di formato + filtri, per riusare i file già generati', max_length=64)),
+                ('stato', models.CharField(choices=[('IN_CODA', 'In coda'), ('IN_CORSO', 'In corso'), ('COMPLETATO', 'Completato'), ('ERRORE', 'Errore')], default='IN_CODA', max_length=20)),
+                ('righe_totali', models.PositiveIntegerField(default=0)),
+                ('righe_elaborate', models.PositiveIntegerField(default=0)),
+                ('percorso_file', models.CharField(blank=True, max_length=500)),
+                ('messaggio_errore', models.TextField(blank=True)),
+                ('data_creazione', models.DateTimeField(auto_now_add=True)),
+                ('data_completamento', models.DateTimeField(blank=True, null=True)),
+                ('utente', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Esportazione',
+                'verbose_name_plural': 'Esportazioni',
+                'ordering': ['-data_creazione'],
+            },
+        ),
+    ]
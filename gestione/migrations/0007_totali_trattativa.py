@@ -0,0 +1,79 @@
+# Generated by Django 4.2.30 on 2026-10-18 00:28
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import DecimalField, F, Sum
+from django.db.models.functions import Coalesce
+
+
+def popola_totali(apps, schema_editor):
+    """Calcola i totali delle trattative esistenti a partire dalle attività."""
+    Trattativa = apps.get_model('gestione', 'Trattativa')
+    Attivita = apps.get_model('gestione', 'Attivita')
+    totali = {
+        riga['trattativa_id']: riga
+        for riga in Attivita.objects.values('trattativa_id').annotate(
+            costo=Sum(F('tempo_dedicato_ore') * Coalesce(F('ruolo__costo_orario'), Decimal(0)), output_field=DecimalField()),
+            ricavo=Sum('prezzo_vendita_attivita'),
+        ).order_by()
+    }
+    centesimo = Decimal('0.01')
+    da_aggiornare = []
+    for t in Trattativa.objects.all().iterator():
+        riga = totali.get(t.pk, {})
+        t.costo_personale_totale = Decimal(riga.get('costo') or 0).quantize(centesimo)
+        t.ricavo_servizi_totale = Decimal(riga.get('ricavo') or 0).quantize(centesimo)
+        t.valore_totale_stimato = t.valore_stimato + t.ricavo_servizi_totale
+        t.costo_totale_stimato = t.costo_materiali_stimato + t.costo_personale_totale
+        t.margine_stimato_euro = t.valore_totale_stimato - t.costo_totale_stimato
+        t.margine_stimato_perc = (
+            (t.margine_stimato_euro * 100 / t.valore_totale_stimato).quantize(centesimo)
+            if t.valore_totale_stimato else Decimal(0)
+        )
+        da_aggiornare.append(t)
+    Trattativa.objects.bulk_update(da_aggiornare, [
+        'costo_personale_totale', 'ricavo_servizi_totale', 'valore_totale_stimato',
+        'costo_totale_stimato', 'margine_stimato_euro', 'margine_stimato_perc',
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestione', '0006_esportazionejob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trattativa',
+            name='costo_personale_totale',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12, verbose_name='Costo Personale (€)'),
+        ),
+        migrations.AddField(
+            model_name='trattativa',
+            name='costo_totale_stimato',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12, verbose_name='Costo Totale Stimato (€)'),
+        ),
+        migrations.AddField(
+            model_name='trattativa',
+            name='margine_stimato_euro',
+            field=models.DecimalField(db_index=True, decimal_places=2, default=0, editable=False, max_digits=12, verbose_name='Margine Stimato (€)'),
+        ),
+        migrations.AddField(
+            model_name='trattativa',
+            name='margine_stimato_perc',
+            field=models.DecimalField(db_index=True, decimal_places=2, default=0, editable=False, max_digits=7, verbose_name='Margine Stimato (%)'),
+        ),
+        migrations.AddField(
+            model_name='trattativa',
+            name='ricavo_servizi_totale',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12, verbose_name='Ricavo Servizi (€)'),
+        ),
+        migrations.AddField(
+            model_name='trattativa',
+            name='valore_totale_stimato',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12, verbose_name='Valore Totale Stimato (€)'),
+        ),
+        migrations.RunPython(popola_totali, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 4.2.30 on 2026-10-18 00:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestione', '0007_totali_trattativa'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='attivita',
+            index=models.Index(fields=['trattativa', '-data_attivita'], name='attivita_tratt_data_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='attivita',
+            index=models.Index(fields=['trattativa', 'categoria'], name='attivita_tratt_cat_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='messaggiochat',
+            index=models.Index(fields=['trattativa', 'timestamp'], name='messaggio_tratt_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='riepilogotrattativemensile',
+            index=models.Index(fields=['anno', 'mese'], name='riepilogo_tratt_periodo_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='riepilogovenditemensile',
+            index=models.Index(fields=['anno', 'mese'], name='riepilogo_vendite_periodo_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trattativa',
+            index=models.Index(fields=['stato', '-data_ultimo_aggiornamento', '-id'], name='trattativa_stato_agg_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trattativa',
+            index=models.Index(fields=['-data_ultimo_aggiornamento', '-id'], name='trattativa_agg_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trattativa',
+            index=models.Index(fields=['data_creazione'], name='trattativa_creazione_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trattativa',
+            index=models.Index(condition=models.Q(('stato__in', ['VINTO', 'PERSO']), _negated=True), fields=['stato', 'valore_totale_stimato', 'costo_personale_totale'], name='trattativa_aperte_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vendita',
+            index=models.Index(fields=['data_vendita'], name='vendita_data_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-18 00:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestione', '0008_indici_query'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='trattativa',
+            index=models.Index(fields=['-costo_personale_totale', '-id'], name='trattativa_costo_pers_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trattativa',
+            index=models.Index(fields=['-costo_materiali_stimato', '-id'], name='trattativa_costo_mat_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 01:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestione', '0009_indici_ordinamento_lista'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='impostazionigenerali',
+            name='soglia_alert_finanziamenti_respinti',
+            field=models.PositiveIntegerField(default=3, help_text='Alert in dashboard se i finanziamenti non approvati del periodo superano questo numero.', verbose_name='Soglia Alert Finanziamenti Non Approvati'),
+        ),
+        migrations.AddField(
+            model_name='impostazionigenerali',
+            name='soglia_alert_giorni_evasione',
+            field=models.PositiveIntegerField(default=60, help_text='Alert in dashboard se il tempo medio di evasione degli ordini supera questi giorni.', verbose_name='Soglia Alert Tempo di Evasione (giorni)'),
+        ),
+        migrations.AddField(
+            model_name='impostazionigenerali',
+            name='soglia_alert_resi_difetti',
+            field=models.PositiveIntegerField(default=5, help_text='Alert in dashboard se i resi/difetti del periodo superano questo numero.', verbose_name='Soglia Alert Resi/Difetti'),
+        ),
+    ]
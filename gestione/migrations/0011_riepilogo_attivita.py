@@ -0,0 +1,59 @@
+# Generated by Django 4.2.30 on 2026-10-18 01:09
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import Coalesce, ExtractMonth, ExtractYear
+import django.db.models.deletion
+
+
+def popola_riepilogo(apps, schema_editor):
+    """Costruisce il riepilogo a partire dalle attività esistenti."""
+    Attivita = apps.get_model('gestione', 'Attivita')
+    RiepilogoAttivitaMensile = apps.get_model('gestione', 'RiepilogoAttivitaMensile')
+    celle = Attivita.objects.annotate(
+        anno=ExtractYear('data_attivita'), mese=ExtractMonth('data_attivita'),
+    ).values('anno', 'mese', 'trattativa_id', 'ruolo_id', 'categoria_id').annotate(
+        ore=Coalesce(Sum('tempo_dedicato_ore'), Decimal(0)),
+        ricavo=Coalesce(Sum('prezzo_vendita_attivita'), Decimal(0)),
+        numero=Count('id'),
+    ).order_by()
+    RiepilogoAttivitaMensile.objects.bulk_create((
+        RiepilogoAttivitaMensile(
+            anno=c['anno'], mese=c['mese'], trattativa_id=c['trattativa_id'], ruolo_id=c['ruolo_id'],
+            categoria_id=c['categoria_id'], ore_totali=c['ore'], ricavo_servizi=c['ricavo'], numero_attivita=c['numero'],
+        )
+        for c in celle.iterator()
+    ), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestione', '0010_soglie_impostazioni'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RiepilogoAttivitaMensile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('anno', models.PositiveIntegerField()),
+                ('mese', models.PositiveIntegerField()),
+                ('ore_totali', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('ricavo_servizi', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('numero_attivita', models.PositiveIntegerField(default=0)),
+                ('categoria', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='riepiloghi_attivita', to='gestione.categoriaservizio')),
+                ('ruolo', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='riepiloghi_attivita', to='gestione.ruolocosto')),
+                ('trattativa', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='riepiloghi_attivita', to='gestione.trattativa')),
+            ],
+            options={
+                'verbose_name': 'Riepilogo Attività Mensile',
+                'verbose_name_plural': 'Riepiloghi Attività Mensili',
+                'ordering': ['-anno', '-mese'],
+                'indexes': [models.Index(fields=['anno', 'mese'], name='riepilogo_attiv_periodo_idx'), models.Index(fields=['ruolo', 'anno', 'mese'], name='riepilogo_attiv_ruolo_idx')],
+            },
+        ),
+        migrations.RunPython(popola_riepilogo, migrations.RunPython.noop),
+    ]
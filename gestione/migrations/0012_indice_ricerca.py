@@ -0,0 +1,39 @@
+from django.db import migrations
+
+# Indice FTS5 della ricerca globale (vedi gestione/indice_ricerca.py).
+# rowid = tipo * 2^40 + id (0 messaggio, 1 attività, 2 vendita, 3 trattativa).
+# unicode61 con remove_diacritics: "perche" trova "perché".
+# prefix: indici per i prefissi da 2 a 5 lettere (la parola che si sta scrivendo); senza,
+# un prefisso di una parola comune va fuso da migliaia di voci dell'indice a ogni tasto.
+CREA_INDICE = """
+CREATE VIRTUAL TABLE gestione_ricerca USING fts5(
+    titolo, testo, trattativa_id UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '2 3 4 5'
+)
+"""
+
+POPOLA_INDICE = [
+    """INSERT INTO gestione_ricerca (rowid, titolo, testo, trattativa_id)
+       SELECT 3 * 1099511627776 + id, titolo, cliente_nome || ' ' || COALESCE(cliente_contatto, ''), id FROM gestione_trattativa""",
+    """INSERT INTO gestione_ricerca (rowid, titolo, testo, trattativa_id)
+       SELECT 2 * 1099511627776 + v.id, v.descrizione, COALESCE(v.cliente, ''), t.id
+       FROM gestione_vendita v LEFT JOIN gestione_trattativa t ON t.vendita_collegata_id = v.id""",
+    """INSERT INTO gestione_ricerca (rowid, titolo, testo, trattativa_id)
+       SELECT 1099511627776 + id, descrizione, COALESCE(note, ''), trattativa_id FROM gestione_attivita""",
+    """INSERT INTO gestione_ricerca (rowid, titolo, testo, trattativa_id)
+       SELECT id, '', messaggio, trattativa_id FROM gestione_messaggiochat""",
+    "INSERT INTO gestione_ricerca (gestione_ricerca) VALUES ('optimize')",
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestione', '0011_riepilogo_attivita'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREA_INDICE, 'DROP TABLE gestione_ricerca'),
+        migrations.RunSQL(POPOLA_INDICE, migrations.RunSQL.noop),
+    ]
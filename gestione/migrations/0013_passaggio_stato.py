@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-18 01:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def stato_iniziale(apps, schema_editor):
+    """
+    Per le trattative esistenti si conosce solo lo stato attuale: un passaggio
+    ciascuna, all'ultimo aggiornamento (alla creazione per i lead).
+    """
+    Trattativa = apps.get_model('gestione', 'Trattativa')
+    PassaggioStato = apps.get_model('gestione', 'PassaggioStato')
+    righe = Trattativa.objects.values_list('id', 'stato', 'data_creazione', 'data_ultimo_aggiornamento').order_by()
+    PassaggioStato.objects.bulk_create((
+        PassaggioStato(trattativa_id=pk, stato=stato, data=creazione if stato == 'LEAD' else aggiornamento)
+        for pk, stato, creazione, aggiornamento in righe.iterator()
+    ), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestione', '0012_indice_ricerca'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PassaggioStato',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stato_precedente', models.CharField(blank=True, choices=[('LEAD', '1. Lead/Contatto'), ('APPUNTAMENTO', '2. Appuntamento Fissato'), ('PROGETTAZIONE', '3. Progettazione'), ('PREVENTIVO', '4. Preventivo Inviato'), ('IN_CONSEGNA', '5. In Consegna'), ('IN_MONTAGGIO', '6. In Montaggio'), ('VINTO', '7. Chiuso Vinto'), ('PERSO', '8. Chiuso Perso')], max_length=20, null=True)),
+                ('stato', models.CharField(choices=[('LEAD', '1. Lead/Contatto'), ('APPUNTAMENTO', '2. Appuntamento Fissato'), ('PROGETTAZIONE', '3. Progettazione'), ('PREVENTIVO', '4. Preventivo Inviato'), ('IN_CONSEGNA', '5. In Consegna'), ('IN_MONTAGGIO', '6. In Montaggio'), ('VINTO', '7. Chiuso Vinto'), ('PERSO', '8. Chiuso Perso')], max_length=20)),
+                ('data', models.DateTimeField()),
+                ('trattativa', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='passaggi_stato', to='gestione.trattativa')),
+            ],
+            options={
+                'verbose_name': 'Passaggio di Stato',
+                'verbose_name_plural': 'Passaggi di Stato',
+                'ordering': ['data'],
+                'indexes': [models.Index(fields=['trattativa', '-data'], name='passaggio_tratt_data_idx')],
+            },
+        ),
+        migrations.RunPython(stato_iniziale, migrations.RunPython.noop),
+    ]
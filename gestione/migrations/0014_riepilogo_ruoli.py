@@ -0,0 +1,62 @@
+# Generated by Django 4.2.30 on 2026-10-18 02:04
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import Coalesce, ExtractMonth, ExtractYear
+import django.db.models.deletion
+
+
+def popola_riepilogo(apps, schema_editor):
+    """Costruisce il riepilogo per mese, ruolo e categoria dalle attività esistenti."""
+    Attivita = apps.get_model('gestione', 'Attivita')
+    RiepilogoRuoliMensile = apps.get_model('gestione', 'RiepilogoRuoliMensile')
+    celle = Attivita.objects.annotate(
+        anno=ExtractYear('data_attivita'), mese=ExtractMonth('data_attivita'),
+    ).values('anno', 'mese', 'ruolo_id', 'categoria_id').annotate(
+        ore=Coalesce(Sum('tempo_dedicato_ore'), Decimal(0)),
+        ricavo=Coalesce(Sum('prezzo_vendita_attivita'), Decimal(0)),
+        numero=Count('id'),
+    ).order_by()
+    RiepilogoRuoliMensile.objects.bulk_create((
+        RiepilogoRuoliMensile(
+            anno=c['anno'], mese=c['mese'], ruolo_id=c['ruolo_id'], categoria_id=c['categoria_id'],
+            ore_totali=c['ore'], ricavo_servizi=c['ricavo'], numero_attivita=c['numero'],
+        )
+        for c in celle.iterator()
+    ), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestione', '0013_passaggio_stato'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RiepilogoRuoliMensile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('anno', models.PositiveIntegerField()),
+                ('mese', models.PositiveIntegerField()),
+                ('ore_totali', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('ricavo_servizi', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('numero_attivita', models.PositiveIntegerField(default=0)),
+                ('categoria', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='riepiloghi_ruoli', to='gestione.categoriaservizio')),
+                ('ruolo', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='riepiloghi_ruoli', to='gestione.ruolocosto')),
+            ],
+            options={
+                'verbose_name': 'Riepilogo Ruoli Mensile',
+                'verbose_name_plural': 'Riepiloghi Ruoli Mensili',
+                'ordering': ['-anno', '-mese'],
+                'indexes': [models.Index(fields=['anno', 'mese'], name='riepilogo_ruoli_periodo_idx')],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='attivita',
+            index=models.Index(fields=['data_attivita'], name='attivita_data_idx'),
+        ),
+        migrations.RunPython(popola_riepilogo, migrations.RunPython.noop),
+    ]
@@ -8,6 +8,28 @@ from django.db.models.signals import post_save
 from django.dispatch import receiver 
 import datetime 
 
+
+class TracciaValoriMixin:
+    """
+    Memorizza i valori letti dal database, così i segnali possono sapere
+    cosa è cambiato al salvataggio senza una SELECT in più.
+    """
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._valori_db = dict(zip(field_names, values))
+        return instance
+
+    def valore_precedente(self, attname):
+        """Valore del campo com'era nel DB (None per oggetti nuovi)."""
+        return getattr(self, '_valori_db', {}).get(attname)
+
+    def memorizza_valori_correnti(self):
+        self._valori_db = {
+            f.attname: getattr(self, f.attname)
+            for f in self._meta.concrete_fields if f.attname in self.__dict__
+        }
+
 # --- PROFILO UTENTE (PER COSTO ORARIO) ---
 class ProfiloUtente(models.Model):
     utente = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -20,22 +42,31 @@ class ProfiloUtente(models.Model):
     def __str__(self):
         return f"Profilo di {self.utente.username} - €{self.costo_orario}/ora"
 
-# Segnale corretto per creare/aggiornare il profilo utente
-@receiver(post_save, sender=settings.AUTH_USER_MODEL)
-def create_or_update_user_profile(sender, instance, created, **kwargs):
-    if created:
-        ProfiloUtente.objects.get_or_create(utente=instance)
-    else:
+    @classmethod
+    def di(cls, utente):
+        """
+        Profilo dell'utente, creato se manca (utenti di bulk_create, di fixture o
+        precedenti al segnale). Resta in cache sull'oggetto utente: le letture
+        successive sono gratis. Il profilo si legge sempre da qui, non da
+        utente.profiloutente, che per questi utenti solleverebbe un'eccezione.
+        """
         try:
-            profilo, created = ProfiloUtente.objects.get_or_create(utente=instance)
-            if not created:
-                profilo.save() 
-        except ProfiloUtente.DoesNotExist:
-             ProfiloUtente.objects.create(utente=instance)
+            return utente.profiloutente
+        except cls.DoesNotExist:
+            profilo, _ = cls.objects.get_or_create(utente=utente)
+            utente.profiloutente = profilo
+            return profilo
+
+# Il profilo si crea con l'utente: i salvataggi successivi (es. last_login a ogni
+# login) non lo toccano. Se manca (fixture, bulk_create) lo crea ProfiloUtente.di().
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def create_user_profile(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        ProfiloUtente.objects.create(utente=instance)
 
 
 # --- NUOVO MODELLO PER COSTI RUOLO (SPOSTATO QUI) ---
-class RuoloCosto(models.Model):
+class RuoloCosto(TracciaValoriMixin, models.Model):
     """
     Rappresenta un ruolo o una squadra con un costo orario standard.
     Es. Montatore, Progettista, Commerciale, Squadra Esterna, ecc.
@@ -82,7 +113,7 @@ class CategoriaServizio(models.Model):
     def __str__(self):
         return self.nome
 
-class Vendita(models.Model):
+class Vendita(TracciaValoriMixin, models.Model):
     """
     Rappresenta la VENDITA PRINCIPALE (il prodotto, es. la Cucina).
     """
@@ -100,6 +131,10 @@ class Vendita(models.Model):
         verbose_name = "Vendita (Prodotto)"
         verbose_name_plural = "Vendite (Prodotti)"
         ordering = ['-data_vendita']
+        indexes = [
+            # Ricalcolo dei riepiloghi: intervallo di date del mese
+            models.Index(fields=['data_vendita'], name='vendita_data_idx'),
+        ]
     def __str__(self):
         return f"[{self.data_vendita}] {self.descrizione} - €{self.prezzo_vendita}"
     @property
@@ -148,7 +183,7 @@ class Budget(models.Model):
     def __str__(self):
         return f"Budget {self.categoria} per {self.mese}/{self.anno}"
 
-class Trattativa(models.Model):
+class Trattativa(TracciaValoriMixin, models.Model):
     STATO_LEAD = 'LEAD'
     STATO_APPUNTAMENTO = 'APPUNTAMENTO'
     STATO_PROGETTAZIONE = 'PROGETTAZIONE'
@@ -167,6 +202,7 @@ class Trattativa(models.Model):
         (STATO_VINTO, '7. Chiuso Vinto'),
         (STATO_PERSO, '8. Chiuso Perso'),
     ]
+    STATI_CHIUSI = (STATO_VINTO, STATO_PERSO)
     titolo = models.CharField(max_length=255, verbose_name="Titolo Trattativa")
     cliente_nome = models.CharField(max_length=150, verbose_name="Nome Cliente")
     cliente_contatto = models.CharField(max_length=150, blank=True, null=True, verbose_name="Email/Telefono Cliente")
@@ -185,14 +221,89 @@ class Trattativa(models.Model):
     data_creazione = models.DateTimeField(auto_now_add=True)
     data_ultimo_aggiornamento = models.DateTimeField(auto_now=True)
     vendita_collegata = models.OneToOneField(Vendita, on_delete=models.SET_NULL, null=True, blank=True, verbose_name="Vendita Collegata (se vinta)", related_name="trattativa_vinta")
+
+    # --- TOTALI DENORMALIZZATI (AGGIORNATI DAI SEGNALI SU ATTIVITA / RUOLOCOSTO) ---
+    # Non si modificano a mano: vedi calcoli.applica_delta_servizi / ricalcola_totali_trattative
+    costo_personale_totale = models.DecimalField(max_digits=12, decimal_places=2, default=0, editable=False, verbose_name="Costo Personale (€)")
+    ricavo_servizi_totale = models.DecimalField(max_digits=12, decimal_places=2, default=0, editable=False, verbose_name="Ricavo Servizi (€)")
+    valore_totale_stimato = models.DecimalField(max_digits=12, decimal_places=2, default=0, editable=False, verbose_name="Valore Totale Stimato (€)")
+    costo_totale_stimato = models.DecimalField(max_digits=12, decimal_places=2, default=0, editable=False, verbose_name="Costo Totale Stimato (€)")
+    margine_stimato_euro = models.DecimalField(max_digits=12, decimal_places=2, default=0, editable=False, db_index=True, verbose_name="Margine Stimato (€)")
+    margine_stimato_perc = models.DecimalField(max_digits=7, decimal_places=2, default=0, editable=False, db_index=True, verbose_name="Margine Stimato (%)")
+
+    CAMPI_TOTALI = ('costo_personale_totale', 'ricavo_servizi_totale')
+    CAMPI_DERIVATI = ('valore_totale_stimato', 'costo_totale_stimato', 'margine_stimato_euro', 'margine_stimato_perc')
+
     class Meta:
         verbose_name = "Trattativa"
         verbose_name_plural = "Trattative"
         ordering = ['data_ultimo_aggiornamento']
+        indexes = [
+            # Colonne kanban e "carica altre": stato + ordine per aggiornamento (cursore su id)
+            models.Index(fields=['stato', '-data_ultimo_aggiornamento', '-id'], name='trattativa_stato_agg_idx'),
+            # Lista trattative ed esportazioni (ordine predefinito di get_trattative_annotate)
+            models.Index(fields=['-data_ultimo_aggiornamento', '-id'], name='trattativa_agg_idx'),
+            # Riepilogo trattative (mese di creazione) e filtro per data delle esportazioni
+            models.Index(fields=['data_creazione'], name='trattativa_creazione_idx'),
+            # Ordinamenti per costo della lista trattative (paginazione a cursore su campo + id);
+            # i margini hanno già db_index
+            models.Index(fields=['-costo_personale_totale', '-id'], name='trattativa_costo_pers_idx'),
+            models.Index(fields=['-costo_materiali_stimato', '-id'], name='trattativa_costo_mat_idx'),
+            # Solo trattative aperte (= non in STATI_CHIUSI): pipeline della dashboard e report attività.
+            # Copre anche i totali sommati dalla pipeline, quindi la tabella non viene letta.
+            models.Index(
+                fields=['stato', 'valore_totale_stimato', 'costo_personale_totale'],
+                condition=~models.Q(stato__in=['VINTO', 'PERSO']),
+                name='trattativa_aperte_idx',
+            ),
+        ]
     def __str__(self):
         return f"[{self.get_stato_display()}] {self.titolo} - {self.cliente_nome}"
 
-class Attivita(models.Model):
+    def calcola_derivati(self):
+        """Ricalcola in Python valore, costo e margini a partire dai campi dell'istanza."""
+        self.valore_totale_stimato = Decimal(self.valore_stimato or 0) + Decimal(self.ricavo_servizi_totale or 0)
+        self.costo_totale_stimato = Decimal(self.costo_materiali_stimato or 0) + Decimal(self.costo_personale_totale or 0)
+        self.margine_stimato_euro = self.valore_totale_stimato - self.costo_totale_stimato
+        if self.valore_totale_stimato:
+            self.margine_stimato_perc = (self.margine_stimato_euro * 100 / self.valore_totale_stimato).quantize(Decimal('0.01'))
+        else:
+            self.margine_stimato_perc = Decimal(0)
+
+    def save(self, *args, **kwargs):
+        """
+        In creazione i totali partono da zero e i derivati si calcolano qui.
+        In modifica i totali denormalizzati NON vengono riscritti con i valori
+        (forse vecchi) dell'istanza: li aggiornano solo i segnali con UPDATE mirati.
+        Se cambiano valore o costo del prodotto, i margini si ricalcolano nel DB.
+        """
+        if self._state.adding:
+            self.calcola_derivati()
+            return super().save(*args, **kwargs)
+
+        protetti = set(self.CAMPI_TOTALI + self.CAMPI_DERIVATI)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None:
+            update_fields = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in protetti
+            ]
+        else:
+            update_fields = [f for f in update_fields if f not in protetti]
+        kwargs['update_fields'] = update_fields
+        # Da valutare prima di salvare: i segnali post_save aggiornano i valori memorizzati
+        prodotto_cambiato = any(
+            campo in update_fields and self.valore_precedente(campo) != getattr(self, campo)
+            for campo in ('valore_stimato', 'costo_materiali_stimato')
+        )
+        super().save(*args, **kwargs)
+
+        if prodotto_cambiato:
+            from .calcoli import ricalcola_margini
+            ricalcola_margini(Trattativa.objects.filter(pk=self.pk))
+            self.refresh_from_db(fields=self.CAMPI_TOTALI + self.CAMPI_DERIVATI)
+
+class Attivita(TracciaValoriMixin, models.Model):
     trattativa = models.ForeignKey(Trattativa, on_delete=models.CASCADE, related_name="attivita", verbose_name="Trattativa di Riferimento")
     
     # --- MODIFICA QUI ---
@@ -225,6 +336,14 @@ class Attivita(models.Model):
         verbose_name = "Attività (Servizio/Costo)"
         verbose_name_plural = "Attività (Servizi/Costi)"
         ordering = ['-data_attivita']
+        indexes = [
+            # Attività di una trattativa, nell'ordine della pagina di dettaglio
+            models.Index(fields=['trattativa', '-data_attivita'], name='attivita_tratt_data_idx'),
+            # Costi per categoria di servizio (es. montaggio) delle trattative
+            models.Index(fields=['trattativa', 'categoria'], name='attivita_tratt_cat_idx'),
+            # Ricalcolo di un mese del riepilogo ruoli
+            models.Index(fields=['data_attivita'], name='attivita_data_idx'),
+        ]
     def __str__(self):
         return f"{self.descrizione} ({self.tempo_dedicato_ore}h) per {self.trattativa.titolo}"
 
@@ -237,24 +356,217 @@ class MessaggioChat(models.Model):
         verbose_name = "Messaggio Chat"
         verbose_name_plural = "Messaggi Chat"
         ordering = ['timestamp'] 
+        indexes = [
+            models.Index(fields=['trattativa', 'timestamp'], name='messaggio_tratt_ts_idx'),
+        ]
     def __str__(self):
         return f"Messaggio di {self.utente} su {self.trattativa.titolo}"
 
-# --- MODELLO IMPOSTAZIONI SPOSTATO QUI (O RIMOSSO SE NON PIÙ NECESSARIO) ---
-# L'abbiamo rimosso perché il calcolo live è stato tolto.
-# Se lo vuoi tenere, assicurati che sia definito qui, prima di essere usato.
+# --- STORICO DEGLI STATI (PREVISIONI) ---
+class PassaggioStato(models.Model):
+    """
+    Un cambio di stato di una trattativa (o lo stato iniziale, con
+    stato_precedente vuoto). Lo scrivono i segnali e le operazioni in blocco
+    della Kanban; serve a stimare probabilità e tempi di chiusura (vedi previsioni.py).
+    """
+    trattativa = models.ForeignKey(Trattativa, on_delete=models.CASCADE, related_name="passaggi_stato")
+    stato_precedente = models.CharField(max_length=20, choices=Trattativa.STATI_KANBAN_CHOICES, blank=True, null=True)
+    stato = models.CharField(max_length=20, choices=Trattativa.STATI_KANBAN_CHOICES)
+    data = models.DateTimeField()
+    class Meta:
+        verbose_name = "Passaggio di Stato"
+        verbose_name_plural = "Passaggi di Stato"
+        ordering = ['data']
+        indexes = [
+            # Ingresso nella fase attuale (l'ultimo passaggio) e storico di una trattativa
+            models.Index(fields=['trattativa', '-data'], name='passaggio_tratt_data_idx'),
+        ]
+    def __str__(self):
+        return f"{self.trattativa_id}: {self.stato_precedente or '-'} -> {self.stato}"
+
+# --- TABELLE DEI FATTI PRE-AGGREGATE (DASHBOARD / REPORT VENDITORI) ---
+class RiepilogoVenditeMensile(models.Model):
+    """
+    Una riga per mese / categoria merceologica / venditore con i totali
+    delle vendite e dei servizi collegati.
+    Non si modifica a mano: viene aggiornata dai segnali (vedi riepiloghi.py)
+    e ricostruita con `manage.py ricalcola_riepiloghi`.
+    """
+    anno = models.PositiveIntegerField()
+    mese = models.PositiveIntegerField()
+    categoria = models.ForeignKey(CategoriaMerceologica, on_delete=models.CASCADE, null=True, related_name="riepiloghi_vendite")
+    venditore = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, related_name="riepiloghi_vendite")
+    # Prodotti (da Vendita)
+    tot_venduto_prodotti = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    tot_costo_prodotti = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    numero_vendite = models.PositiveIntegerField(default=0)
+    numero_finanziamenti = models.PositiveIntegerField(default=0)
+    numero_resi = models.PositiveIntegerField(default=0)
+    # Servizi (da Attivita delle trattative vinte con la vendita del mese)
+    tot_venduto_servizi = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    costo_personale = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    costo_montaggio = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    # Tempo di evasione (somma e conteggio, per ricavare la media)
+    giorni_evasione_totali = models.IntegerField(default=0)
+    numero_evasioni = models.PositiveIntegerField(default=0)
+    class Meta:
+        verbose_name = "Riepilogo Vendite Mensile"
+        verbose_name_plural = "Riepiloghi Vendite Mensili"
+        ordering = ['-anno', '-mese']
+        indexes = [
+            models.Index(fields=['anno', 'mese'], name='riepilogo_vendite_periodo_idx'),
+        ]
+    def __str__(self):
+        return f"Riepilogo vendite {self.mese}/{self.anno}"
+
+class RiepilogoTrattativeMensile(models.Model):
+    """
+    Conteggio delle trattative per mese di creazione e commerciale.
+    """
+    anno = models.PositiveIntegerField()
+    mese = models.PositiveIntegerField()
+    commerciale = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, related_name="riepiloghi_trattative")
+    lead_generati = models.PositiveIntegerField(default=0)
+    preventivi_persi = models.PositiveIntegerField(default=0)
+    class Meta:
+        verbose_name = "Riepilogo Trattative Mensile"
+        verbose_name_plural = "Riepiloghi Trattative Mensili"
+        ordering = ['-anno', '-mese']
+        indexes = [
+            models.Index(fields=['anno', 'mese'], name='riepilogo_tratt_periodo_idx'),
+        ]
+    def __str__(self):
+        return f"Riepilogo trattative {self.mese}/{self.anno}"
+
+class RiepilogoAttivitaMensile(models.Model):
+    """
+    Ore e ricavi delle attività per mese (di data_attivita), trattativa, ruolo e
+    categoria di servizio: le tabelle per trattativa del report costi attività
+    quando ci sono filtri. Comprime poco (di solito un'attività per cella): le
+    ripartizioni per ruolo, categoria e mese leggono RiepilogoRuoliMensile.
+    Il costo non è salvato: è ore * costo orario attuale del ruolo, come nel
+    resto dell'applicazione. Si aggiorna per trattativa dai segnali (vedi riepiloghi.py).
+    """
+    anno = models.PositiveIntegerField()
+    mese = models.PositiveIntegerField()
+    trattativa = models.ForeignKey(Trattativa, on_delete=models.CASCADE, related_name="riepiloghi_attivita")
+    # SET_NULL come su Attivita: le righe restano allineate senza ricalcoli
+    ruolo = models.ForeignKey(RuoloCosto, on_delete=models.SET_NULL, null=True, related_name="riepiloghi_attivita")
+    categoria = models.ForeignKey(CategoriaServizio, on_delete=models.SET_NULL, null=True, related_name="riepiloghi_attivita")
+    ore_totali = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    ricavo_servizi = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    numero_attivita = models.PositiveIntegerField(default=0)
+    class Meta:
+        verbose_name = "Riepilogo Attività Mensile"
+        verbose_name_plural = "Riepiloghi Attività Mensili"
+        ordering = ['-anno', '-mese']
+        indexes = [
+            models.Index(fields=['anno', 'mese'], name='riepilogo_attiv_periodo_idx'),
+            models.Index(fields=['ruolo', 'anno', 'mese'], name='riepilogo_attiv_ruolo_idx'),
+        ]
+    def __str__(self):
+        return f"Riepilogo attività {self.mese}/{self.anno}"
+
+class RiepilogoRuoliMensile(models.Model):
+    """
+    Ore e ricavi delle attività per mese, ruolo e categoria di servizio, senza la
+    trattativa: poche righe per mese anche con anni di attività registrate.
+    Ripartizioni per ruolo, categoria e mese del report costi attività; si
+    ricalcola per mese, come il riepilogo vendite.
+    """
+    anno = models.PositiveIntegerField()
+    mese = models.PositiveIntegerField()
+    ruolo = models.ForeignKey(RuoloCosto, on_delete=models.SET_NULL, null=True, related_name="riepiloghi_ruoli")
+    categoria = models.ForeignKey(CategoriaServizio, on_delete=models.SET_NULL, null=True, related_name="riepiloghi_ruoli")
+    ore_totali = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    ricavo_servizi = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    numero_attivita = models.PositiveIntegerField(default=0)
+    class Meta:
+        verbose_name = "Riepilogo Ruoli Mensile"
+        verbose_name_plural = "Riepiloghi Ruoli Mensili"
+        ordering = ['-anno', '-mese']
+        indexes = [
+            models.Index(fields=['anno', 'mese'], name='riepilogo_ruoli_periodo_idx'),
+        ]
+    def __str__(self):
+        return f"Riepilogo ruoli {self.mese}/{self.anno}"
+
+# --- ESPORTAZIONI IN BACKGROUND ---
+class EsportazioneJob(models.Model):
+    """
+    Un'esportazione del report trattative eseguita dal worker
+    (`manage.py esegui_esportazioni`) invece che dentro la richiesta HTTP.
+    """
+    STATO_IN_CODA = 'IN_CODA'
+    STATO_IN_CORSO = 'IN_CORSO'
+    STATO_COMPLETATO = 'COMPLETATO'
+    STATO_ERRORE = 'ERRORE'
+    STATI_CHOICES = [
+        (STATO_IN_CODA, 'In coda'),
+        (STATO_IN_CORSO, 'In corso'),
+        (STATO_COMPLETATO, 'Completato'),
+        (STATO_ERRORE, 'Errore'),
+    ]
+    FORMATO_XLSX = 'xlsx'
+    FORMATO_CSV = 'csv'
+    FORMATI_CHOICES = [(FORMATO_XLSX, 'Excel'), (FORMATO_CSV, 'CSV')]
+    utente = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
+    formato = models.CharField(max_length=10, choices=FORMATI_CHOICES, default=FORMATO_XLSX)
+    filtri = models.JSONField(default=dict, blank=True)
+    chiave_filtri = models.CharField(max_length=64, db_index=True, help_text="Hash di formato + filtri, per riusare i file già generati")
+    stato = models.CharField(max_length=20, choices=STATI_CHOICES, default=STATO_IN_CODA)
+    righe_totali = models.PositiveIntegerField(default=0)
+    righe_elaborate = models.PositiveIntegerField(default=0)
+    percorso_file = models.CharField(max_length=500, blank=True)
+    messaggio_errore = models.TextField(blank=True)
+    data_creazione = models.DateTimeField(auto_now_add=True)
+    data_completamento = models.DateTimeField(null=True, blank=True)
+    class Meta:
+        verbose_name = "Esportazione"
+        verbose_name_plural = "Esportazioni"
+        ordering = ['-data_creazione']
+    def __str__(self):
+        return f"Esportazione #{self.pk} ({self.formato}) - {self.get_stato_display()}"
+    @property
+    def progresso(self) -> int:
+        if self.stato == self.STATO_COMPLETATO:
+            return 100
+        if not self.righe_totali:
+            return 0
+        return min(99, int(self.righe_elaborate * 100 / self.righe_totali))
+    @property
+    def terminato(self) -> bool:
+        return self.stato in (self.STATO_COMPLETATO, self.STATO_ERRORE)
+
+# --- MODELLO IMPOSTAZIONI ---
+# Letto attraverso gestione/impostazioni.py, che ne tiene una copia per processo.
 class ImpostazioniGenerali(models.Model):
     """
     Un modello Singleton (può esistere solo 1 riga) per le impostazioni globali.
-    Viene creato automaticamente con PK=1.
+    Si salva sempre con PK=1; finché non la si salva valgono i default dei campi.
     """
     soglia_alert_margine_servizio = models.DecimalField(
         max_digits=5, 
         decimal_places=2, 
-        default=20.00, 
+        default=Decimal('20.00'), # Decimal: l'istanza non salvata di load() si usa nei calcoli
         verbose_name="Soglia Alert Margine Servizi (%)",
         help_text="Es. 20. Se il prezzo di un servizio è sotto [Costo Personale + 20%], mostra un alert."
     )
+    soglia_alert_giorni_evasione = models.PositiveIntegerField(
+        default=60,
+        verbose_name="Soglia Alert Tempo di Evasione (giorni)",
+        help_text="Alert in dashboard se il tempo medio di evasione degli ordini supera questi giorni."
+    )
+    soglia_alert_resi_difetti = models.PositiveIntegerField(
+        default=5,
+        verbose_name="Soglia Alert Resi/Difetti",
+        help_text="Alert in dashboard se i resi/difetti del periodo superano questo numero."
+    )
+    soglia_alert_finanziamenti_respinti = models.PositiveIntegerField(
+        default=3,
+        verbose_name="Soglia Alert Finanziamenti Non Approvati",
+        help_text="Alert in dashboard se i finanziamenti non approvati del periodo superano questo numero."
+    )
 
     class Meta:
         verbose_name = "Impostazioni Generali"
@@ -264,14 +576,11 @@ class ImpostazioniGenerali(models.Model):
         return "Impostazioni Generali"
 
     def save(self, *args, **kwargs):
-        # Forza l'esistenza di una sola riga con PK=1
+        # Forza l'esistenza di una sola riga con PK=1: non possono nascerne altre
         self.pk = 1 
         super(ImpostazioniGenerali, self).save(*args, **kwargs)
-        # Elimina eventuali altre righe create per errore
-        ImpostazioniGenerali.objects.exclude(pk=1).delete()
 
     @classmethod
     def load(cls):
-        # Metodo helper per caricare l'unica istanza
-        obj, created = cls.objects.get_or_create(pk=1)
-        return obj
\ No newline at end of file
+        """L'unica istanza; se non è mai stata salvata, una nuova con i default (senza scrivere)."""
+        return cls.objects.filter(pk=1).first() or cls(pk=1)
\ No newline at end of file
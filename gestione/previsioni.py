@@ -0,0 +1,347 @@
+# gestione/previsioni.py
+"""
+Previsione della pipeline: probabilità di vincita di ogni trattativa aperta e
+valore atteso delle chiusure mese per mese.
+
+Il modello si stima dalle trattative chiuse negli ultimi STORICO_GIORNI e dal
+loro storico degli stati (PassaggioStato):
+- probabilità per fase: tra le chiuse arrivate almeno a quella fase, la quota di vinte;
+- correzione per commerciale: il suo tasso di vincita diviso quello generale;
+- tempi: per ogni fase, i giorni dall'ingresso nella fase alla vincita.
+I tassi vengono tirati verso quello generale come se ci fossero PESO_PRIOR
+chiuse in più: una fase o un commerciale con poche trattative non finiscono a 0% o 100%.
+
+Le trattative aperte si valutano tutte insieme con NumPy: probabilità = tasso
+della fase * correzione del commerciale; il valore atteso si divide sui mesi con
+la distribuzione dei tempi della fase, tolti i giorni già passati nella fase.
+
+Cache: il modello cambia solo quando una trattativa si chiude (o si riapre) e ha
+una versione, come la dashboard. La previsione tiene una riga per trattativa
+aperta: quando una trattativa si sposta o cambia valore, a fine transazione si
+rivaluta solo quella. Due processi che aggiornano insieme possono perdere un
+aggiornamento: per questo la voce dura al massimo DURATA_PREVISIONE.
+"""
+
+import datetime
+import threading
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .calcoli import filtro_trattative_aperte
+from .models import Trattativa, PassaggioStato
+from .riepiloghi import intervallo_mese_aware
+
+# Fasi aperte, nell'ordine della Kanban
+FASI = [stato for stato, _ in Trattativa.STATI_KANBAN_CHOICES if stato not in Trattativa.STATI_CHIUSI]
+INDICE_FASE = {stato: i for i, stato in enumerate(FASI)}
+
+STORICO_GIORNI = 730 # Trattative chiuse usate per stimare il modello
+PESO_PRIOR = 20 # Chiuse "fittizie" al tasso generale aggiunte a ogni fase e commerciale
+MIN_CAMPIONI_TEMPI = 10 # Sotto, per i tempi della fase si usano quelli dalla creazione alla vincita
+ORIZZONTE_MESI = 6 # Mesi previsti, corrente compreso; il resto va in "oltre"
+SECONDI_GIORNO = 86400
+
+PREFISSO = 'gestione:previsioni'
+CHIAVE_VERSIONE = f'{PREFISSO}:versione'
+CHIAVE_MODELLO = f'{PREFISSO}:modello'
+DURATA_MODELLO = 60 * 60 * 24 # Anche senza chiusure il modello si ristima ogni giorno
+DURATA_PREVISIONE = 60 * 15
+
+_in_attesa = threading.local()
+
+
+def _giorni(istanti):
+    """Datetime aware -> array di giorni (float) dall'epoch."""
+    return np.fromiter((istante.timestamp() for istante in istanti), float, len(istanti)) / SECONDI_GIORNO
+
+def _tasso(vinte, totali, base):
+    return (vinte + PESO_PRIOR * base) / (totali + PESO_PRIOR)
+
+
+# --- STIMA DEL MODELLO ---
+@dataclass
+class Modello:
+    tasso_base: float
+    trattative_chiuse: int
+    probabilita_fase: np.ndarray # per indice di FASI
+    chiuse_per_fase: np.ndarray # chiuse arrivate almeno alla fase
+    correzione_commerciale: dict # id commerciale (None compreso) -> moltiplicatore
+    tempi_fase: list # per fase: giorni dall'ingresso alla vincita, ordinati
+    giorni_in_fase: np.ndarray # mediana della permanenza nella fase, nan se non ci sono dati
+
+def addestra(adesso=None):
+    """Stima il Modello dalle trattative chiuse di recente (due query)."""
+    adesso = adesso or timezone.now()
+    chiuse = Trattativa.objects.filter(
+        stato__in=Trattativa.STATI_CHIUSI, data_ultimo_aggiornamento__gte=adesso - datetime.timedelta(days=STORICO_GIORNI),
+    )
+    righe = list(chiuse.values_list('id', 'stato', 'commerciale_id', 'data_creazione', 'data_ultimo_aggiornamento').order_by('id'))
+    passaggi = list(PassaggioStato.objects.filter(trattativa__in=chiuse).values_list('trattativa_id', 'stato', 'data').order_by())
+
+    n = len(righe)
+    ids = np.fromiter((r[0] for r in righe), np.int64, n)
+    vinta = np.fromiter((r[1] == Trattativa.STATO_VINTO for r in righe), bool, n)
+    creazione = _giorni([r[3] for r in righe])
+    base = (vinta.sum() + 1) / (n + 2) # senza storico: 50%
+
+    # Passaggi -> riga della trattativa; fase -1 per gli stati chiusi
+    trattativa = np.fromiter((p[0] for p in passaggi), np.int64, len(passaggi))
+    riga = np.searchsorted(ids, trattativa)
+    # Le due query non sono una lettura unica: i passaggi di una trattativa chiusa
+    # tra la prima e la seconda non hanno una riga e si scartano
+    trovati = riga < n
+    trovati[trovati] = ids[riga[trovati]] == trattativa[trovati]
+    riga = riga[trovati]
+    fase = np.fromiter((INDICE_FASE.get(p[1], -1) for p in passaggi), np.intp, len(passaggi))[trovati]
+    giorno = _giorni([p[2] for p in passaggi])[trovati]
+
+    # Chiusura: l'ultimo passaggio (l'ingresso nello stato chiuso), altrimenti l'ultimo aggiornamento
+    chiusura = np.full(n, -np.inf)
+    np.maximum.at(chiusura, riga, giorno)
+    chiusura = np.where(np.isfinite(chiusura), chiusura, _giorni([r[4] for r in righe]))
+
+    # Fase più avanzata raggiunta (-1 = storico sconosciuto: conta solo nei tassi generali)
+    aperta = fase >= 0
+    fase_max = np.full(n, -1)
+    np.maximum.at(fase_max, riga[aperta], fase[aperta])
+    raggiunta = fase_max >= 0
+    # Chi è arrivato alla fase k è passato anche dalle precedenti: somme cumulate dalla fine
+    chiuse_per_fase = np.cumsum(np.bincount(fase_max[raggiunta], minlength=len(FASI))[::-1])[::-1]
+    vinte_per_fase = np.cumsum(np.bincount(fase_max[raggiunta & vinta], minlength=len(FASI))[::-1])[::-1]
+
+    commerciali = np.fromiter((-1 if r[2] is None else r[2] for r in righe), np.int64, n)
+    chiavi, indice = np.unique(commerciali, return_inverse=True)
+    tassi_commerciali = _tasso(np.bincount(indice, weights=vinta, minlength=len(chiavi)), np.bincount(indice, minlength=len(chiavi)), base)
+    correzione = {(None if chiave == -1 else int(chiave)): float(t / base) for chiave, t in zip(chiavi, tassi_commerciali)}
+
+    # Ingresso (primo passaggio) in ogni fase, per trattativa
+    ingresso = np.full((n, len(FASI)), np.inf)
+    np.minimum.at(ingresso, (riga[aperta], fase[aperta]), giorno[aperta])
+    generali = np.sort(chiusura[vinta] - creazione[vinta])
+    tempi_fase = []
+    for k in range(len(FASI)):
+        ingressi = ingresso[vinta, k]
+        tempi = np.sort(chiusura[vinta][np.isfinite(ingressi)] - ingressi[np.isfinite(ingressi)])
+        tempi_fase.append(tempi if len(tempi) >= MIN_CAMPIONI_TEMPI else generali)
+
+    # Permanenza: dal passaggio nella fase al passaggio successivo della stessa trattativa
+    ordine = np.lexsort((giorno, riga))
+    r, f, g = riga[ordine], fase[ordine], giorno[ordine]
+    seguito = (r[1:] == r[:-1]) & (f[:-1] >= 0)
+    permanenze, fasi_permanenze = g[1:][seguito] - g[:-1][seguito], f[:-1][seguito]
+    giorni_in_fase = np.array([
+        np.median(permanenze[fasi_permanenze == k]) if (fasi_permanenze == k).any() else np.nan
+        for k in range(len(FASI))
+    ])
+
+    return Modello(
+        tasso_base=float(base), trattative_chiuse=n,
+        probabilita_fase=_tasso(vinte_per_fase, chiuse_per_fase, base), chiuse_per_fase=chiuse_per_fase,
+        correzione_commerciale=correzione, tempi_fase=tempi_fase, giorni_in_fase=giorni_in_fase,
+    )
+
+
+# --- VALUTAZIONE DELLE TRATTATIVE APERTE ---
+def _mesi(adesso):
+    """(anno, mese) dei mesi previsti e, per ognuno, i giorni da `adesso` alla sua fine."""
+    locale = timezone.localtime(adesso)
+    mesi, limiti = [], []
+    for n in range(ORIZZONTE_MESI):
+        anno, mese = divmod(locale.year * 12 + locale.month - 1 + n, 12)
+        mesi.append((anno, mese + 1))
+        limiti.append((intervallo_mese_aware(anno, mese + 1)[1] - adesso).total_seconds() / SECONDI_GIORNO)
+    return mesi, np.array(limiti)
+
+def ripartizione(tempi, eta, limiti):
+    """
+    Quota di chiusura in ogni mese (colonne: i mesi di `limiti`, poi "oltre") per
+    trattative nella fase da `eta` giorni, con i tempi ordinati della fase: la
+    distribuzione empirica ristretta ai tempi più lunghi di `eta`.
+    Chi è già oltre tutti i tempi osservati è in ritardo: chiude nel mese corrente.
+    """
+    quote = np.zeros((len(eta), len(limiti) + 1))
+    if not len(tempi):
+        quote[:, -1] = 1 # Nessuna vincita da cui stimare i tempi
+        return quote
+    gia_passati = np.searchsorted(tempi, eta, side='right')
+    entro = np.searchsorted(tempi, eta[:, None] + limiti[None, :], side='right')
+    rimasti = len(tempi) - gia_passati
+    cumulate = (entro - gia_passati[:, None]) / np.maximum(rimasti, 1)[:, None]
+    quote[:, :-1] = np.diff(cumulate, axis=1, prepend=0)
+    quote[:, -1] = 1 - cumulate[:, -1]
+    in_ritardo = rimasti == 0
+    quote[in_ritardo] = 0
+    quote[in_ritardo, 0] = 1
+    return quote
+
+def _trattative_aperte(ids=None):
+    """(id, stato, commerciale, valore, ingresso nella fase) delle trattative aperte, in una query."""
+    ingresso = PassaggioStato.objects.filter(trattativa=OuterRef('pk')).order_by('-data', '-id').values('data')[:1]
+    trattative = Trattativa.objects.filter(filtro_trattative_aperte())
+    if ids is not None:
+        trattative = trattative.filter(pk__in=ids)
+    return list(trattative.annotate(
+        ingresso_fase=Coalesce(Subquery(ingresso), 'data_ultimo_aggiornamento'),
+    ).values_list('id', 'stato', 'commerciale_id', 'valore_totale_stimato', 'ingresso_fase').order_by())
+
+def valuta(modello, righe, adesso, limiti):
+    """
+    Ritorna (ids, probabilità, valori, contributi) per le righe di
+    _trattative_aperte(); contributi[i, m] è il valore atteso della trattativa i
+    nel mese m (ultima colonna: oltre l'orizzonte). Le righe con uno stato che
+    non è una fase della Kanban (dati sporchi) si saltano.
+    """
+    righe = [r for r in righe if r[1] in INDICE_FASE]
+    n = len(righe)
+    ids = np.fromiter((r[0] for r in righe), np.int64, n)
+    fase = np.fromiter((INDICE_FASE[r[1]] for r in righe), np.intp, n)
+    correzione = np.fromiter((modello.correzione_commerciale.get(r[2], 1.0) for r in righe), float, n)
+    valori = np.fromiter((float(r[3]) for r in righe), float, n)
+    eta = np.maximum(adesso.timestamp() / SECONDI_GIORNO - _giorni([r[4] for r in righe]), 0)
+
+    probabilita = np.clip(modello.probabilita_fase[fase] * correzione, 0, 1)
+    quote = np.zeros((n, len(limiti) + 1))
+    for k, tempi in enumerate(modello.tempi_fase): # un ciclo per fase, non per trattativa
+        nella_fase = fase == k
+        if nella_fase.any():
+            quote[nella_fase] = ripartizione(tempi, eta[nella_fase], limiti)
+    return ids, probabilita, valori, (probabilita * valori)[:, None] * quote
+
+def calcola(modello, versione, adesso=None):
+    adesso = adesso or timezone.now()
+    mesi, limiti = _mesi(adesso)
+    ids, probabilita, valori, contributi = valuta(modello, _trattative_aperte(), adesso, limiti)
+    return {
+        'versione': versione, 'adesso': adesso, 'scadenza': time.time() + DURATA_PREVISIONE,
+        'mesi': mesi, 'limiti': limiti, 'ids': ids, 'probabilita': probabilita, 'valori': valori, 'contributi': contributi,
+    }
+
+
+# --- CACHE ---
+def _chiave_previsione(adesso):
+    """I mesi previsti partono da quello corrente: la chiave cambia da sola a inizio mese."""
+    locale = timezone.localtime(adesso)
+    return f'{PREFISSO}:previsione:{locale.year}-{locale.month:02d}'
+
+def _versione(trovati):
+    versione = trovati.get(CHIAVE_VERSIONE)
+    if versione is None:
+        cache.add(CHIAVE_VERSIONE, time.time_ns(), None)
+        versione = cache.get(CHIAVE_VERSIONE)
+    return versione
+
+def previsione():
+    """(Modello, previsione) dalla cache; le voci mancanti o vecchie si ricalcolano."""
+    adesso = timezone.now()
+    chiave = _chiave_previsione(adesso)
+    trovati = cache.get_many([CHIAVE_VERSIONE, CHIAVE_MODELLO, chiave])
+    versione = _versione(trovati)
+    voce = trovati.get(CHIAVE_MODELLO)
+    if voce is not None and voce[0] == versione:
+        modello = voce[1]
+    else:
+        modello = addestra(adesso)
+        cache.set(CHIAVE_MODELLO, (versione, modello), DURATA_MODELLO)
+    dati = trovati.get(chiave)
+    if dati is None or dati['versione'] != versione:
+        dati = calcola(modello, versione, adesso)
+        cache.set(chiave, dati, DURATA_PREVISIONE)
+    return modello, dati
+
+def aggiorna(ids):
+    """Rivaluta nella previsione in cache solo le trattative `ids` (tolte se non più aperte)."""
+    trovati = cache.get_many([CHIAVE_VERSIONE, CHIAVE_MODELLO])
+    voce = trovati.get(CHIAVE_MODELLO)
+    if voce is None or voce[0] != trovati.get(CHIAVE_VERSIONE):
+        return # La prossima lettura ricalcola tutto
+    chiave = _chiave_previsione(timezone.now())
+    dati = cache.get(chiave)
+    if dati is None or dati['versione'] != voce[0]:
+        return
+    nuove = valuta(voce[1], _trattative_aperte(ids), dati['adesso'], dati['limiti'])
+    restano = ~np.isin(dati['ids'], list(ids))
+    for nome, valori in zip(('ids', 'probabilita', 'valori', 'contributi'), nuove):
+        dati[nome] = np.concatenate([dati[nome][restano], valori])
+    durata = dati['scadenza'] - time.time()
+    if durata > 0:
+        cache.set(chiave, dati, durata)
+
+def invalida():
+    """Nuova versione: modello e previsione si ricalcolano alla prossima lettura."""
+    cache.set(CHIAVE_VERSIONE, time.time_ns(), None)
+
+
+# --- CODA DELLE TRATTATIVE DA RIVALUTARE ---
+def chiusura_cambiata(precedente, stato):
+    """True se la trattativa entra in uno stato chiuso o ne esce (None = appena creata): cambia il modello."""
+    return (precedente in Trattativa.STATI_CHIUSI) != (stato in Trattativa.STATI_CHIUSI)
+
+def segna(trattativa_id, chiusura=False):
+    """
+    Segna una trattativa da rivalutare a fine transazione (o subito, in
+    autocommit). Con `chiusura` (è entrata o uscita da uno stato chiuso) cambia
+    il modello: si ricalcola tutto.
+    """
+    if not hasattr(_in_attesa, 'ids'):
+        _in_attesa.ids, _in_attesa.chiusura = set(), False
+    _in_attesa.ids.add(trattativa_id)
+    _in_attesa.chiusura = _in_attesa.chiusura or chiusura
+    transaction.on_commit(_svuota_coda)
+
+def invalida_a_fine_transazione():
+    """Per le scritture in blocco (importazioni, dati sintetici): si ricalcola tutto."""
+    segna(None, chiusura=True)
+
+def _svuota_coda():
+    if not hasattr(_in_attesa, 'ids'):
+        return # già svuotata da una callback precedente della stessa transazione
+    ids, chiusura = _in_attesa.ids, _in_attesa.chiusura
+    del _in_attesa.ids, _in_attesa.chiusura
+    if chiusura:
+        invalida()
+    else:
+        aggiorna(ids)
+
+
+# --- RIEPILOGO (DASHBOARD, API) ---
+def riepilogo(trattative=False):
+    """Previsione per mese e statistiche del modello, con tipi semplici (JSON, cache della dashboard)."""
+    modello, dati = previsione()
+    per_mese = dati['contributi'].sum(axis=0)
+    risultato = {
+        'calcolata_il': dati['adesso'].isoformat(),
+        'trattative_aperte': len(dati['ids']),
+        'valore_pipeline': round(float(dati['valori'].sum()), 2),
+        'valore_ponderato': round(float(per_mese.sum()), 2),
+        'mesi': [
+            {'anno': anno, 'mese': mese, 'etichetta': f"{mese:02d}/{anno}", 'valore_atteso': round(float(valore), 2)}
+            for (anno, mese), valore in zip(dati['mesi'], per_mese[:-1])
+        ],
+        'oltre_orizzonte': round(float(per_mese[-1]), 2),
+        'tasso_base': round(modello.tasso_base, 4),
+        'trattative_chiuse': modello.trattative_chiuse,
+        'fasi': [
+            {
+                'stato': stato, 'probabilita': round(float(modello.probabilita_fase[k]), 4),
+                'chiuse': int(modello.chiuse_per_fase[k]),
+                'giorni_in_fase': None if np.isnan(modello.giorni_in_fase[k]) else round(float(modello.giorni_in_fase[k]), 1),
+            }
+            for k, stato in enumerate(FASI)
+        ],
+    }
+    if trattative:
+        ordine = np.argsort(-dati['contributi'].sum(axis=1))
+        risultato['trattative'] = [
+            {'id': int(dati['ids'][i]), 'probabilita': round(float(dati['probabilita'][i]), 4),
+             'valore_atteso': round(float(dati['contributi'][i].sum()), 2)}
+            for i in ordine
+        ]
+    return risultato
@@ -0,0 +1,215 @@
+# gestione/profilazione.py
+"""
+Profilazione delle richieste: numero e tempo delle query SQL, query duplicate,
+tempo di render dei template e latenza totale, per vista.
+
+Solo una frazione delle richieste (PROFILAZIONE_CAMPIONAMENTO) viene misurata,
+così il middleware può restare attivo in produzione. Ogni richiesta misurata
+diventa una riga JSON nel log `gestione.profilazione` (file a rotazione, vedi
+LOGGING in settings) e riceve l'header Server-Timing; le query più lente di
+PROFILAZIONE_SOGLIA_QUERY_LENTA_MS finiscono anche nel log `gestione.query_lente`.
+"""
+
+import contextlib
+import contextvars
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import random
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import connections
+from django.template.backends.django import DjangoTemplates, Template
+
+log_profilazione = logging.getLogger('gestione.profilazione')
+log_query_lente = logging.getLogger('gestione.query_lente')
+
+# Misura della richiesta in corso (None se la richiesta non è campionata)
+_misura_corrente = contextvars.ContextVar('misura_profilazione', default=None)
+
+LUNGHEZZA_MAX_SQL = 1000 # Le query lente vengono troncate nel log
+
+
+class Misura:
+    """Dati raccolti durante una richiesta campionata."""
+
+    def __init__(self):
+        self.query = [] # (sql, params, millisecondi)
+        self.ms_template = 0.0
+        self._profondita_template = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        # Usata come execute_wrapper sulle connessioni al DB
+        inizio = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.query.append((sql, params, (time.perf_counter() - inizio) * 1000))
+
+    @property
+    def ms_sql(self):
+        return sum(ms for _, _, ms in self.query)
+
+    def query_duplicate(self):
+        """Query ripetute identiche (stesso SQL e stessi parametri): si potevano riusare."""
+        conteggi = Counter((sql, repr(params)) for sql, params, _ in self.query)
+        return sum(n - 1 for n in conteggi.values())
+
+    def query_simili(self):
+        """Query con lo stesso SQL e parametri diversi: il segno tipico di un N+1."""
+        conteggi = Counter(sql for sql, _, _ in self.query)
+        return sum(n - 1 for n in conteggi.values())
+
+
+class ProfilazioneMiddleware:
+    """
+    Misura le richieste campionate. Va messo per primo in MIDDLEWARE, così la
+    latenza comprende anche gli altri middleware. Le risposte in streaming sono
+    misurate fino all'inizio dell'invio.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if random.random() >= settings.PROFILAZIONE_CAMPIONAMENTO:
+            return self.get_response(request)
+
+        misura = Misura()
+        token = _misura_corrente.set(misura)
+        inizio = time.perf_counter()
+        try:
+            with contextlib.ExitStack() as stack:
+                for connessione in connections.all():
+                    stack.enter_context(connessione.execute_wrapper(misura))
+                response = self.get_response(request)
+        finally:
+            _misura_corrente.reset(token)
+        ms_totale = (time.perf_counter() - inizio) * 1000
+
+        vista = request.resolver_match.view_name if request.resolver_match else None
+        response['Server-Timing'] = ', '.join([
+            f'sql;dur={misura.ms_sql:.1f};desc="{len(misura.query)} query"',
+            f'tpl;dur={misura.ms_template:.1f}',
+            f'total;dur={ms_totale:.1f}',
+        ])
+        soglia = settings.PROFILAZIONE_SOGLIA_QUERY_LENTA_MS
+        query_lente = [(sql, ms) for sql, _, ms in misura.query if ms >= soglia]
+        for sql, ms in query_lente:
+            log_query_lente.warning(json.dumps({
+                'data': datetime.datetime.now().isoformat(timespec='seconds'),
+                'vista': vista, 'ms': round(ms, 2), 'sql': sql[:LUNGHEZZA_MAX_SQL],
+            }, ensure_ascii=False))
+        log_profilazione.info(json.dumps({
+            'data': datetime.datetime.now().isoformat(timespec='seconds'),
+            'vista': vista,
+            'metodo': request.method,
+            'percorso': request.path,
+            'stato': response.status_code,
+            'ms_totale': round(ms_totale, 2),
+            'ms_sql': round(misura.ms_sql, 2),
+            'ms_template': round(misura.ms_template, 2),
+            'query': len(misura.query),
+            'query_duplicate': misura.query_duplicate(),
+            'query_simili': misura.query_simili(),
+            'query_lente': len(query_lente),
+        }, ensure_ascii=False))
+        return response
+
+
+# --- TEMPO DI RENDER DEI TEMPLATE ---
+class _TemplateProfilato(Template):
+    def render(self, context=None, request=None):
+        misura = _misura_corrente.get()
+        if misura is None:
+            return super().render(context, request)
+        # Un template renderizzato dentro un altro (render_to_string in un tag) non va contato due volte
+        misura._profondita_template += 1
+        inizio = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            misura._profondita_template -= 1
+            if not misura._profondita_template:
+                misura.ms_template += (time.perf_counter() - inizio) * 1000
+
+
+class DjangoTemplatesProfilati(DjangoTemplates):
+    """Backend dei template Django che misura il tempo di render nelle richieste campionate."""
+
+    def from_string(self, template_code):
+        return _TemplateProfilato(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return _TemplateProfilato(template.template, self)
+
+
+# --- FILE DI LOG ---
+class FileARotazione(logging.handlers.RotatingFileHandler):
+    """
+    RotatingFileHandler (handler di LOGGING) che apre il file, e crea la cartella,
+    solo alla prima riga scritta: importare i settings (check, test, immagini in
+    sola lettura) non scrive su disco.
+    """
+
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, delay=True, **kwargs)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
+
+
+# --- AGGREGAZIONE DEL LOG ---
+def percentile(valori, p):
+    ordinati = sorted(valori)
+    return ordinati[min(len(ordinati) - 1, round(p / 100 * (len(ordinati) - 1)))]
+
+def file_di_log(percorso=None, backup=None):
+    """Il log corrente e i file ruotati ancora presenti (profilazione.log, .1, .2, ...)."""
+    percorso = str(percorso or settings.PROFILAZIONE_LOG)
+    backup = settings.PROFILAZIONE_LOG_BACKUP if backup is None else backup
+    candidati = [percorso] + [f'{percorso}.{i}' for i in range(1, backup + 1)]
+    return [p for p in candidati if os.path.exists(p)]
+
+def leggi_campioni(percorsi):
+    """Righe JSON dei log di profilazione; quelle illeggibili (es. troncate) vengono saltate."""
+    for percorso in percorsi:
+        with open(percorso, encoding='utf-8') as f:
+            for riga in f:
+                try:
+                    yield json.loads(riga)
+                except ValueError:
+                    continue
+
+def riepilogo_per_vista(campioni, viste=()):
+    """
+    Ritorna un dict vista -> statistiche (p50/p95/p99 della latenza, query medie e
+    massime, duplicate, tempo SQL e template). Le `viste` passate compaiono anche
+    senza campioni.
+    """
+    per_vista = defaultdict(list)
+    for campione in campioni:
+        per_vista[campione.get('vista') or '(nessuna)'].append(campione)
+    riepilogo = {vista: None for vista in viste}
+    for vista, elenco in per_vista.items():
+        latenze = [c['ms_totale'] for c in elenco]
+        riepilogo[vista] = {
+            'campioni': len(elenco),
+            'p50': percentile(latenze, 50),
+            'p95': percentile(latenze, 95),
+            'p99': percentile(latenze, 99),
+            'query_media': sum(c['query'] for c in elenco) / len(elenco),
+            'query_max': max(c['query'] for c in elenco),
+            'query_simili_max': max(c.get('query_simili', 0) for c in elenco),
+            'query_duplicate_max': max(c.get('query_duplicate', 0) for c in elenco),
+            'ms_sql_p95': percentile([c['ms_sql'] for c in elenco], 95),
+            'ms_template_p95': percentile([c.get('ms_template', 0) for c in elenco], 95),
+            'query_lente': sum(c.get('query_lente', 0) for c in elenco),
+        }
+    return riepilogo
@@ -0,0 +1,281 @@
+# gestione/riepiloghi.py
+"""
+Manutenzione delle tabelle dei fatti mensili usate da dashboard, report venditori
+e report costi attività.
+
+Ogni modifica a Vendita / Attivita / Trattativa / RuoloCosto segna come "da ricalcolare"
+solo i mesi coinvolti (per il riepilogo attività per trattativa: le trattative
+coinvolte); il ricalcolo avviene una volta sola a fine transazione.
+"""
+
+import datetime
+import threading
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Sum, Count, Q
+from django.db.models.functions import Coalesce, ExtractMonth, ExtractYear
+from django.utils import timezone
+
+from . import cache_dashboard
+from .calcoli import get_costo_attivita_query
+from .models import (
+    Vendita, Trattativa, Attivita,
+    RiepilogoVenditeMensile, RiepilogoTrattativeMensile, RiepilogoAttivitaMensile, RiepilogoRuoliMensile,
+)
+
+VENDITE = 'vendite'
+TRATTATIVE = 'trattative'
+ATTIVITA = 'attivita'
+TRATTATIVE_PER_QUERY = 500
+
+_in_attesa = threading.local()
+
+
+# --- INTERVALLI DI DATE ---
+def intervallo_mese(anno, mese):
+    """Ritorna (primo giorno del mese, primo giorno del mese successivo)."""
+    inizio = datetime.date(anno, mese, 1)
+    fine = datetime.date(anno + 1, 1, 1) if mese == 12 else datetime.date(anno, mese + 1, 1)
+    return inizio, fine
+
+def filtro_intervallo_mesi(dal=None, al=None):
+    """Q sui campi anno/mese per i mesi da `dal` ad `al` (coppie (anno, mese)) compresi."""
+    filtro = Q()
+    if dal:
+        filtro &= Q(anno__gt=dal[0]) | Q(anno=dal[0], mese__gte=dal[1])
+    if al:
+        filtro &= Q(anno__lt=al[0]) | Q(anno=al[0], mese__lte=al[1])
+    return filtro
+
+def intervallo_mese_aware(anno, mese):
+    """Come intervallo_mese, ma in datetime aware nel fuso orario corrente."""
+    inizio, fine = intervallo_mese(anno, mese)
+    return (
+        timezone.make_aware(datetime.datetime.combine(inizio, datetime.time.min)),
+        timezone.make_aware(datetime.datetime.combine(fine, datetime.time.min)),
+    )
+
+
+# --- RICALCOLO DI UN SINGOLO MESE ---
+def ricalcola_mese_vendite(anno, mese):
+    """Ricostruisce le righe di RiepilogoVenditeMensile per un mese."""
+    inizio, fine = intervallo_mese(anno, mese)
+    celle = {}
+
+    def cella(categoria_id, venditore_id):
+        chiave = (categoria_id, venditore_id)
+        if chiave not in celle:
+            celle[chiave] = RiepilogoVenditeMensile(
+                anno=anno, mese=mese, categoria_id=categoria_id, venditore_id=venditore_id
+            )
+        return celle[chiave]
+
+    # 1. Prodotti
+    vendite = Vendita.objects.filter(
+        data_vendita__gte=inizio, data_vendita__lt=fine
+    ).values('categoria_id', 'venditore_id').annotate(
+        tot_venduto=Coalesce(Sum('prezzo_vendita'), Decimal(0)),
+        tot_costo=Coalesce(Sum('costo_acquisto'), Decimal(0)),
+        numero=Count('id'),
+        finanziamenti=Count('id', filter=Q(flag_finanziamento=True)),
+        resi=Count('id', filter=Q(flag_reso=True)),
+    ).order_by()
+    for v in vendite:
+        riga = cella(v['categoria_id'], v['venditore_id'])
+        riga.tot_venduto_prodotti = v['tot_venduto']
+        riga.tot_costo_prodotti = v['tot_costo']
+        riga.numero_vendite = v['numero']
+        riga.numero_finanziamenti = v['finanziamenti']
+        riga.numero_resi = v['resi']
+
+    # 2. Servizi delle trattative vinte con una vendita nel mese
+    servizi = Attivita.objects.filter(
+        trattativa__vendita_collegata__data_vendita__gte=inizio,
+        trattativa__vendita_collegata__data_vendita__lt=fine,
+    ).values(
+        'trattativa__vendita_collegata__categoria_id',
+        'trattativa__vendita_collegata__venditore_id',
+    ).annotate(
+        tot_venduto_servizi=Coalesce(Sum('prezzo_vendita_attivita'), Decimal(0)),
+        costo_personale=Coalesce(get_costo_attivita_query(), Decimal(0)),
+        costo_montaggio=Coalesce(
+            get_costo_attivita_query(filtro=Q(categoria__nome__icontains='Montaggio')), Decimal(0)
+        ),
+    ).order_by()
+    for s in servizi:
+        riga = cella(
+            s['trattativa__vendita_collegata__categoria_id'],
+            s['trattativa__vendita_collegata__venditore_id'],
+        )
+        riga.tot_venduto_servizi = s['tot_venduto_servizi']
+        riga.costo_personale = s['costo_personale']
+        riga.costo_montaggio = s['costo_montaggio']
+
+    # 3. Tempo di evasione (giorni tra creazione trattativa e vendita)
+    evasioni = Trattativa.objects.filter(
+        vendita_collegata__data_vendita__gte=inizio,
+        vendita_collegata__data_vendita__lt=fine,
+    ).values_list(
+        'vendita_collegata__categoria_id', 'vendita_collegata__venditore_id',
+        'vendita_collegata__data_vendita', 'data_creazione',
+    )
+    for categoria_id, venditore_id, data_vendita, data_creazione in evasioni:
+        riga = cella(categoria_id, venditore_id)
+        riga.giorni_evasione_totali += (data_vendita - timezone.localtime(data_creazione).date()).days
+        riga.numero_evasioni += 1
+
+    with transaction.atomic():
+        RiepilogoVenditeMensile.objects.filter(anno=anno, mese=mese).delete()
+        RiepilogoVenditeMensile.objects.bulk_create(celle.values())
+
+def ricalcola_mese_trattative(anno, mese):
+    """Ricostruisce le righe di RiepilogoTrattativeMensile per un mese."""
+    inizio, fine = intervallo_mese_aware(anno, mese)
+    conteggi = Trattativa.objects.filter(
+        data_creazione__gte=inizio, data_creazione__lt=fine
+    ).values('commerciale_id').annotate(
+        lead=Count('id'),
+        persi=Count('id', filter=Q(stato=Trattativa.STATO_PERSO)),
+    ).order_by()
+    righe = [
+        RiepilogoTrattativeMensile(
+            anno=anno, mese=mese, commerciale_id=c['commerciale_id'],
+            lead_generati=c['lead'], preventivi_persi=c['persi'],
+        )
+        for c in conteggi
+    ]
+    with transaction.atomic():
+        RiepilogoTrattativeMensile.objects.filter(anno=anno, mese=mese).delete()
+        RiepilogoTrattativeMensile.objects.bulk_create(righe)
+
+def ricalcola_mese_attivita(anno, mese):
+    """Ricostruisce le righe di RiepilogoRuoliMensile per un mese (attività lette dall'indice per data)."""
+    inizio, fine = intervallo_mese(anno, mese)
+    celle = Attivita.objects.filter(
+        data_attivita__gte=inizio, data_attivita__lt=fine
+    ).values('ruolo_id', 'categoria_id').annotate(
+        ore=Coalesce(Sum('tempo_dedicato_ore'), Decimal(0)),
+        ricavo=Coalesce(Sum('prezzo_vendita_attivita'), Decimal(0)),
+        numero=Count('id'),
+    ).order_by()
+    righe = [
+        RiepilogoRuoliMensile(
+            anno=anno, mese=mese, ruolo_id=c['ruolo_id'], categoria_id=c['categoria_id'],
+            ore_totali=c['ore'], ricavo_servizi=c['ricavo'], numero_attivita=c['numero'],
+        )
+        for c in celle
+    ]
+    with transaction.atomic():
+        RiepilogoRuoliMensile.objects.filter(anno=anno, mese=mese).delete()
+        RiepilogoRuoliMensile.objects.bulk_create(righe)
+
+
+# --- RICALCOLO DEL RIEPILOGO ATTIVITÀ (PER TRATTATIVA) ---
+def ricalcola_attivita_trattative(trattativa_ids):
+    """
+    Ricostruisce le righe di RiepilogoAttivitaMensile delle trattative indicate:
+    poche attività ciascuna, lette dall'indice per trattativa.
+    """
+    ids = sorted(trattativa_ids)
+    for inizio in range(0, len(ids), TRATTATIVE_PER_QUERY):
+        gruppo = ids[inizio:inizio + TRATTATIVE_PER_QUERY]
+        celle = Attivita.objects.filter(trattativa_id__in=gruppo).annotate(
+            anno=ExtractYear('data_attivita'), mese=ExtractMonth('data_attivita'),
+        ).values('anno', 'mese', 'trattativa_id', 'ruolo_id', 'categoria_id').annotate(
+            ore=Coalesce(Sum('tempo_dedicato_ore'), Decimal(0)),
+            ricavo=Coalesce(Sum('prezzo_vendita_attivita'), Decimal(0)),
+            numero=Count('id'),
+        ).order_by()
+        righe = [
+            RiepilogoAttivitaMensile(
+                anno=c['anno'], mese=c['mese'], trattativa_id=c['trattativa_id'],
+                ruolo_id=c['ruolo_id'], categoria_id=c['categoria_id'],
+                ore_totali=c['ore'], ricavo_servizi=c['ricavo'], numero_attivita=c['numero'],
+            )
+            for c in celle
+        ]
+        with transaction.atomic():
+            RiepilogoAttivitaMensile.objects.filter(trattativa_id__in=gruppo).delete()
+            RiepilogoAttivitaMensile.objects.bulk_create(righe)
+
+
+# --- CODA DEI MESI DA RICALCOLARE ---
+def segna_mese(tipo, anno, mese):
+    """
+    Segna un mese come da ricalcolare. Il ricalcolo parte a fine transazione
+    (o subito, in autocommit), così una cancellazione a cascata di 100 attività
+    ricalcola il mese una volta sola.
+    """
+    if not hasattr(_in_attesa, 'mesi'):
+        _in_attesa.mesi = set()
+    _in_attesa.mesi.add((tipo, anno, mese))
+    transaction.on_commit(_svuota_coda)
+
+def segna_data_vendita(data):
+    if data:
+        segna_mese(VENDITE, data.year, data.month)
+
+def segna_data_attivita(data):
+    if data:
+        segna_mese(ATTIVITA, data.year, data.month)
+
+def segna_data_creazione(data):
+    if data:
+        locale = timezone.localtime(data)
+        segna_mese(TRATTATIVE, locale.year, locale.month)
+
+def segna_trattativa_attivita(trattativa_id):
+    """Segna la trattativa per il riepilogo attività; come segna_mese, il ricalcolo è a fine transazione."""
+    if not trattativa_id:
+        return
+    if not hasattr(_in_attesa, 'trattative'):
+        _in_attesa.trattative = set()
+    _in_attesa.trattative.add(trattativa_id)
+    transaction.on_commit(_svuota_coda)
+
+def _svuota_coda():
+    trattative = getattr(_in_attesa, 'trattative', None)
+    if trattative:
+        _in_attesa.trattative = set()
+        ricalcola_attivita_trattative(trattative)
+    mesi = getattr(_in_attesa, 'mesi', None)
+    if not mesi:
+        return
+    _in_attesa.mesi = set()
+    for tipo, anno, mese in sorted(mesi):
+        if tipo == VENDITE:
+            ricalcola_mese_vendite(anno, mese)
+        elif tipo == TRATTATIVE:
+            ricalcola_mese_trattative(anno, mese)
+        else:
+            ricalcola_mese_attivita(anno, mese)
+    # I fatti della dashboard sono cambiati (il riepilogo ruoli non è nella dashboard):
+    # la cache va rinnovata, lo storico del grafico solo se è stato toccato un mese passato
+    mesi = [(anno, mese) for tipo, anno, mese in mesi if tipo != ATTIVITA]
+    if not mesi:
+        return
+    oggi = timezone.localdate()
+    cache_dashboard.invalida(storico=any(m < (oggi.year, oggi.month) for m in mesi))
+
+
+# --- RICOSTRUZIONE COMPLETA ---
+def ricostruisci_tutto():
+    """Svuota e ricalcola tutte le tabelle dei fatti. Ritorna il numero di mesi elaborati."""
+    mesi_vendite = {(d.year, d.month) for d in Vendita.objects.dates('data_vendita', 'month')}
+    mesi_trattative = {(d.year, d.month) for d in Trattativa.objects.datetimes('data_creazione', 'month')}
+    mesi_attivita = {(d.year, d.month) for d in Attivita.objects.dates('data_attivita', 'month')}
+    with transaction.atomic():
+        RiepilogoVenditeMensile.objects.all().delete()
+        RiepilogoTrattativeMensile.objects.all().delete()
+        RiepilogoAttivitaMensile.objects.all().delete()
+        RiepilogoRuoliMensile.objects.all().delete()
+        for anno, mese in sorted(mesi_vendite):
+            ricalcola_mese_vendite(anno, mese)
+        for anno, mese in sorted(mesi_trattative):
+            ricalcola_mese_trattative(anno, mese)
+        for anno, mese in sorted(mesi_attivita):
+            ricalcola_mese_attivita(anno, mese)
+        ricalcola_attivita_trattative(Attivita.objects.values_list('trattativa_id', flat=True).distinct().order_by())
+        cache_dashboard.invalida_a_fine_transazione(storico=True)
+    return len(mesi_vendite) + len(mesi_trattative) + len(mesi_attivita)
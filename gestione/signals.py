@@ -0,0 +1,265 @@
+# gestione/signals.py
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from decimal import Decimal
+
+from . import riepiloghi, cache_dashboard, cache_costi, eventi, impostazioni, indice_ricerca, previsioni
+from .calcoli import applica_delta_servizi, ricalcola_totali_trattative
+from .models import (
+    Vendita, Trattativa, Attivita, MessaggioChat, RuoloCosto, StatMensile, Budget, ImpostazioniGenerali, PassaggioStato,
+)
+
+
+# --- RIEPILOGHI MENSILI (DASHBOARD / REPORT VENDITORI) ---
+def _segna_vendita_trattativa(trattativa_id):
+    """Segna il mese della vendita collegata alla trattativa (se vinta)."""
+    if not trattativa_id:
+        return
+    data = Vendita.objects.filter(trattativa_vinta__id=trattativa_id).values_list('data_vendita', flat=True).first()
+    riepiloghi.segna_data_vendita(data)
+
+@receiver(post_save, sender=Vendita)
+def riepiloghi_vendita_salvata(sender, instance, created, **kwargs):
+    riepiloghi.segna_data_vendita(instance.data_vendita)
+    precedente = instance.valore_precedente('data_vendita')
+    if precedente and precedente != instance.data_vendita:
+        riepiloghi.segna_data_vendita(precedente)
+
+@receiver(post_delete, sender=Vendita)
+def riepiloghi_vendita_eliminata(sender, instance, **kwargs):
+    riepiloghi.segna_data_vendita(instance.data_vendita)
+
+@receiver(post_save, sender=Attivita)
+def riepiloghi_attivita_salvata(sender, instance, created, **kwargs):
+    _segna_vendita_trattativa(instance.trattativa_id)
+    riepiloghi.segna_trattativa_attivita(instance.trattativa_id)
+    riepiloghi.segna_data_attivita(instance.data_attivita)
+    precedente = instance.valore_precedente('trattativa_id')
+    if precedente and precedente != instance.trattativa_id:
+        _segna_vendita_trattativa(precedente)
+        riepiloghi.segna_trattativa_attivita(precedente)
+    data_precedente = instance.valore_precedente('data_attivita')
+    if data_precedente and data_precedente != instance.data_attivita:
+        riepiloghi.segna_data_attivita(data_precedente)
+
+@receiver(post_delete, sender=Attivita)
+def riepiloghi_attivita_eliminata(sender, instance, **kwargs):
+    _segna_vendita_trattativa(instance.trattativa_id)
+    riepiloghi.segna_trattativa_attivita(instance.trattativa_id)
+    riepiloghi.segna_data_attivita(instance.data_attivita)
+
+@receiver(post_save, sender=Trattativa)
+def riepiloghi_trattativa_salvata(sender, instance, created, **kwargs):
+    riepiloghi.segna_data_creazione(instance.data_creazione)
+    precedente = instance.valore_precedente('vendita_collegata_id')
+    if created or precedente != instance.vendita_collegata_id:
+        for vendita_id in {precedente, instance.vendita_collegata_id} - {None}:
+            data = Vendita.objects.filter(pk=vendita_id).values_list('data_vendita', flat=True).first()
+            riepiloghi.segna_data_vendita(data)
+
+@receiver(post_delete, sender=Trattativa)
+def riepiloghi_trattativa_eliminata(sender, instance, **kwargs):
+    riepiloghi.segna_data_creazione(instance.data_creazione)
+    if instance.vendita_collegata_id:
+        data = Vendita.objects.filter(pk=instance.vendita_collegata_id).values_list('data_vendita', flat=True).first()
+        riepiloghi.segna_data_vendita(data)
+
+def _segna_mesi_ruolo(ruolo):
+    """Segna i mesi delle vendite che hanno attività svolte con questo ruolo."""
+    for data in Vendita.objects.filter(trattativa_vinta__attivita__ruolo=ruolo).dates('data_vendita', 'month'):
+        riepiloghi.segna_data_vendita(data)
+
+@receiver(post_save, sender=RuoloCosto)
+def riepiloghi_ruolo_salvato(sender, instance, created, **kwargs):
+    if not created and instance.valore_precedente('costo_orario') != instance.costo_orario:
+        _segna_mesi_ruolo(instance)
+
+@receiver(pre_delete, sender=RuoloCosto)
+def riepiloghi_ruolo_eliminato(sender, instance, **kwargs):
+    # pre_delete: dopo la cancellazione le attività non puntano più al ruolo (SET_NULL)
+    _segna_mesi_ruolo(instance)
+
+
+# --- TOTALI DENORMALIZZATI SU TRATTATIVA ---
+def _costo_orario(ruolo_id, ruolo=None):
+    if not ruolo_id:
+        return Decimal(0)
+    if ruolo is not None and ruolo.pk == ruolo_id:
+        return ruolo.costo_orario
+    costo = RuoloCosto.objects.filter(pk=ruolo_id).values_list('costo_orario', flat=True).first()
+    return costo or Decimal(0)
+
+def _costo_e_ricavo(ore, ruolo_id, prezzo, ruolo=None):
+    return Decimal(ore or 0) * _costo_orario(ruolo_id, ruolo), Decimal(prezzo or 0)
+
+@receiver(post_save, sender=Attivita)
+def totali_attivita_salvata(sender, instance, created, **kwargs):
+    ruolo = instance.ruolo if Attivita.ruolo.is_cached(instance) else None
+    costo, ricavo = _costo_e_ricavo(instance.tempo_dedicato_ore, instance.ruolo_id, instance.prezzo_vendita_attivita, ruolo)
+    if created or not hasattr(instance, '_valori_db'):
+        applica_delta_servizi(instance.trattativa_id, costo, ricavo)
+        return
+    trattativa_prec = instance.valore_precedente('trattativa_id')
+    costo_prec, ricavo_prec = _costo_e_ricavo(
+        instance.valore_precedente('tempo_dedicato_ore'), instance.valore_precedente('ruolo_id'),
+        instance.valore_precedente('prezzo_vendita_attivita'), ruolo,
+    )
+    if trattativa_prec == instance.trattativa_id:
+        applica_delta_servizi(instance.trattativa_id, costo - costo_prec, ricavo - ricavo_prec)
+    else:
+        applica_delta_servizi(trattativa_prec, -costo_prec, -ricavo_prec)
+        applica_delta_servizi(instance.trattativa_id, costo, ricavo)
+
+@receiver(post_delete, sender=Attivita)
+def totali_attivita_eliminata(sender, instance, **kwargs):
+    # Valori dell'istanza com'era nel DB: l'attività eliminata potrebbe avere modifiche non salvate
+    valori = getattr(instance, '_valori_db', None) or {}
+    costo, ricavo = _costo_e_ricavo(
+        valori.get('tempo_dedicato_ore', instance.tempo_dedicato_ore),
+        valori.get('ruolo_id', instance.ruolo_id),
+        valori.get('prezzo_vendita_attivita', instance.prezzo_vendita_attivita),
+    )
+    applica_delta_servizi(valori.get('trattativa_id', instance.trattativa_id), -costo, -ricavo)
+
+@receiver(post_save, sender=RuoloCosto)
+def totali_ruolo_salvato(sender, instance, created, **kwargs):
+    if not created and instance.valore_precedente('costo_orario') != instance.costo_orario:
+        ricalcola_totali_trattative(Trattativa.objects.filter(
+            pk__in=Attivita.objects.filter(ruolo=instance).values('trattativa_id')
+        ))
+
+@receiver(pre_delete, sender=RuoloCosto)
+def totali_ruolo_in_eliminazione(sender, instance, **kwargs):
+    instance._trattative_coinvolte = list(
+        Attivita.objects.filter(ruolo=instance).values_list('trattativa_id', flat=True).distinct()
+    )
+
+@receiver(post_delete, sender=RuoloCosto)
+def totali_ruolo_eliminato(sender, instance, **kwargs):
+    # Le attività ora hanno ruolo NULL (SET_NULL), quindi costo zero
+    coinvolte = getattr(instance, '_trattative_coinvolte', [])
+    if coinvolte:
+        ricalcola_totali_trattative(Trattativa.objects.filter(pk__in=coinvolte))
+
+
+# --- STORICO DEGLI STATI E PREVISIONI ---
+# Prima della cache della dashboard: a fine transazione la previsione (che la
+# dashboard mostra) si aggiorna prima che i dati della dashboard vengano invalidati.
+@receiver(post_save, sender=Trattativa)
+def previsioni_trattativa_salvata(sender, instance, created, **kwargs):
+    precedente = None if created else instance.valore_precedente('stato')
+    if created or precedente != instance.stato:
+        PassaggioStato.objects.create(
+            trattativa=instance, stato_precedente=precedente, stato=instance.stato, data=instance.data_ultimo_aggiornamento,
+        )
+    # Anche senza cambio di stato: valore e commerciale entrano nella previsione
+    previsioni.segna(instance.pk, chiusura=previsioni.chiusura_cambiata(precedente, instance.stato))
+
+@receiver(post_delete, sender=Trattativa)
+def previsioni_trattativa_eliminata(sender, instance, **kwargs):
+    previsioni.segna(instance.pk, chiusura=instance.stato in Trattativa.STATI_CHIUSI)
+
+@receiver(post_save, sender=Attivita)
+@receiver(post_delete, sender=Attivita)
+def previsioni_attivita_modificata(sender, instance, **kwargs):
+    # Il ricavo dei servizi entra nel valore totale stimato della trattativa
+    for trattativa_id in {instance.trattativa_id, instance.valore_precedente('trattativa_id')} - {None}:
+        previsioni.segna(trattativa_id)
+
+
+# --- CACHE DELLA DASHBOARD ---
+# Lo storico del grafico viene rinnovato da riepiloghi quando si ricalcola un mese passato
+@receiver(post_save, sender=Vendita)
+@receiver(post_delete, sender=Vendita)
+@receiver(post_save, sender=Attivita)
+@receiver(post_delete, sender=Attivita)
+@receiver(post_save, sender=Trattativa)
+@receiver(post_delete, sender=Trattativa)
+@receiver(post_save, sender=Budget)
+@receiver(post_delete, sender=Budget)
+@receiver(post_save, sender=RuoloCosto)
+@receiver(post_delete, sender=RuoloCosto)
+def cache_dashboard_dati_modificati(sender, instance, **kwargs):
+    cache_dashboard.invalida_a_fine_transazione()
+
+@receiver(post_save, sender=StatMensile)
+@receiver(post_delete, sender=StatMensile)
+def cache_dashboard_costi_mensili_modificati(sender, instance, **kwargs):
+    # I costi manuali entrano direttamente nell'EBIT del grafico, senza passare dai riepiloghi
+    oggi = timezone.localdate()
+    cache_dashboard.invalida_a_fine_transazione(storico=(instance.anno, instance.mese) < (oggi.year, oggi.month))
+
+
+# --- CACHE DI PROCESSO (COSTI DEI RUOLI, IMPOSTAZIONI) ---
+@receiver(post_save, sender=RuoloCosto)
+@receiver(post_delete, sender=RuoloCosto)
+def cache_costi_modificati(sender, instance, **kwargs):
+    cache_costi.svuota_a_fine_transazione()
+
+@receiver(post_save, sender=ImpostazioniGenerali)
+@receiver(post_delete, sender=ImpostazioniGenerali)
+def impostazioni_modificate(sender, instance, **kwargs):
+    impostazioni.invalida_a_fine_transazione()
+    # Le soglie decidono gli alert salvati con i dati della dashboard
+    cache_dashboard.invalida_a_fine_transazione()
+
+
+# --- EVENTI DELLA KANBAN (SSE) ---
+@receiver(post_save, sender=Trattativa)
+def eventi_trattativa_salvata(sender, instance, created, **kwargs):
+    precedente = instance.valore_precedente('stato')
+    if created or precedente != instance.stato:
+        eventi.pubblica_card(instance, None if created else precedente)
+
+@receiver(post_delete, sender=Trattativa)
+def eventi_trattativa_eliminata(sender, instance, **kwargs):
+    dati = {'id': instance.id, 'stato': None, 'stato_precedente': instance.stato}
+    transaction.on_commit(lambda: eventi.kanban.pubblica('eliminata', dati))
+
+
+# --- INDICE DI RICERCA ---
+def _testo_cambiato(instance, created):
+    if created or not hasattr(instance, 'valore_precedente'):
+        return True # MessaggioChat non memorizza i valori: si riscrive sempre
+    return any(
+        instance.valore_precedente(campo) != getattr(instance, campo)
+        for campo in indice_ricerca.CAMPI_INDICIZZATI[type(instance)]
+    )
+
+@receiver(post_save, sender=Trattativa)
+@receiver(post_save, sender=Vendita)
+@receiver(post_save, sender=Attivita)
+@receiver(post_save, sender=MessaggioChat)
+def ricerca_oggetto_salvato(sender, instance, created, **kwargs):
+    # Spostamenti in kanban e totali non toccano i campi indicizzati: niente da fare
+    if _testo_cambiato(instance, created):
+        indice_ricerca.segna(sender, instance.pk)
+    if sender is Trattativa:
+        # Il link della vendita punta alla trattativa che la collega
+        precedente = instance.valore_precedente('vendita_collegata_id')
+        if created or precedente != instance.vendita_collegata_id:
+            for vendita_id in {precedente, instance.vendita_collegata_id} - {None}:
+                indice_ricerca.segna(Vendita, vendita_id)
+
+@receiver(post_delete, sender=Trattativa)
+@receiver(post_delete, sender=Vendita)
+@receiver(post_delete, sender=Attivita)
+@receiver(post_delete, sender=MessaggioChat)
+def ricerca_oggetto_eliminato(sender, instance, **kwargs):
+    indice_ricerca.segna(sender, instance.pk, eliminato=True)
+    if sender is Trattativa and instance.vendita_collegata_id:
+        indice_ricerca.segna(Vendita, instance.vendita_collegata_id)
+
+
+# --- VALORI MEMORIZZATI (TracciaValoriMixin) ---
+# Registrato per ultimo: i ricevitori sopra devono ancora vedere i valori precedenti.
+@receiver(post_save, sender=Vendita)
+@receiver(post_save, sender=Trattativa)
+@receiver(post_save, sender=Attivita)
+@receiver(post_save, sender=RuoloCosto)
+def memorizza_valori_salvati(sender, instance, **kwargs):
+    instance.memorizza_valori_correnti()
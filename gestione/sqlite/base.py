@@ -0,0 +1,69 @@
+# gestione/sqlite/base.py
+"""
+Backend SQLite di produzione: lo stesso di Django, più le impostazioni che
+servono con più richieste concorrenti (ENGINE 'gestione.sqlite').
+
+- PRAGMA a ogni connessione: WAL (i lettori non bloccano chi scrive e viceversa),
+  synchronous=NORMAL (sicuro con WAL, niente fsync a ogni commit), busy_timeout,
+  mmap_size e cache_size. Si cambiano con OPTIONS['pragma'].
+- Le transazioni (atomic) iniziano con BEGIN IMMEDIATE: il lock di scrittura si
+  prende subito e, se è occupato, si aspetta il busy_timeout. Con il BEGIN
+  normale una transazione che legge e poi scrive fallisce subito con
+  "database is locked" se un'altra ha scritto nel frattempo.
+- OPTIONS['sola_lettura']: la connessione apre il file in mode=ro (alias dei
+  report, vedi gestione/database.py).
+"""
+
+import pathlib
+import urllib.parse
+
+from django.db.backends.sqlite3 import base
+
+PRAGMA_PREDEFINITI = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000, # ms
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -32000, # negativo = KiB (32 MB per connessione)
+    'temp_store': 'MEMORY',
+}
+OPZIONI_BACKEND = ('pragma', 'sola_lettura', 'transazioni_immediate')
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        # Opzioni di questo backend, non di sqlite3.connect()
+        for nome in OPZIONI_BACKEND:
+            params.pop(nome, None)
+        if self.sola_lettura and not self.is_in_memory_db():
+            nome = str(params['database'])
+            if not nome.startswith('file:'):
+                percorso = urllib.parse.quote(pathlib.Path(nome).resolve().as_posix())
+                params['database'] = f'file:{percorso}?mode=ro'
+        return params
+
+    @property
+    def sola_lettura(self):
+        return bool(self.settings_dict['OPTIONS'].get('sola_lettura'))
+
+    @property
+    def pragma(self):
+        pragma = {**PRAGMA_PREDEFINITI, **self.settings_dict['OPTIONS'].get('pragma', {})}
+        if self.sola_lettura:
+            pragma.pop('journal_mode') # Lo imposta (una volta per tutte, nel file) chi scrive
+        return pragma
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for nome, valore in self.pragma.items():
+            if valore is not None:
+                conn.execute(f'PRAGMA {nome} = {valore}')
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        if self.sola_lettura or not self.settings_dict['OPTIONS'].get('transazioni_immediate', True):
+            super()._start_transaction_under_autocommit()
+        else:
+            self.cursor().execute('BEGIN IMMEDIATE')
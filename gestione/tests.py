@@ -1,3 +1,1812 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import io
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import openpyxl
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core import serializers
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections, models
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse, URLPattern
+from django.utils import timezone
+
+from . import admin, calcoli, previsioni, riepiloghi, esportazioni, profilazione, cache_dashboard, cache_costi, impostazioni, views, eventi, importazioni, database, indice_ricerca
+from .dati_sintetici import genera_dataset
+from .sqlite.base import DatabaseWrapper as SqliteOttimizzato
+from .models import (
+    Vendita, CategoriaMerceologica, CategoriaServizio, RuoloCosto,
+    Trattativa, Attivita, MessaggioChat, EsportazioneJob, ProfiloUtente,
+    ImpostazioniGenerali, StatMensile, RiepilogoTrattativeMensile, RiepilogoVenditeMensile, RiepilogoAttivitaMensile,
+    RiepilogoRuoliMensile, PassaggioStato,
+)
+from .urls import urlpatterns
+
+
+# --- INDICI: PIANI DI ESECUZIONE DELLE QUERY PRINCIPALI ---
+class IndiciQueryTest(TestCase):
+    """
+    Esegue le viste principali registrando SQL e parametri reali, poi controlla
+    con EXPLAIN QUERY PLAN che le query usino gli indici definiti nei modelli.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.utente = User.objects.create_user('commerciale', password='x')
+        categoria = CategoriaMerceologica.objects.create(nome='Cucine')
+        montaggio = CategoriaServizio.objects.create(nome='Montaggio')
+        ruolo = RuoloCosto.objects.create(nome='Montatore', costo_orario=Decimal('25.00'))
+        stati = [stato for stato, _ in Trattativa.STATI_KANBAN_CHOICES]
+        for i in range(40):
+            trattativa = Trattativa.objects.create(
+                titolo=f'Trattativa {i}', cliente_nome='Cliente', valore_stimato=Decimal('1000.00'),
+                stato=stati[i % len(stati)], commerciale=cls.utente,
+            )
+            Attivita.objects.create(
+                trattativa=trattativa, ruolo=ruolo, categoria=montaggio,
+                descrizione='Montaggio', tempo_dedicato_ore=Decimal('2.00'),
+            )
+            MessaggioChat.objects.create(trattativa=trattativa, utente=cls.utente, messaggio='Ok')
+            Vendita.objects.create(
+                descrizione='Cucina', categoria=categoria, prezzo_vendita=Decimal('100.00'),
+                costo_acquisto=Decimal('50.00'), data_vendita=datetime.date(2025, 1 + i % 12, 10),
+                venditore=cls.utente,
+            )
+        cls.trattativa = Trattativa.objects.first()
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.utente)
+
+    def _query_eseguite(self, funzione):
+        """Esegue `funzione` e ritorna le (sql, params) delle SELECT eseguite."""
+        eseguite = []
+        def registra(execute, sql, params, many, context):
+            eseguite.append((sql, params))
+            return execute(sql, params, many, context)
+        with connection.execute_wrapper(registra):
+            funzione()
+        return [(sql, params) for sql, params in eseguite if sql.startswith('SELECT')]
+
+    def _piano(self, sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return ' | '.join(riga[-1] for riga in cursor.fetchall())
+
+    def assertIndiceUsato(self, funzione, frammento_sql, indice):
+        query = [q for q in self._query_eseguite(funzione) if frammento_sql in q[0]]
+        self.assertTrue(query, f"Nessuna query contiene {frammento_sql!r}")
+        for sql, params in query:
+            piano = self._piano(sql, params)
+            self.assertIn(indice, piano, f"{indice} non usato.\nQuery: {sql}\nPiano: {piano}")
+
+    def test_kanban_colonne_su_indice_stato(self):
+        self.assertIndiceUsato(
+            lambda: self.client.get(reverse('kanban_board')), 'ROW_NUMBER', 'trattativa_stato_agg_idx'
+        )
+
+    def test_kanban_carica_altre_su_indice_stato(self):
+        adesso = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        self.assertIndiceUsato(
+            lambda: self.client.get(reverse('kanban_colonna'), {'stato': Trattativa.STATO_LEAD, 'prima_di': adesso, 'ultimo_id': '999999'}),
+            'FROM "gestione_trattativa"', 'trattativa_stato_agg_idx',
+        )
+
+    def test_pipeline_dashboard_su_indice_parziale(self):
+        self.assertIndiceUsato(
+            lambda: self.client.get(reverse('dashboard')),
+            'SUM("gestione_trattativa"."valore_totale_stimato")', 'COVERING INDEX trattativa_aperte_idx',
+        )
+
+    def test_lista_ordinata_su_indice(self):
+        self.assertIndiceUsato(
+            lambda: self.client.get(reverse('trattativa_lista')),
+            'ORDER BY "gestione_trattativa"."data_ultimo_aggiornamento" DESC', 'trattativa_agg_idx',
+        )
+
+    def test_lista_ordinata_per_costo_su_indice(self):
+        self.assertIndiceUsato(
+            lambda: self.client.get(reverse('trattativa_lista'), {'ordina': '-costo_personale', 'dopo': '10.00', 'ultimo_id': '999999'}),
+            'ORDER BY "gestione_trattativa"."costo_personale_totale" DESC', 'trattativa_costo_pers_idx',
+        )
+
+    def test_dettaglio_attivita_e_chat_su_indici(self):
+        vista = lambda: self.client.get(reverse('trattativa_dettaglio', args=[self.trattativa.pk]))
+        self.assertIndiceUsato(vista, 'FROM "gestione_attivita"', 'attivita_tratt_data_idx')
+        self.assertIndiceUsato(vista, 'FROM "gestione_messaggiochat"', 'messaggio_tratt_ts_idx')
+
+    def test_ricalcolo_riepilogo_su_intervallo_date(self):
+        self.assertIndiceUsato(
+            lambda: riepiloghi.ricalcola_mese_vendite(2025, 3),
+            'FROM "gestione_vendita"', 'vendita_data_idx',
+        )
+
+
+# --- PRESTAZIONI: NUMERO DI QUERY E TEMPI DI OGNI VISTA ---
+# Budget per nome di rotta: (numero massimo di query, secondi).
+# I conteggi includono sessione e utente (2 query). Ogni pagina elenco mostra una
+# pagina piena di righe, quindi un N+1 supera subito il budget.
+BUDGET_QUERY_SECONDI = 2.0
+BUDGET_VISTE = {
+    'dashboard': (16, BUDGET_QUERY_SECONDI), # a cache vuota (impostazioni e previsione comprese); dalla cache bastano 2 query
+    'report_venditori': (5, BUDGET_QUERY_SECONDI),
+    'kanban_board': (5, BUDGET_QUERY_SECONDI),
+    'kanban_colonna': (4, BUDGET_QUERY_SECONDI),
+    'move_trattativa': (5, BUDGET_QUERY_SECONDI),
+    'eventi_kanban': (2, BUDGET_QUERY_SECONDI), # sotto WSGI (test client) risponde 204
+    'operazioni_kanban': (10, BUDGET_QUERY_SECONDI), # 200 trattative, UPDATE a lotti; i riepiloghi partono a fine transazione
+    'chiudi_trattativa_modal': (5, BUDGET_QUERY_SECONDI),
+    'report_attivita': (8, BUDGET_QUERY_SECONDI), # senza filtri: totali delle trattative, poi le ore delle prime
+    'trattativa_dettaglio': (7, BUDGET_QUERY_SECONDI),
+    'add_attivita': (13, BUDGET_QUERY_SECONDI),
+    'add_messaggio': (5, BUDGET_QUERY_SECONDI),
+    'messaggi_precedenti': (3, BUDGET_QUERY_SECONDI),
+    'messaggi_nuovi': (3, BUDGET_QUERY_SECONDI),
+    'statistiche_mensili': (4, BUDGET_QUERY_SECONDI),
+    'nuova_trattativa': (4, BUDGET_QUERY_SECONDI),
+    'trattativa_lista': (5, BUDGET_QUERY_SECONDI),
+    'esporta_trattative_excel': (4, 6.0),
+    'esporta_trattative_csv': (4, 4.0),
+    'avvia_esportazione': (6, BUDGET_QUERY_SECONDI), # ricerca e creazione del job in una transazione
+    'stato_esportazione': (3, BUDGET_QUERY_SECONDI),
+    'scarica_esportazione': (3, BUDGET_QUERY_SECONDI),
+    'edit_attivita': (7, BUDGET_QUERY_SECONDI),
+    'delete_attivita': (10, BUDGET_QUERY_SECONDI),
+    'calcola_costi_attivita': (4, BUDGET_QUERY_SECONDI), # Ruoli e soglia solo a cache di processo vuota
+    'prestazioni_viste': (2, BUDGET_QUERY_SECONDI),
+    'ricerca': (4, BUDGET_QUERY_SECONDI), # indice FTS5 + titoli delle trattative di attività e messaggi
+    'previsioni_pipeline': (5, BUDGET_QUERY_SECONDI), # a cache vuota: chiuse, loro passaggi, aperte
+}
+
+# Changelist dell'admin (100 righe per pagina): (numero massimo di query, secondi)
+BUDGET_ADMIN = {
+    'gestione_vendita': (10, BUDGET_QUERY_SECONDI),
+    'gestione_trattativa': (8, BUDGET_QUERY_SECONDI),
+    'gestione_attivita': (9, BUDGET_QUERY_SECONDI),
+    'gestione_messaggiochat': (8, BUDGET_QUERY_SECONDI),
+}
+
+
+CARTELLA_ESPORTAZIONI_TEST = tempfile.mkdtemp(prefix='test_esportazioni_')
+
+
+@override_settings(ESPORTAZIONI_DIR=CARTELLA_ESPORTAZIONI_TEST)
+class PrestazioniVisteTest(TestCase):
+    """
+    Suite di regressione delle prestazioni: ogni rotta di gestione/urls.py ha un
+    budget di query SQL e di tempo, misurato su un dataset sintetico di alcune
+    migliaia di righe (dati_sintetici.genera_dataset, lo stesso del comando benchmark).
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        genera_dataset(num_trattative=2000, num_vendite=2500, seme=42)
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'x')
+        cls.trattativa = Trattativa.objects.filter(stato=Trattativa.STATO_PREVENTIVO, attivita__isnull=False).first()
+        cls.attivita = cls.trattativa.attivita.first()
+        cls.ruolo = RuoloCosto.objects.first()
+        ImpostazioniGenerali().save() # la riga esiste già in produzione
+        cls.job = EsportazioneJob.objects.create(formato=EsportazioneJob.FORMATO_CSV, filtri={'stato': Trattativa.STATO_LEAD})
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(CARTELLA_ESPORTAZIONI_TEST, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.admin)
+
+    def misura(self, nome, richiesta, budget=None):
+        """Esegue la richiesta (consumando anche le risposte in streaming) e controlla i budget."""
+        max_query, max_secondi = budget or BUDGET_VISTE[nome]
+        with CaptureQueriesContext(connection) as query:
+            inizio = time.perf_counter()
+            risposta = richiesta()
+            if risposta.streaming:
+                b''.join(risposta.streaming_content)
+            durata = time.perf_counter() - inizio
+        self.assertLess(risposta.status_code, 400, f"{nome}: stato HTTP {risposta.status_code}")
+        elenco = '\n'.join(q['sql'][:200] for q in query.captured_queries)
+        self.assertLessEqual(len(query), max_query, f"{nome}: {len(query)} query (budget {max_query})\n{elenco}")
+        self.assertLessEqual(durata, max_secondi, f"{nome}: {durata:.2f}s (budget {max_secondi}s)")
+        return risposta
+
+    def test_ogni_rotta_ha_un_budget(self):
+        nomi = {p.name for p in urlpatterns if isinstance(p, URLPattern)}
+        self.assertEqual(nomi - set(BUDGET_VISTE), set(), "Rotte senza budget in BUDGET_VISTE")
+
+    def test_report_e_dashboard(self):
+        c = self.client
+        self.misura('dashboard', lambda: c.get(reverse('dashboard')))
+        self.misura('dashboard', lambda: c.get(reverse('dashboard'), {'anno': timezone.localdate().year, 'mese': 1}))
+        # Dalla cache: solo sessione e utente
+        self.misura('dashboard', lambda: c.get(reverse('dashboard')), (2, BUDGET_QUERY_SECONDI))
+        self.misura('report_venditori', lambda: c.get(reverse('report_venditori')))
+        self.misura('report_attivita', lambda: c.get(reverse('report_attivita')))
+        self.misura('report_attivita', lambda: c.get(reverse('report_attivita'), {
+            'dal': f'{timezone.localdate().year - 1}-01', 'al': f'{timezone.localdate().year}-12', 'ruolo': self.ruolo.id,
+        }))
+        self.misura('statistiche_mensili', lambda: c.get(reverse('statistiche_mensili')))
+
+    def test_kanban(self):
+        c = self.client
+        self.misura('kanban_board', lambda: c.get(reverse('kanban_board')))
+        self.misura('kanban_board', lambda: c.get(reverse('kanban_board'), {'storico': '1'}))
+        ultima = Trattativa.objects.filter(stato=Trattativa.STATO_LEAD).order_by('-data_ultimo_aggiornamento', '-id')[24]
+        self.misura('kanban_colonna', lambda: c.get(reverse('kanban_colonna'), {
+            'stato': Trattativa.STATO_LEAD, 'prima_di': ultima.data_ultimo_aggiornamento.isoformat(), 'ultimo_id': ultima.id,
+        }))
+        self.misura('move_trattativa', lambda: c.post(reverse('move_trattativa'), {'id': self.trattativa.id, 'stato': Trattativa.STATO_CONSEGNA}))
+        self.misura('chiudi_trattativa_modal', lambda: c.get(reverse('chiudi_trattativa_modal', args=[self.trattativa.id])))
+        self.misura('eventi_kanban', lambda: c.get(reverse('eventi_kanban')))
+        aperte = Trattativa.objects.exclude(stato__in=Trattativa.STATI_CHIUSI).order_by('id').values_list('id', flat=True)[:200]
+        operazioni = [{'id': pk, 'stato': Trattativa.STATO_PERSO, 'commerciale': self.admin.id} for pk in aperte]
+        risposta = self.misura('operazioni_kanban', lambda: c.post(
+            reverse('operazioni_kanban'), {'operazioni': operazioni}, content_type='application/json',
+        ))
+        self.assertEqual(risposta.json()['aggiornate'], 200)
+
+    def test_dettaglio_e_attivita(self):
+        c = self.client
+        t = self.trattativa
+        categoria = CategoriaServizio.objects.first()
+        self.misura('trattativa_dettaglio', lambda: c.get(reverse('trattativa_dettaglio', args=[t.id])))
+        self.misura('add_attivita', lambda: c.get(reverse('add_attivita', args=[t.id])))
+        self.misura('add_attivita', lambda: c.post(reverse('add_attivita', args=[t.id]), {
+            'ruolo': self.ruolo.id, 'categoria': categoria.id, 'descrizione': 'Rilievo',
+            'tempo_dedicato_ore': '2', 'prezzo_vendita_attivita': '100', 'data_attivita': '2025-01-10',
+        }))
+        self.misura('edit_attivita', lambda: c.get(reverse('edit_attivita', args=[self.attivita.id])))
+        self.misura('calcola_costi_attivita', lambda: c.get(reverse('calcola_costi_attivita'), {
+            'ruolo': self.ruolo.id, 'tempo_dedicato_ore': '3', 'prezzo_vendita_attivita': '50',
+        }))
+        self.misura('add_messaggio', lambda: c.post(reverse('add_messaggio', args=[t.id]), {'messaggio': 'Ciao'}))
+        self.misura('add_messaggio', lambda: c.post(reverse('add_messaggio', args=[t.id]), {'messaggio': 'Ciao', 'dopo_id': '0'}))
+        ultimo = t.messaggi_chat.latest('id')
+        self.misura('messaggi_precedenti', lambda: c.get(reverse('messaggi_precedenti', args=[t.id]), {
+            'prima_di': ultimo.timestamp.isoformat(), 'ultimo_id': ultimo.id,
+        }))
+        self.misura('messaggi_nuovi', lambda: c.get(reverse('messaggi_nuovi', args=[t.id]), {'dopo_id': ultimo.id}))
+        self.misura('delete_attivita', lambda: c.post(reverse('delete_attivita', args=[self.attivita.id])))
+
+    def test_lista_e_nuova_trattativa(self):
+        c = self.client
+        self.misura('trattativa_lista', lambda: c.get(reverse('trattativa_lista')))
+        ultima = Trattativa.objects.order_by('margine_stimato_perc', 'id')[1000]
+        self.misura('trattativa_lista', lambda: c.get(reverse('trattativa_lista'), {
+            'ordina': 'margine_perc', 'dopo': str(ultima.margine_stimato_perc), 'ultimo_id': ultima.id, 'totale': '2000',
+        }, HTTP_HX_REQUEST='true'))
+        self.misura('nuova_trattativa', lambda: self.client.get(reverse('nuova_trattativa')))
+
+    def test_prestazioni(self):
+        self.misura('prestazioni_viste', lambda: self.client.get(reverse('prestazioni_viste')))
+
+    def test_ricerca(self):
+        c = self.client
+        risposta = self.misura('ricerca', lambda: c.get(reverse('ricerca'), {'q': 'misure conf'}))
+        self.assertEqual(len(risposta.context['risultati']), views.RICERCA_MAX_RISULTATI)
+        self.misura('ricerca', lambda: c.get(reverse('ricerca'), {'q': 'cl'}, HTTP_HX_REQUEST='true'))
+
+    def test_previsioni(self):
+        c = self.client
+        dati = self.misura('previsioni_pipeline', lambda: c.get(reverse('previsioni_pipeline'), {'trattative': '1'})).json()
+        self.assertEqual(dati['trattative_aperte'], Trattativa.objects.exclude(stato__in=Trattativa.STATI_CHIUSI).count())
+        self.assertAlmostEqual(dati['valore_ponderato'], sum(t['valore_atteso'] for t in dati['trattative']), places=0)
+        # Nei dati sintetici le perse si fermano a una fase a caso: più avanti, più probabile la vincita
+        probabilita = [fase['probabilita'] for fase in dati['fasi']]
+        self.assertEqual(probabilita, sorted(probabilita))
+        self.misura('previsioni_pipeline', lambda: c.get(reverse('previsioni_pipeline')), (2, BUDGET_QUERY_SECONDI))
+
+    def test_lista_a_cursore_senza_buchi_ne_doppioni(self):
+        """Seguendo "carica altre" si vedono tutte le trattative filtrate, una volta sola e nell'ordine giusto."""
+        filtri = {'stato': Trattativa.STATO_LEAD, 'ordina': '-margine_euro'}
+        attese = list(
+            Trattativa.objects.filter(stato=Trattativa.STATO_LEAD).order_by('-margine_stimato_euro', '-id').values_list('id', flat=True)
+        )
+        risposta = self.client.get(reverse('trattativa_lista'), filtri, HTTP_HX_REQUEST='true')
+        viste = [t.id for t in risposta.context['trattative']]
+        self.assertEqual(risposta.context['totale'], len(attese))
+        while risposta.context['pagina_successiva']:
+            risposta = self.client.get(reverse('trattativa_lista') + '?' + risposta.context['pagina_successiva'], HTTP_HX_REQUEST='true')
+            viste += [t.id for t in risposta.context['trattative']]
+        self.assertEqual(viste, attese)
+
+    def test_esportazioni(self):
+        c = self.client
+        self.misura('esporta_trattative_excel', lambda: c.get(reverse('esporta_trattative_excel')))
+        self.misura('esporta_trattative_csv', lambda: c.get(reverse('esporta_trattative_csv')))
+        self.misura('avvia_esportazione', lambda: c.post(reverse('avvia_esportazione'), {'formato': 'csv', 'stato': Trattativa.STATO_VINTO}))
+        esportazioni.esegui_job(self.job.pk)
+        self.misura('stato_esportazione', lambda: c.get(reverse('stato_esportazione', args=[self.job.pk])))
+        self.misura('scarica_esportazione', lambda: c.get(reverse('scarica_esportazione', args=[self.job.pk])))
+
+    def test_excel_in_streaming(self):
+        filtri = {'stato': Trattativa.STATO_LEAD}
+        risposta = self.client.get(reverse('esporta_trattative_excel'), filtri)
+        self.assertTrue(risposta.streaming)
+        self.assertIn('.xlsx', risposta['Content-Disposition'])
+        foglio = openpyxl.load_workbook(io.BytesIO(b''.join(risposta.streaming_content))).active
+        righe = list(foglio.iter_rows(values_only=True))
+        self.assertEqual(righe[0], tuple(intestazione for intestazione, _ in esportazioni.COLONNE))
+        attese = list(esportazioni.righe_trattative(esportazioni.trattative_da_esportare(filtri)))
+        self.assertEqual(len(righe) - 1, len(attese))
+        # La data è un numero di Excel: precisa al millisecondo
+        self.assertEqual([r[:5] + r[6:] for r in righe[1:]], [tuple(r[:5] + r[6:]) for r in attese])
+        self.assertLess(abs(righe[1][5] - attese[0][5]), datetime.timedelta(milliseconds=1))
+        self.assertEqual(foglio['G2'].number_format, esportazioni.FORMATO_EURO)
+        self.assertTrue(foglio['A1'].font.b)
+
+        # Il primo blocco parte prima che tutte le righe siano state lette
+        lette = []
+        def righe_contate():
+            for riga in attese:
+                lette.append(riga)
+                yield riga
+        blocchi = esportazioni.genera_xlsx(righe_contate(), righe_per_blocco=100)
+        self.assertTrue(next(blocchi))
+        self.assertEqual(len(lette), 100)
+        self.assertGreater(len(attese), 100)
+        blocchi.close()
+
+    def test_esportazione_fallita_non_lascia_file(self):
+        job = EsportazioneJob.objects.create(formato=EsportazioneJob.FORMATO_CSV, filtri={'stato': Trattativa.STATO_VINTO})
+        def scrivi_a_meta(righe, destinazione):
+            destinazione.write('mezza riga')
+            raise OSError('disco pieno')
+        with mock.patch.object(esportazioni, 'scrivi_csv', scrivi_a_meta):
+            esportazioni.esegui_job(job.pk)
+        job.refresh_from_db()
+        self.assertEqual(job.stato, EsportazioneJob.STATO_ERRORE)
+        self.assertEqual(job.messaggio_errore, 'disco pieno')
+        self.assertFalse([f for f in os.listdir(CARTELLA_ESPORTAZIONI_TEST) if f.startswith(f'{job.pk}_')])
+
+    def test_job_visibili_solo_a_chi_li_ha_avviati(self):
+        autore = User.objects.create_user('autore', password='x')
+        altro = User.objects.create_user('altro', password='x')
+        filtri = {'stato': Trattativa.STATO_PERSO}
+        job, creato = esportazioni.trova_o_crea_job(EsportazioneJob.FORMATO_CSV, filtri, utente=autore)
+        self.assertTrue(creato)
+        self.assertEqual(esportazioni.trova_o_crea_job(EsportazioneJob.FORMATO_CSV, filtri, utente=autore), (job, False))
+        self.assertTrue(esportazioni.trova_o_crea_job(EsportazioneJob.FORMATO_CSV, filtri, utente=altro)[1])
+        esportazioni.esegui_job(job.pk)
+        self.client.force_login(altro)
+        self.assertEqual(self.client.get(reverse('stato_esportazione', args=[job.pk])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('scarica_esportazione', args=[job.pk])).status_code, 404)
+        self.client.force_login(autore)
+        self.assertEqual(self.client.get(reverse('stato_esportazione', args=[job.pk])).status_code, 200)
+        risposta = self.client.get(reverse('scarica_esportazione', args=[job.pk]))
+        self.assertEqual(risposta.status_code, 200)
+        risposta.close()
+
+    def test_admin_senza_n_piu_uno(self):
+        """Una pagina di changelist costa un numero fisso di query, non una per riga."""
+        for modello, budget in BUDGET_ADMIN.items():
+            with self.subTest(modello=modello):
+                self.misura(modello, lambda: self.client.get(reverse(f'admin:{modello}_changelist')), budget)
+
+    def test_admin_margini_e_conteggio_stimato(self):
+        url = reverse('admin:gestione_vendita_changelist')
+        # Colonna 7 (dopo la casella delle azioni): margine % calcolato nella query
+        risposta = self.misura('gestione_vendita', lambda: self.client.get(url, {'o': '-7'}), BUDGET_ADMIN['gestione_vendita'])
+        margini = [v.margine_percentuale for v in risposta.context['cl'].result_list]
+        self.assertEqual(margini, sorted(margini, reverse=True))
+        self.assertContains(risposta, f"{margini[0]:.2f}%")
+        with mock.patch.object(admin, 'CONTEGGIO_STIMATO_OLTRE', 0):
+            ids = Vendita.objects.order_by('id').values_list('id', flat=True)
+            self.assertEqual(self.client.get(url).context['cl'].result_count, ids.last() - ids.first() + 1)
+            # Con un filtro la stima non vale: si conta
+            risposta = self.client.get(url, {'flag_reso__exact': '1'})
+            self.assertEqual(risposta.context['cl'].result_count, Vendita.objects.filter(flag_reso=True).count())
+        # L'inline delle attività elenca solo campi esistenti
+        self.assertContains(self.client.get(reverse('admin:gestione_trattativa_change', args=[self.trattativa.id])), 'attivita-0-ruolo')
+
+
+# --- PROFILO UTENTE ---
+class ProfiloUtenteTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.utente = User.objects.create_user('commerciale', password='segreta')
+
+    def test_profilo_creato_con_l_utente(self):
+        self.assertTrue(ProfiloUtente.objects.filter(utente=self.utente).exists())
+
+    def test_login_senza_query_sul_profilo(self):
+        # Utente, UPDATE di last_login e 3 query della sessione: il profilo non si tocca
+        with CaptureQueriesContext(connection) as query:
+            risposta = self.client.post(reverse('login'), {'username': 'commerciale', 'password': 'segreta'})
+        self.assertEqual(risposta.status_code, 302)
+        sql = [q['sql'] for q in query.captured_queries if 'SAVEPOINT' not in q['sql']]
+        self.assertEqual(len(sql), 5, '\n'.join(sql))
+        self.assertFalse([q for q in sql if 'gestione_profiloutente' in q])
+
+    def test_profilo_mancante_creato_al_primo_uso(self):
+        # Un utente caricato da fixture (raw=True) non passa dal segnale
+        dati = '[{"model": "auth.user", "pk": 900, "fields": {"username": "da_fixture", "password": ""}}]'
+        for oggetto in serializers.deserialize('json', dati):
+            oggetto.save()
+        utente = User.objects.get(pk=900)
+        self.assertFalse(ProfiloUtente.objects.filter(utente=utente).exists())
+        profilo = ProfiloUtente.di(utente)
+        self.assertEqual(profilo.utente_id, utente.pk)
+        self.assertTrue(ProfiloUtente.objects.filter(utente=utente).exists())
+        with self.assertNumQueries(0):
+            self.assertIs(ProfiloUtente.di(utente), profilo)
+        # Un secondo oggetto utente trova il profilo già creato
+        self.assertEqual(ProfiloUtente.di(User.objects.get(pk=900)).pk, profilo.pk)
+
+    def test_admin_crea_il_profilo_mancante(self):
+        User.objects.bulk_create([User(username='senza_profilo')])
+        utente = User.objects.get(username='senza_profilo')
+        admin_utente = User.objects.create_superuser('capo', password='segreta')
+        self.client.force_login(admin_utente)
+        risposta = self.client.get(reverse('admin:auth_user_change', args=[utente.pk]))
+        self.assertEqual(risposta.status_code, 200)
+        self.assertTrue(ProfiloUtente.objects.filter(utente=utente).exists())
+
+
+# --- SQLITE: PRAGMA, TRANSAZIONI IMMEDIATE, CONNESSIONE DI LETTURA ---
+class SqliteTest(TestCase):
+
+    def setUp(self):
+        cartella = tempfile.TemporaryDirectory(prefix='test_sqlite_')
+        self.addCleanup(cartella.cleanup)
+        self.percorso = os.path.join(cartella.name, 'prova.sqlite3')
+
+    def wrapper(self, **opzioni):
+        db = SqliteOttimizzato({**connection.settings_dict, 'NAME': self.percorso, 'OPTIONS': opzioni}, alias='prova')
+        self.addCleanup(db.close)
+        return db
+
+    def pragma(self, db, nome):
+        with db.cursor() as cursore:
+            cursore.execute(f'PRAGMA {nome}')
+            return cursore.fetchone()[0]
+
+    def test_pragma_a_ogni_connessione(self):
+        db = self.wrapper(pragma={'busy_timeout': 1234})
+        self.assertEqual(self.pragma(db, 'journal_mode'), 'wal')
+        self.assertEqual(self.pragma(db, 'synchronous'), 1) # NORMAL
+        self.assertEqual(self.pragma(db, 'busy_timeout'), 1234)
+        self.assertEqual(self.pragma(db, 'cache_size'), -32000)
+
+    def test_transazione_prende_subito_il_lock_e_lettura_non_scrive(self):
+        db = self.wrapper()
+        with db.cursor() as cursore:
+            cursore.execute('CREATE TABLE prova (a INTEGER)')
+        db._start_transaction_under_autocommit()
+        # BEGIN IMMEDIATE: un altro scrittore trova il lock già preso, anche prima di qualunque scrittura
+        altro = sqlite3.connect(self.percorso, timeout=0)
+        self.addCleanup(altro.close)
+        with self.assertRaisesMessage(sqlite3.OperationalError, 'locked'):
+            altro.execute('BEGIN IMMEDIATE')
+        db.connection.rollback()
+
+        lettura = self.wrapper(sola_lettura=True)
+        self.assertEqual(self.pragma(lettura, 'journal_mode'), 'wal')
+        with self.assertRaisesMessage(OperationalError, 'readonly'):
+            with lettura.cursor() as cursore:
+                cursore.execute('INSERT INTO prova VALUES (1)')
+
+    def test_router_solo_fuori_dalle_transazioni(self):
+        router = database.RouterLettura()
+        self.assertIsNone(router.db_for_read(Trattativa))
+        with database.lettura():
+            # TestCase è dentro una transazione: si legge da 'default'
+            self.assertIsNone(router.db_for_read(Trattativa))
+            with mock.patch.object(connection, 'in_atomic_block', False):
+                self.assertEqual(router.db_for_read(Trattativa), database.ALIAS_LETTURA)
+        self.assertEqual(router.db_for_write(Trattativa), 'default')
+
+
+# --- REPLICA PER LE LETTURE DEI REPORT ---
+class ReplicaTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.utente = User.objects.create_user('commerciale', password='x')
+        cls.trattativa = Trattativa.objects.create(titolo='Trattativa', cliente_nome='Cliente', commerciale=cls.utente)
+
+    def setUp(self):
+        cache.clear()
+        cartella = tempfile.TemporaryDirectory(prefix='test_replica_')
+        self.addCleanup(cartella.cleanup)
+        self.cartella = cartella.name
+        self.addCleanup(setattr, database, '_replica_in_pausa_fino', 0.0)
+
+    def aggiungi_replica(self, nome_file):
+        percorso = os.path.join(self.cartella, nome_file)
+        connections.settings[database.ALIAS_REPLICA] = {
+            **connections.settings['default'], 'NAME': percorso, 'OPTIONS': {'sola_lettura': True},
+        }
+        def rimuovi():
+            connections[database.ALIAS_REPLICA].close()
+            del connections[database.ALIAS_REPLICA]
+            del connections.settings[database.ALIAS_REPLICA]
+        self.addCleanup(rimuovi)
+        return percorso
+
+    def test_copia_come_replica_e_ricaduta_se_non_raggiungibile(self):
+        origine = os.path.join(self.cartella, 'primario.sqlite3')
+        with sqlite3.connect(origine) as db:
+            db.execute('CREATE TABLE prova (a INTEGER)')
+            db.execute('INSERT INTO prova VALUES (7)')
+        db.close()
+        database.aggiorna_replica(origine, self.aggiungi_replica('replica.sqlite3'))
+
+        with mock.patch.object(connection, 'in_atomic_block', False):
+            with database.lettura():
+                self.assertEqual(database.alias_lettura(), database.ALIAS_REPLICA)
+                with connections[database.ALIAS_REPLICA].cursor() as cursore:
+                    cursore.execute('SELECT a FROM prova')
+                    self.assertEqual(cursore.fetchone()[0], 7)
+            with database.lettura(replica=False):
+                self.assertEqual(database.alias_lettura(), database.ALIAS_LETTURA)
+            # La replica non si apre: si legge dal primario, e per un po' non si riprova
+            connections[database.ALIAS_REPLICA].close()
+            connections.settings[database.ALIAS_REPLICA]['NAME'] = os.path.join(self.cartella, 'manca.sqlite3')
+            with database.lettura():
+                with self.assertLogs('gestione.database', 'WARNING'):
+                    self.assertEqual(database.alias_lettura(), database.ALIAS_LETTURA)
+                with self.assertNoLogs('gestione.database', 'WARNING'):
+                    self.assertEqual(database.alias_lettura(), database.ALIAS_LETTURA)
+
+    def test_dopo_una_scrittura_le_letture_restano_sul_primario(self):
+        self.aggiungi_replica('replica.sqlite3')
+        self.client.force_login(self.utente)
+        vista = database.su_lettura(lambda request: database._lettura.get()) # True = replica ammessa
+        richiesta = mock.Mock(user=self.utente)
+
+        self.client.get(reverse('dashboard'))
+        self.assertFalse(database.scrittura_recente(self.utente))
+        self.assertTrue(vista(richiesta))
+
+        risposta = self.client.post(reverse('move_trattativa'), {'id': self.trattativa.id, 'stato': Trattativa.STATO_CONSEGNA})
+        self.assertEqual(risposta.status_code, 204)
+        self.assertTrue(database.scrittura_recente(self.utente))
+        self.assertFalse(vista(richiesta))
+
+        cache.clear() # Come allo scadere di REPLICA_PRIMARIO_DOPO_SCRITTURA_SECONDI
+        self.assertTrue(vista(richiesta))
+
+
+# --- PROFILAZIONE DELLE RICHIESTE ---
+class ProfilazioneTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'x')
+        cls.utente = User.objects.create_user('commerciale', password='x')
+        for i in range(3):
+            Trattativa.objects.create(titolo=f'Trattativa {i}', cliente_nome='Cliente', commerciale=cls.utente)
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def test_cartella_dei_log_creata_alla_prima_riga(self):
+        cartella = os.path.join(tempfile.mkdtemp(), 'logs')
+        self.addCleanup(shutil.rmtree, os.path.dirname(cartella))
+        handler = profilazione.FileARotazione(os.path.join(cartella, 'profilazione.log'), maxBytes=1024, backupCount=1)
+        self.addCleanup(handler.close)
+        self.assertFalse(os.path.exists(cartella))
+        handler.emit(logging.makeLogRecord({'msg': '{}'}))
+        self.assertTrue(os.path.exists(os.path.join(cartella, 'profilazione.log')))
+
+    @override_settings(PROFILAZIONE_CAMPIONAMENTO=1)
+    def test_richiesta_campionata_scrive_log_e_server_timing(self):
+        with self.assertLogs('gestione.profilazione', 'INFO') as log, CaptureQueriesContext(connection) as query:
+            risposta = self.client.get(reverse('trattativa_lista'))
+        self.assertIn('total;dur=', risposta['Server-Timing'])
+        self.assertIn(f'desc="{len(query)} query"', risposta['Server-Timing'])
+        campione = json.loads(log.records[0].getMessage())
+        self.assertEqual(campione['vista'], 'trattativa_lista')
+        self.assertEqual(campione['stato'], 200)
+        self.assertEqual(campione['query'], len(query))
+        self.assertGreater(campione['ms_template'], 0)
+        self.assertGreaterEqual(campione['ms_totale'], campione['ms_sql'])
+
+    @override_settings(PROFILAZIONE_CAMPIONAMENTO=1, PROFILAZIONE_SOGLIA_QUERY_LENTA_MS=0)
+    def test_query_lente_nel_log_dedicato(self):
+        with self.assertLogs('gestione.query_lente', 'WARNING') as log, self.assertLogs('gestione.profilazione', 'INFO'):
+            self.client.get(reverse('trattativa_lista'))
+        self.assertEqual(json.loads(log.records[0].getMessage())['vista'], 'trattativa_lista')
+
+    @override_settings(PROFILAZIONE_CAMPIONAMENTO=0)
+    def test_richiesta_non_campionata_non_misurata(self):
+        with self.assertNoLogs('gestione.profilazione', 'INFO'):
+            risposta = self.client.get(reverse('trattativa_lista'))
+        self.assertNotIn('Server-Timing', risposta)
+
+    def test_duplicate_e_simili(self):
+        misura = profilazione.Misura()
+        misura.query = [('SELECT 1 WHERE id = %s', (1,), 1.0)] * 2 + [('SELECT 1 WHERE id = %s', (2,), 1.0)]
+        self.assertEqual(misura.query_duplicate(), 1)
+        self.assertEqual(misura.query_simili(), 2)
+
+    def test_pagina_prestazioni_aggrega_percentili(self):
+        cartella = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cartella)
+        percorso = os.path.join(cartella, 'profilazione.log')
+        # 100 campioni nel file corrente, 1 in quello ruotato, più una riga troncata
+        with open(percorso, 'w', encoding='utf-8') as f:
+            for ms in range(1, 101):
+                f.write(json.dumps({'vista': 'dashboard', 'ms_totale': ms, 'ms_sql': 1, 'query': 5}) + '\n')
+            f.write('{"vista": "dash')
+        with open(percorso + '.1', 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'vista': 'kanban_board', 'ms_totale': 7, 'ms_sql': 1, 'query': 3}) + '\n')
+
+        with override_settings(PROFILAZIONE_LOG=percorso):
+            risposta = self.client.get(reverse('prestazioni_viste'))
+        righe = dict(risposta.context['righe'])
+        self.assertEqual(righe['dashboard']['campioni'], 100)
+        self.assertEqual((righe['dashboard']['p50'], righe['dashboard']['p95'], righe['dashboard']['p99']), (51, 95, 99))
+        self.assertEqual(righe['kanban_board']['campioni'], 1)
+        self.assertIsNone(righe['report_venditori']) # rotta senza campioni
+        self.assertEqual(risposta.context['righe'][0][0], 'dashboard') # la più lenta per prima
+
+    def test_pagina_prestazioni_solo_staff(self):
+        self.client.force_login(self.utente)
+        risposta = self.client.get(reverse('prestazioni_viste'))
+        self.assertEqual(risposta.status_code, 302)
+
+
+# --- CACHE DELLA DASHBOARD ---
+class CacheDashboardTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.utente = User.objects.create_user('commerciale', password='x')
+        cls.categoria = CategoriaMerceologica.objects.create(nome='Cucine')
+        cls.oggi = timezone.localdate()
+        # Con execute=True i riepiloghi vengono aggiornati dai segnali, come dopo un commit
+        with cls.captureOnCommitCallbacks(execute=True):
+            cls.vendita(cls.oggi, '1000.00')
+            cls.vendita(cls.oggi - datetime.timedelta(days=62), '500.00')
+
+    @classmethod
+    def vendita(cls, data, prezzo):
+        return Vendita.objects.create(
+            descrizione='Cucina', categoria=cls.categoria, prezzo_vendita=Decimal(prezzo),
+            costo_acquisto=Decimal('100.00'), data_vendita=data, venditore=cls.utente,
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.utente)
+
+    def test_suite_con_la_cache_in_memoria(self):
+        # Vedi gestione/esecutore_test.py: la cartella cache/ del progetto non si tocca
+        self.assertIsInstance(caches['default'], LocMemCache)
+
+    def test_visita_ripetuta_costa_una_lettura(self):
+        self.client.get(reverse('dashboard'))
+        with mock.patch.object(cache, 'get_many', wraps=cache.get_many) as get_many, \
+                mock.patch.object(cache, 'set') as set_, mock.patch.object(cache, 'add') as add, \
+                CaptureQueriesContext(connection) as query:
+            risposta = self.client.get(reverse('dashboard'))
+        self.assertEqual(get_many.call_count, 1)
+        set_.assert_not_called()
+        add.assert_not_called()
+        self.assertEqual(len(query), 2) # sessione e utente
+        self.assertEqual(risposta.context['vendite_totali'], Decimal('1500.00'))
+
+    def test_filtri_diversi_voci_diverse(self):
+        self.client.get(reverse('dashboard'))
+        risposta = self.client.get(reverse('dashboard'), {'anno': self.oggi.year, 'mese': self.oggi.month})
+        self.assertEqual(risposta.context['vendite_totali'], Decimal('1000.00'))
+
+    def test_modifica_del_mese_corrente_non_ricalcola_lo_storico(self):
+        prima = self.client.get(reverse('dashboard')).context
+        with self.captureOnCommitCallbacks(execute=True):
+            self.vendita(self.oggi, '200.00')
+        with mock.patch('gestione.views._trend_mensile', wraps=views._trend_mensile) as trend:
+            dopo = self.client.get(reverse('dashboard')).context
+        self.assertEqual(dopo['vendite_totali'], prima['vendite_totali'] + Decimal('200.00'))
+        trend.assert_called_once() # solo il mese corrente
+        self.assertEqual(json.loads(dopo['chart_data_vendite'])[-1], json.loads(prima['chart_data_vendite'])[-1] + 200)
+
+    def test_modifica_di_un_mese_passato_rinnova_lo_storico(self):
+        prima = json.loads(self.client.get(reverse('dashboard')).context['chart_data_vendite'])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.vendita(self.oggi - datetime.timedelta(days=62), '300.00')
+        dopo = json.loads(self.client.get(reverse('dashboard')).context['chart_data_vendite'])
+        self.assertEqual(sum(dopo), sum(prima) + 300)
+
+    def test_costi_mensili_e_budget_invalidano(self):
+        self.client.get(reverse('dashboard'))
+        with self.captureOnCommitCallbacks(execute=True):
+            StatMensile.objects.create(anno=self.oggi.year, mese=self.oggi.month, costi_operativi_fissi=Decimal('400.00'))
+        risposta = self.client.get(reverse('dashboard'))
+        self.assertEqual(risposta.context['utile_operativo_ebit'], Decimal('900.00'))
+
+    def test_cache_vuota_riparte_da_versione_nuova(self):
+        self.client.get(reverse('dashboard'))
+        cache.delete(cache_dashboard.CHIAVE_VERSIONE) # es. voce espulsa dalla cache
+        with mock.patch('gestione.views._dati_dashboard', wraps=views._dati_dashboard) as calcolo:
+            self.client.get(reverse('dashboard'))
+        calcolo.assert_called_once()
+
+
+# --- RIEPILOGO ATTIVITÀ E REPORT COSTI ---
+class RiepilogoAttivitaTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.utente = User.objects.create_user('commerciale', password='x')
+        cls.montatore = RuoloCosto.objects.create(nome='Montatore', costo_orario=Decimal('25.00'))
+        cls.progettista = RuoloCosto.objects.create(nome='Progettista', costo_orario=Decimal('40.00'))
+        cls.montaggio = CategoriaServizio.objects.create(nome='Montaggio')
+        cls.rilievo = CategoriaServizio.objects.create(nome='Rilievo')
+        cls.aperta = Trattativa.objects.create(titolo='Cucina', cliente_nome='Rossi', valore_stimato=Decimal('1000.00'), commerciale=cls.utente)
+        cls.vinta = Trattativa.objects.create(
+            titolo='Bagno', cliente_nome='Bianchi', valore_stimato=Decimal('500.00'), commerciale=cls.utente, stato=Trattativa.STATO_VINTO,
+        )
+
+    def setUp(self):
+        self.client.force_login(self.utente)
+
+    def attivita(self, trattativa, ruolo, categoria, ore, data):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Attivita.objects.create(
+                trattativa=trattativa, ruolo=ruolo, categoria=categoria, descrizione='Lavoro',
+                tempo_dedicato_ore=Decimal(ore), data_attivita=data,
+            )
+
+    def assertRiepilogoAllineato(self):
+        """Le righe mantenute dai segnali coincidono con quelle ricostruite da zero."""
+        campi = ('anno', 'mese', 'trattativa_id', 'ruolo_id', 'categoria_id', 'ore_totali', 'numero_attivita')
+        mantenute = sorted(RiepilogoAttivitaMensile.objects.values_list(*campi))
+        campi_celle = ('anno', 'mese', 'ruolo_id', 'categoria_id', 'ore_totali', 'numero_attivita')
+        celle = sorted(RiepilogoRuoliMensile.objects.values_list(*campi_celle))
+        riepiloghi.ricostruisci_tutto()
+        self.assertEqual(mantenute, sorted(RiepilogoAttivitaMensile.objects.values_list(*campi)))
+        self.assertEqual(celle, sorted(RiepilogoRuoliMensile.objects.values_list(*campi_celle)))
+        return mantenute
+
+    def test_riepilogo_segue_le_attivita(self):
+        a = self.attivita(self.aperta, self.montatore, self.montaggio, '2', datetime.date(2025, 1, 10))
+        self.attivita(self.aperta, self.montatore, self.montaggio, '3', datetime.date(2025, 1, 20))
+        righe = self.assertRiepilogoAllineato()
+        self.assertEqual(righe, [(2025, 1, self.aperta.id, self.montatore.id, self.montaggio.id, Decimal('5.00'), 2)])
+
+        # Cambio di mese, ruolo e trattativa: la cella vecchia si svuota, ne nasce una nuova
+        with self.captureOnCommitCallbacks(execute=True):
+            a.data_attivita = datetime.date(2025, 2, 1)
+            a.ruolo = self.progettista
+            a.trattativa = self.vinta
+            a.save()
+        self.assertEqual(len(self.assertRiepilogoAllineato()), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            a.delete()
+        self.assertEqual(len(self.assertRiepilogoAllineato()), 1)
+
+    def test_celle_per_ruolo_senza_trattativa(self):
+        # Stesso mese, ruolo e categoria su due trattative: una cella sola
+        self.attivita(self.aperta, self.montatore, self.montaggio, '2', datetime.date(2025, 1, 10))
+        self.attivita(self.vinta, self.montatore, self.montaggio, '3', datetime.date(2025, 1, 20))
+        self.assertEqual(RiepilogoAttivitaMensile.objects.count(), 2)
+        self.assertEqual(
+            list(RiepilogoRuoliMensile.objects.values_list('anno', 'mese', 'ruolo_id', 'ore_totali', 'numero_attivita')),
+            [(2025, 1, self.montatore.id, Decimal('5.00'), 2)],
+        )
+        # Il report non legge le attività, con o senza filtri
+        for filtri in ({}, {'dal': '2025-01', 'ruolo': self.montatore.id}):
+            with CaptureQueriesContext(connection) as query:
+                self.client.get(reverse('report_attivita'), filtri)
+            self.assertFalse([q for q in query.captured_queries if '"gestione_attivita"' in q['sql']])
+
+    def test_report_con_filtri_e_drill_down(self):
+        self.attivita(self.aperta, self.montatore, self.montaggio, '2', datetime.date(2025, 1, 10))
+        self.attivita(self.aperta, self.progettista, self.rilievo, '1', datetime.date(2025, 3, 5))
+        self.attivita(self.vinta, self.montatore, self.montaggio, '4', datetime.date(2025, 3, 6))
+
+        risposta = self.client.get(reverse('report_attivita'))
+        # 2h e 4h a 25€, 1h a 40€
+        ruoli = {r['ruolo__nome']: r['costo'] for r in risposta.context['costo_per_ruolo']}
+        self.assertEqual(ruoli, {'Montatore': Decimal('150.00'), 'Progettista': Decimal('40.00')})
+        self.assertEqual(risposta.context['costo_trattative_vinte'], Decimal('100.00'))
+        self.assertEqual([t['costo'] for t in risposta.context['costo_per_trattativa_attiva']], [Decimal('90.00')])
+        self.assertEqual([(m['anno'], m['mese']) for m in risposta.context['costo_per_mese']], [(2025, 3), (2025, 1)])
+
+        # Solo marzo, poi drill-down sul montatore
+        risposta = self.client.get(reverse('report_attivita'), {'dal': '2025-03', 'al': '2025-03'})
+        self.assertEqual(sum(r['costo'] for r in risposta.context['costo_per_ruolo']), Decimal('140.00'))
+        montatore = next(r for r in risposta.context['costo_per_ruolo'] if r['ruolo_id'] == self.montatore.id)
+        risposta = self.client.get(reverse('report_attivita') + montatore['url'])
+        self.assertEqual([r['ruolo_id'] for r in risposta.context['costo_per_ruolo']], [self.montatore.id])
+        self.assertEqual(risposta.context['costo_trattative_vinte'], Decimal('100.00'))
+        self.assertEqual(list(risposta.context['costo_per_trattativa_attiva']), [])
+        self.assertContains(risposta, 'Ruolo: Montatore')
+
+
+# --- RIEPILOGHI MENSILI CONTRO GLI AGGREGATI DEI DATI GREZZI ---
+class RiepiloghiAggregatiTest(TestCase):
+    """
+    Ogni tabella dei fatti deve coincidere con gli aggregati calcolati in Python
+    dalle righe di Vendita, Trattativa, Attivita e StatMensile, dopo ogni modifica.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.venditore = User.objects.create_user('venditore', password='x')
+        cls.altro = User.objects.create_user('altro', password='x')
+        cls.cucine = CategoriaMerceologica.objects.create(nome='Cucine')
+        cls.notte = CategoriaMerceologica.objects.create(nome='Notte')
+        cls.montatore = RuoloCosto.objects.create(nome='Montatore', costo_orario=Decimal('25.00'))
+        cls.progettista = RuoloCosto.objects.create(nome='Progettista', costo_orario=Decimal('40.00'))
+        cls.montaggio = CategoriaServizio.objects.create(nome='Montaggio')
+        cls.rilievo = CategoriaServizio.objects.create(nome='Rilievo')
+
+    def setUp(self):
+        cache_costi.svuota()
+        self.addCleanup(cache_costi.svuota)
+
+    # Dati, salvati come farebbero le viste: i riepiloghi si aggiornano a fine transazione
+    def vendita(self, data, prezzo='1000', categoria=None, venditore=None, **campi):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Vendita.objects.create(
+                descrizione='Prodotto', categoria=categoria or self.cucine, venditore=venditore or self.venditore,
+                prezzo_vendita=Decimal(prezzo), costo_acquisto=Decimal(prezzo) / 2, data_vendita=data, **campi,
+            )
+
+    def trattativa(self, vendita=None, commerciale=None, **campi):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Trattativa.objects.create(
+                titolo='Trattativa', cliente_nome='Cliente', commerciale=commerciale or self.venditore,
+                vendita_collegata=vendita, **campi,
+            )
+
+    def attivita(self, trattativa, ruolo, categoria, ore, data, prezzo='0'):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Attivita.objects.create(
+                trattativa=trattativa, ruolo=ruolo, categoria=categoria, descrizione='Lavoro',
+                tempo_dedicato_ore=Decimal(ore), prezzo_vendita_attivita=Decimal(prezzo), data_attivita=data,
+            )
+
+    def salva(self, istanza, **campi):
+        with self.captureOnCommitCallbacks(execute=True):
+            for campo, valore in campi.items():
+                setattr(istanza, campo, valore)
+            istanza.save()
+
+    def elimina(self, istanza):
+        with self.captureOnCommitCallbacks(execute=True):
+            istanza.delete()
+
+    # Aggregati dai dati grezzi
+    @staticmethod
+    def somma(celle, chiave, valori):
+        cella = celle.setdefault(chiave, [0] * len(valori))
+        for indice, valore in enumerate(valori):
+            cella[indice] += valore
+
+    def vendite_attese(self):
+        celle = {}
+        for v in Vendita.objects.all():
+            self.somma(celle, (v.data_vendita.year, v.data_vendita.month, v.categoria_id, v.venditore_id), [
+                v.prezzo_vendita, v.costo_acquisto, 1, int(v.flag_finanziamento), int(v.flag_reso), 0, 0, 0, 0, 0,
+            ])
+        for t in Trattativa.objects.filter(vendita_collegata__isnull=False).select_related('vendita_collegata'):
+            v = t.vendita_collegata
+            chiave = (v.data_vendita.year, v.data_vendita.month, v.categoria_id, v.venditore_id)
+            giorni = (v.data_vendita - timezone.localtime(t.data_creazione).date()).days
+            self.somma(celle, chiave, [0, 0, 0, 0, 0, 0, 0, 0, giorni, 1])
+            for a in t.attivita.select_related('ruolo', 'categoria'):
+                costo = a.tempo_dedicato_ore * (a.ruolo.costo_orario if a.ruolo else 0)
+                montaggio = costo if a.categoria and 'montaggio' in a.categoria.nome.lower() else 0
+                self.somma(celle, chiave, [0, 0, 0, 0, 0, a.prezzo_vendita_attivita, costo, montaggio, 0, 0])
+        return {chiave: tuple(Decimal(x).quantize(Decimal('0.01')) for x in valori) for chiave, valori in celle.items()}
+
+    def vendite_memorizzate(self):
+        return {
+            (r.anno, r.mese, r.categoria_id, r.venditore_id): tuple(Decimal(x).quantize(Decimal('0.01')) for x in (
+                r.tot_venduto_prodotti, r.tot_costo_prodotti, r.numero_vendite, r.numero_finanziamenti, r.numero_resi,
+                r.tot_venduto_servizi, r.costo_personale, r.costo_montaggio, r.giorni_evasione_totali, r.numero_evasioni,
+            ))
+            for r in RiepilogoVenditeMensile.objects.all()
+        }
+
+    def trattative_attese(self):
+        celle = {}
+        for t in Trattativa.objects.all():
+            creazione = timezone.localtime(t.data_creazione)
+            self.somma(celle, (creazione.year, creazione.month, t.commerciale_id), [1, int(t.stato == Trattativa.STATO_PERSO)])
+        return {chiave: tuple(valori) for chiave, valori in celle.items()}
+
+    def attivita_attese(self, per_trattativa):
+        celle = {}
+        for a in Attivita.objects.all():
+            chiave = (a.data_attivita.year, a.data_attivita.month) + ((a.trattativa_id,) if per_trattativa else ()) + (a.ruolo_id, a.categoria_id)
+            self.somma(celle, chiave, [a.tempo_dedicato_ore, a.prezzo_vendita_attivita, 1])
+        return {chiave: (Decimal(o).quantize(Decimal('0.01')), Decimal(r).quantize(Decimal('0.01')), n) for chiave, (o, r, n) in celle.items()}
+
+    def ebit_atteso(self):
+        """EBIT per mese del grafico: vendite del mese meno costi dei prodotti, personale e costi manuali."""
+        mesi = {}
+        for (anno, mese, _, _), (venduto, costo, _, _, _, servizi, personale, _, _, _) in self.vendite_attese().items():
+            self.somma(mesi, (anno, mese), [venduto + servizi - costo - personale])
+        for stat in StatMensile.objects.all():
+            if (stat.anno, stat.mese) in mesi:
+                self.somma(mesi, (stat.anno, stat.mese), [-stat.costi_operativi_fissi - stat.costo_marketing_mese])
+        return [(f'{mese:02d}/{anno}', float(valori[0])) for (anno, mese), valori in sorted(mesi.items())]
+
+    def assertRiepiloghiAllineati(self):
+        self.assertEqual(self.vendite_memorizzate(), self.vendite_attese())
+        self.assertEqual(
+            {(r.anno, r.mese, r.commerciale_id): (r.lead_generati, r.preventivi_persi) for r in RiepilogoTrattativeMensile.objects.all()},
+            self.trattative_attese(),
+        )
+        self.assertEqual(
+            {(r.anno, r.mese, r.trattativa_id, r.ruolo_id, r.categoria_id): (r.ore_totali, r.ricavo_servizi, r.numero_attivita)
+             for r in RiepilogoAttivitaMensile.objects.all()},
+            self.attivita_attese(per_trattativa=True),
+        )
+        self.assertEqual(
+            {(r.anno, r.mese, r.ruolo_id, r.categoria_id): (r.ore_totali, r.ricavo_servizi, r.numero_attivita)
+             for r in RiepilogoRuoliMensile.objects.all()},
+            self.attivita_attese(per_trattativa=False),
+        )
+        self.assertEqual([(etichetta, ebit) for etichetta, _, _, ebit in views._trend_mensile(models.Q())], self.ebit_atteso())
+
+    def dati_di_prova(self):
+        """Due mesi di vendite, una vinta con servizi, una trattativa aperta con attività e i costi manuali."""
+        gennaio = self.vendita(datetime.date(2025, 1, 10), '1200', flag_finanziamento=True)
+        self.vendita(datetime.date(2025, 1, 20), '800', categoria=self.notte, venditore=self.altro, flag_reso=True)
+        febbraio = self.vendita(datetime.date(2025, 2, 5), '2000')
+        vinta = self.trattativa(gennaio, stato=Trattativa.STATO_VINTO)
+        self.trattativa(commerciale=self.altro, stato=Trattativa.STATO_PERSO)
+        aperta = self.trattativa()
+        self.attivita(vinta, self.montatore, self.montaggio, '4', datetime.date(2025, 1, 12), prezzo='300')
+        self.attivita(vinta, self.progettista, self.rilievo, '2', datetime.date(2024, 12, 20), prezzo='100')
+        self.attivita(aperta, self.montatore, self.montaggio, '3', datetime.date(2025, 2, 1))
+        StatMensile.objects.create(anno=2025, mese=1, costi_operativi_fissi=Decimal('500.00'), costo_marketing_mese=Decimal('50.00'))
+        return gennaio, febbraio, vinta, aperta
+
+    def test_creazione_modifica_ed_eliminazione(self):
+        gennaio, febbraio, vinta, aperta = self.dati_di_prova()
+        self.assertRiepiloghiAllineati()
+        self.assertEqual(RiepilogoVenditeMensile.objects.filter(anno=2025, mese=1).count(), 2)
+
+        self.salva(gennaio, prezzo_vendita=Decimal('1500.00'), flag_reso=True, venditore=self.altro)
+        self.salva(aperta, stato=Trattativa.STATO_PERSO)
+        attivita = aperta.attivita.get()
+        self.salva(attivita, tempo_dedicato_ore=Decimal('5.5'), categoria=self.rilievo)
+        # La trattativa aperta viene vinta con la vendita di febbraio: i suoi servizi entrano in febbraio
+        self.salva(aperta, vendita_collegata=febbraio, stato=Trattativa.STATO_VINTO)
+        self.assertRiepiloghiAllineati()
+
+        self.elimina(attivita)
+        self.elimina(vinta)
+        self.elimina(febbraio)
+        self.assertRiepiloghiAllineati()
+        self.assertFalse(RiepilogoVenditeMensile.objects.filter(anno=2025, mese=2).exists())
+
+    def test_vendita_spostata_di_mese(self):
+        gennaio, _, vinta, _ = self.dati_di_prova()
+        self.salva(gennaio, data_vendita=datetime.date(2025, 3, 1))
+        self.assertRiepiloghiAllineati()
+        # Gennaio perde vendita e servizi della trattativa vinta, marzo li prende tutti
+        self.assertFalse(RiepilogoVenditeMensile.objects.filter(anno=2025, mese=1, venditore=self.venditore).exists())
+        marzo = RiepilogoVenditeMensile.objects.get(anno=2025, mese=3)
+        self.assertEqual((marzo.numero_vendite, marzo.tot_venduto_servizi, marzo.costo_personale), (1, Decimal('400.00'), Decimal('180.00')))
+
+        # Anche all'indietro, oltre il cambio d'anno
+        self.salva(gennaio, data_vendita=datetime.date(2024, 12, 31))
+        self.assertRiepiloghiAllineati()
+        self.assertFalse(RiepilogoVenditeMensile.objects.filter(anno=2025, mese=3).exists())
+
+    def test_costo_del_ruolo(self):
+        self.dati_di_prova()
+        self.salva(self.montatore, costo_orario=Decimal('30.00'))
+        self.assertRiepiloghiAllineati()
+        # 4h a 30€ + 2h a 40€, di cui montaggio solo le prime
+        gennaio = RiepilogoVenditeMensile.objects.get(anno=2025, mese=1, venditore=self.venditore)
+        self.assertEqual((gennaio.costo_personale, gennaio.costo_montaggio), (Decimal('200.00'), Decimal('120.00')))
+
+        self.elimina(self.progettista)
+        self.assertRiepiloghiAllineati()
+
+    def test_ricostruzione_da_zero(self):
+        self.dati_di_prova()
+        # Tabelle svuotate o sporcate a mano (es. import con bulk_create, che non invia segnali)
+        RiepilogoVenditeMensile.objects.filter(mese=1).delete()
+        RiepilogoTrattativeMensile.objects.update(lead_generati=99)
+        RiepilogoAttivitaMensile.objects.all().delete()
+        RiepilogoRuoliMensile.objects.create(anno=2030, mese=1, ore_totali=Decimal('1.00'), numero_attivita=1)
+        Vendita.objects.bulk_create([Vendita(
+            descrizione='Importata', categoria=self.notte, venditore=self.venditore,
+            prezzo_vendita=Decimal('700.00'), costo_acquisto=Decimal('300.00'), data_vendita=datetime.date(2025, 4, 2),
+        )])
+        self.assertNotEqual(self.vendite_memorizzate(), self.vendite_attese())
+
+        uscita = io.StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('ricalcola_riepiloghi', stdout=uscita)
+        self.assertIn('Riepiloghi ricostruiti', uscita.getvalue())
+        self.assertRiepiloghiAllineati()
+
+
+# --- DETTAGLIO TRATTATIVA: AGGIORNAMENTI HTMX DELLE ATTIVITÀ ---
+class AttivitaHtmxTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.utente = User.objects.create_user('commerciale', password='x')
+        cls.montaggio = CategoriaServizio.objects.create(nome='Montaggio')
+        cls.ruolo = RuoloCosto.objects.create(nome='Montatore', costo_orario=Decimal('25.00'))
+        cls.trattativa = Trattativa.objects.create(
+            titolo='Cucina', cliente_nome='Cliente', valore_stimato=Decimal('1000.00'),
+            costo_materiali_stimato=Decimal('400.00'), commerciale=cls.utente,
+        )
+        cls.attivita = Attivita.objects.create(
+            trattativa=cls.trattativa, ruolo=cls.ruolo, categoria=cls.montaggio,
+            descrizione='Rilievo', tempo_dedicato_ore=Decimal('2.00'),
+        )
+
+    def setUp(self):
+        self.client.force_login(self.utente)
+
+    def dati_attivita(self, **valori):
+        return {
+            'ruolo': self.ruolo.id, 'categoria': self.montaggio.id, 'descrizione': 'Montaggio',
+            'tempo_dedicato_ore': '4', 'prezzo_vendita_attivita': '200', 'data_attivita': '2025-01-10', **valori,
+        }
+
+    def assertRispostaFuoriBanda(self, risposta):
+        self.assertEqual(risposta.status_code, 200)
+        self.assertNotIn('HX-Refresh', risposta)
+        self.assertEqual(risposta['HX-Reswap'], 'none')
+        self.assertEqual(risposta['HX-Trigger'], 'chiudiModal')
+        self.assertContains(risposta, 'id="analisi-economica" hx-swap-oob="true"')
+        self.assertContains(risposta, 'id="messages-container" hx-swap-oob="true"')
+
+    def test_aggiunta_ritorna_solo_la_riga_e_i_totali(self):
+        with CaptureQueriesContext(connection) as query:
+            risposta = self.client.post(reverse('add_attivita', args=[self.trattativa.id]), self.dati_attivita())
+        self.assertRispostaFuoriBanda(risposta)
+        nuova = Attivita.objects.latest('id')
+        self.assertContains(risposta, 'hx-swap-oob="afterbegin:#attivita-tbody"')
+        self.assertContains(risposta, f'id="attivita-row-{nuova.id}"')
+        self.assertNotContains(risposta, f'id="attivita-row-{self.attivita.id}"')
+        # Costo personale 2h + 4h a 25€, ricavo servizi 200€: margine 1000 + 200 - 400 - 150
+        self.assertEqual(risposta.context['trattativa'].margine_stimato_euro, Decimal('650.00'))
+        self.assertContains(risposta, '€ 650,00')
+        # Nessuna riaggregazione delle attività
+        self.assertFalse([q for q in query.captured_queries if 'SUM(' in q['sql']])
+
+    def test_modifica_sostituisce_la_riga(self):
+        risposta = self.client.post(reverse('edit_attivita', args=[self.attivita.id]), self.dati_attivita(descrizione='Rilievo misure'))
+        self.assertRispostaFuoriBanda(risposta)
+        self.assertContains(risposta, f'<tr id="attivita-row-{self.attivita.id}" hx-swap-oob="true">')
+        self.assertContains(risposta, 'Rilievo misure')
+        self.assertEqual(risposta.context['trattativa'].costo_personale_totale, Decimal('100.00'))
+
+    def test_eliminazione_toglie_la_riga(self):
+        risposta = self.client.post(reverse('delete_attivita', args=[self.attivita.id]))
+        self.assertRispostaFuoriBanda(risposta)
+        self.assertContains(risposta, f'<tr id="attivita-row-{self.attivita.id}" hx-swap-oob="delete"></tr>')
+        self.assertEqual(risposta.context['trattativa'].costo_personale_totale, Decimal('0.00'))
+
+    def test_form_non_valido_resta_nel_modal(self):
+        risposta = self.client.post(reverse('add_attivita', args=[self.trattativa.id]), self.dati_attivita(descrizione=''))
+        self.assertEqual(risposta.status_code, 400)
+        self.assertNotIn('HX-Trigger', risposta)
+
+
+# --- CALCOLO COSTI DELLE ATTIVITÀ (CACHE DI PROCESSO) ---
+class CalcoloCostiTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.utente = User.objects.create_user('commerciale', password='x')
+        cls.ruolo = RuoloCosto.objects.create(nome='Montatore', costo_orario=Decimal('25.00'))
+        cls.trattativa = Trattativa.objects.create(
+            titolo='Cucina', cliente_nome='Cliente', valore_stimato=Decimal('1000.00'), commerciale=cls.utente,
+        )
+
+    def setUp(self):
+        # La cache è del processo: il rollback dei test precedenti non la svuota
+        cache_costi.svuota()
+        impostazioni.invalida()
+        self.addCleanup(cache_costi.svuota)
+        self.addCleanup(impostazioni.invalida)
+        self.client.force_login(self.utente)
+
+    def calcola(self, ore='3', prezzo='50'):
+        return self.client.get(reverse('calcola_costi_attivita'), {
+            'ruolo': self.ruolo.id, 'tempo_dedicato_ore': ore, 'prezzo_vendita_attivita': prezzo,
+        })
+
+    def test_costi_e_soglia_si_leggono_una_volta(self):
+        self.calcola()
+        with CaptureQueriesContext(connection) as query:
+            risposta = self.calcola()
+        # 3h a 25€ = 75€, +20% di margine minimo
+        self.assertContains(risposta, '€ 75,00')
+        self.assertContains(risposta, 'Prezzo min. suggerito: € 90.00')
+        tabelle = ' '.join(q['sql'] for q in query.captured_queries)
+        self.assertNotIn('gestione_ruolocosto', tabelle)
+        self.assertNotIn('gestione_impostazionigenerali', tabelle)
+        # load() non viene più chiamato: la riga delle impostazioni non si crea leggendo
+        self.assertFalse(ImpostazioniGenerali.objects.exists())
+
+    def test_le_modifiche_svuotano_la_cache(self):
+        self.calcola()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ruolo.costo_orario = Decimal('10.00')
+            self.ruolo.save()
+            ImpostazioniGenerali.objects.create(soglia_alert_margine_servizio=Decimal('100.00'))
+        risposta = self.calcola()
+        self.assertContains(risposta, '€ 30,00')
+        self.assertContains(risposta, 'Prezzo min. suggerito: € 60.00')
+
+    def test_il_modal_porta_costi_e_soglia(self):
+        risposta = self.client.get(reverse('add_attivita', args=[self.trattativa.id]))
+        self.assertContains(risposta, '<script id="costi-ruoli-dati" type="application/json">{"%d": "25.00"}</script>' % self.ruolo.id, html=False)
+        self.assertContains(risposta, '<script id="soglia-margine-dati" type="application/json">"20.00"</script>', html=False)
+        # Anteprima iniziale già nel modal, senza richieste al caricamento
+        self.assertContains(risposta, 'id="costo-orario-display"')
+        self.assertNotContains(risposta, reverse('calcola_costi_attivita'))
+
+
+# --- TOTALI DENORMALIZZATI DELLE TRATTATIVE ---
+class TotaliTrattativaTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.utente = User.objects.create_superuser('capo', password='x')
+        cls.montatore = RuoloCosto.objects.create(nome='Montatore', costo_orario=Decimal('25.00'))
+        cls.progettista = RuoloCosto.objects.create(nome='Progettista', costo_orario=Decimal('40.00'))
+        cls.categoria = CategoriaServizio.objects.create(nome='Montaggio')
+        cls.cucina, cls.bagno, cls.senza_montatore = [
+            Trattativa.objects.create(
+                titolo=titolo, cliente_nome='Cliente', commerciale=cls.utente,
+                valore_stimato=Decimal('1000.00'), costo_materiali_stimato=Decimal('400.00'),
+            )
+            for titolo in ('Cucina', 'Bagno', 'Soggiorno')
+        ]
+        for trattativa, ruolo, ore, prezzo in (
+            (cls.cucina, cls.montatore, '4', '150'), (cls.cucina, cls.progettista, '2', '100'),
+            (cls.bagno, cls.montatore, '3', '90'), (cls.senza_montatore, cls.progettista, '5', '300'),
+        ):
+            Attivita.objects.create(
+                trattativa=trattativa, ruolo=ruolo, categoria=cls.categoria, descrizione='Lavoro',
+                tempo_dedicato_ore=Decimal(ore), prezzo_vendita_attivita=Decimal(prezzo),
+            )
+
+    def setUp(self):
+        cache_costi.svuota()
+        self.addCleanup(cache_costi.svuota)
+
+    def assertTotaliCorretti(self, trattativa):
+        """Totali e margini memorizzati contro quelli ricalcolati dalle attività, riga per riga."""
+        trattativa = Trattativa.objects.get(pk=trattativa.pk)
+        attese = Trattativa(valore_stimato=trattativa.valore_stimato, costo_materiali_stimato=trattativa.costo_materiali_stimato)
+        attese.costo_personale_totale = sum(
+            (a.tempo_dedicato_ore * (a.ruolo.costo_orario if a.ruolo else 0) for a in trattativa.attivita.select_related('ruolo')),
+            Decimal(0),
+        )
+        attese.ricavo_servizi_totale = sum((a.prezzo_vendita_attivita for a in trattativa.attivita.all()), Decimal(0))
+        attese.calcola_derivati()
+        for campo in Trattativa.CAMPI_TOTALI + Trattativa.CAMPI_DERIVATI:
+            self.assertEqual(
+                getattr(trattativa, campo).quantize(Decimal('0.01')), Decimal(getattr(attese, campo)).quantize(Decimal('0.01')),
+                f'{trattativa.titolo}: {campo}',
+            )
+
+    def test_totali_dopo_le_attivita(self):
+        for trattativa in (self.cucina, self.bagno, self.senza_montatore):
+            self.assertTotaliCorretti(trattativa)
+        self.assertEqual(Trattativa.objects.get(pk=self.cucina.pk).costo_personale_totale, Decimal('180.00'))
+
+    def test_costo_del_ruolo_aggiorna_tutte_le_trattative(self):
+        self.montatore.costo_orario = Decimal('30.00')
+        self.montatore.save()
+        # 4h a 30€ + 2h a 40€; 3h a 30€; la terza non usa il montatore
+        self.assertEqual(Trattativa.objects.get(pk=self.cucina.pk).costo_personale_totale, Decimal('200.00'))
+        self.assertEqual(Trattativa.objects.get(pk=self.bagno.pk).costo_personale_totale, Decimal('90.00'))
+        self.assertEqual(Trattativa.objects.get(pk=self.senza_montatore.pk).costo_personale_totale, Decimal('200.00'))
+        for trattativa in (self.cucina, self.bagno, self.senza_montatore):
+            self.assertTotaliCorretti(trattativa)
+        self.assertEqual(calcoli.trattative_con_totali_errati(), [])
+
+    def test_eliminare_il_ruolo_azzera_il_suo_costo(self):
+        self.montatore.delete()
+        for trattativa in (self.cucina, self.bagno, self.senza_montatore):
+            self.assertTotaliCorretti(trattativa)
+        self.assertEqual(Trattativa.objects.get(pk=self.bagno.pk).costo_personale_totale, Decimal('0.00'))
+
+    def test_totali_corrotti_segnalati_e_riparati(self):
+        Trattativa.objects.filter(pk=self.cucina.pk).update(costo_personale_totale=Decimal('999.00'))
+        Trattativa.objects.filter(pk=self.bagno.pk).update(ricavo_servizi_totale=Decimal('1.00'))
+        errate = calcoli.trattative_con_totali_errati()
+        self.assertEqual(errate, [
+            (self.cucina.pk, Decimal('999.00'), Decimal('180.00'), Decimal('250.00'), Decimal('250.00')),
+            (self.bagno.pk, Decimal('75.00'), Decimal('75.00'), Decimal('1.00'), Decimal('90.00')),
+        ])
+
+        uscita = io.StringIO()
+        call_command('verifica_totali_trattative', stdout=uscita)
+        self.assertIn(f'Trattativa {self.cucina.pk}: costo personale 999.00 (atteso 180', uscita.getvalue())
+        self.assertIn('2 trattative non allineate', uscita.getvalue())
+        # Senza --ripara non cambia nulla
+        self.assertEqual(len(calcoli.trattative_con_totali_errati()), 2)
+
+        uscita = io.StringIO()
+        call_command('verifica_totali_trattative', '--ripara', stdout=uscita)
+        self.assertIn('Totali ricalcolati per 2 trattative', uscita.getvalue())
+        self.assertEqual(calcoli.trattative_con_totali_errati(), [])
+        for trattativa in (self.cucina, self.bagno, self.senza_montatore):
+            self.assertTotaliCorretti(trattativa)
+
+        uscita = io.StringIO()
+        call_command('verifica_totali_trattative', stdout=uscita)
+        self.assertIn('Tutti i totali sono allineati', uscita.getvalue())
+
+    def modulo_admin(self, trattativa, righe):
+        """Dati POST della pagina admin della trattativa con l'inline delle attività."""
+        dati = {
+            'titolo': trattativa.titolo, 'cliente_nome': trattativa.cliente_nome, 'cliente_contatto': '',
+            'valore_stimato': trattativa.valore_stimato, 'costo_materiali_stimato': trattativa.costo_materiali_stimato,
+            'stato': trattativa.stato, 'commerciale': trattativa.commerciale_id, 'vendita_collegata': '',
+            'attivita-TOTAL_FORMS': len(righe), 'attivita-INITIAL_FORMS': sum(1 for r in righe if r.get('id')),
+            'attivita-MIN_NUM_FORMS': 0, 'attivita-MAX_NUM_FORMS': 1000,
+        }
+        for indice, riga in enumerate(righe):
+            dati.update({f'attivita-{indice}-{campo}': valore for campo, valore in riga.items()})
+            dati[f'attivita-{indice}-trattativa'] = trattativa.pk
+        return dati
+
+    def test_inline_dell_admin_mantiene_i_totali(self):
+        self.client.force_login(self.utente)
+        url = reverse('admin:gestione_trattativa_change', args=[self.cucina.pk])
+        montaggio, progetto = self.cucina.attivita.order_by('pk')
+        comuni = {'data_attivita': '2026-01-15', 'categoria': self.categoria.pk, 'descrizione': 'Lavoro'}
+        righe = [
+            # Modifica: 4h -> 6h di montaggio
+            {**comuni, 'id': montaggio.pk, 'tempo_dedicato_ore': '6', 'ruolo': self.montatore.pk},
+            # Eliminazione
+            {**comuni, 'id': progetto.pk, 'tempo_dedicato_ore': '2', 'ruolo': self.progettista.pk, 'DELETE': 'on'},
+            # Aggiunta
+            {**comuni, 'tempo_dedicato_ore': '1.5', 'ruolo': self.progettista.pk},
+        ]
+        with self.captureOnCommitCallbacks(execute=True):
+            risposta = self.client.post(url, self.modulo_admin(self.cucina, righe))
+        self.assertEqual(risposta.status_code, 302, getattr(risposta, 'context', None) and risposta.context['errors'])
+        self.assertEqual(self.cucina.attivita.count(), 2)
+        # 6h a 25€ + 1,5h a 40€
+        self.assertEqual(Trattativa.objects.get(pk=self.cucina.pk).costo_personale_totale, Decimal('210.00'))
+        self.assertTotaliCorretti(self.cucina)
+        self.assertEqual(calcoli.trattative_con_totali_errati(), [])
+
+
+# --- IMPOSTAZIONI GENERALI (SINGLETON IN CACHE) ---
+class ImpostazioniTest(TestCase):
+
+    def setUp(self):
+        impostazioni.invalida()
+        self.addCleanup(impostazioni.invalida)
+
+    def test_senza_riga_valgono_i_default_e_non_si_scrive(self):
+        with self.assertNumQueries(1):
+            valori = impostazioni.correnti()
+        self.assertEqual(valori.soglia_alert_margine_servizio, Decimal('20.00'))
+        self.assertEqual(valori.soglia_alert_giorni_evasione, 60)
+        self.assertEqual(valori.soglia_alert_resi_difetti, 5)
+        self.assertEqual(valori.soglia_alert_finanziamenti_respinti, 3)
+        self.assertFalse(ImpostazioniGenerali.objects.exists())
+        # A regime nessuna query
+        with self.assertNumQueries(0):
+            self.assertIs(impostazioni.correnti(), valori)
+
+    def test_salvataggio_senza_delete_e_nuova_versione(self):
+        impostazioni.correnti()
+        riga = ImpostazioniGenerali(soglia_alert_resi_difetti=10)
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as query:
+            riga.save()
+        self.assertEqual(riga.pk, 1)
+        self.assertFalse([q for q in query.captured_queries if q['sql'].startswith('DELETE')])
+        self.assertEqual(impostazioni.correnti().soglia_alert_resi_difetti, 10)
+
+    def test_la_versione_condivisa_aggiorna_gli_altri_processi(self):
+        impostazioni.correnti()
+        # Un altro processo salva: qui arriva solo la versione nuova nella cache condivisa
+        ImpostazioniGenerali.objects.create(soglia_alert_giorni_evasione=30)
+        cache.set(impostazioni.CHIAVE_VERSIONE, 'altro-processo', None)
+        self.assertEqual(impostazioni.correnti().soglia_alert_giorni_evasione, 30)
+
+
+# --- CHAT: PAGINE A CURSORE E POLLING ---
+class ChatTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.utente = User.objects.create_user('commerciale', password='x')
+        cls.trattativa = Trattativa.objects.create(titolo='Cucina', cliente_nome='Cliente', commerciale=cls.utente)
+        # Molti messaggi con lo stesso timestamp: il cursore deve distinguerli con l'id
+        istante = timezone.now() - datetime.timedelta(days=1)
+        MessaggioChat.objects.bulk_create([
+            MessaggioChat(trattativa=cls.trattativa, utente=cls.utente, messaggio=f'Messaggio {i}')
+            for i in range(views.CHAT_MESSAGGI_PER_PAGINA * 2 + 5)
+        ])
+        MessaggioChat.objects.update(timestamp=istante)
+        cls.messaggi = list(MessaggioChat.objects.order_by('id').values_list('id', flat=True))
+
+    def setUp(self):
+        self.client.force_login(self.utente)
+
+    def test_dettaglio_mostra_solo_gli_ultimi(self):
+        risposta = self.client.get(reverse('trattativa_dettaglio', args=[self.trattativa.id]))
+        mostrati = [m.id for m in risposta.context['messaggi_chat']]
+        self.assertEqual(mostrati, self.messaggi[-views.CHAT_MESSAGGI_PER_PAGINA:])
+        self.assertContains(risposta, 'hx-trigger="intersect once"')
+        self.assertContains(risposta, f'id="chat-dopo-id" name="dopo_id" value="{self.messaggi[-1]}"')
+
+    def test_pagine_precedenti_senza_buchi_ne_doppioni(self):
+        risposta = self.client.get(reverse('trattativa_dettaglio', args=[self.trattativa.id]))
+        visti = [m.id for m in risposta.context['messaggi_chat']]
+        cursore = risposta.context['cursore_chat']
+        while cursore:
+            risposta = self.client.get(reverse('messaggi_precedenti', args=[self.trattativa.id]), cursore)
+            visti = [m.id for m in risposta.context['messaggi_chat']] + visti
+            cursore = risposta.context['cursore_chat']
+        self.assertEqual(visti, self.messaggi)
+        self.assertNotContains(risposta, 'intersect once')
+
+    def test_polling_senza_novita_ritorna_204(self):
+        url = reverse('messaggi_nuovi', args=[self.trattativa.id])
+        with CaptureQueriesContext(connection) as query:
+            risposta = self.client.get(url, {'dopo_id': self.messaggi[-1]})
+        self.assertEqual(risposta.status_code, 204)
+        self.assertEqual(risposta.content, b'')
+        self.assertEqual(len([q for q in query.captured_queries if 'gestione_messaggiochat' in q['sql']]), 1)
+        self.assertEqual(self.client.get(url, {'dopo_id': 'x'}).status_code, 400)
+
+    def test_invio_ritorna_anche_i_messaggi_arrivati_nel_frattempo(self):
+        altro = User.objects.create_user('montatore', password='x')
+        arrivato = MessaggioChat.objects.create(trattativa=self.trattativa, utente=altro, messaggio='Arrivato')
+        risposta = self.client.post(reverse('add_messaggio', args=[self.trattativa.id]), {
+            'messaggio': 'Mio', 'dopo_id': self.messaggi[-1],
+        })
+        mio = MessaggioChat.objects.latest('id')
+        self.assertEqual([m.id for m in risposta.context['messaggi_chat']], [arrivato.id, mio.id])
+        self.assertContains(risposta, f'id="chat-dopo-id" name="dopo_id" value="{mio.id}" hx-swap-oob="true"')
+        # Il poller successivo non li riporta
+        risposta = self.client.get(reverse('messaggi_nuovi', args=[self.trattativa.id]), {'dopo_id': mio.id})
+        self.assertEqual(risposta.status_code, 204)
+
+
+# --- RICERCA GLOBALE (FTS5) ---
+class RicercaTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.utente = User.objects.create_user('commerciale', password='x')
+        cls.categoria = CategoriaMerceologica.objects.create(nome='Cucine')
+
+    def setUp(self):
+        self.client.force_login(self.utente)
+
+    def trovati(self, testo):
+        return [(r.etichetta, r.oggetto_id) for r in indice_ricerca.cerca(testo)]
+
+    def test_indice_seguito_dai_segnali(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            vendita = Vendita.objects.create(
+                descrizione='Cucina su misura', categoria=self.categoria, prezzo_vendita=1000, costo_acquisto=600,
+                data_vendita=datetime.date(2025, 3, 1), cliente='Famiglia Rossi',
+            )
+            trattativa = Trattativa.objects.create(titolo='Cucina Rossi', cliente_nome='Mario Rossi', vendita_collegata=vendita)
+            attivita = Attivita.objects.create(trattativa=trattativa, descrizione='Montaggio', note='Pensili da rinforzare')
+            messaggio = MessaggioChat.objects.create(trattativa=trattativa, utente=self.utente, messaggio='Il cliente è già passato in negozio')
+        # Il titolo pesa più del testo; le parole si cercano anche come prefisso e senza accenti
+        self.assertEqual(self.trovati('rossi'), [('Trattativa', trattativa.id), ('Vendita', vendita.id)])
+        self.assertEqual(self.trovati('pensil'), [('Attività', attivita.id)])
+        self.assertEqual(self.trovati('gia negozio'), [('Messaggio', messaggio.id)])
+        risultato = indice_ricerca.cerca('negozio')[0]
+        self.assertEqual((risultato.trattativa_titolo, risultato.url), ('Cucina Rossi', reverse('trattativa_dettaglio', args=[trattativa.id])))
+        self.assertIn('<mark>negozio</mark>', risultato.estratto)
+        self.assertEqual(indice_ricerca.cerca('su misura')[0].url, reverse('trattativa_dettaglio', args=[trattativa.id]))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            trattativa.titolo = 'Soggiorno Bianchi'
+            trattativa.save()
+        self.assertEqual(self.trovati('soggiorno'), [('Trattativa', trattativa.id)])
+        self.assertEqual(self.trovati('cucina rossi'), [('Vendita', vendita.id)])
+
+        # Cancellazione a cascata: spariscono trattativa, attività e messaggi; la vendita perde il link
+        with self.captureOnCommitCallbacks(execute=True):
+            trattativa.delete()
+        self.assertEqual(self.trovati('soggiorno') + self.trovati('pensili') + self.trovati('negozio'), [])
+        self.assertEqual(indice_ricerca.cerca('rossi')[0].url, reverse('admin:gestione_vendita_change', args=[vendita.id]))
+
+    def test_prima_i_titoli_poi_i_messaggi_recenti(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            trattativa = Trattativa.objects.create(titolo='Cucina Neri', cliente_nome='Neri')
+            messaggi = [MessaggioChat.objects.create(trattativa=trattativa, messaggio='Chiamare Neri') for _ in range(5)]
+        # Solo le prime righe per rowid entrano nell'ordinamento per pertinenza
+        with mock.patch.object(indice_ricerca, 'FINESTRA_PUNTEGGIO', 3):
+            trovati = self.trovati('neri')
+        self.assertEqual(trovati[0], ('Trattativa', trattativa.id))
+        self.assertEqual(set(trovati[1:]), {('Messaggio', m.id) for m in messaggi[-2:]})
+
+    def test_testo_utente_e_html(self):
+        self.assertEqual(indice_ricerca.espressione('a "OR" cucina-ros*'), '"OR" "cucina" "ros"*')
+        self.assertEqual(indice_ricerca.espressione(' ? '), '')
+        trattativa = Trattativa.objects.create(titolo='Bagno', cliente_nome='Verdi')
+        with self.captureOnCommitCallbacks(execute=True):
+            MessaggioChat.objects.create(trattativa=trattativa, utente=self.utente, messaggio='<script>sconto</script>')
+        self.assertIn('&lt;script&gt;<mark>sconto</mark>', indice_ricerca.cerca('sconto')[0].estratto)
+
+        risposta = self.client.get(reverse('ricerca'), {'q': 'scon'}, HTTP_HX_REQUEST='true')
+        self.assertTemplateUsed(risposta, 'gestione/partials/_partial_ricerca_suggerimenti.html')
+        self.assertContains(risposta, '<mark>sconto</mark>')
+        self.assertNotContains(risposta, '<script>')
+        self.assertEqual(self.client.get(reverse('ricerca'), {'q': ''}, HTTP_HX_REQUEST='true').content.strip(), b'')
+        self.assertContains(self.client.get(reverse('ricerca'), {'q': 'bagno'}), '<mark>Bagno</mark>')
+
+
+# --- PREVISIONE DELLA PIPELINE ---
+class PrevisioniTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.utente = User.objects.create_user('commerciale', password='x')
+        # 10 vinte passando da tutte le fasi (10 giorni per fase), 20 perse subito dopo il lead
+        chiuse = Trattativa.objects.bulk_create([
+            Trattativa(titolo=f'Chiusa {i}', cliente_nome='Cliente', commerciale=cls.utente,
+                       stato=Trattativa.STATO_VINTO if i < 10 else Trattativa.STATO_PERSO)
+            for i in range(30)
+        ])
+        inizio = timezone.now() - datetime.timedelta(days=100)
+        passaggi = []
+        for t in chiuse:
+            percorso = previsioni.FASI + [t.stato] if t.stato == Trattativa.STATO_VINTO else [Trattativa.STATO_LEAD, t.stato]
+            passo = 10 if t.stato == Trattativa.STATO_VINTO else 5
+            passaggi += [
+                PassaggioStato(trattativa=t, stato=stato, data=inizio + datetime.timedelta(days=passo * i))
+                for i, stato in enumerate(percorso)
+            ]
+        PassaggioStato.objects.bulk_create(passaggi)
+        cls.lead = Trattativa.objects.create(titolo='Cucina', cliente_nome='Rossi', valore_stimato=Decimal('1000'), commerciale=cls.utente)
+        Trattativa.objects.create(titolo='Bagno', cliente_nome='Bianchi', valore_stimato=Decimal('2000'), stato=Trattativa.STATO_PREVENTIVO)
+        Trattativa.objects.create(titolo='Armadio', cliente_nome='Verdi', valore_stimato=Decimal('500'), stato=Trattativa.STATO_MONTAGGIO)
+        cls.base = 11 / 32
+
+    def setUp(self):
+        # Code rimaste da altri test: in TestCase le callback di fine transazione non partono
+        previsioni._svuota_coda()
+        cache.clear()
+
+    def test_modello_dalle_chiuse(self):
+        modello = previsioni.addestra()
+        self.assertAlmostEqual(modello.tasso_base, self.base)
+        self.assertEqual(list(modello.chiuse_per_fase), [30, 10, 10, 10, 10, 10])
+        peso = previsioni.PESO_PRIOR
+        self.assertAlmostEqual(modello.probabilita_fase[0], (10 + peso * self.base) / (30 + peso))
+        self.assertAlmostEqual(modello.probabilita_fase[5], (10 + peso * self.base) / (10 + peso))
+        self.assertAlmostEqual(modello.correzione_commerciale[self.utente.id], (10 + peso * self.base) / (30 + peso) / self.base)
+        np.testing.assert_allclose(modello.tempi_fase[5], 10) # dall'ultima fase alla vincita
+        self.assertEqual(list(modello.giorni_in_fase), [5, 10, 10, 10, 10, 10])
+
+    def test_passaggi_di_trattative_non_lette_scartati(self):
+        # Come se altre trattative si fossero chiuse tra le due query: i loro passaggi non contano
+        atteso = previsioni.addestra()
+        with mock.patch.object(PassaggioStato.objects, 'filter', lambda **filtri: PassaggioStato.objects.all()):
+            modello = previsioni.addestra()
+        np.testing.assert_allclose(modello.probabilita_fase, atteso.probabilita_fase)
+        np.testing.assert_allclose(modello.giorni_in_fase, atteso.giorni_in_fase)
+
+    def test_ripartizione_sui_mesi(self):
+        quote = previsioni.ripartizione(np.array([10., 20., 30., 100.]), np.array([0., 25., 150.]), np.array([10., 45.]))
+        # colonne: entro 10 giorni, entro 45, oltre; chi è oltre tutti i tempi osservati chiude subito
+        np.testing.assert_allclose(quote, [[.25, .5, .25], [.5, 0, .5], [1, 0, 0]])
+
+    def test_valutazione_in_blocco_come_una_per_volta(self):
+        modello, adesso = previsioni.addestra(), timezone.now()
+        _, limiti = previsioni._mesi(adesso)
+        righe = previsioni._trattative_aperte()
+        ids, probabilita, valori, contributi = previsioni.valuta(modello, righe, adesso, limiti)
+        np.testing.assert_allclose(contributi.sum(axis=1), probabilita * valori)
+        for i, riga in enumerate(righe):
+            np.testing.assert_allclose(contributi[i], previsioni.valuta(modello, [riga], adesso, limiti)[3][0])
+
+    def test_spostamento_rivaluta_solo_la_trattativa(self):
+        modello, _ = previsioni.previsione()
+        trattativa = Trattativa.objects.get(pk=self.lead.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            trattativa.stato = Trattativa.STATO_PREVENTIVO
+            trattativa.save()
+        self.assertEqual(trattativa.passaggi_stato.count(), 2)
+        with mock.patch.object(previsioni, 'calcola') as calcola, mock.patch.object(previsioni, 'addestra') as addestra:
+            _, dopo = previsioni.previsione()
+        calcola.assert_not_called()
+        addestra.assert_not_called()
+        probabilita = dict(zip(dopo['ids'], dopo['probabilita']))
+        self.assertAlmostEqual(probabilita[trattativa.pk], modello.probabilita_fase[3] * modello.correzione_commerciale[self.utente.id])
+        # Uguale a un ricalcolo completo
+        completa = previsioni.calcola(modello, dopo['versione'], dopo['adesso'])
+        np.testing.assert_allclose(dopo['contributi'][np.argsort(dopo['ids'])], completa['contributi'][np.argsort(completa['ids'])])
+
+        # Una chiusura cambia il modello: si ristima tutto
+        with self.captureOnCommitCallbacks(execute=True):
+            trattativa.stato = Trattativa.STATO_PERSO
+            trattativa.save()
+        with mock.patch.object(previsioni, 'addestra', wraps=previsioni.addestra) as addestra:
+            modello, dopo = previsioni.previsione()
+        addestra.assert_called_once()
+        self.assertNotIn(trattativa.pk, dopo['ids'])
+        self.assertEqual(modello.trattative_chiuse, 31)
+
+    def test_stato_sconosciuto_non_rompe_la_previsione(self):
+        self.client.force_login(self.utente)
+        risposta = self.client.post(reverse('move_trattativa'), {'id': self.lead.pk, 'stato': 'FOO'})
+        self.assertEqual(risposta.status_code, 400)
+        self.assertEqual(Trattativa.objects.get(pk=self.lead.pk).stato, Trattativa.STATO_LEAD)
+        # Dati sporchi scritti per altre vie: la trattativa si salta, il resto si prevede
+        Trattativa.objects.filter(pk=self.lead.pk).update(stato='FOO')
+        _, dati = previsioni.previsione()
+        self.assertNotIn(self.lead.pk, dati['ids'])
+        self.assertEqual(len(dati['ids']), 2)
+        self.assertEqual(self.client.get(reverse('previsioni_pipeline')).status_code, 200)
+
+
+# --- EVENTI DELLA KANBAN (SSE) ---
+class EventiKanbanTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.utente = User.objects.create_user('commerciale', password='x')
+        cls.trattativa = Trattativa.objects.create(titolo='Cucina', cliente_nome='Cliente', commerciale=cls.utente)
+
+    def setUp(self):
+        self.canale = eventi.Canale(recenti=3)
+        patcher = mock.patch.object(eventi, 'kanban', self.canale)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_spostamento_pubblica_la_card_dopo_il_commit(self):
+        self.client.force_login(self.utente)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('move_trattativa'), {'id': self.trattativa.id, 'stato': Trattativa.STATO_PROGETTAZIONE})
+            self.assertEqual(self.canale._ultimo, 0)
+        (_, (_, tipo, dati)), = self.canale._recenti
+        dati = json.loads(dati)
+        self.assertEqual(tipo, 'spostata')
+        self.assertEqual((dati['stato'], dati['stato_precedente']), (Trattativa.STATO_PROGETTAZIONE, Trattativa.STATO_LEAD))
+        self.assertIn(f'id="trattativa-{self.trattativa.id}"', dati['html'])
+        # Salvare senza cambiare stato non pubblica niente
+        with self.captureOnCommitCallbacks(execute=True):
+            Trattativa.objects.get(pk=self.trattativa.pk).save()
+        self.assertEqual(self.canale._ultimo, 1)
+
+    async def test_riconnessione_ripete_gli_eventi_persi(self):
+        primo = self.canale.pubblica('spostata', {'id': 1})
+        self.canale.pubblica('chiusa', {'id': 2})
+        coda, arretrati = self.canale.iscrivi(primo)
+        self.assertEqual([tipo for _, tipo, _ in arretrati], ['chiusa'])
+        # Troppo vecchio per il buffer o di un altro processo: il client deve ricaricare
+        for _ in range(3):
+            self.canale.pubblica('spostata', {'id': 3})
+        self.assertIsNone(self.canale.iscrivi(primo)[1])
+        self.assertIsNone(self.canale.iscrivi('abc-1')[1])
+        await asyncio.sleep(0) # la consegna passa dal loop (call_soon_threadsafe)
+        self.assertEqual(coda.qsize(), 3)
+
+    @mock.patch.object(eventi, 'DURATA_MAX_SECONDI', 0.5)
+    async def test_stream_consegna_gli_eventi_pubblicati(self):
+        await sync_to_async(self.async_client.force_login)(self.utente)
+        risposta = await self.async_client.get(reverse('eventi_kanban'))
+        self.assertEqual(risposta['Content-Type'], 'text/event-stream')
+        stream = aiter(risposta.streaming_content)
+        self.assertEqual(await anext(stream), b'retry: 3000\n\n')
+        self.assertEqual(self.canale.iscritti, 1)
+        id_evento = self.canale.pubblica('spostata', {'id': 7, 'stato': 'LEAD'})
+        blocco = await asyncio.wait_for(anext(stream), 2)
+        self.assertEqual(blocco.decode(), f'id: {id_evento}\nevent: spostata\ndata: {{"id": 7, "stato": "LEAD"}}\n\n')
+        # Allo scadere della durata massima lo stream si chiude (il browser si riconnette)
+        self.assertEqual({blocco async for blocco in stream} - {b': battito\n\n'}, set())
+        self.assertEqual(self.canale.iscritti, 0)
+
+    def test_senza_asgi_o_senza_login(self):
+        self.assertEqual(self.client.get(reverse('eventi_kanban')).status_code, 403)
+        self.client.force_login(self.utente)
+        self.assertEqual(self.client.get(reverse('eventi_kanban')).status_code, 204)
+
+
+# --- OPERAZIONI MASSIVE SULLA KANBAN ---
+class OperazioniKanbanTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.utente = User.objects.create_user('commerciale', password='x')
+        cls.collega = User.objects.create_user('collega', password='x')
+        cls.aperte = [
+            Trattativa.objects.create(titolo=f'Cucina {i}', cliente_nome='Cliente', commerciale=cls.utente)
+            for i in range(3)
+        ]
+        cls.chiusa = Trattativa.objects.create(titolo='Bagno', cliente_nome='Cliente', stato=Trattativa.STATO_PERSO)
+
+    def setUp(self):
+        self.client.force_login(self.utente)
+
+    def invia(self, operazioni):
+        return self.client.post(reverse('operazioni_kanban'), {'operazioni': operazioni}, content_type='application/json')
+
+    def test_applica_le_valide_e_segnala_le_altre(self):
+        a, b, c = self.aperte
+        prima = Trattativa.objects.get(pk=a.pk).data_ultimo_aggiornamento
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as query:
+            risposta = self.invia([
+                {'id': a.id, 'stato': Trattativa.STATO_PREVENTIVO},
+                {'id': b.id, 'stato': Trattativa.STATO_PERSO, 'commerciale': self.collega.id},
+                {'id': c.id, 'stato': 'INVENTATO'},
+                {'id': c.id, 'stato': Trattativa.STATO_VINTO},
+                {'id': self.chiusa.id, 'stato': Trattativa.STATO_LEAD},
+                {'id': 999999, 'commerciale': self.collega.id},
+                {'id': c.id, 'commerciale': 999999},
+            ])
+        self.assertEqual(risposta.status_code, 200)
+        dati = risposta.json()
+        self.assertEqual(dati['aggiornate'], 2)
+        self.assertEqual([r['ok'] for r in dati['risultati']], [True, True, False, False, False, False, False])
+        self.assertEqual(dati['risultati'][4]['errore'], "Trattativa già chiusa.")
+        self.assertEqual(
+            list(Trattativa.objects.filter(pk__in=[a.pk, b.pk, c.pk]).order_by('pk').values_list('stato', 'commerciale_id')),
+            [(Trattativa.STATO_PREVENTIVO, self.utente.id), (Trattativa.STATO_PERSO, self.collega.id), (Trattativa.STATO_LEAD, self.utente.id)],
+        )
+        self.assertGreater(Trattativa.objects.get(pk=a.pk).data_ultimo_aggiornamento, prima)
+        self.assertEqual(list(PassaggioStato.objects.filter(trattativa__in=[a, b], stato_precedente__isnull=False).order_by(
+            'trattativa_id').values_list('stato_precedente', 'stato')), [(Trattativa.STATO_LEAD, Trattativa.STATO_PREVENTIVO), (Trattativa.STATO_LEAD, Trattativa.STATO_PERSO)])
+        # Un solo UPDATE, che tocca solo i campi modificati
+        update = [q['sql'] for q in query.captured_queries if q['sql'].startswith('UPDATE "gestione_trattativa"')]
+        self.assertEqual(len(update), 1)
+        self.assertNotIn('"titolo"', update[0])
+        # bulk_update non manda segnali: il riepilogo del mese va aggiornato a mano
+        self.assertEqual(
+            RiepilogoTrattativeMensile.objects.get(commerciale=self.collega).preventivi_persi, 1,
+        )
+
+    def test_richieste_malformate(self):
+        self.assertEqual(self.client.post(reverse('operazioni_kanban'), 'non json', content_type='application/json').status_code, 400)
+        self.assertEqual(self.invia([]).status_code, 400)
+        self.assertEqual(self.invia([{'id': self.aperte[0].id}]).status_code, 400)
+        self.assertEqual(self.invia([{'id': 'x', 'stato': 'LEAD'}]).status_code, 400)
+        self.assertEqual(self.invia([{'id': self.aperte[0].id, 'stato': ['PERSO']}]).status_code, 400)
+        self.assertEqual(self.invia([{'id': self.aperte[0].id, 'commerciale': 'x'}]).status_code, 400)
+        self.assertEqual(self.invia([{'id': True, 'stato': 'PERSO'}]).status_code, 400)
+        self.assertEqual(self.invia([{'id': self.aperte[0].id, 'commerciale': False}]).status_code, 400)
+
+
+# --- IMPORTAZIONE IN BLOCCO ---
+def _csv(*righe):
+    return io.BytesIO(('\ufeff' + '\n'.join(';'.join(r) for r in righe)).encode('utf-8'))
+
+class ImportazioniTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.utente = User.objects.create_superuser('admin', 'admin@example.com', 'x')
+        cls.cucine = CategoriaMerceologica.objects.create(nome='Cucine')
+        cls.montaggio = CategoriaServizio.objects.create(nome='Montaggio')
+        cls.ruolo = RuoloCosto.objects.create(nome='Montatore', costo_orario=Decimal('25.00'))
+
+    def vendite(self):
+        return _csv(
+            ['Data Vendita', 'Descrizione', 'Categoria', 'Prezzo Vendita', 'Costo Acquisto', 'Venditore', 'Flag Reso'],
+            ['15/03/2024', 'Cucina Rossi', 'cucine', '1.234,50', '700', 'ADMIN', 'no'],
+            ['2024-03-20', 'Cucina Bianchi', 'Cucine', '2000', '1200', '', 'sì'],
+            ['32/03/2024', 'Data sbagliata', 'Cucine', '100', '50', '', ''],
+            ['2024-03-21', '', 'Bagni', 'molto', '50', 'nessuno', ''],
+            ['2024-04-02', 'Cucina Verdi', 'Cucine', '3000', '1800', '', ''],
+        )
+
+    def test_vendite_a_blocchi_con_report_degli_errori(self):
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as query:
+            risultato = importazioni.importa(self.vendite(), 'vendite', dimensione_blocco=2)
+        self.assertEqual((risultato.righe_lette, risultato.righe_importate, risultato.errori_totali), (5, 3, 2))
+        self.assertEqual([numero for numero, _ in risultato.errori], [4, 5])
+        self.assertIn('data_vendita', risultato.errori[0][1])
+        for colonna in ('descrizione', 'categoria', 'prezzo_vendita', 'venditore'):
+            self.assertIn(colonna, risultato.errori[1][1])
+        rossi = Vendita.objects.get(descrizione='Cucina Rossi')
+        self.assertEqual((rossi.prezzo_vendita, rossi.venditore, rossi.data_vendita), (Decimal('1234.50'), self.utente, datetime.date(2024, 3, 15)))
+        self.assertTrue(Vendita.objects.get(descrizione='Cucina Bianchi').flag_reso)
+        # Un INSERT per blocco, nessun INSERT riga per riga
+        self.assertEqual(len([q for q in query.captured_queries if q['sql'].startswith('INSERT INTO "gestione_vendita"')]), 2)
+        # Una transazione (qui un savepoint) per blocco, non una per tutto il file
+        self.assertEqual(len([q for q in query.captured_queries if q['sql'].startswith('SAVEPOINT')]), 2)
+        # I riepiloghi dei mesi toccati sono aggiornati come avrebbero fatto i segnali
+        marzo = RiepilogoVenditeMensile.objects.filter(anno=2024, mese=3).aggregate(n=models.Sum('numero_vendite'))['n']
+        self.assertEqual(marzo, 2)
+        self.assertEqual([r.oggetto_id for r in indice_ricerca.cerca('rossi')], [rossi.id])
+
+    def test_prova_non_scrive(self):
+        with CaptureQueriesContext(connection) as query:
+            risultato = importazioni.importa(self.vendite(), 'vendite', prova=True)
+        # Nessuna transazione, quindi nessun lock di scrittura
+        self.assertFalse([q for q in query.captured_queries if q['sql'].startswith('SAVEPOINT')])
+        self.assertEqual((risultato.righe_importate, risultato.errori_totali), (3, 2))
+        self.assertFalse(Vendita.objects.exists())
+
+    def test_interruzione_tiene_i_blocchi_salvati(self):
+        costruisci = importazioni.ImportatoreVendite.costruisci
+        def costruisci_fino_a_verdi(importatore, valori, anagrafiche):
+            if valori.get('descrizione') == 'Cucina Verdi':
+                raise RuntimeError('file troncato')
+            return costruisci(importatore, valori, anagrafiche)
+        with self.captureOnCommitCallbacks(execute=True), \
+                mock.patch.object(importazioni.ImportatoreVendite, 'costruisci', costruisci_fino_a_verdi), \
+                self.assertRaisesMessage(RuntimeError, 'file troncato'):
+            importazioni.importa(self.vendite(), 'vendite', dimensione_blocco=2)
+        # Il primo blocco è già confermato, e con i riepiloghi aggiornati
+        self.assertEqual(Vendita.objects.count(), 2)
+        self.assertEqual(RiepilogoVenditeMensile.objects.filter(anno=2024, mese=3).aggregate(n=models.Sum('numero_vendite'))['n'], 2)
+
+    def test_colonne_mancanti(self):
+        with self.assertRaisesMessage(importazioni.ErroreImportazione, 'Colonne mancanti: costo_acquisto'):
+            importazioni.importa(_csv(['data_vendita', 'descrizione', 'categoria', 'prezzo_vendita']), 'vendite')
+
+    def test_trattative_da_excel(self):
+        wb = openpyxl.Workbook()
+        ws = wb.active
+        ws.append(['titolo', 'cliente_nome', 'stato', 'commerciale', 'valore_stimato', 'costo_materiali_stimato', 'data_creazione'])
+        ws.append(['Cucina', 'Rossi', 'Preventivo Inviato', 'admin', 1000, 600, datetime.datetime(2023, 5, 10, 9, 30)])
+        ws.append(['Bagno', 'Verdi', 'CHIUSO', '', 10, 5, None])
+        file = io.BytesIO()
+        wb.save(file)
+        file.seek(0)
+        risultato = importazioni.importa(file, 'trattative', formato='xlsx')
+        self.assertEqual(risultato.errori, [(3, "stato: 'CHIUSO' non è uno stato valido.")])
+        cucina = Trattativa.objects.get()
+        self.assertEqual((cucina.stato, cucina.commerciale), (Trattativa.STATO_PREVENTIVO, self.utente))
+        self.assertEqual(cucina.margine_stimato_euro, Decimal('400.00'))
+        self.assertEqual(timezone.localtime(cucina.data_creazione).date(), datetime.date(2023, 5, 10))
+
+    def test_attivita_aggiornano_i_totali(self):
+        trattativa = Trattativa.objects.create(titolo='Cucina', cliente_nome='Rossi', valore_stimato=Decimal('1000'))
+        file = _csv(
+            ['trattativa', 'ruolo', 'categoria', 'descrizione', 'tempo_dedicato_ore', 'prezzo_vendita_attivita'],
+            [str(trattativa.id), 'Montatore', 'Montaggio', 'Montaggio cucina', '4', '150'],
+            ['999999', 'Montatore', 'Montaggio', 'Trattativa inesistente', '1', '0'],
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            risultato = importazioni.importa(file, 'attivita')
+        self.assertEqual(risultato.errori, [(3, "trattativa: la trattativa 999999 non esiste.")])
+        trattativa.refresh_from_db()
+        self.assertEqual((trattativa.costo_personale_totale, trattativa.ricavo_servizi_totale), (Decimal('100.00'), Decimal('150.00')))
+
+    def test_comando_e_pagina_admin(self):
+        with tempfile.NamedTemporaryFile(suffix='.csv', delete=False) as f:
+            f.write(self.vendite().getvalue())
+        self.addCleanup(os.remove, f.name)
+        report = f.name + '.errori.csv'
+        self.addCleanup(lambda: os.path.exists(report) and os.remove(report))
+        call_command('importa_dati', 'vendite', f.name, '--prova', '--errori', report, stdout=io.StringIO())
+        with open(report, encoding='utf-8') as r:
+            self.assertEqual(len(r.readlines()), 3) # intestazione + 2 errori
+        self.assertFalse(Vendita.objects.exists())
+
+        self.client.force_login(self.utente)
+        url = reverse('admin:gestione_vendita_importa')
+        self.assertContains(self.client.get(reverse('admin:gestione_vendita_changelist')), url)
+        risposta = self.client.post(url, {'file': SimpleUploadedFile('vendite.csv', self.vendite().getvalue())})
+        self.assertContains(risposta, 'Righe scartate')
+        self.assertEqual(Vendita.objects.count(), 3)
@@ -10,14 +10,23 @@ urlpatterns = [
     
     # Kanban
     path('kanban/', views.kanban_board, name='kanban_board'),
+    # Pagine successive di una colonna (HTMX "carica altre")
+    path('kanban/colonna/', views.kanban_colonna, name='kanban_colonna'),
     # API per spostare le card (drag-and-drop)
     path('api/move-trattativa/', views.move_trattativa, name='move_trattativa'),
+    # API JSON per spostamenti e riassegnazioni in blocco
+    path('api/operazioni-trattative/', views.operazioni_kanban, name='operazioni_kanban'),
+    # Stream SSE degli spostamenti (richiede il server ASGI, vedi gestione/eventi.py)
+    path('kanban/eventi/', views.eventi_kanban, name='eventi_kanban'),
     
     # URL Modal "Chiudi Vinto"
     path('trattativa/<int:trattativa_id>/chiudi/', 
          views.chiudi_trattativa_modal, 
          name='chiudi_trattativa_modal'),
 
+    # Previsione delle chiusure della pipeline (JSON)
+    path('previsioni/', views.previsioni_pipeline, name='previsioni_pipeline'),
+
     # Report Attività
     path('report-attivita/', views.report_attivita, name='report_attivita'),
 
@@ -31,6 +40,9 @@ urlpatterns = [
     path('trattativa/<int:trattativa_id>/add-messaggio/', 
          views.add_messaggio, 
          name='add_messaggio'),
+    # Chat: pagine precedenti (scroll) e polling dei messaggi nuovi
+    path('trattativa/<int:trattativa_id>/messaggi/', views.messaggi_precedenti, name='messaggi_precedenti'),
+    path('trattativa/<int:trattativa_id>/messaggi/nuovi/', views.messaggi_nuovi, name='messaggi_nuovi'),
     
     # URL Statistiche Mensili
     path('statistiche-mensili/', views.statistiche_mensili, name='statistiche_mensili'),
@@ -41,8 +53,18 @@ urlpatterns = [
     # --- NUOVI URL (PUNTO 17) ---
     path('lista/', views.trattativa_lista, name='trattativa_lista'),
     path('esporta-excel/', views.esporta_trattative_excel, name='esporta_trattative_excel'),
+    path('esporta-csv/', views.esporta_trattative_csv, name='esporta_trattative_csv'),
+    path('esportazioni/avvia/', views.avvia_esportazione, name='avvia_esportazione'),
+    path('esportazioni/<int:job_id>/', views.stato_esportazione, name='stato_esportazione'),
+    path('esportazioni/<int:job_id>/scarica/', views.scarica_esportazione, name='scarica_esportazione'),
     path('accounts/', include('django.contrib.auth.urls')),
     path('attivita/<int:attivita_id>/modifica/', views.edit_attivita, name='edit_attivita'),
     path('attivita/<int:attivita_id>/elimina/', views.delete_attivita, name='delete_attivita'),
     path('attivita/calcola-costi/', views.calcola_costi_attivita, name='calcola_costi_attivita'),
+
+    # Ricerca globale (pagina e suggerimenti HTMX della navbar)
+    path('cerca/', views.ricerca, name='ricerca'),
+
+    # Prestazioni delle viste (log di profilazione), solo staff
+    path('prestazioni/', views.prestazioni_viste, name='prestazioni_viste'),
 ]
\ No newline at end of file
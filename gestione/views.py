@@ -2,149 +2,112 @@
 
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
-from django.db import models 
-from django.db.models import Sum, Count, F, ExpressionWrapper, DecimalField, Q, Subquery, OuterRef, Avg, Case, When, Value
-from django.db.models.functions import TruncMonth, Coalesce
+from django.contrib.admin.views.decorators import staff_member_required
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db.models import Sum, Count, F, ExpressionWrapper, DecimalField, Q, Case, When, Value, Window
+from django.db.models.functions import RowNumber
+from django.db.models.functions import Coalesce
 from decimal import Decimal
 from .models import (
     Vendita, CategoriaMerceologica, CategoriaServizio, StatMensile, Budget, 
     Trattativa, Attivita, MessaggioChat, ProfiloUtente,
-    ImpostazioniGenerali, RuoloCosto # Assicurati che RuoloCosto sia importato
+    RuoloCosto, # Assicurati che RuoloCosto sia importato
+    RiepilogoVenditeMensile, RiepilogoTrattativeMensile, RiepilogoAttivitaMensile, RiepilogoRuoliMensile,
+    EsportazioneJob, PassaggioStato
 )
 import datetime
-from django.contrib.auth.models import User
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 import json
+from .calcoli import get_trattative_annotate, filtro_trattative_aperte
+from django.db import transaction
 from .forms import (
     TrattativaVintaForm, AttivitaForm, MessaggioChatForm, 
     TrattativaForm, StatMensileForm, TrattativaDettaglioForm
 )
 from django.contrib import messages
 from django.views.decorators.http import require_POST
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, FileResponse, StreamingHttpResponse, Http404
 from django.views.decorators.csrf import csrf_exempt
-import openpyxl
-from openpyxl.styles import Font, Alignment
-from openpyxl.utils import get_column_letter
+import os
+from django.conf import settings
+from . import esportazioni, profilazione, cache_dashboard, cache_costi, eventi, riepiloghi, impostazioni, database, indice_ricerca, previsioni
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
 
-# --- SOGLIE DI ALLERTA ---
-ALERT_SOGLIA_GIORNI_EVASIONE = 60
-ALERT_SOGLIA_RESI_DIFETTI = 5
-ALERT_SOGLIA_FINAN_NON_APPROV = 3
+def _filtra_periodo(queryset, anno, mese):
+    """Filtra una tabella con campi anno/mese (riepiloghi, StatMensile)."""
+    if anno: queryset = queryset.filter(anno=anno)
+    if mese: queryset = queryset.filter(mese=mese)
+    return queryset
 
-# --- FUNZIONI HELPER (BASATE SU RUOLO) ---
-def get_costo_attivita_query():
-    """
-    Ritorna un'espressione SQL per calcolare il costo delle attività.
-    Logica: Ore * costo_orario del Ruolo.
-    """
-    return Sum(
-        F('tempo_dedicato_ore') * Coalesce(F('ruolo__costo_orario'), Decimal(0.0)),
-        output_field=DecimalField()
-    )
+def _anni_disponibili():
+    return RiepilogoVenditeMensile.objects.values_list('anno', flat=True).distinct().order_by('-anno')
 
-def get_costo_personale_trattativa(trattativa_id):
-    """Calcola il costo totale del personale per una singola trattativa."""
-    costo = Attivita.objects.filter(
-        trattativa_id=trattativa_id
-    ).aggregate(
-        costo_totale=Coalesce(get_costo_attivita_query(), Decimal(0.0))
-    )['costo_totale']
-    return costo
 
-def get_costo_personale_query():
-    """
-    Ritorna un'espressione SQL per calcolare il costo aggregato.
-    """
-    return Sum(
-        F('attivita__tempo_dedicato_ore') * Coalesce(F('attivita__ruolo__costo_orario'), Decimal(0.0)),
-        output_field=DecimalField()
-    )
-    
-# --- FINE FUNZIONI HELPER ---
-
-
-# --- NUOVA FUNZIONE HELPER (PUNTO 19) ---
-def get_trattative_annotate():
-    tutte_le_trattative = Trattativa.objects.all().select_related('commerciale')
-
-    # 1. Annotiamo il costo del personale (da Attività)
-    trattative_con_costi = tutte_le_trattative.annotate(
-        costo_personale_totale=Coalesce(
-            Sum(
-                F('attivita__tempo_dedicato_ore') * Coalesce(F('attivita__ruolo__costo_orario'), Decimal(0.0)),
-                output_field=DecimalField()
-            ),
-            Decimal(0.0) 
-        ),
-        ricavo_servizi_totale=Coalesce(
-            Sum('attivita__prezzo_vendita_attivita'),
-            Decimal(0.0)
-        )
-    )
+def _trend_mensile(filtro_mesi):
+    """Punti del grafico (etichetta, vendite, margine, EBIT) per i mesi selezionati da `filtro_mesi`."""
+    trend = RiepilogoVenditeMensile.objects.filter(filtro_mesi).values('anno', 'mese').annotate(
+        tot_venduto_prod=Coalesce(Sum('tot_venduto_prodotti'), Decimal(0)),
+        tot_costo_prod=Coalesce(Sum('tot_costo_prodotti'), Decimal(0)),
+        tot_venduto_serv=Coalesce(Sum('tot_venduto_servizi'), Decimal(0)),
+        costo_personale=Coalesce(Sum('costo_personale'), Decimal(0)),
+    ).order_by('anno', 'mese')
+    costi_manuali_mese = {
+        (s.anno, s.mese): s for s in StatMensile.objects.filter(filtro_mesi)
+    }
 
-    # 3. Annotiamo il margine e la percentuale
-    trattative_con_margine = trattative_con_costi.annotate(
-        valore_totale_stimato=F('valore_stimato') + F('ricavo_servizi_totale'),
-        costo_totale_stimato=F('costo_materiali_stimato') + F('costo_personale_totale'),
-        margine_stimato_euro=F('valore_totale_stimato') - F('costo_totale_stimato'),
-        margine_stimato_perc=Case(
-            When(valore_totale_stimato=0, then=Value(Decimal(0.0))),
-            default=ExpressionWrapper(
-                ( (F('valore_totale_stimato') - F('costo_totale_stimato')) * Decimal(100.0) ) / F('valore_totale_stimato'),
-                output_field=DecimalField(max_digits=5, decimal_places=2)
-            ),
-            output_field=DecimalField(max_digits=5, decimal_places=2)
-        )
-    )
-    return trattative_con_margine.order_by('-data_ultimo_aggiornamento')
+    punti = []
+    for dati_mese in trend:
+        stat = costi_manuali_mese.get((dati_mese['anno'], dati_mese['mese']))
+        
+        month_label = f"{dati_mese['mese']:02d}/{dati_mese['anno']}"
+        vendite_mese = dati_mese['tot_venduto_prod'] + dati_mese['tot_venduto_serv']
+        margine_mese = vendite_mese - dati_mese['tot_costo_prod']
+        
+        costi_fissi_mese = stat.costi_operativi_fissi if stat else Decimal(0)
+        costo_mktg_mese = stat.costo_marketing_mese if stat else Decimal(0)
+        
+        ebit_mese = margine_mese - costi_fissi_mese - dati_mese['costo_personale'] - costo_mktg_mese
+        punti.append((month_label, float(vendite_mese), float(margine_mese), float(ebit_mese)))
+    return punti
 
 
-@login_required 
-def dashboard(request):
-    # ... (Il resto della vista dashboard è invariato) ...
-    selected_year = request.GET.get('anno'); selected_month = request.GET.get('mese')
-    vendite_qs = Vendita.objects.all(); trattative_qs = Trattativa.objects.all(); stats_qs = StatMensile.objects.all()
-    filter_title = "Totale Complessivo"; is_filtered = False
-    if selected_year:
-        vendite_qs = vendite_qs.filter(data_vendita__year=selected_year); trattative_qs = trattative_qs.filter(data_creazione__year=selected_year); stats_qs = stats_qs.filter(anno=selected_year)
-        filter_title = f"Anno {selected_year}"; is_filtered = True
-    if selected_month:
-        vendite_qs = vendite_qs.filter(data_vendita__month=selected_month); trattative_qs = trattative_qs.filter(data_creazione__month=selected_month); stats_qs = stats_qs.filter(mese=selected_month)
-        filter_title = f"{selected_month}/{selected_year}"; is_filtered = True
+def _dati_dashboard(selected_year, selected_month, oggi):
+    """KPI, tabella categorie, avvisi, pipeline e (senza filtri) il punto del mese corrente nel grafico."""
+    riepilogo_qs = _filtra_periodo(RiepilogoVenditeMensile.objects.all(), selected_year, selected_month)
+    riepilogo_trattative_qs = _filtra_periodo(RiepilogoTrattativeMensile.objects.all(), selected_year, selected_month)
+    stats_qs = _filtra_periodo(StatMensile.objects.all(), selected_year, selected_month)
 
-    trattative_vinte_nel_periodo = Trattativa.objects.filter(vendita_collegata__in=vendite_qs)
-    
-    aggregati_vendite = vendite_qs.aggregate(
-        tot_venduto_prodotti=Coalesce(Sum('prezzo_vendita'), Decimal(0)),
-        tot_costo_prodotti=Coalesce(Sum('costo_acquisto'), Decimal(0)),
-        numero_vendite=Count('id'),
-        numero_finanziamenti=Count('id', filter=Q(flag_finanziamento=True)),
-        numero_resi=Coalesce(Count('id', filter=Q(flag_reso=True)), 0)
+    aggregati = riepilogo_qs.aggregate(
+        tot_venduto_prodotti=Coalesce(Sum('tot_venduto_prodotti'), Decimal(0)),
+        tot_costo_prodotti=Coalesce(Sum('tot_costo_prodotti'), Decimal(0)),
+        numero_vendite=Coalesce(Sum('numero_vendite'), 0),
+        numero_finanziamenti=Coalesce(Sum('numero_finanziamenti'), 0),
+        numero_resi=Coalesce(Sum('numero_resi'), 0),
+        tot_venduto_servizi=Coalesce(Sum('tot_venduto_servizi'), Decimal(0)),
+        costo_personale_periodo=Coalesce(Sum('costo_personale'), Decimal(0)),
+        costo_montaggio=Coalesce(Sum('costo_montaggio'), Decimal(0)),
+        giorni_evasione_totali=Coalesce(Sum('giorni_evasione_totali'), 0),
+        numero_evasioni=Coalesce(Sum('numero_evasioni'), 0),
     )
     
-    aggregati_servizi = Attivita.objects.filter(
-        trattativa__in=trattative_vinte_nel_periodo
-    ).aggregate(
-        tot_venduto_servizi=Coalesce(Sum('prezzo_vendita_attivita'), Decimal(0)),
-        costo_personale_periodo=Coalesce(get_costo_attivita_query(), Decimal(0.0))
-    )
-    
-    vendite_totali = aggregati_vendite['tot_venduto_prodotti'] + aggregati_servizi['tot_venduto_servizi']
-    costi_totali_cogs = aggregati_vendite['tot_costo_prodotti'] 
+    vendite_totali = aggregati['tot_venduto_prodotti'] + aggregati['tot_venduto_servizi']
+    costi_totali_cogs = aggregati['tot_costo_prodotti'] 
     margine_lordo_euro = vendite_totali - costi_totali_cogs
     
     margine_totale_percent = Decimal(0)
     if vendite_totali > 0: margine_totale_percent = (margine_lordo_euro / vendite_totali) * 100
-    numero_vendite = aggregati_vendite['numero_vendite']
+    numero_vendite = aggregati['numero_vendite']
     scontrino_medio = Decimal(0)
     if numero_vendite > 0: scontrino_medio = vendite_totali / numero_vendite
     perc_finanziamenti = Decimal(0)
-    if numero_vendite > 0: perc_finanziamenti = (aggregati_vendite['numero_finanziamenti'] / Decimal(numero_vendite)) * 100
+    if numero_vendite > 0: perc_finanziamenti = (aggregati['numero_finanziamenti'] / Decimal(numero_vendite)) * 100
     
     perc_incidenza_servizi = Decimal(0)
     if vendite_totali > 0:
-        perc_incidenza_servizi = (aggregati_servizi['tot_venduto_servizi'] / vendite_totali) * 100
+        perc_incidenza_servizi = (aggregati['tot_venduto_servizi'] / vendite_totali) * 100
 
     costi_manuali = stats_qs.aggregate(
         tot_fissi=Coalesce(Sum('costi_operativi_fissi'), Decimal(0)),
@@ -152,14 +115,14 @@ def dashboard(request):
         tot_finan_respinti=Coalesce(Sum('finanziamenti_non_approvati'), 0)
     )
     costi_fissi_periodo = costi_manuali['tot_fissi']
-    costo_personale_periodo = aggregati_servizi['costo_personale_periodo']
+    costo_personale_periodo = aggregati['costo_personale_periodo']
     
     costi_operativi_totali = costi_fissi_periodo + costo_personale_periodo + costi_manuali['tot_marketing']
     utile_operativo_ebit = margine_lordo_euro - costi_operativi_totali
 
-    aggregati_trattative = trattative_qs.aggregate(
-        lead_generati=Count('id'),
-        preventivi_persi=Count('id', filter=Q(stato=Trattativa.STATO_PERSO))
+    aggregati_trattative = riepilogo_trattative_qs.aggregate(
+        lead_generati=Coalesce(Sum('lead_generati'), 0),
+        preventivi_persi=Coalesce(Sum('preventivi_persi'), 0)
     )
     perc_preventivi_persi = Decimal(0)
     if aggregati_trattative['lead_generati'] > 0:
@@ -167,106 +130,51 @@ def dashboard(request):
     costo_per_lead = Decimal(0)
     if aggregati_trattative['lead_generati'] > 0:
         costo_per_lead = costi_manuali['tot_marketing'] / Decimal(aggregati_trattative['lead_generati'])
-    tempo_evasione_avg = trattative_vinte_nel_periodo.annotate(
-        tempo=ExpressionWrapper(F('vendita_collegata__data_vendita') - F('data_creazione'), output_field=models.DurationField())
-    ).aggregate(
-        tempo_medio=Avg('tempo')
-    )['tempo_medio']
-    tempo_medio_evasione_giorni = tempo_evasione_avg.days if tempo_evasione_avg else 0
+    tempo_medio_evasione_giorni = 0
+    if aggregati['numero_evasioni'] > 0:
+        tempo_medio_evasione_giorni = aggregati['giorni_evasione_totali'] // aggregati['numero_evasioni']
     
-    costo_montaggio = Attivita.objects.filter(
-        trattativa__in=trattative_vinte_nel_periodo, 
-        categoria__nome__icontains='Montaggio'
-    ).aggregate(
-        costo_totale=Coalesce(get_costo_attivita_query(), Decimal(0.0))
-    )['costo_totale']
     costo_medio_montaggio = Decimal(0)
     if numero_vendite > 0:
-        costo_medio_montaggio = costo_montaggio / Decimal(numero_vendite)
+        costo_medio_montaggio = aggregati['costo_montaggio'] / Decimal(numero_vendite)
 
     budget_lookup = {}
     if selected_year and selected_month:
         budget_qs = Budget.objects.filter(anno=selected_year, mese=selected_month)
         for b in budget_qs: budget_lookup[b.categoria_id] = {'vendite': b.obiettivo_vendite_euro, 'margine_perc': b.obiettivo_margine_percentuale}
     
-    categorie_summary_qs = CategoriaMerceologica.objects.annotate(
-        tot_venduto=Coalesce(Sum('vendita__prezzo_vendita', filter=Q(vendita__in=vendite_qs)), Decimal(0)),
-        tot_costo=Coalesce(Sum('vendita__costo_acquisto', filter=Q(vendita__in=vendite_qs)), Decimal(0))
-    ).annotate(margine_euro=F('tot_venduto') - F('tot_costo')).annotate(
-        margine_perc=Case(
-            When(tot_venduto=0, then=Value(Decimal(0.0))),
-            default=ExpressionWrapper((F('margine_euro') * Decimal('100.0') / F('tot_venduto')), output_field=DecimalField(max_digits=5, decimal_places=2)),
-            output_field=DecimalField(max_digits=5, decimal_places=2)
-        )
+    categorie_summary_qs = riepilogo_qs.filter(categoria__isnull=False).values('categoria_id', 'categoria__nome').annotate(
+        tot_venduto=Coalesce(Sum('tot_venduto_prodotti'), Decimal(0)),
+        tot_costo=Coalesce(Sum('tot_costo_prodotti'), Decimal(0))
     ).filter(tot_venduto__gt=0).order_by('-tot_venduto')
     
     categorie_summary = []
     alerts = [] 
     for cat in categorie_summary_qs:
-        budget_cat = budget_lookup.get(cat.id)
+        nome = cat['categoria__nome']
+        margine_euro = cat['tot_venduto'] - cat['tot_costo']
+        margine_perc = (margine_euro * Decimal('100.0') / cat['tot_venduto']).quantize(Decimal('0.01'))
+        budget_cat = budget_lookup.get(cat['categoria_id'])
         scostamento_vendite, scostamento_margine = None, None
         if budget_cat:
-            scostamento_vendite = cat.tot_venduto - budget_cat['vendite']
-            scostamento_margine = (cat.margine_perc or Decimal(0)) - budget_cat['margine_perc']
-            if scostamento_margine < -5: alerts.append({'level': 'danger', 'message': f"Margine Categoria '{cat.nome}' in forte calo: {cat.margine_perc:.2f}% (Budget: {budget_cat['margine_perc']}%)"})
-            elif scostamento_margine < 0: alerts.append({'level': 'warning', 'message': f"Margine Categoria '{cat.nome}' sotto budget: {cat.margine_perc:.2f}% (Budget: {budget_cat['margine_perc']}%)"})
-        categorie_summary.append({'nome': cat.nome, 'tot_venduto': cat.tot_venduto, 'margine_euro': cat.margine_euro, 'margine_perc': cat.margine_perc, 'budget_vendite': budget_cat['vendite'] if budget_cat else None, 'budget_margine_perc': budget_cat['margine_perc'] if budget_cat else None, 'scostamento_vendite': scostamento_vendite, 'scostamento_margine': scostamento_margine})
+            scostamento_vendite = cat['tot_venduto'] - budget_cat['vendite']
+            scostamento_margine = margine_perc - budget_cat['margine_perc']
+            if scostamento_margine < -5: alerts.append({'level': 'danger', 'message': f"Margine Categoria '{nome}' in forte calo: {margine_perc:.2f}% (Budget: {budget_cat['margine_perc']}%)"})
+            elif scostamento_margine < 0: alerts.append({'level': 'warning', 'message': f"Margine Categoria '{nome}' sotto budget: {margine_perc:.2f}% (Budget: {budget_cat['margine_perc']}%)"})
+        categorie_summary.append({'nome': nome, 'tot_venduto': cat['tot_venduto'], 'margine_euro': margine_euro, 'margine_perc': margine_perc, 'budget_vendite': budget_cat['vendite'] if budget_cat else None, 'budget_margine_perc': budget_cat['margine_perc'] if budget_cat else None, 'scostamento_vendite': scostamento_vendite, 'scostamento_margine': scostamento_margine})
     
-    if tempo_medio_evasione_giorni > ALERT_SOGLIA_GIORNI_EVASIONE: alerts.append({'level': 'warning', 'message': f"Tempo medio evasione ordini OLTRE SOGLIA: {tempo_medio_evasione_giorni} giorni"})
-    if aggregati_vendite['numero_resi'] > ALERT_SOGLIA_RESI_DIFETTI: alerts.append({'level': 'danger', 'message': f"Aumento Resi/Difetti: {aggregati_vendite['numero_resi']} casi rilevati"})
-    if costi_manuali['tot_finan_respinti'] > ALERT_SOGLIA_FINAN_NON_APPROV: alerts.append({'level': 'info', 'message': f"Finanziamenti non approvati in aumento: {costi_manuali['tot_finan_respinti']} casi"})
+    soglie = impostazioni.correnti()
+    if tempo_medio_evasione_giorni > soglie.soglia_alert_giorni_evasione: alerts.append({'level': 'warning', 'message': f"Tempo medio evasione ordini OLTRE SOGLIA: {tempo_medio_evasione_giorni} giorni"})
+    if aggregati['numero_resi'] > soglie.soglia_alert_resi_difetti: alerts.append({'level': 'danger', 'message': f"Aumento Resi/Difetti: {aggregati['numero_resi']} casi rilevati"})
+    if costi_manuali['tot_finan_respinti'] > soglie.soglia_alert_finanziamenti_respinti: alerts.append({'level': 'info', 'message': f"Finanziamenti non approvati in aumento: {costi_manuali['tot_finan_respinti']} casi"})
 
-    chart_labels, chart_data_vendite, chart_data_margine, chart_data_ebit = [], [], [], []
-    if not is_filtered:
-        today = timezone.now().date(); start_date = today - datetime.timedelta(days=365)
-        stats_costs_q = StatMensile.objects.filter(anno=OuterRef('month__year'), mese=OuterRef('month__month'))
-        stats_costs_fissi = stats_costs_q.values('costi_operativi_fissi'); stats_costs_mktg = stats_costs_q.values('costo_marketing_mese')
-        
-        trend_prodotti = Vendita.objects.filter(data_vendita__gte=start_date).annotate(month=TruncMonth('data_vendita')).values('month').annotate(
-            tot_venduto_prod=Coalesce(Sum('prezzo_vendita'), Decimal(0)), 
-            tot_costo_prod=Coalesce(Sum('costo_acquisto'), Decimal(0)), 
-            costi_fissi=Coalesce(Subquery(stats_costs_fissi[:1]), Decimal(0)), 
-            costi_mktg=Coalesce(Subquery(stats_costs_mktg[:1]), Decimal(0))
-        ).order_by('month')
-        
-        trend_servizi = Attivita.objects.filter(
-            trattativa__vendita_collegata__data_vendita__gte=start_date
-        ).annotate(
-            month=TruncMonth('trattativa__vendita_collegata__data_vendita')
-        ).values('month').annotate(
-            tot_venduto_serv=Coalesce(Sum('prezzo_vendita_attivita'), Decimal(0)),
-            costo_personale=Coalesce(get_costo_attivita_query(), Decimal(0.0))
-        ).order_by('month')
-        
-        prodotti_dict = {d['month']: d for d in trend_prodotti}
-        servizi_dict = {s['month']: s for s in trend_servizi}
-        all_months = sorted(list(set(prodotti_dict.keys()) | set(servizi_dict.keys())))
+    # Il grafico (solo senza filtri) usa lo storico in cache più il mese corrente
+    trend_mese_corrente = []
+    if not (selected_year or selected_month):
+        trend_mese_corrente = _trend_mensile(Q(anno=oggi.year, mese=oggi.month))
 
-        for month in all_months:
-            data_prod = prodotti_dict.get(month, {})
-            data_serv = servizi_dict.get(month, {})
-            
-            month_label = month.strftime('%m/%Y')
-            vendite_prodotti = data_prod.get('tot_venduto_prod', Decimal(0))
-            vendite_servizi = data_serv.get('tot_venduto_serv', Decimal(0))
-            vendite_mese = vendite_prodotti + vendite_servizi
-            
-            costo_prodotti = data_prod.get('tot_costo_prod', Decimal(0))
-            margine_mese = vendite_mese - costo_prodotti
-            
-            costi_fissi_mese = data_prod.get('costi_fissi', Decimal(0))
-            costo_mktg_mese = data_prod.get('costi_mktg', Decimal(0))
-            costo_personale_mese = data_serv.get('costo_personale', Decimal(0))
-            
-            ebit_mese = margine_mese - costi_fissi_mese - costo_personale_mese - costo_mktg_mese
-            
-            chart_labels.append(month_label)
-            chart_data_vendite.append(float(vendite_mese))
-            chart_data_margine.append(float(margine_mese))
-            chart_data_ebit.append(float(ebit_mese))
-
-    stati_attivi = [Trattativa.STATO_LEAD, Trattativa.STATO_APPUNTAMENTO, Trattativa.STATO_PROGETTAZIONE, Trattativa.STATO_PREVENTIVO, Trattativa.STATO_CONSEGNA, Trattativa.STATO_MONTAGGIO] 
-    pipeline_attiva_qs = get_trattative_annotate().filter(stato__in=stati_attivi) 
+    # Trattative aperte: la query usa solo l'indice parziale trattativa_aperte_idx
+    pipeline_attiva_qs = Trattativa.objects.filter(filtro_trattative_aperte())
     
     pipeline_aggregati = pipeline_attiva_qs.aggregate(
         valore_totale=Coalesce(Sum('valore_totale_stimato'), Decimal(0)), 
@@ -276,19 +184,59 @@ def dashboard(request):
     pipeline_valore = pipeline_aggregati['valore_totale']
     pipeline_numero = pipeline_aggregati['numero_trattative']
     pipeline_costo_loggato = pipeline_aggregati['costo_personale_loggato'] 
+    # Previsione delle chiusure: ha una cache sua, aggiornata a ogni spostamento (vedi previsioni.py)
+    previsione = previsioni.riepilogo()
             
-    available_years = Vendita.objects.dates('data_vendita', 'year', order='DESC'); available_months = range(1, 13)
-    context = {
+    return {
         'vendite_totali': vendite_totali, 'margine_totale_euro': margine_lordo_euro, 'margine_totale_percent': margine_totale_percent,
         'utile_operativo_ebit': utile_operativo_ebit, 'scontrino_medio': scontrino_medio, 'perc_incidenza_servizi': perc_incidenza_servizi,
-        'perc_finanziamenti': perc_finanziamenti, 'numero_resi': aggregati_vendite['numero_resi'], 'numero_vendite': numero_vendite,
+        'perc_finanziamenti': perc_finanziamenti, 'numero_resi': aggregati['numero_resi'], 'numero_vendite': numero_vendite,
         'pipeline_valore': pipeline_valore, 'pipeline_numero': pipeline_numero, 'pipeline_costo_loggato': pipeline_costo_loggato,
         'costo_personale_periodo': costo_personale_periodo, 'kpi_perc_preventivi_persi': perc_preventivi_persi,
         'kpi_costo_per_lead': costo_per_lead, 'kpi_costo_medio_montaggio': costo_medio_montaggio,
         'kpi_tempo_medio_evasione_giorni': tempo_medio_evasione_giorni, 'kpi_finanziamenti_non_approvati': costi_manuali['tot_finan_respinti'],
-        'categorie_summary': categorie_summary, 'filter_title': filter_title, 'is_filtered': is_filtered,
-        'available_years': available_years, 'available_months': available_months, 'selected_year': int(selected_year) if selected_year else None,
-        'selected_month': int(selected_month) if selected_month else None, 'active_page': 'dashboard', 'alerts': alerts,
+        'categorie_summary': categorie_summary, 'alerts': alerts, 'available_years': list(_anni_disponibili()),
+        'trend_mese_corrente': trend_mese_corrente, 'previsione': previsione,
+    }
+
+
+@login_required 
+@database.su_lettura
+def dashboard(request):
+    # I totali arrivano dalle tabelle dei fatti mensili (vedi riepiloghi.py) e restano
+    # in cache finché i dati non cambiano (vedi cache_dashboard.py).
+    selected_year = request.GET.get('anno'); selected_month = request.GET.get('mese')
+    filter_title = "Totale Complessivo"; is_filtered = False
+    if selected_year:
+        filter_title = f"Anno {selected_year}"; is_filtered = True
+    if selected_month:
+        filter_title = f"{selected_month}/{selected_year}"; is_filtered = True
+
+    oggi = timezone.localdate()
+    calcola_storico = None
+    if not is_filtered:
+        # Ultimi 12 mesi, escluso quello corrente (che fa parte dei dati "vivi")
+        start_date = oggi - datetime.timedelta(days=365)
+        dal_mese = Q(anno__gt=start_date.year) | Q(anno=start_date.year, mese__gte=start_date.month)
+        prima_del_mese_corrente = Q(anno__lt=oggi.year) | Q(anno=oggi.year, mese__lt=oggi.month)
+        calcola_storico = lambda: _trend_mensile(dal_mese & prima_del_mese_corrente)
+    dati, storico = cache_dashboard.dati_dashboard(
+        selected_year, selected_month, lambda: _dati_dashboard(selected_year, selected_month, oggi),
+        mese_corrente=(oggi.year, oggi.month), calcola_storico=calcola_storico,
+    )
+
+    chart_labels, chart_data_vendite, chart_data_margine, chart_data_ebit = [], [], [], []
+    for month_label, vendite_mese, margine_mese, ebit_mese in (storico or []) + dati['trend_mese_corrente']:
+        chart_labels.append(month_label)
+        chart_data_vendite.append(vendite_mese)
+        chart_data_margine.append(margine_mese)
+        chart_data_ebit.append(ebit_mese)
+
+    available_months = range(1, 13)
+    context = {
+        **dati, 'filter_title': filter_title, 'is_filtered': is_filtered,
+        'available_months': available_months, 'selected_year': int(selected_year) if selected_year else None,
+        'selected_month': int(selected_month) if selected_month else None, 'active_page': 'dashboard',
         'chart_labels': json.dumps(chart_labels), 'chart_data_vendite': json.dumps(chart_data_vendite),
         'chart_data_margine': json.dumps(chart_data_margine), 'chart_data_ebit': json.dumps(chart_data_ebit),
     }
@@ -296,21 +244,30 @@ def dashboard(request):
 
 
 @login_required
+@database.su_lettura
 def report_venditori(request):
-    # ... (Il resto della vista report_venditori è invariato) ...
     selected_year = request.GET.get('anno'); selected_month = request.GET.get('mese')
-    vendite_qs = Vendita.objects.all(); filter_title = "Totale Complessivo" 
-    if selected_year: vendite_qs = vendite_qs.filter(data_vendita__year=selected_year); filter_title = f"Anno {selected_year}"
-    if selected_month: vendite_qs = vendite_qs.filter(data_vendita__month=selected_month); filter_title = f"{selected_month}/{selected_year}"
-    sales_report = User.objects.filter(vendita__in=vendite_qs).distinct().annotate(
-        tot_venduto=Coalesce(Sum('vendita__prezzo_vendita', filter=Q(vendita__in=vendite_qs)), Decimal(0)),
-        tot_costo=Coalesce(Sum('vendita__costo_acquisto', filter=Q(vendita__in=vendite_qs)), Decimal(0)),
-        num_vendite=Count('vendita__id', filter=Q(vendita__in=vendite_qs))
-    ).annotate(margine_euro=F('tot_venduto') - F('tot_costo')).annotate(
-        margine_perc=Case(When(tot_venduto=0, then=Value(Decimal(0.0))), default=ExpressionWrapper((F('margine_euro') * Decimal('100.0') / F('tot_venduto')), output_field=DecimalField(max_digits=5, decimal_places=2))),
-        scontrino_medio=Case(When(num_vendite=0, then=Value(Decimal(0.0))), default=ExpressionWrapper(F('tot_venduto') / F('num_vendite'), output_field=DecimalField(max_digits=10, decimal_places=2)))
-    ).filter(num_vendite__gt=0).order_by('-tot_venduto') 
-    available_years = Vendita.objects.dates('data_vendita', 'year', order='DESC'); available_months = range(1, 13)
+    filter_title = "Totale Complessivo" 
+    if selected_year: filter_title = f"Anno {selected_year}"
+    if selected_month: filter_title = f"{selected_month}/{selected_year}"
+    riepilogo_qs = _filtra_periodo(RiepilogoVenditeMensile.objects.filter(venditore__isnull=False), selected_year, selected_month)
+    righe_venditori = riepilogo_qs.values(
+        'venditore_id', 'venditore__username', 'venditore__first_name', 'venditore__last_name'
+    ).annotate(
+        tot_venduto=Coalesce(Sum('tot_venduto_prodotti'), Decimal(0)),
+        tot_costo=Coalesce(Sum('tot_costo_prodotti'), Decimal(0)),
+        num_vendite=Coalesce(Sum('numero_vendite'), 0)
+    ).filter(num_vendite__gt=0).order_by('-tot_venduto')
+    sales_report = []
+    for riga in righe_venditori:
+        margine_euro = riga['tot_venduto'] - riga['tot_costo']
+        sales_report.append({
+            'username': riga['venditore__username'], 'first_name': riga['venditore__first_name'], 'last_name': riga['venditore__last_name'],
+            'tot_venduto': riga['tot_venduto'], 'margine_euro': margine_euro,
+            'margine_perc': (margine_euro * Decimal('100.0') / riga['tot_venduto']) if riga['tot_venduto'] else Decimal(0),
+            'num_vendite': riga['num_vendite'], 'scontrino_medio': riga['tot_venduto'] / riga['num_vendite'],
+        })
+    available_years = _anni_disponibili(); available_months = range(1, 13)
     context = {
         'sales_report': sales_report, 'filter_title': filter_title, 'available_years': available_years, 'available_months': available_months,
         'selected_year': int(selected_year) if selected_year else None, 'selected_month': int(selected_month) if selected_month else None,
@@ -319,30 +276,120 @@ def report_venditori(request):
     return render(request, 'gestione/report_venditori.html', context)
 
 
+# --- PREVISIONE DELLA PIPELINE ---
+@login_required
+@database.su_lettura
+def previsioni_pipeline(request):
+    """
+    API JSON della previsione: valore atteso delle chiusure per mese e probabilità
+    per fase (vedi previsioni.py). Con ?trattative=1 anche probabilità e valore
+    atteso di ogni trattativa aperta.
+    """
+    return JsonResponse(previsioni.riepilogo(trattative=request.GET.get('trattative') == '1'))
+
+
+# --- PAGINAZIONE A CURSORE (KEYSET) ---
+def _pagina_keyset(queryset, campo, discendente, dopo=None, dimensione=25):
+    """
+    Ritorna (righe, altre_disponibili) ordinando per (campo, id). `dopo` è la
+    coppia (valore di campo, id) dell'ultima riga già mostrata: la pagina parte da lì
+    con un confronto su indice, senza OFFSET, quindi costa uguale a ogni pagina.
+    """
+    operatore = 'lt' if discendente else 'gt'
+    if dopo is not None:
+        valore, ultimo_id = dopo
+        queryset = queryset.filter(
+            Q(**{f'{campo}__{operatore}': valore}) | Q(**{campo: valore, f'id__{operatore}': ultimo_id})
+        )
+    segno = '-' if discendente else ''
+    righe = list(queryset.order_by(f'{segno}{campo}', f'{segno}id')[:dimensione + 1])
+    return righe[:dimensione], len(righe) > dimensione
+
+
+# --- LISTA TRATTATIVE ---
+LISTA_PER_PAGINA = 50
+# chiave del parametro ?ordina= (con '-' davanti per l'ordine decrescente) -> (campo, etichetta)
+ORDINAMENTI_LISTA = {
+    'aggiornamento': ('data_ultimo_aggiornamento', "Ultimo aggiornamento"),
+    'creazione': ('data_creazione', "Data creazione"),
+    'margine_euro': ('margine_stimato_euro', "Margine (€)"),
+    'margine_perc': ('margine_stimato_perc', "Margine (%)"),
+    'costo_personale': ('costo_personale_totale', "Costo personale"),
+    'costo_materiali': ('costo_materiali_stimato', "Costo materiali"),
+}
+ORDINAMENTO_LISTA_PREDEFINITO = '-aggiornamento'
+
+
 # --- VISTE KANBAN ---
+KANBAN_CARD_PER_COLONNA = 25 # Card caricate per colonna; le altre arrivano con "carica altre"
+KANBAN_GIORNI_CHIUSE = 90 # Le colonne VINTO/PERSO mostrano solo le trattative chiuse di recente
+
+def _filtro_kanban(mostra_storico=False):
+    """Stati aperti sempre; stati chiusi solo se aggiornati negli ultimi KANBAN_GIORNI_CHIUSE giorni."""
+    if mostra_storico:
+        return Q()
+    limite = timezone.now() - datetime.timedelta(days=KANBAN_GIORNI_CHIUSE)
+    return ~Q(stato__in=Trattativa.STATI_CHIUSI) | Q(data_ultimo_aggiornamento__gte=limite)
+
+def _cursore_kanban(trattativa):
+    return {'prima_di': trattativa.data_ultimo_aggiornamento.isoformat(), 'ultimo_id': trattativa.id}
+
 @login_required
 def kanban_board(request):
-    # ... (Il resto della vista kanban_board è invariato) ...
-    stati_kanban = [
-        (Trattativa.STATO_LEAD, '1. Lead/Contatto'), (Trattativa.STATO_APPUNTAMENTO, '2. Appuntamento Fissato'),
-        (Trattativa.STATO_PROGETTAZIONE, '3. Progettazione'), (Trattativa.STATO_PREVENTIVO, '4. Preventivo Inviato'),
-        (Trattativa.STATO_CONSEGNA, '5. In Consegna'), (Trattativa.STATO_MONTAGGIO, '6. In Montaggio'),
-        (Trattativa.STATO_VINTO, '7. Chiuso Vinto'), (Trattativa.STATO_PERSO, '8. Chiuso Perso'),
-    ]
-    trattative_annotate = get_trattative_annotate().filter(
-        stato__in=[s[0] for s in stati_kanban]
-    )
-    colonne = []
-    for stato_key, stato_display in stati_kanban:
-        colonne.append({
-            'stato_key': stato_key, 
-            'stato_display': stato_display,
-            'trattative': [t for t in trattative_annotate if t.stato == stato_key]
-        })
-    context = {'active_page': 'kanban', 'colonne': colonne,}
+    mostra_storico = request.GET.get('storico') == '1'
+    filtro = _filtro_kanban(mostra_storico)
+
+    # Prime N card di ogni colonna in un'unica query (ROW_NUMBER per stato)
+    prime_card = get_trattative_annotate().filter(filtro).annotate(
+        posizione=Window(
+            RowNumber(), partition_by=F('stato'),
+            order_by=[F('data_ultimo_aggiornamento').desc(), F('id').desc()],
+        )
+    ).filter(posizione__lte=KANBAN_CARD_PER_COLONNA)
+    totali = dict(Trattativa.objects.filter(filtro).values_list('stato').annotate(totale=Count('id')).order_by())
+
+    colonne = {
+        stato_key: {'stato_key': stato_key, 'stato_display': stato_display, 'trattative': [], 'totale': totali.get(stato_key, 0)}
+        for stato_key, stato_display in Trattativa.STATI_KANBAN_CHOICES
+    }
+    # Un solo passaggio sulle card per distribuirle nelle colonne
+    for t in prime_card:
+        colonne[t.stato]['trattative'].append(t)
+    for colonna in colonne.values():
+        if colonna['totale'] > len(colonna['trattative']):
+            colonna['cursore'] = _cursore_kanban(colonna['trattative'][-1])
+
+    context = {
+        'active_page': 'kanban', 'colonne': list(colonne.values()),
+        'mostra_storico': mostra_storico, 'giorni_chiuse': KANBAN_GIORNI_CHIUSE,
+    }
     return render(request, 'gestione/kanban_board.html', context)
 
 
+@login_required
+def kanban_colonna(request):
+    """
+    Pagina successiva di card di una colonna (HTMX "carica altre").
+    Paginazione a cursore su (data_ultimo_aggiornamento, id), senza OFFSET.
+    """
+    stato = request.GET.get('stato')
+    prima_di = parse_datetime(request.GET.get('prima_di') or '')
+    ultimo_id = request.GET.get('ultimo_id') or ''
+    if stato not in dict(Trattativa.STATI_KANBAN_CHOICES) or not prima_di or not ultimo_id.isdigit():
+        return HttpResponse(status=400, content="Parametri non validi.")
+    mostra_storico = request.GET.get('storico') == '1'
+
+    trattative, altre = _pagina_keyset(
+        get_trattative_annotate().filter(_filtro_kanban(mostra_storico), stato=stato),
+        'data_ultimo_aggiornamento', discendente=True,
+        dopo=(prima_di, int(ultimo_id)), dimensione=KANBAN_CARD_PER_COLONNA,
+    )
+    colonna = {'stato_key': stato, 'trattative': trattative}
+    if altre:
+        colonna['cursore'] = _cursore_kanban(trattative[-1])
+    return render(request, 'gestione/partials/_partial_kanban_card_pagina.html', {'colonna': colonna, 'mostra_storico': mostra_storico})
+
+
 @csrf_exempt
 @login_required
 @require_POST
@@ -353,12 +400,139 @@ def move_trattativa(request):
         trattativa = get_object_or_404(Trattativa, pk=trattativa_id)
         if trattativa.stato == Trattativa.STATO_VINTO or trattativa.stato == Trattativa.STATO_PERSO:
             return HttpResponse(status=403, content="Trattativa già chiusa.")
+        if nuovo_stato not in dict(Trattativa.STATI_KANBAN_CHOICES):
+            return HttpResponse(status=400, content="Stato non valido.")
         trattativa.stato = nuovo_stato; trattativa.save()
         headers = {'HX-Trigger': json.dumps({'trattativaMossa': {'trattativaId': trattativa.id,'nuovoStato': nuovo_stato}})}
         return HttpResponse(status=204, headers=headers)
     except Exception as e:
         return HttpResponse(status=400, content=str(e))
 
+# --- OPERAZIONI MASSIVE SULLA KANBAN ---
+OPERAZIONI_MAX = 1000 # Elementi per richiesta
+
+def _valida_operazione(operazione, trattative, commerciali):
+    """Ritorna il messaggio d'errore dell'operazione {id, stato?, commerciale?}, o None se è valida."""
+    trattativa = trattative.get(operazione['id'])
+    if trattativa is None:
+        return "Trattativa inesistente."
+    if 'stato' in operazione:
+        if trattativa.stato in Trattativa.STATI_CHIUSI:
+            return "Trattativa già chiusa."
+        if operazione['stato'] not in dict(Trattativa.STATI_KANBAN_CHOICES):
+            return "Stato non valido."
+        if operazione['stato'] == Trattativa.STATO_VINTO:
+            return "Per chiudere come vinta serve la vendita: usa il modal di chiusura."
+    if operazione.get('commerciale') is not None and operazione['commerciale'] not in commerciali:
+        return "Commerciale inesistente o non attivo."
+    return None
+
+def applica_operazioni_kanban(operazioni):
+    """
+    Sposta e/o riassegna più trattative in una transazione: una SELECT per le
+    trattative, una per i commerciali e un bulk_update dei soli campi toccati.
+    bulk_update non manda i segnali, quindi riepiloghi, cache della dashboard,
+    eventi della Kanban, storico degli stati e previsioni si aggiornano qui.
+    Ritorna un risultato per operazione.
+    """
+    with transaction.atomic():
+        trattative = Trattativa.objects.select_for_update().in_bulk({o['id'] for o in operazioni})
+        commerciali = set(User.objects.filter(
+            pk__in={o['commerciale'] for o in operazioni if o.get('commerciale') is not None}, is_active=True,
+        ).values_list('id', flat=True))
+
+        risultati, modificate, campi, precedenti = [], {}, {'data_ultimo_aggiornamento'}, {}
+        adesso = timezone.now()
+        for operazione in operazioni:
+            errore = _valida_operazione(operazione, trattative, commerciali)
+            if errore:
+                risultati.append({'id': operazione['id'], 'ok': False, 'errore': errore})
+                continue
+            trattativa = trattative[operazione['id']]
+            precedenti.setdefault(trattativa.id, trattativa.stato)
+            if 'stato' in operazione:
+                trattativa.stato = operazione['stato']
+                campi.add('stato')
+            if 'commerciale' in operazione:
+                trattativa.commerciale_id = operazione['commerciale']
+                campi.add('commerciale')
+            trattativa.data_ultimo_aggiornamento = adesso # auto_now non vale per bulk_update
+            modificate[trattativa.id] = trattativa
+            risultati.append({'id': trattativa.id, 'ok': True, 'stato': trattativa.stato, 'commerciale': trattativa.commerciale_id})
+
+        if modificate:
+            Trattativa.objects.bulk_update(modificate.values(), sorted(campi))
+            passaggi = []
+            for trattativa in modificate.values():
+                # Stato e commerciale entrano nel riepilogo trattative del mese di creazione
+                riepiloghi.segna_data_creazione(trattativa.data_creazione)
+                precedente = precedenti[trattativa.id]
+                if trattativa.stato != precedente:
+                    eventi.pubblica_card(trattativa, precedente)
+                    passaggi.append(PassaggioStato(trattativa=trattativa, stato_precedente=precedente, stato=trattativa.stato, data=adesso))
+                previsioni.segna(trattativa.id, chiusura=previsioni.chiusura_cambiata(precedente, trattativa.stato))
+                trattativa.memorizza_valori_correnti()
+            PassaggioStato.objects.bulk_create(passaggi)
+            cache_dashboard.invalida_a_fine_transazione()
+    return risultati
+
+def _intero(valore):
+    """Un intero JSON: True/False sono int per Python, ma non sono id."""
+    return isinstance(valore, int) and not isinstance(valore, bool)
+
+def _operazioni_da_json(corpo):
+    """Valida la forma della richiesta; solleva ValueError con un messaggio leggibile."""
+    dati = json.loads(corpo)
+    operazioni = dati.get('operazioni') if isinstance(dati, dict) else None
+    if not isinstance(operazioni, list) or not operazioni:
+        raise ValueError("Serve una lista 'operazioni' non vuota.")
+    if len(operazioni) > OPERAZIONI_MAX:
+        raise ValueError(f"Al massimo {OPERAZIONI_MAX} operazioni per richiesta.")
+    for operazione in operazioni:
+        if not isinstance(operazione, dict) or not _intero(operazione.get('id')):
+            raise ValueError("Ogni operazione deve avere un 'id' intero.")
+        if not {'stato', 'commerciale'} & operazione.keys():
+            raise ValueError(f"Operazione {operazione['id']}: indicare 'stato' e/o 'commerciale'.")
+        if not isinstance(operazione.get('stato', ''), str):
+            raise ValueError(f"Operazione {operazione['id']}: 'stato' deve essere una stringa.")
+        if operazione.get('commerciale') is not None and not _intero(operazione['commerciale']):
+            raise ValueError(f"Operazione {operazione['id']}: 'commerciale' deve essere un id o null.")
+    return operazioni
+
+@login_required
+@require_POST
+def operazioni_kanban(request):
+    """
+    API JSON per spostare e riassegnare molte trattative in una richiesta:
+    {"operazioni": [{"id": 1, "stato": "PERSO"}, {"id": 2, "commerciale": 3}, ...]}.
+    Le operazioni non valide vengono saltate e segnalate nei risultati.
+    """
+    try:
+        operazioni = _operazioni_da_json(request.body)
+    except ValueError as e: # comprende il JSON non valido
+        return JsonResponse({'errore': str(e)}, status=400)
+    risultati = applica_operazioni_kanban(operazioni)
+    return JsonResponse({'aggiornate': sum(r['ok'] for r in risultati), 'risultati': risultati})
+
+
+async def eventi_kanban(request):
+    """
+    Stream SSE degli eventi della Kanban (vedi eventi.py). Serve il server ASGI:
+    sotto WSGI terrebbe occupato un thread per client, quindi risponde 204 e
+    il browser non si riconnette (la board funziona come prima, senza push).
+    """
+    autenticato = await sync_to_async(lambda: request.user.is_authenticated)()
+    if not autenticato:
+        return HttpResponse(status=403)
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+    risposta = StreamingHttpResponse(
+        eventi.flusso(eventi.kanban, request.headers.get('Last-Event-ID')), content_type='text/event-stream',
+    )
+    risposta['Cache-Control'] = 'no-cache'
+    risposta['X-Accel-Buffering'] = 'no' # nginx: niente buffering dello stream
+    return risposta
+
 @login_required
 def chiudi_trattativa_modal(request, trattativa_id):
     # ... (Il resto della vista chiudi_trattativa_modal è invariato) ...
@@ -382,36 +556,114 @@ def chiudi_trattativa_modal(request, trattativa_id):
     return render(request, 'gestione/partials/modal_chiudi_vinto.html', {'form': form, 'trattativa': trattativa})
 
 
-# --- VISTA report_attivita (CORRETTA) ---
+# --- VISTA report_attivita ---
+# Non legge le attività. Le ripartizioni per ruolo, categoria e mese vengono da
+# RiepilogoRuoliMensile (una riga per mese/ruolo/categoria, vedi riepiloghi.py): il
+# costo dipende dai mesi, non dagli anni di attività registrate. Le tabelle per
+# trattativa leggono i totali denormalizzati della trattativa e, solo con dei filtri,
+# RiepilogoAttivitaMensile (una riga per mese/trattativa/ruolo/categoria).
+REPORT_ATTIVITA_MAX_TRATTATIVE = 50
+
+def _mese_da_parametro(valore):
+    """'AAAA-MM' (input type="month") -> (anno, mese), None se vuoto o non valido."""
+    try:
+        anno, mese = (int(parte) for parte in (valore or '').split('-'))
+    except ValueError:
+        return None
+    return (anno, mese) if 1 <= mese <= 12 else None
+
+def _id_da_parametro(valore):
+    return int(valore) if (valore or '').isdigit() else None
+
+def _query_report(parametri, **valori):
+    """Querystring del report con alcuni filtri cambiati (None li toglie): i link di drill-down."""
+    parametri = parametri.copy()
+    for nome, valore in valori.items():
+        if valore is None:
+            parametri.pop(nome, None)
+        else:
+            parametri[nome] = valore
+    return '?' + parametri.urlencode()
+
 @login_required
+@database.su_lettura
 def report_attivita(request):
-    # --- CORREZIONE QUI ---
-    # Sostituiamo "costo_per_commerciale" con "costo_per_ruolo"
-    costo_per_ruolo = RuoloCosto.objects.filter(attivita__isnull=False).distinct().annotate(
-        ore_totali=Coalesce(Sum('attivita__tempo_dedicato_ore'), Decimal(0.0))
-    ).annotate(
-        # Calcoliamo il costo totale moltiplicando le ore per il costo orario del ruolo
-        costo_totale=F('ore_totali') * F('costo_orario')
-    ).order_by('-costo_totale')
-    # --- FINE CORREZIONE ---
+    dal = _mese_da_parametro(request.GET.get('dal'))
+    al = _mese_da_parametro(request.GET.get('al'))
+    ruolo_id = _id_da_parametro(request.GET.get('ruolo'))
+    categoria_id = _id_da_parametro(request.GET.get('categoria'))
+
+    celle = RiepilogoRuoliMensile.objects.filter(riepiloghi.filtro_intervallo_mesi(dal, al))
+    righe = RiepilogoAttivitaMensile.objects.filter(riepiloghi.filtro_intervallo_mesi(dal, al))
+    if ruolo_id:
+        celle, righe = celle.filter(ruolo_id=ruolo_id), righe.filter(ruolo_id=ruolo_id)
+    if categoria_id:
+        celle, righe = celle.filter(categoria_id=categoria_id), righe.filter(categoria_id=categoria_id)
+    totali = {
+        'ore': Coalesce(Sum('ore_totali'), Decimal(0)),
+        # Costo al costo orario attuale del ruolo, come get_costo_attivita_query
+        'costo': Coalesce(Sum(F('ore_totali') * Coalesce(F('ruolo__costo_orario'), Decimal(0)), output_field=DecimalField()), Decimal(0)),
+    }
+    parametri = request.GET
+
+    costo_per_ruolo = list(celle.values('ruolo_id', 'ruolo__nome', 'ruolo__costo_orario').annotate(**totali).order_by('-costo'))
+    for riga in costo_per_ruolo:
+        riga['url'] = _query_report(parametri, ruolo=riga['ruolo_id'])
+    costo_per_categoria = list(celle.values('categoria_id', 'categoria__nome').annotate(**totali).order_by('-costo'))
+    for riga in costo_per_categoria:
+        riga['url'] = _query_report(parametri, categoria=riga['categoria_id'])
+    costo_per_mese = list(celle.values('anno', 'mese').annotate(**totali).order_by('-anno', '-mese'))
+    for riga in costo_per_mese:
+        mese = f"{riga['anno']}-{riga['mese']:02d}"
+        riga['url'] = _query_report(parametri, dal=mese, al=mese)
+
+    if dal or al or ruolo_id or categoria_id:
+        chiuse = dict(righe.filter(trattativa__stato__in=Trattativa.STATI_CHIUSI).values('trattativa__stato').annotate(
+            costo=totali['costo']
+        ).order_by().values_list('trattativa__stato', 'costo'))
+        costo_per_trattativa_attiva = righe.exclude(trattativa__stato__in=Trattativa.STATI_CHIUSI).values(
+            'trattativa_id', 'trattativa__titolo', 'trattativa__commerciale__username',
+        ).annotate(**totali).order_by('-costo', 'trattativa_id')[:REPORT_ATTIVITA_MAX_TRATTATIVE]
+    else:
+        # Senza filtri il costo di ogni trattativa è il totale denormalizzato (vedi calcoli.py)
+        chiuse = dict(Trattativa.objects.filter(stato__in=Trattativa.STATI_CHIUSI).values('stato').annotate(
+            costo=Sum('costo_personale_totale'),
+        ).order_by().values_list('stato', 'costo'))
+        aperte = Trattativa.objects.filter(filtro_trattative_aperte(), costo_personale_totale__gt=0).order_by(
+            '-costo_personale_totale', 'id',
+        ).values_list('id', 'titolo', 'commerciale__username', 'costo_personale_totale')[:REPORT_ATTIVITA_MAX_TRATTATIVE]
+        costo_per_trattativa_attiva = [
+            {'trattativa_id': pk, 'trattativa__titolo': titolo, 'trattativa__commerciale__username': commerciale, 'costo': costo}
+            for pk, titolo, commerciale, costo in aperte
+        ]
+        ore = dict(righe.filter(trattativa_id__in=[t['trattativa_id'] for t in costo_per_trattativa_attiva]).values(
+            'trattativa_id',
+        ).annotate(ore=totali['ore']).order_by().values_list('trattativa_id', 'ore'))
+        for trattativa in costo_per_trattativa_attiva:
+            trattativa['ore'] = ore.get(trattativa['trattativa_id'], Decimal(0))
+
+    filtri_attivi = []
+    if ruolo_id:
+        nome = next((r['ruolo__nome'] for r in costo_per_ruolo if r['ruolo_id'] == ruolo_id), ruolo_id)
+        filtri_attivi.append({'etichetta': f"Ruolo: {nome}", 'url': _query_report(parametri, ruolo=None)})
+    if categoria_id:
+        nome = next((c['categoria__nome'] for c in costo_per_categoria if c['categoria_id'] == categoria_id), categoria_id)
+        filtri_attivi.append({'etichetta': f"Categoria: {nome}", 'url': _query_report(parametri, categoria=None)})
 
-    stati_attivi = [Trattativa.STATO_LEAD, Trattativa.STATO_APPUNTAMENTO, Trattativa.STATO_PROGETTAZIONE, Trattativa.STATO_PREVENTIVO, Trattativa.STATO_CONSEGNA, Trattativa.STATO_MONTAGGIO]
-    
-    # Questa query è corretta perché get_costo_personale_query usa 'attivita__ruolo__costo_orario'
-    costo_per_trattativa_attiva = Trattativa.objects.filter(stato__in=stati_attivi, attivita__isnull=False).distinct().annotate(
-        ore_totali=Coalesce(Sum('attivita__tempo_dedicato_ore'), Decimal(0.0)),
-        costo_totale=Coalesce(get_costo_personale_query(), Decimal(0.0)) # Questa funzione è corretta
-    ).select_related('commerciale').order_by('-costo_totale')
-    
-    costo_trattative_perse = Attivita.objects.filter(trattativa__stato=Trattativa.STATO_PERSO).aggregate(costo_totale_perso=Coalesce(get_costo_attivita_query(), Decimal(0.0)))['costo_totale_perso']
-    costo_trattative_vinte = Attivita.objects.filter(trattativa__stato=Trattativa.STATO_VINTO).aggregate(costo_totale_vinte=Coalesce(get_costo_attivita_query(), Decimal(0.0)))['costo_totale_vinte']
-    
     context = {
         'active_page': 'report_attivita', 
-        'costo_per_ruolo': costo_per_ruolo, # <-- Nome variabile cambiato
+        'costo_per_ruolo': costo_per_ruolo,
+        'costo_per_categoria': costo_per_categoria,
+        'costo_per_mese': costo_per_mese,
         'costo_per_trattativa_attiva': costo_per_trattativa_attiva,
-        'costo_trattative_perse': costo_trattative_perse, 
-        'costo_trattative_vinte': costo_trattative_vinte,
+        'max_trattative': REPORT_ATTIVITA_MAX_TRATTATIVE,
+        'costo_trattative_perse': chiuse.get(Trattativa.STATO_PERSO, Decimal(0)), 
+        'costo_trattative_vinte': chiuse.get(Trattativa.STATO_VINTO, Decimal(0)),
+        'filtro_dal': request.GET.get('dal', '') if dal else '',
+        'filtro_al': request.GET.get('al', '') if al else '',
+        'filtro_ruolo': ruolo_id or '',
+        'filtro_categoria': categoria_id or '',
+        'filtri_attivi': filtri_attivi,
     }
     return render(request, 'gestione/report_attivita.html', context)
 
@@ -434,35 +686,90 @@ def trattativa_dettaglio(request, trattativa_id):
     # Query corretta (usa 'ruolo')
     attivita = trattativa.attivita.all().select_related('categoria', 'ruolo').order_by('-data_attivita')
     
-    messaggi_chat = trattativa.messaggi_chat.all().select_related('utente').order_by('timestamp')
-    
-    # Calcolo corretto (usa 'get_costo_personale_trattativa')
-    costo_personale_trattativa = get_costo_personale_trattativa(trattativa_id)
-    ricavo_servizi_trattativa = attivita.aggregate(total=Coalesce(Sum('prezzo_vendita_attivita'), Decimal(0.0)))['total']
-    
-    valore_totale = trattativa.valore_stimato + ricavo_servizi_trattativa
-    costo_totale = trattativa.costo_materiali_stimato + costo_personale_trattativa
-    
-    margine_stimato_euro = valore_totale - costo_totale
-    margine_stimato_perc = Decimal(0)
-    if valore_totale > 0:
-        margine_stimato_perc = (margine_stimato_euro / valore_totale) * 100
+    # Solo gli ultimi messaggi: i precedenti arrivano scorrendo la chat, i nuovi con il polling
+    messaggi_chat, altri_precedenti = _pagina_messaggi(trattativa.id)
     
+    # Totali e margini (card dell'analisi economica) sono colonne di Trattativa,
+    # aggiornate dai segnali sulle attività
     attivita_form = AttivitaForm()
     chat_form = MessaggioChatForm()
     context = {
         'active_page': 'kanban', 'trattativa': trattativa, 'form_dati': form_dati,
         'attivita_lista': attivita, 'messaggi_chat': messaggi_chat,
+        'cursore_chat': _cursore_chat(messaggi_chat[0]) if altri_precedenti else None,
+        'ultimo_messaggio_id': messaggi_chat[-1].id if messaggi_chat else 0,
         'attivita_form': attivita_form, 'chat_form': chat_form,
-        'valore_totale_stimato': valore_totale,
-        'costo_personale_trattativa': costo_personale_trattativa,
-        'ricavo_servizi_trattativa': ricavo_servizi_trattativa,
-        'margine_stimato_euro': margine_stimato_euro, 
-        'margine_stimato_perc': margine_stimato_perc,
     }
     return render(request, 'gestione/trattativa_dettaglio.html', context)
 
 
+def _risposta_attivita(request, trattativa, azione, attivita=None, attivita_id=None):
+    """
+    Risposta HTMX di add/edit/delete attività: solo la riga toccata e, fuori banda,
+    la card dell'analisi economica e i messaggi. I totali li ha già aggiornati il
+    segnale con un delta sulla trattativa: qui si rileggono solo quelle colonne.
+    """
+    trattativa.refresh_from_db(fields=Trattativa.CAMPI_TOTALI + Trattativa.CAMPI_DERIVATI)
+    response = render(request, 'gestione/partials/_partial_attivita_aggiornata.html', {
+        'trattativa': trattativa, 'azione': azione, 'attivita': attivita, 'attivita_id': attivita_id,
+    })
+    response['HX-Reswap'] = 'none' # Il target (il modal) resta com'è: contano gli swap fuori banda
+    response['HX-Trigger'] = 'chiudiModal'
+    return response
+
+
+# --- MODAL ATTIVITÀ E CALCOLO COSTI ---
+def _decimale(valore):
+    try:
+        return Decimal(str(valore).replace(',', '.')) if valore not in (None, '') else Decimal(0)
+    except Exception:
+        return Decimal(0)
+
+def _calcolo_costi(ruolo_id, ore, prezzo_vendita):
+    """Contesto di _partial_calcolo_costi.html; costi e soglia arrivano dalle copie di processo."""
+    costo_orario = cache_costi.costo_orario(ruolo_id) if ruolo_id else Decimal(0)
+    ore = _decimale(ore)
+    prezzo_vendita = _decimale(prezzo_vendita)
+    costo_totale = ore * costo_orario
+
+    show_alert = False
+    alert_message = ""
+    if costo_totale > 0:
+        soglia_margine = impostazioni.correnti().soglia_alert_margine_servizio / Decimal(100.0)
+        prezzo_minimo = costo_totale * (1 + soglia_margine)
+
+        if prezzo_vendita <= 0:
+            show_alert = True
+            alert_message = f"(Stai offrendo un servizio a €0.00 che costa € {costo_totale:.2f})"
+        elif prezzo_vendita < prezzo_minimo:
+            show_alert = True
+            alert_message = f"(Prezzo min. suggerito: € {prezzo_minimo:.2f})"
+
+    return {
+        'costo_orario': costo_orario,
+        'costo_totale': costo_totale,
+        'show_alert': show_alert,
+        'alert_message': alert_message,
+    }
+
+def _modal_attivita(request, trattativa, form, is_editing, status=200):
+    """
+    Il modal porta con sé la mappa ruolo -> costo orario e la soglia del margine:
+    l'anteprima dei costi si aggiorna nel browser, senza richieste al server.
+    """
+    context = {
+        'trattativa': trattativa,
+        'attivita_form': form,
+        'is_editing': is_editing,
+        'costi_ruoli': {str(pk): str(costo) for pk, costo in cache_costi.costi_ruoli().items()},
+        'soglia_margine': str(impostazioni.correnti().soglia_alert_margine_servizio),
+        **_calcolo_costi(form['ruolo'].value(), form['tempo_dedicato_ore'].value(), form['prezzo_vendita_attivita'].value()),
+    }
+    if form.is_bound:
+        context['attivita_form_errors'] = form.errors
+    return render(request, 'gestione/partials/_modal_add_attivita.html', context, status=status)
+
+
 # --- VISTA add_attivita (SEMPLIFICATA) ---
 @login_required
 def add_attivita(request, trattativa_id):
@@ -473,18 +780,13 @@ def add_attivita(request, trattativa_id):
         if form.is_valid():
             form.save(commit=False)
             form.instance.trattativa = trattativa
-            form.save()
+            with transaction.atomic(): # Attività e totali della trattativa insieme
+                attivita = form.save()
             messages.success(request, "Attività loggata con successo!")
-            headers = {'HX-Refresh': 'true'}
-            return HttpResponse(status=204, headers=headers)
+            return _risposta_attivita(request, trattativa, 'aggiunta', attivita)
         else:
             messages.error(request, "Errore nel form attività.")
-            return render(request, 'gestione/partials/_modal_add_attivita.html', {
-                'trattativa': trattativa, 
-                'attivita_form_errors': form.errors, 
-                'attivita_form': form,         
-                'is_editing': False
-            }, status=400)
+            return _modal_attivita(request, trattativa, form, is_editing=False, status=400)
     
     # --- LOGICA GET ---
     else: 
@@ -492,124 +794,64 @@ def add_attivita(request, trattativa_id):
             'data_attivita': datetime.date.today(),
         })
         
-        return render(request, 'gestione/partials/_modal_add_attivita.html', {
-            'trattativa': trattativa, 
-            'attivita_form': form,
-            'is_editing': False
-        })
+        return _modal_attivita(request, trattativa, form, is_editing=False)
 
 # --- VISTA: EDIT ATTIVITA (SEMPLIFICATA) ---
 @login_required
 def edit_attivita(request, attivita_id):
-    attivita = get_object_or_404(Attivita, pk=attivita_id)
+    attivita = get_object_or_404(Attivita.objects.select_related('trattativa', 'categoria', 'ruolo'), pk=attivita_id)
     trattativa = attivita.trattativa
     
     if request.method == 'POST':
         form = AttivitaForm(request.POST, instance=attivita)
         if form.is_valid():
-            form.save()
+            with transaction.atomic():
+                form.save()
             messages.success(request, "Attività aggiornata con successo!")
-            return HttpResponse(status=204, headers={'HX-Refresh': 'true'})
+            return _risposta_attivita(request, trattativa, 'modificata', attivita)
         else:
             messages.error(request, "Errore nel form attività.")
-            return render(request, 'gestione/partials/_modal_add_attivita.html', {
-                'trattativa': trattativa,
-                'attivita_form': form,
-                'attivita_form_errors': form.errors,
-                'is_editing': True
-            }, status=400)
+            return _modal_attivita(request, trattativa, form, is_editing=True, status=400)
     
     # --- LOGICA GET ---
     else:
         form = AttivitaForm(instance=attivita)
-        return render(request, 'gestione/partials/_modal_add_attivita.html', {
-            'trattativa': trattativa,
-            'attivita_form': form,
-            'is_editing': True
-        })
+        return _modal_attivita(request, trattativa, form, is_editing=True)
 
 # --- VISTA: DELETE ATTIVITA ---
 @login_required
 @require_POST
 def delete_attivita(request, attivita_id):
     try:
-        attivita = get_object_or_404(Attivita, pk=attivita_id)
-        attivita.delete()
+        attivita = get_object_or_404(Attivita.objects.select_related('trattativa'), pk=attivita_id)
+        with transaction.atomic():
+            attivita.delete()
         messages.success(request, "Attività eliminata con successo.")
-        # Ricarica l'intera pagina per aggiornare i totali
-        return HttpResponse(status=204, headers={'HX-Refresh': 'true'})
+        return _risposta_attivita(request, attivita.trattativa, 'eliminata', attivita_id=attivita_id)
     except Exception as e:
         messages.error(request, f"Errore durante l'eliminazione: {e}")
         return HttpResponse(status=400, headers={'HX-Refresh': 'true'})
 
 
-# --- NUOVA VISTA PER CALCOLO COSTI LIVE (HTMX) ---
+# --- VISTA PER CALCOLO COSTI LIVE ---
+# Il modal fa l'anteprima da solo (vedi _modal_attivita); la vista resta per chi chiede il calcolo al server.
 @login_required
 def calcola_costi_attivita(request):
-    
-    # 1. Recupera i dati inviati da HTMX
-    ruolo_id = request.GET.get('ruolo')
-    ore_str = request.GET.get('tempo_dedicato_ore', '0').replace(',', '.')
-    prezzo_str = request.GET.get('prezzo_vendita_attivita', '0').replace(',', '.')
-
-    costo_orario = Decimal(0.0)
-    costo_totale = Decimal(0.0)
-    ore = Decimal(0.0)
-    prezzo_vendita = Decimal(0.0)
-    
-    show_alert = False
-    alert_message = ""
-
-    # 2. Cerca il costo del ruolo
-    if ruolo_id:
-        try:
-            ruolo = RuoloCosto.objects.get(pk=ruolo_id)
-            if ruolo.costo_orario is not None:
-                costo_orario = ruolo.costo_orario
-        except RuoloCosto.DoesNotExist:
-            pass # costo_orario rimane 0
-
-    # 3. Fai i calcoli
-    try:
-        ore = Decimal(ore_str) if ore_str else Decimal(0.0)
-    except Exception:
-        ore = Decimal(0.0)
-        
-    try:
-        prezzo_vendita = Decimal(prezzo_str) if prezzo_str else Decimal(0.0)
-    except Exception:
-        prezzo_vendita = Decimal(0.0)
-
-    costo_totale = ore * costo_orario
-
-    # 4. Controlla il margine (logica degli alert)
-    if costo_totale > 0:
-        impostazioni = ImpostazioniGenerali.load()
-        soglia_margine = impostazioni.soglia_alert_margine_servizio / Decimal(100.0)
-        
-        prezzo_minimo = costo_totale * (1 + soglia_margine)
-
-        if prezzo_vendita <= 0:
-            show_alert = True
-            alert_message = f"(Stai offrendo un servizio a €0.00 che costa € {costo_totale:.2f})"
-        elif prezzo_vendita < prezzo_minimo:
-            show_alert = True
-            alert_message = f"(Prezzo min. suggerito: € {prezzo_minimo:.2f})"
-            
-    context = {
-        'costo_orario': costo_orario,
-        'costo_totale': costo_totale,
-        'show_alert': show_alert,
-        'alert_message': alert_message,
-    }
-    
-    # 5. Restituisci il partial template
+    context = _calcolo_costi(
+        request.GET.get('ruolo'),
+        request.GET.get('tempo_dedicato_ore', '0'),
+        request.GET.get('prezzo_vendita_attivita', '0'),
+    )
     return render(request, 'gestione/partials/_partial_calcolo_costi.html', context)
 
 
 @login_required
 @require_POST
 def add_messaggio(request, trattativa_id):
+    """
+    Salva il messaggio e ritorna quelli arrivati dopo `dopo_id` (l'ultimo già in
+    pagina, mandato dal form insieme al poller), compreso il nuovo.
+    """
     trattativa = get_object_or_404(Trattativa, pk=trattativa_id)
     form = MessaggioChatForm(request.POST)
     if form.is_valid():
@@ -617,11 +859,67 @@ def add_messaggio(request, trattativa_id):
         messaggio.trattativa = trattativa
         messaggio.utente = request.user
         messaggio.save()
-        return render(request, 'gestione/partials/_partial_singolo_messaggio.html', {'msg': messaggio})
+        dopo_id = request.POST.get('dopo_id', '')
+        if not dopo_id.isdigit():
+            return render(request, 'gestione/partials/partial_singolo_messaggio.html', {'msg': messaggio})
+        return _risposta_messaggi_nuovi(request, trattativa.id, int(dopo_id))
     messages.error(request, "Errore: il messaggio non può essere vuoto.")
     return HttpResponse(status=400)
 
 
+# --- CHAT: PAGINE PRECEDENTI E POLLING ---
+CHAT_MESSAGGI_PER_PAGINA = 30
+CHAT_MAX_NUOVI = 200 # Messaggi nuovi per risposta: chi resta indietro recupera al giro dopo
+
+def _pagina_messaggi(trattativa_id, dopo=None):
+    """
+    Una pagina di messaggi, dal più vecchio al più recente, che finisce prima del
+    cursore `dopo` (timestamp, id). Ritorna (messaggi, altri_precedenti).
+    """
+    messaggi, altri = _pagina_keyset(
+        MessaggioChat.objects.filter(trattativa_id=trattativa_id).select_related('utente'),
+        'timestamp', discendente=True, dopo=dopo, dimensione=CHAT_MESSAGGI_PER_PAGINA,
+    )
+    messaggi.reverse()
+    return messaggi, altri
+
+def _cursore_chat(messaggio):
+    return {'prima_di': messaggio.timestamp.isoformat(), 'ultimo_id': messaggio.id}
+
+def _risposta_messaggi_nuovi(request, trattativa_id, dopo_id):
+    """Messaggi con id > dopo_id e, fuori banda, il poller aggiornato; 204 se non c'è niente."""
+    nuovi = list(
+        MessaggioChat.objects.filter(trattativa_id=trattativa_id, id__gt=dopo_id)
+        .select_related('utente').order_by('id')[:CHAT_MAX_NUOVI]
+    )
+    if not nuovi:
+        return HttpResponse(status=204)
+    return render(request, 'gestione/partials/_partial_chat_nuovi.html', {
+        'messaggi_chat': nuovi, 'trattativa_id': trattativa_id, 'ultimo_messaggio_id': nuovi[-1].id,
+    })
+
+@login_required
+def messaggi_precedenti(request, trattativa_id):
+    """Pagina di messaggi più vecchi del cursore (prima_di, ultimo_id), caricata scorrendo in alto."""
+    prima_di = parse_datetime(request.GET.get('prima_di') or '')
+    ultimo_id = request.GET.get('ultimo_id') or ''
+    if not prima_di or not ultimo_id.isdigit():
+        return HttpResponse(status=400, content="Parametri non validi.")
+    messaggi_chat, altri_precedenti = _pagina_messaggi(trattativa_id, dopo=(prima_di, int(ultimo_id)))
+    return render(request, 'gestione/partials/_partial_chat_pagina.html', {
+        'messaggi_chat': messaggi_chat, 'trattativa_id': trattativa_id,
+        'cursore_chat': _cursore_chat(messaggi_chat[0]) if altri_precedenti else None,
+    })
+
+@login_required
+def messaggi_nuovi(request, trattativa_id):
+    """Polling della chat: una query sull'indice, 204 (nessuno swap) se non ci sono messaggi nuovi."""
+    dopo_id = request.GET.get('dopo_id') or ''
+    if not dopo_id.isdigit():
+        return HttpResponse(status=400, content="Parametri non validi.")
+    return _risposta_messaggi_nuovi(request, trattativa_id, int(dopo_id))
+
+
 @login_required
 def statistiche_mensili(request):
     anno_corrente = datetime.date.today().year
@@ -678,80 +976,172 @@ def nuova_trattativa(request):
 @login_required
 def trattativa_lista(request):
     """
-    Mostra una vista tabellare di tutte le trattative
-    con i costi e i margini calcolati.
+    Vista tabellare delle trattative con costi e margini, paginata a cursore
+    (LISTA_PER_PAGINA righe), ordinabile e filtrabile. Con HTMX ritorna solo
+    le righe della tabella (filtri, ordinamento e "carica altre").
     """
-    trattative_list = get_trattative_annotate().order_by('-data_ultimo_aggiornamento')
-    
+    ordina = request.GET.get('ordina') or ORDINAMENTO_LISTA_PREDEFINITO
+    chiave = ordina.lstrip('-')
+    if chiave not in ORDINAMENTI_LISTA:
+        ordina, chiave = ORDINAMENTO_LISTA_PREDEFINITO, ORDINAMENTO_LISTA_PREDEFINITO.lstrip('-')
+    discendente = ordina.startswith('-')
+    campo = ORDINAMENTI_LISTA[chiave][0]
+
+    filtri = esportazioni.filtri_da_richiesta(request.GET)
+    trattative = esportazioni.filtra_trattative(get_trattative_annotate(), filtri)
+
+    dopo = None
+    if request.GET.get('dopo') and request.GET.get('ultimo_id', '').isdigit():
+        try:
+            dopo = (Trattativa._meta.get_field(campo).to_python(request.GET['dopo']), int(request.GET['ultimo_id']))
+        except ValidationError:
+            return HttpResponse(status=400, content="Cursore non valido.")
+    righe, altre = _pagina_keyset(trattative, campo, discendente, dopo, LISTA_PER_PAGINA)
+
+    # Il totale si conta solo alla prima pagina; le successive lo ricevono nell'URL
+    totale = request.GET.get('totale', '')
+    totale = int(totale) if dopo is not None and totale.isdigit() else trattative.count()
+
+    pagina_successiva = None
+    if altre:
+        parametri = request.GET.copy()
+        ultima = righe[-1]
+        valore = getattr(ultima, campo)
+        parametri['dopo'] = valore.isoformat() if hasattr(valore, 'isoformat') else str(valore)
+        parametri['ultimo_id'] = ultima.id
+        parametri['totale'] = totale
+        parametri['ordina'] = ordina
+        pagina_successiva = parametri.urlencode()
+
     context = {
         'active_page': 'lista', # Per la navbar
-        'trattative': trattative_list
+        'trattative': righe, 'totale': totale, 'pagina_successiva': pagina_successiva,
     }
+    if request.htmx:
+        return render(request, 'gestione/partials/_partial_lista_trattative_righe.html', context)
+
+    context.update({
+        'filtri': filtri, 'ordina': ordina,
+        'ordinamenti': [(k, etichetta) for k, (_, etichetta) in ORDINAMENTI_LISTA.items()],
+        'stati': Trattativa.STATI_KANBAN_CHOICES,
+        'commerciali': User.objects.filter(is_active=True).order_by('username'),
+    })
     return render(request, 'gestione/trattativa_lista.html', context)
 
 
 @login_required
+@database.su_lettura
 def esporta_trattative_excel(request):
     """
     Genera e scarica un file Excel con il report
     completo di tutte le trattative.
+    Il file .xlsx viene inviato a blocchi mentre le righe arrivano dal DB
+    (vedi esportazioni.genera_xlsx), come il CSV.
     """
-    trattative = get_trattative_annotate().order_by('stato', '-data_ultimo_aggiornamento')
-    
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "Report Trattative"
-
-    # Intestazioni
-    headers = [
-        "ID", "Titolo", "Stato", "Cliente", "Commerciale", 
-        "Data Creazione", "Valore Prodotto (€)", "Ricavo Servizi (€)", "Valore Totale (€)",
-        "Costo Materiali (€)", "Costo Personale (€)", "Costo Totale (€)",
-        "Margine Stimato (€)", "Margine Stimato (%)"
-    ]
-    ws.append(headers)
-
-    # Applica stile alle intestazioni
-    for cell in ws[1]:
-        cell.font = Font(bold=True)
-        cell.alignment = Alignment(horizontal="center")
-
-    # Popola i dati
-    for t in trattative:
-        commerciale_username = t.commerciale.username if t.commerciale else "N/A"
-        
-        ws.append([
-            t.id, t.titolo, t.get_stato_display(), t.cliente_nome, commerciale_username,
-            t.data_creazione.replace(tzinfo=None), # Rimuovi timezone per Excel
-            float(t.valore_stimato), # Valore Prodotto
-            float(t.ricavo_servizi_totale), # Ricavo Servizi
-            float(t.valore_totale_stimato), # Valore Totale
-            float(t.costo_materiali_stimato), # Costo Materiali
-            float(t.costo_personale_totale), # Costo Personale
-            float(t.costo_totale_stimato), # Costo Totale
-            float(t.margine_stimato_euro), # Margine €
-            float(t.margine_stimato_perc) / 100.0 # Margine %
-        ])
-
-    # Aggiusta la larghezza delle colonne e formatta i numeri
-    for i, col in enumerate(headers, 1):
-        col_letter = get_column_letter(i)
-        if "€" in col:
-            ws.column_dimensions[col_letter].width = 18
-            for cell in ws[col_letter][1:]: # Salta l'intestazione
-                cell.number_format = '€ #,##0.00'
-        elif "%" in col:
-            ws.column_dimensions[col_letter].width = 15
-            for cell in ws[col_letter][1:]:
-                cell.number_format = '0.00%'
-        else:
-            ws.column_dimensions[col_letter].width = 20 # Larghezza standard
-
-    # Crea la risposta HTTP
-    response = HttpResponse(
+    trattative = esportazioni.trattative_da_esportare(esportazioni.filtri_da_richiesta(request.GET))
+    response = StreamingHttpResponse(
+        esportazioni.genera_xlsx(esportazioni.righe_trattative(trattative)),
         content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
     )
     response['Content-Disposition'] = f'attachment; filename="report_trattative_{timezone.now().strftime("%Y-%m-%d")}.xlsx"'
-    
-    wb.save(response)
-    return response
\ No newline at end of file
+    return response
+
+
+@login_required
+@database.su_lettura
+def esporta_trattative_csv(request):
+    """
+    Stesso report dell'export Excel, in CSV: le righe vengono generate
+    e inviate al client una alla volta.
+    """
+    trattative = esportazioni.trattative_da_esportare(esportazioni.filtri_da_richiesta(request.GET))
+    response = StreamingHttpResponse(
+        esportazioni.genera_csv(esportazioni.righe_trattative(trattative)),
+        content_type='text/csv; charset=utf-8',
+    )
+    response['Content-Disposition'] = f'attachment; filename="report_trattative_{timezone.now().strftime("%Y-%m-%d")}.csv"'
+    return response
+
+
+# --- RICERCA GLOBALE ---
+RICERCA_SUGGERIMENTI = 8 # Risultati del menu a tendina della navbar
+RICERCA_MAX_RISULTATI = 50
+
+@login_required
+@database.su_lettura
+def ricerca(request):
+    """
+    Ricerca su trattative, vendite, attività e chat (indice FTS5, vedi indice_ricerca.py).
+    Da HTMX risponde con i suggerimenti della navbar, altrimenti con la pagina dei risultati.
+    """
+    testo = request.GET.get('q', '').strip()
+    if request.htmx:
+        context = {'testo': testo, 'risultati': indice_ricerca.cerca(testo, RICERCA_SUGGERIMENTI)}
+        return render(request, 'gestione/partials/_partial_ricerca_suggerimenti.html', context)
+    context = {
+        'testo': testo,
+        'risultati': indice_ricerca.cerca(testo, RICERCA_MAX_RISULTATI),
+        'max_risultati': RICERCA_MAX_RISULTATI,
+    }
+    return render(request, 'gestione/ricerca.html', context)
+
+
+# --- ESPORTAZIONI IN BACKGROUND ---
+@login_required
+@require_POST
+def avvia_esportazione(request):
+    """
+    Mette in coda un'esportazione (o riusa quella con gli stessi filtri ancora valida)
+    e ritorna il box di avanzamento, che HTMX aggiorna finché il file non è pronto.
+    """
+    formato = request.POST.get('formato')
+    if formato not in dict(EsportazioneJob.FORMATI_CHOICES):
+        formato = EsportazioneJob.FORMATO_XLSX
+    filtri = esportazioni.filtri_da_richiesta(request.POST)
+    job, creato = esportazioni.trova_o_crea_job(formato, filtri, utente=request.user)
+    return render(request, 'gestione/partials/_partial_stato_esportazione.html', {'job': job, 'riusato': not creato})
+
+
+def _job_visibili(request):
+    """I job di chi li ha avviati; lo staff li vede tutti."""
+    if request.user.is_staff:
+        return EsportazioneJob.objects.all()
+    return EsportazioneJob.objects.filter(utente=request.user)
+
+@login_required
+def stato_esportazione(request, job_id):
+    job = get_object_or_404(_job_visibili(request), pk=job_id)
+    return render(request, 'gestione/partials/_partial_stato_esportazione.html', {'job': job})
+
+
+@login_required
+def scarica_esportazione(request, job_id):
+    job = get_object_or_404(_job_visibili(request), pk=job_id, stato=EsportazioneJob.STATO_COMPLETATO)
+    if not os.path.exists(job.percorso_file):
+        raise Http404("File dell'esportazione non più disponibile.")
+    return FileResponse(
+        open(job.percorso_file, 'rb'), as_attachment=True,
+        filename=f"report_trattative_{timezone.localtime(job.data_creazione).strftime('%Y-%m-%d')}.{job.formato}",
+    )
+
+
+# --- PRESTAZIONI (PROFILAZIONE) ---
+@staff_member_required
+def prestazioni_viste(request):
+    """
+    Latenza p50/p95/p99, query e tempi SQL/template per vista, aggregati dai log
+    di profilazione (solo le richieste campionate). Riservata allo staff.
+    """
+    from .urls import urlpatterns # import locale: urls.py importa questo modulo
+    viste = [p.name for p in urlpatterns if getattr(p, 'name', None)]
+    percorsi = profilazione.file_di_log()
+    riepilogo = profilazione.riepilogo_per_vista(profilazione.leggi_campioni(percorsi), viste)
+    # Prima le viste più lente; quelle senza campioni in fondo
+    righe = sorted(riepilogo.items(), key=lambda voce: (voce[1] is None, -(voce[1] or {}).get('p95', 0)))
+    context = {
+        'righe': righe,
+        'campioni': sum(stats['campioni'] for _, stats in righe if stats),
+        'campionamento': settings.PROFILAZIONE_CAMPIONAMENTO,
+        'soglia_query_lenta': settings.PROFILAZIONE_SOGLIA_QUERY_LENTA_MS,
+    }
+    return render(request, 'gestione/prestazioni_viste.html', context)